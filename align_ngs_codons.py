@@ -5,55 +5,51 @@ import os
 import sys
 import argparse
 import collections
-from itertools import groupby
 import random
 import string
-import subprocess
-from subprocess import DEVNULL
-import pandas as pd
-import regex
-import seqanpy
-from pprint import pprint
+import csv
 from collections import Counter
+import profiling_hooks
+import reference_cache
+from seq_io import py3_fasta_iter
+from seq_io import record_names
+from memory_budget import use_streaming
+from fasta_index import write_indexed_fasta
 
 
 __author__ = 'Colin Anthony'
 
 
-def py3_fasta_iter(fasta_name):
-    """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
-    """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
-
-
 def fasta_to_dct(file_name):
     """
     :param file_name: The fasta formatted file to read from.
-    :return: a dictionary of the contents of the file name given. Dictionary in the format:
-    {sequence_id: sequence_string, id_2: sequence_2, etc.}
+    :return: a dictionary of the contents of the file name given, with collapsed records expanded to each of their
+    names. Dictionary in the format: {sequence_id: sequence_string, id_2: sequence_2, etc.}
     """
     dct = collections.defaultdict(str)
     my_gen = py3_fasta_iter(file_name)
     for k, v in my_gen:
         v = v.replace("-", "")
-        new_key = k.replace(" ", "_")
-        if new_key in dct.keys():
-            print("Duplicate sequence ids found. Exiting")
-            raise KeyError("Duplicate sequence ids found")
-        dct[new_key] = v.upper()
+        for new_key in record_names(k.replace(" ", "_")):
+            if new_key in dct.keys():
+                print("Duplicate sequence ids found. Exiting")
+                raise KeyError("Duplicate sequence ids found")
+            dct[new_key] = v.upper()
 
     return dct
 
 
+def load_reference_sequences(file_name):
+    """
+    read a reference fasta file, parsed once per process by the reference cache
+    :param file_name: the reference fasta file
+    :return: a dictionary of the reference sequences {sequence_id: sequence_string}
+    """
+    ref_seqs = reference_cache.cached("fasta", file_name, lambda: dict(fasta_to_dct(file_name)))
+
+    return collections.defaultdict(str, ref_seqs)
+
+
 def fasta_to_dct_keep_gap(file_name):
     """
     :param file_name: The fasta formatted file to read from.
@@ -76,8 +72,8 @@ def fasta_to_dct_keep_gap(file_name):
 def fasta_to_dct_rev(file_name):
     """
     :param file_name: The fasta formatted file to read from.
-    :return: a dictionary of the contents of the file name given. Dictionary in the format:
-    {sequence_id: sequence_string, id_2: sequence_2, etc.}
+    :return: a dictionary of the contents of the file name given, keyed by sequence, with the names of collapsed
+    records expanded. Dictionary in the format: {sequence_string: [sequence_id, id_2, etc.]}
     """
     dct = collections.defaultdict(list)
     my_gen = py3_fasta_iter(file_name)
@@ -86,7 +82,7 @@ def fasta_to_dct_rev(file_name):
         if new_key in dct.keys():
             print("Duplicate sequence ids found. Exiting")
             raise KeyError("Duplicate sequence ids found")
-        dct[str(v).replace(" ", "_").upper()].append(new_key)
+        dct[str(v).replace(" ", "_").upper()].extend(record_names(new_key))
 
     return dct
 
@@ -149,6 +145,34 @@ def get_best_reference(seq_dictionary):
     return ref_dict
 
 
+def get_best_reference_streaming(file_name):
+    """
+    get_best_reference for a fasta file, reading it one record at a time and keeping only the first sequence of each
+    length for each time point, for inputs too large to hold in memory twice
+    :param file_name: the fasta file
+    :return: (dict) the same as get_best_reference(fasta_to_dct(file_name))
+    """
+    length_counts = collections.defaultdict(Counter)
+    # dicts keep the order in which each length was first seen, which decides ties like get_most_common does
+    first_of_length = collections.defaultdict(dict)
+    for name, seq in py3_fasta_iter(file_name):
+        seq = seq.replace("-", "").upper()
+        time = "_".join(name.replace(" ", "_").split("_")[:2])
+        # a collapsed record counts once for each of its names
+        length_counts[time][len(seq)] += len(record_names(name))
+        first_of_length[time].setdefault(len(seq), seq)
+
+    ref_dict = collections.defaultdict(str)
+    for time, counts in length_counts.items():
+        most_common_count = max(counts.values())
+        for seq_len, seq in first_of_length[time].items():
+            if counts[seq_len] == most_common_count:
+                ref_dict[time] = seq
+                break
+
+    return ref_dict
+
+
 def get_refs_reading_frame(ref_dict):
     """
     take dict of ref sequences and get their reading frames
@@ -195,8 +219,10 @@ def pairwise_align_dna(sequence, reference, regex_complied, gene):
     :param gene: (str) the target gene (ENV, GAG, POL, etc...
     :return: (str) aligned query sequence, (str) aligned ref sequence, (int) reading frame for query sequence
     """
-    # do overlap pairwise alignment to not get truncated query sequence
+    # seqanpy, regex and pprint are imported where they are used, so that the script starts quickly
+    import seqanpy
 
+    # do overlap pairwise alignment to not get truncated query sequence
     if gene == "ENV":
         overlap = seqanpy.align_overlap(sequence, reference, band=-1, score_match=4, score_mismatch=-1, score_gapext=-3,
                                         score_gapopen=-14)
@@ -408,6 +434,15 @@ def translate_dna(sequence):
     return "".join(prot)
 
 
+def read_regions_table(regions_file):
+    """
+    :param regions_file: (str) one of the reference region csv files
+    :return: (list) of dicts, one per row, key = column header
+    """
+    with open(regions_file, 'r', newline='') as handle:
+        return list(csv.DictReader(handle))
+
+
 def get_var_regions_dict(ref_type, gene_region, regions_path):
     """
     imports regex search string from reference csv file
@@ -417,12 +452,10 @@ def get_var_regions_dict(ref_type, gene_region, regions_path):
     :return: (dict) key = variable gene region name , value = sequence string
     """
     regions_file = os.path.join(regions_path, "HIV_var_cons_regions.csv")
-    data = pd.read_csv(regions_file, sep=',', header=0, parse_dates=True, na_values=[' '])
-    df = pd.DataFrame(data)
-    ref_df = df.loc[df["reference_type"] == ref_type]
-    ref_gene_df = ref_df.loc[df["gene"] == gene_region]
-    var_regions_dict = dict(zip(ref_gene_df["gene_region"], ref_gene_df["sequence"]))
-    error = dict(zip(ref_gene_df["gene_region"], ref_gene_df["error"]))
+    rows = reference_cache.cached("csv", regions_file, lambda: read_regions_table(regions_file))
+    ref_gene_rows = [row for row in rows if row["reference_type"] == ref_type and row["gene"] == gene_region]
+    var_regions_dict = dict((row["gene_region"], row["sequence"]) for row in ref_gene_rows)
+    error = dict((row["gene_region"], int(row["error"])) for row in ref_gene_rows)
     return var_regions_dict, error
 
 
@@ -435,12 +468,12 @@ def get_ref_start_end(ref_type, sub_regions, regions_path):
     :return: (dict) key = variable gene region name , value = sequence string
     """
     regions_file = os.path.join(regions_path, "gene_sub_regions_start_end.csv")
-    data = pd.read_csv(regions_file, sep=',', header=0, parse_dates=True, na_values=[' '])
-    df = pd.DataFrame(data)
-    ref_df = df.loc[df["reference_type"] == ref_type]
-    ref_region = ref_df.loc[df["sub_region"] == sub_regions]
-    ref_start = int(ref_region["ref_start"]) * 3
-    ref_end = int(ref_region["ref_end"]) * 3
+    rows = reference_cache.cached("csv", regions_file, lambda: read_regions_table(regions_file))
+    ref_region = [row for row in rows if row["reference_type"] == ref_type and row["sub_region"] == sub_regions]
+    if len(ref_region) != 1:
+        raise ValueError("Expected one row for {0} {1} in {2}".format(ref_type, sub_regions, regions_file))
+    ref_start = int(ref_region[0]["ref_start"]) * 3
+    ref_end = int(ref_region[0]["ref_end"]) * 3
 
     return ref_start, ref_end
 
@@ -454,6 +487,8 @@ def find_var_region_boundaries(prot_sequence, regions_dict, sub_regions, errors_
     :param errors_allowed: (int) number of miss-matches allowed in regex
     :return:
     """
+    import regex
+
     regions_index_d = collections.defaultdict(int)
     if sub_regions == "C0C1" or sub_regions == "C2C3" or sub_regions == "GP41" or sub_regions == "P17" \
             or sub_regions == "P24" or not sub_regions:
@@ -472,34 +507,34 @@ def find_var_region_boundaries(prot_sequence, regions_dict, sub_regions, errors_
                 error = errors_allowed[var_reg_name]
                 pattern = "{0}{{e<{1}}}".format(var_seq, error)
 
-                match = regex.search(pattern, prot_sequence, regex.BESTMATCH)
+                match = reference_cache.compile_pattern(pattern, regex.BESTMATCH).search(prot_sequence)
 
                 # if failed to get regex match for start of V1 for C1C2 amplicon data, try shorter regex search pattern
                 if match is None and var_reg_name == "V1_start" and sub_regions == "C1C2":
                     alt_pattern = r'(XL[NKIE]C[NRTSI]){e<1}'
-                    match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                    match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
                 # if failed to get regex match for end of V2 for C1C2 amplicon data, try shorter regex search pattern
                 if match is None and var_reg_name == "V2_end" and sub_regions == "C1C2":
                     alt_pattern = r'(Y[RKIV]L[IT][NRS]CN){e<2}'
-                    match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                    match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
                     if match is None and var_reg_name == "V2_end" and sub_regions == "C1C2":
                         alt_pattern = r'(Y[RKIV]L[IT]X){e<1}'
-                        match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                        match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
                 # if failed to get regex match for start of V3 for C3C5 amplicon data, try shorter regex search pattern
                 if match is None and var_reg_name == "V3_start" and sub_regions == "C3C5":
                     alt_pattern = r'(FYC[ND]T[ST].LF[NTSKD]){e<3}'
-                    match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                    match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
                 # if failed to get regex match for start of V4 for C3C5 amplicon data, try shorter regex search pattern
                 if match is None and var_reg_name == "V4_start" and sub_regions == "C3C5":
                     alt_pattern = r'(LI[LV][TVL]RDGG.){e<3}'
-                    match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                    match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
                     if match is None and var_reg_name == "V4_start" and sub_regions == "C3C5":
                         alt_pattern = r'(L[IL][LV][TVL]RD.){e<3}'
-                        match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                        match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
                 # if failed to get regex match for end of V4 for C3C5 amplicon data, try shorter regex search pattern
                 if match is None and var_reg_name == "V4_end" and sub_regions == "C3C5":
                     alt_pattern = r'(E[TIV]FR){e<1}'
-                    match = regex.search(alt_pattern, prot_sequence, regex.BESTMATCH)
+                    match = reference_cache.compile_pattern(alt_pattern, regex.BESTMATCH).search(prot_sequence)
 
                 if match is not None:
                     if region_key == "start":
@@ -666,27 +701,49 @@ def write_regions_to_file(region_dict, path_for_tmp_file):
     return file_names
 
 
-def call_aligner(file_names, var):
+def call_aligner(file_names, var, threads=1):
     """
     Takes a dict of protein sequences, writes them to a temp file and aligns them with mafft.
+    The region files are aligned concurrently, the threads are divided between the mafft jobs by the resource manager.
     Aligned file is read back in and returned as a dictionary
     :param file_names: (list) list of the files to align
     :param var: (bool) True if the dict is for the variable regions, False if not
+    :param threads: (int) the number of threads for all the mafft jobs together
     :return: (dict) dictionary of aligned protein sequences: key = sequence, value = ID code
     """
+    # imported here, asyncio is slow to import and only needed to run mafft
+    from tool_runner import ToolJob
+    from tool_runner import ToolRunner
+    from tool_runner import failed_jobs
+    from resource_manager import ResourceManager
+
     region_aligned_d = collections.defaultdict(dict)
 
+    runner = ToolRunner()
+    # the load was already taken into account when the threads were granted to this alignment
+    grant = ResourceManager(threads, measure_load=False).grant("align", "mafft", len(file_names),
+                                                               tool_limit=runner.tool_limits["mafft"])
+    jobs = []
     for file in file_names:
-        region = os.path.split(file)[-1].split("_")[2].replace(".fasta", "")
         outfile = file.replace(".fasta", "_aligned.fasta")
         if var:
-            cmd = "mafft --amino --op 1 --ep 0.1 {0} > {1}".format(file, outfile)
+            cmd = ["mafft", "--amino", "--thread", str(grant.threads), "--op", "1", "--ep", "0.1", file]
         else:
-            cmd = "mafft --amino {0} > {1}".format(file, outfile)
-        subprocess.call(cmd, shell=True, stdout=DEVNULL, stderr=DEVNULL)
+            cmd = ["mafft", "--amino", "--thread", str(grant.threads), file]
+        jobs.append(ToolJob("mafft", cmd, outfile + ".log", outfile))
+
+    runner.tool_limits["mafft"] = grant.concurrency
+    failed = failed_jobs(runner.run_jobs(jobs))
+    if failed:
+        sys.exit("mafft failed to align {} region file(s)\nexiting".format(len(failed)))
+
+    for file in file_names:
+        region = os.path.split(file)[-1].split("_")[2].replace(".fasta", "")
+        outfile = file.replace(".fasta", "_aligned.fasta")
         aligned_region_d = fasta_to_dct_keep_gap(outfile)
         os.unlink(file)
         os.unlink(outfile)
+        os.unlink(outfile + ".log")
         region_aligned_d[region].update(aligned_region_d)
 
     return region_aligned_d
@@ -790,7 +847,24 @@ def backtranslate(padded_dna_d, prot_align_d):
     return dna_align_d
 
 
-def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
+def write_translated_alignment(dna_align_d, prot_align_d, look_up_d, outfile):
+    """
+    function to write the protein alignment that the DNA alignment was back-translated from
+    :param dna_align_d: (dict) of back-translated dna sequences {code: aligned_seq}
+    :param prot_align_d: (dict) of aligned protein sequences {code: prot_seq}
+    :param look_up_d: (dict) of sequence code to list of sequence names {code: [name1, name2]}
+    :param outfile: (str) path and name of the protein alignment outfile
+    :return: None
+    """
+    with open(outfile, 'w') as handle:
+        for code in dna_align_d.keys():
+            # stop codons were coded as "Z" for mafft, restore them to "*"
+            prot_seq = prot_align_d[code].replace("Z", "*")
+            for seq_name in look_up_d[code]:
+                handle.write(">{0}\n{1}\n".format(seq_name, prot_seq))
+
+
+def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref, threads=1, memory_budget=None):
 
     # get absolute paths
     infile = os.path.abspath(infile)
@@ -814,7 +888,7 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
     script_folder = os.path.abspath(script_folder)
 
     ref_file = os.path.join(script_folder, "reference_sequences.fasta")
-    ref_seqs = fasta_to_dct(ref_file)
+    ref_seqs = load_reference_sequences(ref_file)
     hxb2_name = "HXB2_{}".format(gene)
     ref_hxb = ref_seqs[hxb2_name]
     if not user_ref:
@@ -826,15 +900,21 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
 
     out_name = name + "_aligned.fasta"
     bad_name = name + "_NOT_aligned.fasta"
+    translated_name = name + "_aligned_translated.fasta"
     outfile = os.path.join(outpath, out_name)
     badfile = os.path.join(outpath, bad_name)
+    translated_outfile = os.path.join(outpath, translated_name)
 
     # read in fasta file and reference
-    name_seq_d = fasta_to_dct(infile)
     in_seqs_d = fasta_to_dct_rev(infile)
 
-    # get internal reference
-    best_ref_dict = get_best_reference(name_seq_d)
+    # get internal reference, without a second copy of the input if it would not fit in the memory budget
+    if use_streaming("align", [infile], memory_budget):
+        best_ref_dict = get_best_reference_streaming(infile)
+    else:
+        name_seq_d = fasta_to_dct(infile)
+        best_ref_dict = get_best_reference(name_seq_d)
+        del name_seq_d
 
     # generate seq_code to seq name list lookup dictionary
     first_look_up_d = collections.defaultdict(list)
@@ -856,6 +936,7 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
     #     if seq_len > seq_length and seq_abundance > 3:
     #         seq_length = seq_len
     #         longest_seq = seq
+    del in_seqs_d
 
     # add hxb2 to the alignment
     first_look_up_d[hxb2_name] = [hxb2_name]
@@ -900,8 +981,9 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
     # set the cons and var regions
     full_order = get_order(sub_region)
 
-    regex_complied_1 = regex.compile(r"(^[-]*)", regex.V1)
-    regex_complied_2 = regex.compile(r"([-]+)", regex.V1)
+    import regex
+    regex_complied_1 = reference_cache.compile_pattern(r"(^[-]*)", regex.V1)
+    regex_complied_2 = reference_cache.compile_pattern(r"([-]+)", regex.V1)
 
     # get the sequences for variable region boundaries for the ref-gene_region
     if gene == "ENV":
@@ -962,6 +1044,7 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
             # if one or more of the var region boundaries was not found, write to file and skip
             missing_regex = check_for_missing_regex(var_region_index_dct)
             if missing_regex:
+                from pprint import pprint
                 pprint(var_region_index_dct[code])
                 print("error finding one or more variable region boundary", prot_seq)
                 names_list = first_look_up_d[code]
@@ -981,14 +1064,14 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
     print("Aligning conserved regions sequences\n")
     tmp_cons_file_to_align = write_regions_to_file(cons_regions_dct, outpath)
     var = False
-    align_cons_prot_d = call_aligner(tmp_cons_file_to_align, var)
+    align_cons_prot_d = call_aligner(tmp_cons_file_to_align, var, threads)
 
     # write the collected variable regions to file and align (optional)
     if var_align:
         print("Aligning variable region sequences\n")
         tmp_var_file_to_align = write_regions_to_file(var_regions_dct, outpath)
         var = True
-        var_prot_d = call_aligner(tmp_var_file_to_align, var)
+        var_prot_d = call_aligner(tmp_var_file_to_align, var, threads)
 
     # pad the variable regions with '-', to the longest sequence
     else:
@@ -1009,13 +1092,14 @@ def main(infile, outpath, name, ref, gene, var_align, sub_region, user_ref):
     print("Back-translating from protein to DNA alignment\n")
     dna_aligned = backtranslate(padded_seq_dict, joined_regions_d)
 
-    # write back-translated DNA alignment to file
+    # write back-translated DNA alignment to file, with its index for the haplotyping step
     print("Writing DNA alignment to outfile\n")
-    with open(outfile, 'w') as handle:
-        for code, align_seq in dna_aligned.items():
-            names_list = first_look_up_d[code]
-            for seq_name in names_list:
-                handle.write(">{0}\n{1}\n".format(seq_name, align_seq))
+    write_indexed_fasta(outfile, ((seq_name, align_seq) for code, align_seq in dna_aligned.items()
+                                  for seq_name in first_look_up_d[code]))
+
+    # write the protein alignment for the back-translated sequences to file
+    print("Writing protein alignment to outfile\n")
+    write_translated_alignment(dna_aligned, joined_regions_d, first_look_up_d, translated_outfile)
 
     print("Total sequences not aligned: ", bad_seq_counter)
     print("Codon aligning completed")
@@ -1050,6 +1134,11 @@ if __name__ == "__main__":
     parser.add_argument('-u', '--user_ref', default=False, type=str,
                         help='the path and file name for the custom DNA reference sequence, '
                              'must start in reading frame 1', required=False)
+    parser.add_argument('-t', '--threads', default=1, type=int,
+                        help='the number of threads for mafft', required=False)
+    parser.add_argument('-mb', '--memory_budget', default=None, type=float,
+                        help='Use less memory if the file would need more than this (MB), defaults to the align '
+                             'entry of NGS_PIPELINE_MEMORY_BUDGETS', required=False)
 
     args = parser.parse_args()
     infile = args.infile
@@ -1060,6 +1149,8 @@ if __name__ == "__main__":
     var_align = args.var_align
     regions = args.regions
     user_ref = args.user_ref
+    threads = args.threads
+    memory_budget = args.memory_budget
 
     if gene == "ENV":
         if not regions:
@@ -1067,4 +1158,5 @@ if __name__ == "__main__":
     if regions == "C4C5":
         regions == "C3C5"
 
-    main(infile, outpath, name, ref, gene, var_align, regions, user_ref)
+    profiling_hooks.run_main(main, "align", name, infile, outpath, name, ref, gene, var_align, regions, user_ref,
+                             threads, memory_budget)
@@ -1,9 +1,15 @@
+import os
+import tempfile
 import unittest
 from align_ngs_codons import pairwise_align_dna
 from align_ngs_codons import gap_padding
 from align_ngs_codons import translate_dna
 from align_ngs_codons import get_cons_regions
 from align_ngs_codons import get_var_regions
+from align_ngs_codons import fasta_to_dct
+from align_ngs_codons import fasta_to_dct_rev
+from align_ngs_codons import get_best_reference
+from align_ngs_codons import get_best_reference_streaming
 
 
 class MyTestCase(unittest.TestCase):
@@ -347,6 +353,16 @@ class MyTestCase(unittest.TestCase):
                 print(k)
                 self.assertEquals(v, test_out[k])
 
+    def test_collapsed_records_are_expanded(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            infile = os.path.join(tmp_dir, "all.fasta")
+            with open(infile, 'w') as handle:
+                handle.write(">P1_W1_a;dups=P1_W1_b,P1_W1_c\nATGAAA\n>P1_W1_d\nATGAAACCC\n>P1_W1_e\nATGAAAGGG\n")
+            self.assertEqual(fasta_to_dct_rev(infile)["ATGAAA"], ["P1_W1_a", "P1_W1_b", "P1_W1_c"])
+            name_seq_d = fasta_to_dct(infile)
+            self.assertEqual(len(name_seq_d), 5)
+            self.assertEqual(get_best_reference(name_seq_d), {"P1_W1": "ATGAAA"})
+            self.assertEqual(get_best_reference_streaming(infile), {"P1_W1": "ATGAAA"})
 
 
 if __name__ == '__main__':
@@ -0,0 +1,263 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from file_transitions import link_or_copy
+
+
+__author__ = 'Colin Anthony'
+
+
+# set NGS_PIPELINE_BINNING_CACHE to a folder, or to "region" for a binning_cache folder in each gene region folder, to
+# reuse the binned outputs of samples whose reads and binning settings did not change
+CACHE_ENV = "NGS_PIPELINE_BINNING_CACHE"
+CACHE_FOLDER = "binning_cache"
+# the settings of each cached result, next to its binned/<sample> folder
+KEY_FILE = "cache_key.json"
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the binning result store for this process and the processes it starts, from the pipelineSettings of the config
+    file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file, binning_cache is true for a
+    store in each gene region folder or the path of a shared store
+    :return: None
+    """
+    cache = pipeline_settings.get("binning_cache", False)
+    if cache is True:
+        os.environ[CACHE_ENV] = "region"
+    elif cache:
+        os.environ[CACHE_ENV] = os.path.abspath(cache)
+
+
+def cache_from_env(region_folder):
+    """
+    :param region_folder: (str) the gene region folder
+    :return: (str) the binning result store folder, None if there is none
+    """
+    cache = os.environ.get(CACHE_ENV, "")
+    if not cache:
+        return None
+    if cache == "region":
+        return os.path.join(region_folder, CACHE_FOLDER)
+
+    return cache
+
+
+def file_checksum(file_name):
+    """
+    :param file_name: (str) the file
+    :return: (str) the sha256 checksum of its contents
+    """
+    sha256 = hashlib.sha256()
+    with open(file_name, 'rb') as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            sha256.update(block)
+
+    return sha256.hexdigest()
+
+
+def tool_version(tool):
+    """
+    :param tool: (str) a tool on the PATH or the path of a script
+    :return: (str) the checksum of the tool's file, so that a new version gives new cache keys, "missing" if it is not
+    found
+    """
+    tool_file = tool if os.path.isfile(tool) else shutil.which(tool)
+    if tool_file is None:
+        return "missing"
+
+    return file_checksum(os.path.realpath(tool_file))
+
+
+def r_package_version(package):
+    """
+    :param package: (str) an installed R package
+    :return: (str) the package version reported by R, "missing" if R or the package is not installed
+    """
+    try:
+        run = subprocess.run(["Rscript", "-e", "cat(as.character(packageVersion('{}')))".format(package)],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=120)
+    except (OSError, subprocess.TimeoutExpired):
+        return "missing"
+    if run.returncode != 0 or not run.stdout.strip():
+        return "missing"
+
+    return run.stdout.strip()
+
+
+class BinningCache(object):
+    """
+    a store of binned/<sample> folders keyed by the hash of the sample's reads and binning settings, so that a rerun of
+    step 2 only bins the samples whose reads, primers or binning tool changed. The files are hardlinked in and out of
+    the store when it is on the same file system as the binned folder
+    """
+
+    def __init__(self, folder):
+        """
+        :param folder: (str) the store folder, created if needed
+        """
+        self.folder = os.path.abspath(folder)
+        os.makedirs(self.folder, exist_ok=True)
+
+    def key(self, read_files, settings):
+        """
+        :param read_files: (list) the R1 and R2 fastq files
+        :param settings: (list) of str, everything else the binned outputs depend on: the binning command without its
+        file and cpu options, the primer lengths and scores, the name prefix and the tool version
+        :return: (str) the cache key
+        """
+        sha256 = hashlib.sha256()
+        for item in [file_checksum(x) for x in read_files] + [str(x) for x in settings]:
+            sha256.update(item.encode())
+            sha256.update(b"\0")
+
+        return sha256.hexdigest()
+
+    def entry(self, key):
+        """
+        :param key: (str) the cache key
+        :return: (str) the folder of the cached result
+        """
+        return os.path.join(self.folder, key[:2], key)
+
+    def restore(self, key, outpath, name_prefix):
+        """
+        :param key: (str) the cache key
+        :param outpath: (str) the binned folder
+        :param name_prefix: (str) the sample name, the cached <name_prefix> folder is restored to outpath
+        :return: (bool) True if the result was in the store and was restored
+        """
+        source = os.path.join(self.entry(key), name_prefix)
+        if not os.path.isdir(source):
+            return False
+        _link_tree(source, os.path.join(outpath, name_prefix))
+        # the time of last use, to clear out old results
+        os.utime(self.entry(key))
+
+        return True
+
+    def store(self, key, outpath, name_prefix, settings=None):
+        """
+        add the binned outputs of a sample to the store, the entry is renamed into place when it is complete
+        :param key: (str) the cache key
+        :param outpath: (str) the binned folder
+        :param name_prefix: (str) the sample name
+        :param settings: (list) the settings the key was made from, kept for reference
+        :return: (str) the folder of the cached result
+        """
+        entry = self.entry(key)
+        if os.path.isdir(entry):
+            return entry
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(dir=os.path.dirname(entry), prefix=".part_")
+        try:
+            _link_tree(os.path.join(outpath, name_prefix), os.path.join(tmp_entry, name_prefix))
+            with open(os.path.join(tmp_entry, KEY_FILE), 'w') as handle:
+                json.dump({"key": key, "sample": name_prefix, "settings": settings}, handle, indent=1)
+            os.rename(tmp_entry, entry)
+        except OSError:
+            # another job stored the same result first
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+
+        return entry
+
+    def entries(self):
+        """
+        :return: (list) of the key file contents of the cached results, with their folder and time of last use
+        """
+        found = []
+        for prefix in sorted(os.listdir(self.folder)):
+            prefix_folder = os.path.join(self.folder, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_folder):
+                continue
+            for key in sorted(os.listdir(prefix_folder)):
+                key_file = os.path.join(prefix_folder, key, KEY_FILE)
+                if not os.path.isfile(key_file):
+                    continue
+                with open(key_file, 'r') as handle:
+                    details = json.load(handle)
+                details["folder"] = os.path.dirname(key_file)
+                details["last_used"] = os.path.getmtime(os.path.dirname(key_file))
+                found.append(details)
+
+        return found
+
+
+def run_cached(cache_folder, read_files, settings, outpath, name_prefix, logfile, run):
+    """
+    restore the binned outputs of a sample from the store, or bin it and store its outputs
+    :param cache_folder: (str) the binning result store folder, None to always bin the sample
+    :param read_files: (list) the R1 and R2 fastq files
+    :param settings: (list) everything else the binned outputs depend on, see BinningCache.key
+    :param outpath: (str) the binned folder
+    :param name_prefix: (str) the sample name
+    :param logfile: (str) path and name of the log file
+    :param run: (func) bins the sample, returns True if it succeeded
+    :return: (bool) True if the outputs were restored from the store
+    """
+    if not cache_folder:
+        run()
+        return False
+
+    cache = BinningCache(cache_folder)
+    key = cache.key(read_files, settings)
+    if cache.restore(key, outpath, name_prefix):
+        message = "Restored the binned outputs of {0} from {1}".format(name_prefix, cache.entry(key))
+        print(message)
+        with open(logfile, 'a') as handle:
+            handle.write("{}\n".format(message))
+        return True
+
+    if run():
+        cache.store(key, outpath, name_prefix, settings)
+
+    return False
+
+
+def _link_tree(source, target):
+    for root, dirs, files in os.walk(source):
+        target_root = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(target_root, exist_ok=True)
+        for file in files:
+            link_or_copy(os.path.join(root, file), os.path.join(target_root, file))
+
+
+def main(cache_folder, older_than):
+
+    cache = BinningCache(cache_folder)
+    now = time.time()
+    for details in cache.entries():
+        age_days = (now - details["last_used"]) / 86400
+        if older_than is not None and age_days > older_than:
+            shutil.rmtree(details["folder"])
+            print("removed {0} ({1}, last used {2:.0f} days ago)".format(details["key"], details["sample"], age_days))
+        else:
+            print("{0}\t{1}\tlast used {2:.0f} days ago".format(details["key"], details["sample"], age_days))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lists the binned samples in a binning result store, and removes '
+                                                 'the ones that were not used for a while',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--cache_folder', default=argparse.SUPPRESS, type=str,
+                        help='The binning result store folder', required=True)
+    parser.add_argument('-d', '--older_than', default=None, type=float,
+                        help='Remove the results that were last used more than this many days ago', required=False)
+
+    args = parser.parse_args()
+    cache_folder = args.cache_folder
+    older_than = args.older_than
+
+    main(cache_folder, older_than)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from binning_cache import BinningCache
+from binning_cache import r_package_version
+from binning_cache import run_cached
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_folder = os.path.join(self.tmp_dir, "binning_cache")
+        self.logfile = os.path.join(self.tmp_dir, "ENV_logfile.txt")
+        self.reads = []
+        for read in ["R1", "R2"]:
+            self.reads.append(os.path.join(self.tmp_dir, "CAP1_ENV_{}.fastq".format(read)))
+            with open(self.reads[-1], 'w') as handle:
+                handle.write("@read1\nACGTACGT\n+\nIIIIIIII\n")
+        self.runs = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def bin_sample(self, outpath, settings):
+        def run():
+            self.runs += 1
+            consensus = os.path.join(outpath, "CAP1_ENV", "n023_buildConsensus", "CAP1_ENV_kept_buildConsensus.fastq")
+            os.makedirs(os.path.dirname(consensus))
+            with open(consensus, 'w') as handle:
+                handle.write("@CAP1_ENV_AAAA_3\nACGT\n+\nIIII\n")
+            return True
+
+        return run_cached(self.cache_folder, self.reads, settings, outpath, "CAP1_ENV", self.logfile, run)
+
+    def test_unchanged_samples_are_restored(self):
+        settings = ["--fwd_primer_seq=GGAAATATGG", "--overlapping", "1,10,24", "tool-checksum"]
+        self.assertFalse(self.bin_sample(os.path.join(self.tmp_dir, "run1"), settings))
+        self.assertTrue(self.bin_sample(os.path.join(self.tmp_dir, "run2"), settings))
+        self.assertEqual(self.runs, 1)
+        restored = os.path.join(self.tmp_dir, "run2", "CAP1_ENV", "n023_buildConsensus",
+                                "CAP1_ENV_kept_buildConsensus.fastq")
+        with open(restored) as handle:
+            self.assertEqual(handle.readline(), "@CAP1_ENV_AAAA_3\n")
+        self.assertEqual(len(BinningCache(self.cache_folder).entries()), 1)
+
+        # new settings or new reads are binned again
+        self.assertFalse(self.bin_sample(os.path.join(self.tmp_dir, "run3"), settings[:-1] + ["new-tool-checksum"]))
+        with open(self.reads[1], 'a') as handle:
+            handle.write("@read2\nACGTACGT\n+\nIIIIIIII\n")
+        self.assertFalse(self.bin_sample(os.path.join(self.tmp_dir, "run4"), settings))
+        self.assertEqual(self.runs, 3)
+
+    def test_r_package_version(self):
+        # a stand-in Rscript that knows one package
+        bin_folder = os.path.join(self.tmp_dir, "bin")
+        os.makedirs(bin_folder)
+        rscript = os.path.join(bin_folder, "Rscript")
+        with open(rscript, 'w') as handle:
+            handle.write("#!/bin/sh\ncase \"$2\" in *MotifBinner2*) printf 2.1.3 ;; *) exit 1 ;; esac\n")
+        os.chmod(rscript, 0o755)
+        with mock.patch.dict(os.environ, {"PATH": bin_folder}):
+            self.assertEqual(r_package_version("MotifBinner2"), "2.1.3")
+            self.assertEqual(r_package_version("NotInstalled"), "missing")
+        with mock.patch.dict(os.environ, {"PATH": os.path.join(self.tmp_dir, "empty")}):
+            self.assertEqual(r_package_version("MotifBinner2"), "missing")
+
+
+if __name__ == '__main__':
+    unittest.main()
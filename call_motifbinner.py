@@ -1,14 +1,54 @@
 #!/usr/bin/python3
 from __future__ import print_function
 from __future__ import division
+import os
+import csv
+import glob
+import shutil
 import argparse
-import subprocess
-import regex
+import tempfile
 
 
 __author__ = 'Colin Anthony'
 
 
+# set NGS_PIPELINE_MOTIFBINNER_SHARDS to eg: 4 to split each sample by primer ID and run MotifBinner on the parts in
+# parallel
+SHARDS_ENV = "NGS_PIPELINE_MOTIFBINNER_SHARDS"
+# the MotifBinner outputs that are merged back from the shards, the other intermediate files are not kept
+CONSENSUS_PATTERN = os.path.join("*_buildConsensus", "*_buildConsensus.fastq")
+# the MotifBinner stats tables that ngs_stats_calculator reads, the other step tables are not kept
+STATS_TABLES = ("n001_fwd_loadData", "n019_mergePEAR", "n023_buildConsensus")
+# the cells of the stats tables that are summed over the shards, as (row, column) after the header: the count in the
+# third column of the first row, which ngs_stats_calculator reads
+STATS_COUNT_CELLS = ((1, 2),)
+# the MotifBinner2 options that the binned outputs don't depend on
+RUN_OPTIONS = ("--fwd_file=", "--rev_file=", "--output_dir=", "--ncpu=")
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the number of MotifBinner shards per sample for this process and the processes it starts, from the
+    pipelineSettings of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    shards = int(pipeline_settings.get("motifbinner_shards", 1) or 1)
+    if shards > 1:
+        os.environ[SHARDS_ENV] = str(shards)
+
+
+def shards_from_env():
+    """
+    :return: (int) the number of MotifBinner shards per sample set in NGS_PIPELINE_MOTIFBINNER_SHARDS, 1 if not set
+    """
+    try:
+        return max(1, int(os.environ.get(SHARDS_ENV, 1)))
+    except ValueError:
+        print("Ignoring invalid number of MotifBinner shards: {}".format(os.environ[SHARDS_ENV]))
+        return 1
+
+
 def get_primer_lens_score(primer, pid_primer):
 
     primer = primer.upper()
@@ -20,6 +60,8 @@ def get_primer_lens_score(primer, pid_primer):
     else:
         pattern = r"([^ACGT][ACGTRYMKSWHBVD]+[N]*[ACGTRYMKSWHBVDN]+[ACGT]$)"
 
+    # imported here so that the script starts quickly
+    import regex
     match = regex.match(pattern, primer.upper())
     if not match:
         print("invalid primer sequence", primer)
@@ -57,8 +99,8 @@ def get_primer_lens_score(primer, pid_primer):
     return primer_lens, primer_score
 
 
-def run_motifbinner(logfile, fwd_read, rev_read, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score,
-                    cDNA_primer, cDNA_primer_lens, cDNA_primer_score, name_prefix, counter, cores, nonoverlap):
+def motifbinner_cmd(fwd_read, rev_read, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score,
+                    cDNA_primer, cDNA_primer_lens, cDNA_primer_score, name_prefix, cores, nonoverlap):
     if not nonoverlap:
         overlap_option = "overlapping"
     else:
@@ -66,45 +108,179 @@ def run_motifbinner(logfile, fwd_read, rev_read, outpath, fwd_primer, fwd_primer
 
     fwd_pid = 'NULL'
     rev_pid_fragment = 2
-    cmd = 'MotifBinner2.R --fwd_file={0} ' \
-          '--fwd_primer_seq={1} ' \
-          '--fwd_primer_lens={2} ' \
-          '--fwd_primer_min_score={3} ' \
-          '--rev_file={4} ' \
-          '--rev_primer_seq={5} ' \
-          '--rev_primer_lens={6} ' \
-          '--rev_primer_min_score={7} ' \
-          '--fwd_pid_in_which_fragment={8} ' \
-          '--rev_pid_in_which_fragment={9} ' \
-          '--output_dir={10} ' \
-          '--base_for_names={11} ' \
-          '--ncpu={12} ' \
-          '--min_read_length=290 '\
-          '--merged_read_length=240 '\
-          '--{13}'.format(fwd_read,
-                          fwd_primer,
-                          fwd_primer_lens,
-                          fwd_primer_score,
-                          rev_read,
-                          cDNA_primer,
-                          cDNA_primer_lens,
-                          cDNA_primer_score,
-                          fwd_pid,
-                          rev_pid_fragment,
-                          outpath,
-                          name_prefix,
-                          cores,
-                          overlap_option)
+    cmd = ['MotifBinner2.R',
+           '--fwd_file={}'.format(fwd_read),
+           '--fwd_primer_seq={}'.format(fwd_primer),
+           '--fwd_primer_lens={}'.format(fwd_primer_lens),
+           '--fwd_primer_min_score={}'.format(fwd_primer_score),
+           '--rev_file={}'.format(rev_read),
+           '--rev_primer_seq={}'.format(cDNA_primer),
+           '--rev_primer_lens={}'.format(cDNA_primer_lens),
+           '--rev_primer_min_score={}'.format(cDNA_primer_score),
+           '--fwd_pid_in_which_fragment={}'.format(fwd_pid),
+           '--rev_pid_in_which_fragment={}'.format(rev_pid_fragment),
+           '--output_dir={}'.format(outpath),
+           '--base_for_names={}'.format(name_prefix),
+           '--ncpu={}'.format(cores),
+           '--min_read_length=290',
+           '--merged_read_length=240',
+           '--{}'.format(overlap_option)]
+
+    return cmd
+
+
+def merge_stats(csv_files, outfile):
+    """
+    merge the per shard MotifBinner stats tables: the count cells (STATS_COUNT_CELLS) are summed and the other
+    cells are taken from the first shard
+    :param csv_files: (list) the same stats table from each shard
+    :param outfile: (str) the merged table
+    :return: None
+    """
+    tables = []
+    for csv_file in csv_files:
+        with open(csv_file, 'r', newline='') as handle:
+            tables.append(list(csv.reader(handle)))
+
+    merged = [list(x) for x in tables[0]]
+    for i, j in STATS_COUNT_CELLS:
+        if i < len(merged) and j < len(merged[i]):
+            merged[i][j] = str(sum(int(x[i][j]) for x in tables))
+
+    with open(outfile, 'w', newline='') as handle:
+        csv.writer(handle).writerows(merged)
+
+
+def merge_shards(shard_folders, outpath, name_prefix):
+    """
+    merge the MotifBinner outputs of the shards of a sample into the layout of a single MotifBinner run, the
+    consensus files are joined and the STATS_TABLES are merged
+    :param shard_folders: (list) the output folders of the shards
+    :param outpath: (str) the MotifBinner output folder
+    :param name_prefix: (str) the base name of the sample
+    :return: (list) the merged files
+    """
+    merged = []
+    stats_patterns = [os.path.join(x, x + ".csv") for x in STATS_TABLES]
+    for pattern in [CONSENSUS_PATTERN] + stats_patterns:
+        parts = {}
+        for shard_folder in shard_folders:
+            shard_root = os.path.join(shard_folder, name_prefix)
+            for file in sorted(glob.glob(os.path.join(shard_root, pattern))):
+                parts.setdefault(os.path.relpath(file, shard_root), []).append(file)
+
+        for rel_name, files in sorted(parts.items()):
+            outfile = os.path.join(outpath, name_prefix, rel_name)
+            os.makedirs(os.path.dirname(outfile), exist_ok=True)
+            if pattern == CONSENSUS_PATTERN:
+                with open(outfile, 'wb') as handle:
+                    for file in files:
+                        with open(file, 'rb') as part:
+                            shutil.copyfileobj(part, handle)
+            else:
+                merge_stats(files, outfile)
+            merged.append(outfile)
+
+    return merged
+
+
+def run_sharded(cmd_args, read1, read2, outpath, cDNA_primer, name_prefix, cores, shards, logfile):
+    """
+    split a sample into shards by primer ID, so that each family is binned whole in one shard, run MotifBinner on the
+    shards in parallel and merge the outputs
+    :param cmd_args: (list) the motifbinner_cmd arguments after the read files and outpath
+    :param read1: (str) the read1 (R1) fastq file
+    :param read2: (str) the read2 (R2) fastq file
+    :param outpath: (str) the MotifBinner output folder
+    :param cDNA_primer: (str) the cDNA primer, its leading N's are the primer ID
+    :param name_prefix: (str) the base name of the sample
+    :param cores: (int) the cores for the sample, shared between the shards
+    :param shards: (int) the number of shards
+    :param logfile: (str) path and name of the log file, the shard logs are written next to it
+    :return: (bool) True if all the shards were binned and merged
+    """
+    # imported here so that the script starts quickly
+    from subsample_reads import pid_length
+    from subsample_reads import shard_pair
+    from tool_runner import ToolJob
+    from tool_runner import ToolRunner
+    from tool_runner import failed_jobs
+    from tool_runner import job_log_file
+
+    os.makedirs(outpath, exist_ok=True)
+    # next to the output folder, not in it, as everything in the output folder is taken to be a binned sample
+    shard_root = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(outpath)),
+                                  prefix=".{}_shards_".format(name_prefix))
+    try:
+        shard_reads = shard_pair(read1, read2, shard_root, shards, pid_length(cDNA_primer))
+        if not shard_reads:
+            print("no reads to bin for {}".format(name_prefix))
+            return False
+        log_folder = os.path.join(os.path.dirname(os.path.abspath(logfile)), "tool_logs")
+        jobs = []
+        shard_folders = []
+        for i, (shard_r1, shard_r2) in enumerate(shard_reads):
+            shard_folder = os.path.join(shard_root, "shard{}_out".format(i))
+            shard_folders.append(shard_folder)
+            cmd = motifbinner_cmd(shard_r1, shard_r2, shard_folder, *cmd_args,
+                                  cores=max(1, cores // len(shard_reads)))
+            jobs.append(ToolJob("MotifBinner2.R", cmd,
+                                job_log_file(log_folder, "motifbinner", "{0}_shard{1}".format(name_prefix, i))))
+
+        results = ToolRunner({"MotifBinner2.R": len(jobs)}).run_jobs(jobs)
+        # a partial merge would silently drop primer ID families, so nothing is merged if a shard failed
+        failed = failed_jobs(results)
+        if not failed:
+            merge_shards(shard_folders, outpath, name_prefix)
+    finally:
+        shutil.rmtree(shard_root, ignore_errors=True)
+
+    return not failed
+
+
+def run_motifbinner(logfile, fwd_read, rev_read, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score,
+                    cDNA_primer, cDNA_primer_lens, cDNA_primer_score, name_prefix, counter, cores, nonoverlap,
+                    shards=1):
+    """
+    :return: (bool) True if MotifBinner2 exited cleanly
+    """
+    cmd = motifbinner_cmd(fwd_read, rev_read, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score,
+                          cDNA_primer, cDNA_primer_lens, cDNA_primer_score, name_prefix, cores, nonoverlap)
 
     # only write to log file if this is the first iteration
     if counter == 0:
         with open(logfile, 'a') as handle:
-            handle.write("MotifBinner2 commands:\n{0}\n".format(cmd))
-    print(cmd)
-    subprocess.call(cmd, shell=True)
+            handle.write("MotifBinner2 commands:\n{0}\n".format(" ".join(cmd)))
+    print(" ".join(cmd))
+    if shards > 1:
+        print("binning {0} in {1} primer ID shards".format(name_prefix, shards))
+        cmd_args = [fwd_primer, fwd_primer_lens, fwd_primer_score, cDNA_primer, cDNA_primer_lens, cDNA_primer_score,
+                    name_prefix]
+        return run_sharded(cmd_args, fwd_read, rev_read, outpath, cDNA_primer, name_prefix, cores, shards, logfile)
 
+    # imported here so that the script starts quickly
+    from tool_runner import run_tool
+    result = run_tool("MotifBinner2.R", cmd)
+    if result.returncode != 0:
+        print("MotifBinner2.R exited with code {0} after {1} s".format(result.returncode, result.duration))
 
-def main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, logfile, cores, non_overlap ):
+    return result.returncode == 0
+
+
+def motifbinner_version():
+    """
+    :return: (str) the version of MotifBinner2 for the binning result store keys: the checksum of the MotifBinner2.R
+    wrapper script and the version of the installed MotifBinner2 R package, which can be upgraded on its own
+    """
+    # imported here so that the script starts quickly
+    from binning_cache import tool_version
+    from binning_cache import r_package_version
+
+    return "{0} MotifBinner2=={1}".format(tool_version("MotifBinner2.R"), r_package_version("MotifBinner2"))
+
+
+def main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, logfile, cores, non_overlap, shards=1,
+         cache_folder=None, version=None):
 
     print("calling MotifBinner")
     fwd_primer = fwd_primer.upper()
@@ -116,9 +292,23 @@ def main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, l
     pid_primer = True
     cDNA_primer_lens, cDNA_primer_score = get_primer_lens_score(cDNA_primer, pid_primer)
 
+    def run():
+        return run_motifbinner(logfile, read1, read2, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score,
+                               cDNA_primer, cDNA_primer_lens, cDNA_primer_score, name_prefix, counter, cores,
+                               non_overlap, shards)
+
+    # the outputs don't depend on the files, output folder or cpu options of the command
+    cmd = motifbinner_cmd(read1, read2, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score, cDNA_primer,
+                          cDNA_primer_lens, cDNA_primer_score, name_prefix, cores, non_overlap)
+    settings = [x for x in cmd if not x.startswith(RUN_OPTIONS)]
+    # imported here so that the script starts quickly
+    from binning_cache import run_cached
+    if cache_folder:
+        # asking R for the package version takes a moment, so step 2 does it once for all the samples
+        settings.append(version or motifbinner_version())
+
     # run motifbinner call function
-    run_motifbinner(logfile, read1, read2, outpath, fwd_primer, fwd_primer_lens, fwd_primer_score,
-                    cDNA_primer, cDNA_primer_lens, cDNA_primer_score, name_prefix, counter, cores, non_overlap)
+    run_cached(cache_folder, [read1, read2], settings, outpath, name_prefix, logfile, run)
 
 
 if __name__ == "__main__":
@@ -145,6 +335,15 @@ if __name__ == "__main__":
                         help='the number of CPU cores to use', required=False)
     parser.add_argument('-v', '--non_overlap', default=False, action='store_true',
                         help="Use if reads don't overlap)", required=False)
+    parser.add_argument('-k', '--shards', default=1, type=int,
+                        help='Split the sample into this many shards by primer ID and bin them in parallel',
+                        required=False)
+    parser.add_argument('-cache', '--cache_folder', default=None, type=str,
+                        help='Restore the binned outputs from this binning result store if the reads and settings '
+                             'are unchanged, and store new ones', required=False)
+    parser.add_argument('-tv', '--tool_version', default=None, type=str,
+                        help='The MotifBinner2 version for the binning result store keys, as given by '
+                             'motifbinner_version, found out if not given', required=False)
 
     args = parser.parse_args()
     read1 = args.read1
@@ -157,5 +356,9 @@ if __name__ == "__main__":
     non_overlap = args.non_overlap
     cores = args.cores
     logfile = args.logfile
+    shards = args.shards
+    cache_folder = args.cache_folder
+    version = args.tool_version
 
-    main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, logfile, cores, non_overlap)
+    main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, logfile, cores, non_overlap, shards,
+         cache_folder, version)
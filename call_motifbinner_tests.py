@@ -0,0 +1,71 @@
+import os
+import csv
+import shutil
+import tempfile
+import unittest
+import call_motifbinner
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        file_name = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'w') as handle:
+            handle.write(content)
+        return file_name
+
+    def test_shard_outputs_are_merged_into_the_sample_layout(self):
+        shard_folders = []
+        for i, (pid, reads) in enumerate([("AAAA", 120), ("CCCC", 80)]):
+            shard_folder = os.path.join(self.tmp_dir, "shard{}_out".format(i))
+            shard_folders.append(shard_folder)
+            sample = os.path.join("shard{}_out".format(i), "CAP1_ENV")
+            self.write(os.path.join(sample, "n023_buildConsensus", "n023_buildConsensus.fastq"),
+                       "@CAP1_ENV_{0}\nACGT\n+\nIIII\n".format(pid))
+            self.write(os.path.join(sample, "n001_fwd_loadData", "n001_fwd_loadData.csv"),
+                       '"","parameter","value"\n"1","n_reads",{0}\n"2","read_file","shard{1}_R1.fastq"\n'.format(
+                           reads, i))
+            self.write(os.path.join(sample, "n002_other", "n002_other.rds"), "intermediate")
+
+        outpath = os.path.join(self.tmp_dir, "binned")
+        merged = call_motifbinner.merge_shards(shard_folders, outpath, "CAP1_ENV")
+        self.assertEqual(len(merged), 2)
+
+        with open(os.path.join(outpath, "CAP1_ENV", "n023_buildConsensus", "n023_buildConsensus.fastq")) as handle:
+            self.assertEqual([x for x in handle if x.startswith("@")], ["@CAP1_ENV_AAAA\n", "@CAP1_ENV_CCCC\n"])
+        with open(os.path.join(outpath, "CAP1_ENV", "n001_fwd_loadData", "n001_fwd_loadData.csv")) as handle:
+            rows = list(csv.reader(handle))
+        self.assertEqual(rows[1], ["1", "n_reads", "200"])
+        self.assertEqual(rows[2], ["2", "read_file", "shard0_R1.fastq"])
+        self.assertFalse(os.path.exists(os.path.join(outpath, "CAP1_ENV", "n002_other")))
+
+    def test_only_count_cells_are_summed(self):
+        tables = []
+        # pid_binner's report layout, the shards have different numbers of sequences, reads and bins
+        for i, (reads, bins) in enumerate([(120, 25), (80, 20)]):
+            tables.append(self.write("shard{}.csv".format(i), '"","parameter","value"\n"1","sequences",{0}\n'
+                                                               '"2","reads",{0}\n"3","bins",{1}\n'.format(reads, bins)))
+        outfile = os.path.join(self.tmp_dir, "merged.csv")
+        call_motifbinner.merge_stats(tables, outfile)
+        with open(outfile) as handle:
+            rows = list(csv.reader(handle))
+        self.assertEqual(rows[1:], [["1", "sequences", "200"], ["2", "reads", "120"], ["3", "bins", "25"]])
+
+    def test_shards_from_env(self):
+        call_motifbinner.enable_from_config({"motifbinner_shards": 3})
+        try:
+            self.assertEqual(call_motifbinner.shards_from_env(), 3)
+        finally:
+            del os.environ[call_motifbinner.SHARDS_ENV]
+        self.assertEqual(call_motifbinner.shards_from_env(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
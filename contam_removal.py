@@ -4,31 +4,21 @@ from __future__ import division
 import os
 import argparse
 import collections
-from itertools import groupby
-# from Bio.Blast import NCBIWWW
-from Bio.Blast import NCBIXML
-from Bio.Blast.Applications import NcbiblastnCommandline
 import sys
+import profiling_hooks
+from seq_io import py3_fasta_iter
+from seq_io import open_seq
+from seq_io import collapsed_header
+from seq_io import collapse_records
+from seq_io import plain_name
+from seq_io import storage_name
+from sample_container import is_block_ref
+from sample_container import split_ref
 
 
 __author__ = 'Colin Anthony'
 
 
-def py3_fasta_iter(fasta_name):
-    """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
-    """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
-
-
 def fasta_to_dct(file_name):
     """
     :param file_name: The fasta formatted file to read from.
@@ -47,11 +37,12 @@ def fasta_to_dct(file_name):
     return dct
 
 
-def blastn_seqs(infile, gene_region, outpath):
+def blastn_seqs(infile, gene_region, outpath, threads):
     """
     :param infile: fasta file to blast
     :param gene_region: (str) the target gene region
     :param outpath: path to the outfile
+    :param threads: (int) the number of threads for blastn
     :return: (bool) True or False depending on whether sequence is not hiv
     """
 
@@ -60,8 +51,9 @@ def blastn_seqs(infile, gene_region, outpath):
     script_folder = os.path.abspath(script_folder)
     blastdb_path = os.path.join(script_folder, "local_blast_db", "lanl_hiv_db")
 
-    # assign temp file
-    tmp_out_file = os.path.join(outpath, "tmp_blast.xml")
+    # assign temp file, named for the input so that concurrent contam checks don't share it
+    tmp_name = os.path.split(infile)[-1].replace(".fasta", "")
+    tmp_out_file = os.path.join(outpath, "tmp_blast_{}.xml".format(tmp_name))
     target_gene = [gene_region.upper().split("_")[0]]
 
     # allow blast hit to pass if blasts to overlapping gene
@@ -81,7 +73,6 @@ def blastn_seqs(infile, gene_region, outpath):
     blastdb = "lanl_hiv_db"
     outformat = 5
     e_value = 0.000001
-    threads = 4
 
     print("running blast")
     # # run online blast
@@ -90,21 +81,22 @@ def blastn_seqs(infile, gene_region, outpath):
     # with open(tmp_out_file, 'w') as handle:
     #     handle.write(blast_results.read())
 
-    #change path to allow blastdb to be detected
-    os.chdir(blastdb_path)
+    # imported here so that the script starts quickly
+    from tool_runner import run_tool
 
-    # run local blast
-    blastn_cline = NcbiblastnCommandline(query=infile, db=blastdb, evalue=e_value, outfmt=outformat, perc_identity=80,
-                                         out=tmp_out_file, num_threads=threads)
+    # run local blast, from the blastdb folder to allow blastdb to be detected
+    blastn_cline = ["blastn", "-query", infile, "-db", blastdb, "-evalue", str(e_value), "-outfmt", str(outformat),
+                    "-perc_identity", "80", "-out", tmp_out_file, "-num_threads", str(threads)]
 
-    stdout, stderr = blastn_cline() # stdin=format_fasta
-    print("stderr = ", stderr)
-    print("stout = ", stdout)
+    result = run_tool("blastn", blastn_cline, cwd=blastdb_path)
+    print("blastn exit code = {0}, {1} s".format(result.returncode, result.duration))
 
     good_records = collections.defaultdict(list)
     bad_records = collections.defaultdict(list)
 
     if os.path.isfile(tmp_out_file):
+        # imported here so that the script starts quickly
+        from Bio.Blast import NCBIXML
         all_blast_results = NCBIXML.parse(open(tmp_out_file))
     else:
         print("the blast failed to write an outfile")
@@ -140,61 +132,58 @@ def blastn_seqs(infile, gene_region, outpath):
     return bad_records, good_records
 
 
-def main(infile, outpath, gene_region, logfile):
+def main(infile, outpath, gene_region, logfile, threads=4):
     print(infile)
     # initialize file names
     infile = os.path.abspath(infile)
     outpath = os.path.abspath(outpath)
-    cln_name = os.path.split(infile)[-1]
-    original_path = os.getcwd()
+    cln_name = plain_name(os.path.split(infile)[-1])
+    # the outfiles are compressed if NGS_PIPELINE_COMPRESSION is set
     cln_out_name = cln_name.replace("_clean.fasta", "_good.fasta")
-    outfile = os.path.join(outpath, cln_out_name)
+    outfile = storage_name(os.path.join(outpath, cln_out_name))
     contam_name = cln_name.replace("_clean.fasta", "_contam_seqs.fasta")
-    contam_outfile = os.path.join(outpath, contam_name)
+    contam_outfile = storage_name(os.path.join(outpath, contam_name))
 
     with open(logfile, 'a') as handle:
         handle.write("Contam removal step:\nSequences identified as contaminants (if any):")
 
-    # clear out any existing outfiles for consensus
-    with open(outfile, 'w') as handle1:
-        handle1.write("")
-    with open(contam_outfile, 'w') as handle2:
-        handle2.write("")
-
-    # store all consensus seqs in a dict
-    all_sequences_d = fasta_to_dct(infile)
-
-    # checck for contam
-
-    contam, not_contam = blastn_seqs(infile, gene_region, outpath)
-
-    # path changed back to original cwd (was changed in blastn_seqs for database location
-    os.chdir(original_path)
-    # set all output names to uppercase to ensure input > output names match
-    contam_names = [x.upper() for x in contam.keys()]
-    not_contam_names = [x.upper() for x in not_contam.keys()]
-
-    # check each sequence to see if it is a contaminant
-    for name, seq in all_sequences_d.items():
-        # set input name to uppercase to ensure match to output name
-        name = name.upper()
-        # if the sequence is not hiv, save to contam file
-        if name in contam_names:
-            print("Non HIV sequence found:\n\t", name)
-            new_name = name + contam[name]
-            with open(contam_outfile, 'a') as handle1:
-                outstr = ">{0}\n{1}\n".format(new_name, seq)
-                handle1.write(outstr)
-
-        # if is not contam, to write to good outfile
-        elif name in not_contam_names:
-            with open(outfile, 'a') as handle2:
-                outstr = ">{0}\n{1}\n".format(name, seq)
+    # group the consensus seqs by sequence, so that each unique sequence is blasted once
+    uniques = collapse_records(fasta_to_dct(infile).items())
+
+    # the blast files go next to the sample container when writing to one
+    work_folder = os.path.dirname(split_ref(outpath)[0]) if is_block_ref(outpath) else outpath
+
+    # checck for contam, blastn only reads plain fasta files, each unique sequence is written under its first name
+    blast_infile = os.path.join(work_folder, "uniques_" + cln_name)
+    with open(blast_infile, 'w') as handle:
+        for names, seq in uniques:
+            handle.write(">{0}\n{1}\n".format(names[0], seq))
+    try:
+        contam, not_contam = blastn_seqs(blast_infile, gene_region, work_folder, threads)
+    finally:
+        os.unlink(blast_infile)
+
+    # check each sequence to see if it is a contaminant, any existing outfiles are replaced
+    with open_seq(contam_outfile, 'w', stage="contam") as handle1, open_seq(outfile, 'w', stage="contam") as handle2:
+        for names, seq in uniques:
+            # set names to uppercase to ensure input > output names match
+            names = [x.upper() for x in names]
+            name = names[0]
+            # if the sequence is not hiv, save each of its names to the contam file
+            if name in contam:
+                for contam_name in names:
+                    print("Non HIV sequence found:\n\t", contam_name)
+                    outstr = ">{0}\n{1}\n".format(contam_name + contam[name], seq)
+                    handle1.write(outstr)
+
+            # if is not contam, to write to good outfile, still collapsed
+            elif name in not_contam:
+                outstr = ">{0}\n{1}\n".format(collapsed_header(names), seq)
                 handle2.write(outstr)
 
-        else:
-            print("Input names did not match with output names. Something strange happened for: ", name)
-            # todo add logging
+            else:
+                print("Input names did not match with output names. Something strange happened for: ", name)
+                # todo add logging
 
     print("contam check complete")
 
@@ -212,11 +201,15 @@ if __name__ == "__main__":
     parser.add_argument('-g', '--gene_region', default=argparse.SUPPRESS, type=str,
                         choices=["ENV", "GAG", "POL", "NEF", "VIF", "VPR", "VPU", "REV", "VPU"],
                         help='the genomic region being sequenced', required=True)
+    parser.add_argument('-t', '--threads', default=4, type=int,
+                        help='the number of threads for blastn', required=False)
 
     args = parser.parse_args()
     infile = args.infile
     outpath = args.outpath
     gene_region = args.gene_region
     logfile = args.logfile
+    threads = args.threads
 
-    main(infile, outpath, gene_region, logfile)
+    sample = plain_name(os.path.split(infile)[-1]).replace("_clean.fasta", "")
+    profiling_hooks.run_main(main, "contam", sample, infile, outpath, gene_region, logfile, threads)
@@ -1,18 +1,29 @@
 # !/usr/bin/python3
 import csv
-from subprocess import call
-from subprocess import Popen
-from subprocess import PIPE
 import argparse
 import os
 import ntpath
+import collections
 import json
 import logging
 import time
+import shutil
 from glob import glob
+from itertools import zip_longest
 
 # Non-standard
 import regex
+from file_transitions import move_file
+from stage_metrics import record_stage
+from stage_metrics import summarise_metrics
+from tool_runner import run_tool
+import supervisor
+import work_queue
+import run_watcher
+import preview_run
+import preflight_check
+import profiling_hooks
+from run_settings import apply_pipeline_settings
 
 
 __author__ = "Colin Anthony, Jon Ambler, David Matten"
@@ -404,7 +415,12 @@ def split_by_primers_matchpair(fastq_R1_file, fastq_R2_file, primer_dict, orient
         # Make a blast database
         create_temp_blast_db(out_dir + 'primerList.fasta', out_dir + 'primers')
 
-    for seq_line, R2_seq_line in zip(open(fastq_R1_file, 'r'), open(fastq_R2_file, 'r')):
+    for seq_line, R2_seq_line in zip_longest(open(fastq_R1_file, 'r'), open(fastq_R2_file, 'r')):
+        # zip would silently drop the end of the longer file and leave the mates out of sync
+        if seq_line is None or R2_seq_line is None:
+            raise ValueError("{0} and {1} have different numbers of lines, the mates are out of sync".format(
+                fastq_R1_file, fastq_R2_file))
+
         # Get the header
         if is_divisable(line_number_header, 4):
             current_header = seq_line
@@ -505,7 +521,8 @@ def create_temp_blast_db(fasta_filepath, db_identifier):
     """
     # Create a blast database for a genome
     database_name = db_identifier + "_BlastDB"
-    return call(["makeblastdb", "-in", fasta_filepath, "-out", database_name, "-dbtype", "nucl"])
+    return run_tool("makeblastdb", ["makeblastdb", "-in", fasta_filepath, "-out", database_name, "-dbtype", "nucl"],
+                    log_file=database_name + "_makeblastdb.log").returncode
 
 
 def primer_blast_search(db_identifier, sequence, out_dir):
@@ -532,10 +549,11 @@ def primer_blast_search(db_identifier, sequence, out_dir):
     #  blastn -db F11_BlastDB -query /Users/Admin/Dropbox/Programs/tools/Cell/Cell_core/blasta.fa
     # print "blasting"
     full_directory = temp_dir + "temp.fa"
-    blast_result_raw = Popen(["blastn", "-db", blast_database, "-query", full_directory, "-outfmt", "7", "-word_size",
-                              "15", "-evalue", "1000"], stdout=PIPE)
-    blast_result = blast_result_raw.stdout.read()
-    blast_result = blast_result.decode('ascii')
+    blast_outfile = temp_dir + "temp_blast.txt"
+    run_tool("blastn", ["blastn", "-db", blast_database, "-query", full_directory, "-outfmt", "7", "-word_size", "15",
+                        "-evalue", "1000"], stdout_file=blast_outfile)
+    with open(blast_outfile, 'r') as handle:
+        blast_result = handle.read()
 
     # print len(blast_result)
 
@@ -562,6 +580,37 @@ def primer_blast_search(db_identifier, sequence, out_dir):
         return "None"
 
 
+def input_file_names(a_file):
+    """
+    work out the patient, sample and read of a fastq file from the sequencer and the name the pipeline uses for it,
+    eg: CAP1_multiplex_S1_L001_R1_001.fastq is renamed to CAP1_multiplex_R1.fastq
+    :param a_file: (str) the path of the fastq file
+    :return: (tuple) patient, sample identifier, orientation (R1 or R2) and the path to rename the file to (None if it
+    is already named that way), or None if it is not an R1 or R2 file
+    """
+    for orientation in ["R1", "R2"]:
+        if orientation not in a_file:
+            continue
+        path = os.path.split(a_file)[0]
+        outf = os.path.split(a_file)[-1].replace("-", "_")
+        outf_rename = regex.sub("S[0-9]+_L[0-9][0-9][0-9]_{0}_[0-9][0-9][0-9].fastq".format(orientation),
+                                "{}.fastq".format(orientation), outf)
+        if outf_rename == outf:
+            # check if they have already been renamed
+            if outf.split("_")[-1] != "{}.fastq".format(orientation):
+                raise ValueError("Unable to rename {0} file {1}\ncheck the file renaming regex".format(orientation,
+                                                                                                      a_file))
+            renamed_file = None
+        else:
+            renamed_file = os.path.join(path, outf_rename)
+        patient = outf_rename.split('_')[0]
+        identifier = outf_rename.replace("_{}.fastq".format(orientation), "")
+
+        return patient, identifier, orientation, renamed_file
+
+    return None
+
+
 def process_input_dir(fastq_directory_path):
     """
     This function finds all the fastq files in a given directory, and groups the based on the patient, sample,
@@ -579,49 +628,18 @@ def process_input_dir(fastq_directory_path):
         file_parts = a_file.split("_")
         if "None" in file_parts:
             continue
-        if "R1" in a_file:
-            path = os.path.split(a_file)[0]
-            inf_R1_name = os.path.split(a_file)[-1]
-            outf_R1 = inf_R1_name.replace("-", "_")
-            outf_R1_rename = regex.sub("S[0-9]+_L[0-9][0-9][0-9]_R1_[0-9][0-9][0-9].fastq", "R1.fastq", outf_R1)
-            outf_R1_rename_with_path = os.path.join(path, outf_R1_rename)
-
-            if outf_R1_rename == outf_R1:
-                # check if they have already been renamed
-                if outf_R1.split("_")[-1] == "R1.fastq":
-                    print("file was already in correct format?")
-                else:
-                    print()
-                    raise ValueError("Unable to rename R1 file {0}\ncheck the file renaming regex".format(a_file))
-            else:
-                os.rename(a_file, outf_R1_rename_with_path)
-
-            print(outf_R1_rename)
-
-            orientation = "R1"
-            patient = outf_R1_rename.split('_')[0]
-            identifier = outf_R1_rename.replace("_R1.fastq", "")
-
-        elif "R2" in a_file:
-            path = os.path.split(a_file)[0]
-            inf_R2_name = os.path.split(a_file)[-1]
-            outf_R2 = inf_R2_name.replace("-", "_")
-            outf_R2_rename = regex.sub("S[0-9]+_L[0-9][0-9][0-9]_R2_[0-9][0-9][0-9].fastq", "R2.fastq", outf_R2)
-            outf_R2_rename_with_path = os.path.join(path, outf_R2_rename)
-            if outf_R2_rename == outf_R2:
-                if outf_R2.split("_")[-1] == "R2.fastq":
-                    print("file was already in correct format?")
-                else:
-                    raise ValueError("Unable to rename R1 file {0}\ncheck the file renaming regex".format(a_file))
-            else:
-                os.rename(a_file, outf_R2_rename_with_path)
-
-            orientation = "R2"
-            patient = outf_R2_rename.split('_')[0]
-            identifier = outf_R2_rename.replace("_R2.fastq", "")
-
-        else:
+        names = input_file_names(a_file)
+        if names is None:
             continue
+        patient, identifier, orientation, renamed_file = names
+        if renamed_file is None:
+            print("file was already in correct format?")
+        else:
+            os.rename(a_file, renamed_file)
+            a_file = renamed_file
+        if orientation == "R1":
+            print(os.path.split(a_file)[-1].replace("-", "_"))
+
         # if a_file[-5:] == 'fastq' or a_file[-2:] == 'fq':
         #
         #     # Identify patient tag
@@ -722,29 +740,111 @@ def check_for_previous_runs(output_directory_to_check, parsed_input_file_dict):
 def update_setuplog(status_to_update, log_file):
     # add path
     print(log_file)
-    old_log = log_file.replace('setup_log.csv', 'setup_log_old.csv')
-    os.rename(log_file, old_log)
-
-    log_file_new = open(log_file, 'wt')
-    log_file_old = open(old_log, 'rt')
+    new_log = log_file.replace('setup_log.csv', 'setup_log_new.csv')
 
-    with log_file_old as lineIn:
-        with log_file_new as lineOut:
+    with open(log_file, 'rt') as lineIn:
+        with open(new_log, 'wt') as lineOut:
             for line in lineIn:
                 lineOut.write(line.replace('Unprocessed', status_to_update))
 
-    os.unlink(old_log)
-    log_file_new.close()
+    move_file(new_log, log_file)
 
     return True
 
 
-def main(config_file, main_pipeline, haplotype):
+def step_2_tasks(data, primer_dict, patient_list, out_dir, run_step=None):
+    """
+    build the step 2 task for each gene region and patient
+    :param data: (dict) the config file settings
+    :param primer_dict: (dict) the primer dict from make_primer_dict
+    :param patient_list: (list) the patients in the run
+    :param out_dir: (str) the output folder
+    :param run_step: (int) the step to start from, defaults to the run_step in the config file
+    :return: (list) of dicts with patient, region, stage, args (for step 2 main) and settings (pipelineSettings) keys
+    """
+    if run_step is None:
+        run_step = data['pipelineSettings']['run_step']
+    tasks = []
+    for gene_region, gene_dict in primer_dict.items():
+        # don't run if the gene_region is None: sequences that couldn't be assigned to a gene region
+        if gene_region is not None or gene_region != "None":
+            overlap = gene_dict['overlap']
+            if overlap == "no":
+                nonoverlap = True
+            else:
+                nonoverlap = False
+
+            for a_patient_entry in patient_list:
+
+                # Adding the required parameters, the path is absolute so that workers on other nodes can use it
+                path = os.path.abspath(out_dir + a_patient_entry + '/' + gene_region)
+                sub_region = gene_dict['sub_region']
+                if not sub_region:
+                    sub_region = False
+                else:
+                    sub_region = sub_region
+                user_ref = False
+                # main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
+                #      run_only, user_ref, cores, scratch_dir)
+                args = [path,
+                        data['pipelineSettings']['out_prefix'],
+                        gene_region,
+                        sub_region,
+                        primer_dict[gene_region]['fwd_full'],
+                        primer_dict[gene_region]['rev_full'],
+                        nonoverlap,
+                        data['pipelineSettings']['min_read_length'],
+                        run_step,
+                        False,
+                        user_ref,
+                        data['pipelineSettings']['cores'],
+                        data['pipelineSettings'].get('scratch_dir', False)]
+                tasks.append(collections.OrderedDict([("patient", a_patient_entry), ("region", gene_region),
+                                                      ("stage", "step_2"), ("args", args),
+                                                      ("settings", data['pipelineSettings'])]))
+
+    return tasks
+
+
+def demultiplex_pair(r1_file_path, r2_file_path, primer_dict, out_dir, a_patient, fwd_match_only, regex_error_rate,
+                     should_do_blast):
+    """
+    split the reads of a sample into the 0new_data folders of the gene regions
+    :param r1_file_path: (str) the R1 fastq file
+    :param r2_file_path: (str) the R2 fastq file
+    :param primer_dict: (dict) the primer dict with kmer keys
+    :param out_dir: (str) the output folder, with a trailing /
+    :param a_patient: (str) the patient
+    :param fwd_match_only: (str) "yes" to assign the read pairs by the forward primer only
+    :param regex_error_rate: (int) the number of mismatches allowed in the primer match
+    :param should_do_blast: (bool) True to check the unmatched reads with blast
+    :return: None
+    """
+    if fwd_match_only == "yes":
+        infast_R1_name = ntpath.basename(r1_file_path)
+        infast_R2_name = ntpath.basename(r2_file_path)
+
+        split_by_primers_matchpair(r1_file_path, r2_file_path,
+                                   primer_dict, 'fwd', infast_R1_name, infast_R2_name, out_dir,
+                                   a_patient,
+                                   regex_error_rate, make_sure=should_do_blast)
+    else:
+        infast_name = ntpath.basename(r1_file_path)
+        split_by_primers(r1_file_path, primer_dict, 'fwd',
+                         infast_name, out_dir, a_patient, regex_error_rate, make_sure=should_do_blast)
+
+        infast_name = ntpath.basename(r2_file_path)
+        split_by_primers(r2_file_path, primer_dict, 'rev',
+                         infast_name, out_dir, a_patient, regex_error_rate, make_sure=should_do_blast)
+
+
+def main(config_file, main_pipeline, haplotype, queue=False):
     """
     The main function for the pipeline
     :param config_file:
     :param main_pipeline:
     :param haplotype:
+    :param queue: (bool) True to queue the step 2 tasks for workers (demultiplex.py --worker) instead of running them
     :return:
     """
 
@@ -766,6 +866,17 @@ def main(config_file, main_pipeline, haplotype):
 
     input_file_dict = process_input_dir(data['input_data']['fastq_dir'])
 
+    # check the inputs before anything is written to the output folder
+    sample_records = data['pipelineSettings'].get('preflight_sample', preflight_check.SAMPLE_RECORDS)
+    if sample_records:
+        pairs = [(sample, files.get('R1'), files.get('R2')) for patient_d in input_file_dict.values()
+                 for sample, files in sorted(patient_d.items())]
+        problems = preflight_check.preflight(pairs, int(data['pipelineSettings'].get('cores', 1)), sample_records,
+                                             data['input_data']['out_folder'])
+        if problems:
+            print('The input files have problems, fix them and re-run the pipeline.')
+            quit()
+
     prev_run_dict, log_file = check_for_previous_runs(data['input_data']['out_folder'], input_file_dict)
 
     patient_list = list(input_file_dict.keys())
@@ -795,6 +906,9 @@ def main(config_file, main_pipeline, haplotype):
     pipeline_logging_name = "Pipeline_{}.log".format(timestr)
     pipeline_logging_file = os.path.join(out_dir, pipeline_logging_name)
     logging.basicConfig(filename=pipeline_logging_file, level=logging.DEBUG)
+    stage_metrics_file = os.path.join(out_dir, "Pipeline_{}_stage_metrics.jsonl".format(timestr))
+    stage_summary_file = os.path.join(out_dir, "Pipeline_{}_stage_summary.csv".format(timestr))
+    failure_manifest = os.path.join(out_dir, "Pipeline_{}_failure_manifest.jsonl".format(timestr))
 
     '''
     if len(patient_list) > 1:
@@ -864,22 +978,10 @@ def main(config_file, main_pipeline, haplotype):
                 r1_file_path = input_file_dict[a_patient][a_sample]['R1']
                 r2_file_path = input_file_dict[a_patient][a_sample]['R2']
 
-                if fwd_match_only == "yes":
-                    infast_R1_name = ntpath.basename(r1_file_path)
-                    infast_R2_name = ntpath.basename(r2_file_path)
-
-                    split_by_primers_matchpair(r1_file_path, r2_file_path,
-                                                test_primer_dict, 'fwd', infast_R1_name, infast_R2_name, out_dir,
-                                                a_patient,
-                                                regex_error_rate, make_sure=should_do_blast)
-                else:
-                    infast_name = ntpath.basename(r1_file_path)
-                    split_by_primers(r1_file_path, test_primer_dict, 'fwd',
-                                    infast_name, out_dir, a_patient, regex_error_rate, make_sure=should_do_blast)
-
-                    infast_name = ntpath.basename(r2_file_path)
-                    split_by_primers(r2_file_path, test_primer_dict, 'rev',
-                                    infast_name, out_dir, a_patient, regex_error_rate, make_sure=should_do_blast)
+                with record_stage(stage_metrics_file, a_patient, "all", "demultiplex",
+                                  inputs=[r1_file_path, r2_file_path], sample=a_sample):
+                    demultiplex_pair(r1_file_path, r2_file_path, test_primer_dict, out_dir, a_patient,
+                                     fwd_match_only, regex_error_rate, should_do_blast)
 
         update_complete = update_setuplog('Complete', log_file)
         print('De-multiplex complete: ' + str(update_complete))
@@ -889,47 +991,27 @@ def main(config_file, main_pipeline, haplotype):
 
         import step_2_ngs_processing_pipeline_master_call
 
-        for gene_region, gene_dict in test_primer_dict.items():
-            print("Running pipeline for:", gene_region)
-
-            # don't run if the gene_region is None: sequences that couldn't be assigned to a gene region
-            if gene_region is not None or gene_region != "None":
-                overlap = gene_dict['overlap']
-                if overlap == "no":
-                    nonoverlap = True
-                else:
-                    nonoverlap = False
-
-                for a_patient_entry in patient_list:
-
-                    # Adding the required parameters
-                    path = out_dir + a_patient_entry + '/' + gene_region
-                    sub_region = gene_dict['sub_region']
-                    if not sub_region:
-                        sub_region = False
-                    else:
-                        sub_region = sub_region
-                    user_ref = False
-                    # main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
-                    #      run_only, cores)
-                    # Calling step 2
-                    try:
-                        step_2_ngs_processing_pipeline_master_call.main(path,
-                                                                        data['pipelineSettings']['out_prefix'],
-                                                                        gene_region,
-                                                                        sub_region,
-                                                                        test_primer_dict[gene_region]['fwd_full'],
-                                                                        test_primer_dict[gene_region]['rev_full'],
-                                                                        nonoverlap,
-                                                                        data['pipelineSettings']['min_read_length'],
-                                                                        data['pipelineSettings']['run_step'],
-                                                                        False,
-                                                                        user_ref,
-                                                                        data['pipelineSettings']['cores'])
-                    except Exception as e:
-                        # Todo is this try except actually necessary
-                        print(e)
-                        pass
+        step_2_task_list = step_2_tasks(data, test_primer_dict, patient_list, out_dir)
+        if queue:
+            # leave the step 2 tasks for the workers, eg: on several nodes that share the output folder
+            queue_dir = os.path.join(out_dir, "work_queue")
+            new_tasks = work_queue.enqueue(queue_dir, step_2_task_list)
+            print("{0} step 2 tasks queued in {1}\nStart workers with: python3 demultiplex.py -c {2} --worker".format(
+                new_tasks, queue_dir, config_file))
+            step_2_task_list = []
+            # the alignments are not ready until the workers have finished
+            make_haplotypes = False
+
+        for task in step_2_task_list:
+            print("Running pipeline for:", task["region"])
+            # Calling step 2
+            try:
+                profiling_hooks.run_main(step_2_ngs_processing_pipeline_master_call.main, "step_2",
+                                         "{0}_{1}".format(task["patient"], task["region"]), *task["args"],
+                                         metrics_file=stage_metrics_file, failure_manifest=failure_manifest)
+            except Exception as e:
+                # step 2 records its own failures, this catches anything that escapes it
+                supervisor.record_failure(failure_manifest, task["patient"], task["region"], None, "step_2", repr(e))
 
         if make_haplotypes:
             print("Making haplotypes from alignment")
@@ -941,6 +1023,205 @@ def main(config_file, main_pipeline, haplotype):
                 data['haplotype_settings']['field'],
             )
 
+    if os.path.isfile(failure_manifest):
+        print("Some stages failed, they are listed in: " + failure_manifest)
+
+    # sum the stage timings of this run into one row per patient, region and stage
+    if os.path.isfile(stage_metrics_file):
+        summarise_metrics(stage_metrics_file, stage_summary_file)
+        print("Stage timing summary written to: " + stage_summary_file)
+
+
+def watch(config_file, main_pipeline, haplotype, queue=False):
+    """
+    Watch mode: demultiplex the R1/R2 pairs that land in fastq_dir as sequencing runs are written, then run (or queue)
+    step 2 for the gene regions that got new samples. Step 2 only processes the new files in 0new_data and adds them
+    to the region's outputs, so each region is updated incrementally. Stops after watch_idle minutes without new data,
+    or with ctrl-c when watch_idle is 0
+    :param config_file: (str) the config file for the run in JSON format
+    :param main_pipeline: (bool) True to run step 2 for the new samples
+    :param haplotype: (bool) True to make the haplotypes when the watch stops
+    :param queue: (bool) True to queue the step 2 tasks for workers (demultiplex.py --worker) instead of running them
+    :return: None
+    """
+    with open(config_file) as json_data_file:
+        data = json.load(json_data_file)
+
+    regex_error_rate = data["demiltiplexSettings"]["error_rate"]
+    fwd_match_only = data["demiltiplexSettings"]["fwd_only"]
+    should_do_blast = data["demiltiplexSettings"]["do_blast"] == "yes"
+    interval, settle, idle = run_watcher.watch_settings(data["pipelineSettings"])
+
+    fastq_dir = data['input_data']['fastq_dir']
+    out_dir = data['input_data']['out_folder']
+    if out_dir[-1] != '/':
+        out_dir = out_dir + '/'
+
+    timestr = time.strftime("%Y%m%d-%H%M%S")
+    logging.basicConfig(filename=os.path.join(out_dir, "Pipeline_{}.log".format(timestr)), level=logging.DEBUG)
+    stage_metrics_file = os.path.join(out_dir, "Pipeline_{}_stage_metrics.jsonl".format(timestr))
+    stage_summary_file = os.path.join(out_dir, "Pipeline_{}_stage_summary.csv".format(timestr))
+    failure_manifest = os.path.join(out_dir, "Pipeline_{}_failure_manifest.jsonl".format(timestr))
+
+    primer_dict = add_kmer_keys(make_primer_dict(data['input_data']['primer_csv']))
+    gene_regions = list(primer_dict.keys())
+
+    import step_1_create_folders
+    import step_2_ngs_processing_pipeline_master_call
+
+    # samples demultiplexed by an earlier run are not demultiplexed again
+    prev_run_dict, log_file = check_for_previous_runs(out_dir, {})
+    state = run_watcher.WatchState(os.path.join(out_dir, run_watcher.WATCH_STATE_FILE))
+    for a_patient in prev_run_dict.keys():
+        for a_sample in prev_run_dict[a_patient].values():
+            if a_sample['status'] == 'Complete' and a_sample['R1'] not in state:
+                names = input_file_names(a_sample['R1'])
+                state.add(names[3] if names and names[3] else a_sample['R1'])
+
+    staging_root = os.path.join(out_dir, run_watcher.STAGING_FOLDER)
+    queue_dir = os.path.join(out_dir, "work_queue")
+    snapshots = {}
+    # the 0new_data files of each region when step 2 last ran on it, so a failing sample is not retried every poll
+    attempted = {}
+    # the sizes of the input pairs that failed the preflight check
+    rejected = {}
+    last_new_data = time.time()
+    print("Watching {0} for new samples every {1:.0f} s, stop with ctrl-c".format(fastq_dir, interval))
+
+    try:
+        while True:
+            regions = set()
+            for r1_file, r2_file in run_watcher.stable_pairs(fastq_dir, snapshots, settle):
+                r1_file = os.path.abspath(r1_file)
+                r2_file = os.path.abspath(r2_file)
+                if "None" in r1_file.split("_"):
+                    continue
+                r1_names = input_file_names(r1_file)
+                r2_names = input_file_names(r2_file)
+                if r1_names is None or r2_names is None or (r1_names[3] or r1_file) in state:
+                    continue
+                # a pair with problems is checked again when its files change
+                sizes = (os.path.getsize(r1_file), os.path.getsize(r2_file))
+                if rejected.get(r1_file) == sizes:
+                    continue
+                problems = preflight_check.scan_pair(r1_file, r2_file,
+                                                     data['pipelineSettings'].get('preflight_sample',
+                                                                                  preflight_check.SAMPLE_RECORDS))
+                if problems["problems"]:
+                    rejected[r1_file] = sizes
+                    for problem in problems["problems"]:
+                        print("Skipping {0}: {1}".format(os.path.basename(r1_file), problem))
+                    continue
+                a_patient, a_sample = r1_names[0], r1_names[1]
+                read_files = []
+                for a_file, names in [(r1_file, r1_names), (r2_file, r2_names)]:
+                    if names[3] is not None:
+                        os.rename(a_file, names[3])
+                    read_files.append(names[3] or a_file)
+                print("Demultiplexing new sample: " + a_sample)
+
+                # demultiplex into the staging folder, so step 2 never sees a partly demultiplexed sample
+                shutil.rmtree(staging_root, ignore_errors=True)
+                for gene_region in gene_regions + ['None']:
+                    os.makedirs(os.path.join(staging_root, a_patient, gene_region, "0new_data"))
+                    step_1_create_folders.main(out_dir, gene_region, [a_patient])
+                with record_stage(stage_metrics_file, a_patient, "all", "demultiplex", inputs=read_files,
+                                  sample=a_sample):
+                    demultiplex_pair(read_files[0], read_files[1], primer_dict, staging_root + '/', a_patient,
+                                     fwd_match_only, regex_error_rate, should_do_blast)
+                regions |= run_watcher.commit_staged(staging_root, out_dir)
+                shutil.rmtree(staging_root, ignore_errors=True)
+
+                with open(log_file, 'a') as handle:
+                    handle.write(",".join([a_patient, a_sample, read_files[0], read_files[1], "Complete"]) + "\n")
+                state.add(read_files[0])
+                last_new_data = time.time()
+
+            # and the regions with new files in 0new_data, eg: left there while step 2 was running
+            regions |= run_watcher.new_data_regions(out_dir, snapshots, settle)
+            regions = set(x for x in regions if x[1] != 'None' and
+                          attempted.get(x) != run_watcher.region_signature(out_dir, *x))
+
+            if regions and main_pipeline:
+                patient_list = sorted(set(x[0] for x in regions))
+                # run all the steps on the new samples
+                tasks = [x for x in step_2_tasks(data, primer_dict, patient_list, out_dir, run_step=1)
+                         if (x["patient"], x["region"]) in regions]
+                signatures = dict((x, run_watcher.region_signature(out_dir, *x)) for x in regions)
+                if queue:
+                    queued = work_queue.requeue(queue_dir, tasks)
+                    for task in tasks:
+                        if work_queue.task_id(task["patient"], task["region"], task["stage"]) in queued:
+                            attempted[(task["patient"], task["region"])] = signatures[(task["patient"],
+                                                                                       task["region"])]
+                    print("{0} step 2 tasks queued in {1}".format(len(queued), queue_dir))
+                else:
+                    for task in tasks:
+                        print("Running pipeline for:", task["patient"], task["region"])
+                        attempted[(task["patient"], task["region"])] = signatures[(task["patient"], task["region"])]
+                        try:
+                            profiling_hooks.run_main(step_2_ngs_processing_pipeline_master_call.main, "step_2",
+                                                     "{0}_{1}".format(task["patient"], task["region"]),
+                                                     *task["args"], metrics_file=stage_metrics_file,
+                                                     failure_manifest=failure_manifest)
+                        except Exception as e:
+                            supervisor.record_failure(failure_manifest, task["patient"], task["region"], None,
+                                                      "step_2", repr(e))
+
+            if idle and time.time() - last_new_data > idle * 60:
+                print("No new samples for {0:.0f} minutes, stopping the watch".format(idle))
+                break
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        print("Watch stopped")
+
+    if main_pipeline and haplotype and not queue:
+        print("Making haplotypes from alignment")
+
+        import step_3_make_haplotpes_from_alignment
+
+        step_3_make_haplotpes_from_alignment.main(
+            data['haplotype_settings']['infile'],
+            data['haplotype_settings']['field'],
+        )
+
+    if os.path.isfile(failure_manifest):
+        print("Some stages failed, they are listed in: " + failure_manifest)
+
+    if os.path.isfile(stage_metrics_file):
+        summarise_metrics(stage_metrics_file, stage_summary_file)
+        print("Stage timing summary written to: " + stage_summary_file)
+
+
+def preview(config_file, n_pairs, reservoir=False):
+    """
+    Preview mode: demultiplex n read pairs of each input and run them through step 2 in a separate <out_folder>_preview
+    tree, then report the share of the reads assigned to each gene region and what survives each stage. Checks a new
+    primer panel, reference or config in minutes, before the full run
+    :param config_file: (str) the config file for the run in JSON format
+    :param n_pairs: (int) the number of read pairs to take from each input
+    :param reservoir: (bool) True for a random sample of the read pairs, False for the first n pairs
+    :return: None
+    """
+    start = time.time()
+    preview_config = preview_run.make_preview(config_file, n_pairs, reservoir)
+    preview_folder = os.path.dirname(preview_config)
+
+    # the pipeline runs from its output folder
+    cwd = os.getcwd()
+    os.chdir(preview_folder)
+    try:
+        main(preview_config, True, False)
+    finally:
+        os.chdir(cwd)
+
+    metrics_files = sorted(glob(os.path.join(preview_folder, "Pipeline_*_stage_metrics.jsonl")))
+    if not metrics_files:
+        print("The preview run did not record any stages, check the log in " + preview_folder)
+        return
+    preview_run.survival_report(metrics_files[-1], os.path.join(preview_folder, preview_run.PREVIEW_REPORT))
+    print("Preview of {0} read pairs per input took {1:.1f} minutes".format(n_pairs, (time.time() - start) / 60))
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
@@ -955,10 +1236,45 @@ if __name__ == '__main__':
                         help='Do not run the main pipeline', required=False)
     parser.add_argument('-hap', '--no_haplotype', default=True, action='store_false',
                         help='Do not run the haplotyping pipeline', required=False)
+    parser.add_argument('-q', '--queue', default=False, action='store_true',
+                        help='Demultiplex, then queue the step 2 tasks in <out_folder>/work_queue for workers '
+                             'instead of running them', required=False)
+    parser.add_argument('-w', '--worker', default=False, action='store_true',
+                        help='Run a worker that processes the queued step 2 tasks, start one on each node that '
+                             'shares the output folder', required=False)
+    parser.add_argument('-wa', '--watch', default=False, action='store_true',
+                        help='Watch the fastq_dir for new R1/R2 pairs and process only the new samples, until no new '
+                             'data lands for watch_idle minutes (or ctrl-c)', required=False)
+    parser.add_argument('-p', '--preview', default=0, type=int,
+                        help='Run demultiplexing and step 2 on this many read pairs of each input, in a separate '
+                             '<out_folder>_preview folder, and report the reads assigned to each gene region and '
+                             'what survives each stage', required=False)
+    parser.add_argument('-pr', '--preview_random', default=False, action='store_true',
+                        help='Take a random sample of the read pairs for --preview, instead of the first ones',
+                        required=False)
     args = parser.parse_args()
 
     config_file = args.config_file
     main_pipeline = args.no_main_pipeline
     haplotype = args.no_haplotype
+    queue = args.queue
+    worker = args.worker
+    watch_mode = args.watch
+    preview_pairs = args.preview
+    preview_random = args.preview_random
 
-    main(config_file, main_pipeline, haplotype)
+    with open(config_file) as json_data_file:
+        config_data = json.load(json_data_file)
+    pipeline_settings = config_data.get("pipelineSettings", {})
+    apply_pipeline_settings(pipeline_settings)
+    config_label = os.path.splitext(os.path.basename(config_file))[0]
+
+    if worker:
+        profiling_hooks.run_main(work_queue.run_worker, "worker", config_label,
+                                 os.path.join(config_data['input_data']['out_folder'], "work_queue"))
+    elif preview_pairs:
+        preview(config_file, preview_pairs, preview_random)
+    elif watch_mode:
+        watch(config_file, main_pipeline, haplotype, queue)
+    else:
+        profiling_hooks.run_main(main, "demultiplex", config_label, config_file, main_pipeline, haplotype, queue)
@@ -0,0 +1,220 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import mmap
+import argparse
+import collections
+
+
+__author__ = 'Colin Anthony'
+
+
+# samtools faidx layout: name, sequence length, offset of the first base, bases per line, bytes per line
+FaiEntry = collections.namedtuple("FaiEntry", ["name", "length", "offset", "line_bases", "line_width"])
+INDEX_SUFFIX = ".fai"
+
+
+def index_name(fasta_file):
+    """
+    :param fasta_file: (str) the fasta file
+    :return: (str) its index file
+    """
+    return fasta_file + INDEX_SUFFIX
+
+
+def _write_index(fasta_file, entries):
+    tmp_file = index_name(fasta_file) + ".part"
+    with open(tmp_file, 'w') as handle:
+        for entry in entries:
+            handle.write("{0}\t{1}\t{2}\t{3}\t{4}\n".format(*entry))
+    os.replace(tmp_file, index_name(fasta_file))
+
+
+def build_index(fasta_file):
+    """
+    index a plain fasta file by reading it once, the index is written next to it as <fasta_file>.fai. The name is the
+    whole header line, and all lines of a sequence but the last must have the same length, as for samtools faidx
+    :param fasta_file: (str) the fasta file
+    :return: (list) of FaiEntry
+    """
+    entries = []
+    names = set()
+    current = None
+    offset = 0
+
+    def finish(record):
+        if record is None:
+            return
+        name, length, seq_offset, line_bases, line_width, _ = record
+        if name in names:
+            raise KeyError("Duplicate sequence ids found: {}".format(name))
+        names.add(name)
+        entries.append(FaiEntry(name, length, seq_offset, line_bases, line_width))
+
+    with open(fasta_file, 'rb') as handle:
+        for line in handle:
+            if line.startswith(b">"):
+                finish(current)
+                # name, length, offset, line bases, line width, length of the last line so far
+                current = [line[1:].rstrip(b"\r\n").decode(), 0, offset + len(line), 0, 0, None]
+            elif current is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if current[5] is not None and current[5] != current[3]:
+                    raise ValueError("{0}: the lines of {1} have different lengths".format(fasta_file, current[0]))
+                if current[3] == 0:
+                    current[3] = bases
+                    current[4] = len(line)
+                elif bases > current[3]:
+                    raise ValueError("{0}: the lines of {1} have different lengths".format(fasta_file, current[0]))
+                current[1] += bases
+                current[5] = bases
+            offset += len(line)
+        finish(current)
+
+    _write_index(fasta_file, entries)
+
+    return entries
+
+
+def write_indexed_fasta(fasta_file, records):
+    """
+    write a fasta file with one line per sequence, and its index, without reading the file back
+    :param fasta_file: (str) the fasta file
+    :param records: (iterable) of (name, sequence) tuples
+    :return: (list) of FaiEntry
+    """
+    entries = []
+    offset = 0
+    with open(fasta_file, 'wb') as handle:
+        for name, seq in records:
+            header = ">{}\n".format(name).encode()
+            seq_line = "{}\n".format(seq).encode()
+            handle.write(header)
+            handle.write(seq_line)
+            entries.append(FaiEntry(name, len(seq), offset + len(header), len(seq), len(seq_line)))
+            offset += len(header) + len(seq_line)
+
+    _write_index(fasta_file, entries)
+
+    return entries
+
+
+class FastaIndex(object):
+    """
+    random access to the sequences of a large plain fasta file (eg: an alignment) by name or name prefix, through its
+    .fai index and an mmap of the file, without parsing the rest of the file. The index is built if it is missing or
+    older than the fasta file
+    """
+
+    def __init__(self, fasta_file):
+        """
+        :param fasta_file: (str) the plain fasta file
+        """
+        self.fasta_file = fasta_file
+        fai = index_name(fasta_file)
+        if not os.path.isfile(fai) or os.path.getmtime(fai) < os.path.getmtime(fasta_file):
+            entries = build_index(fasta_file)
+        else:
+            entries = []
+            with open(fai, 'r') as handle:
+                for line in handle:
+                    name, length, offset, line_bases, line_width = line.rstrip("\n").split("\t")
+                    entries.append(FaiEntry(name, int(length), int(offset), int(line_bases), int(line_width)))
+        self.entries = collections.OrderedDict((x.name, x) for x in entries)
+        self._handle = open(fasta_file, 'rb')
+        # an empty file can't be mapped
+        self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ) if self.entries else b""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if isinstance(self._map, mmap.mmap):
+            self._map.close()
+        self._handle.close()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def names(self):
+        """
+        :return: (list) the sequence names, in file order
+        """
+        return list(self.entries)
+
+    def fetch(self, name):
+        """
+        :param name: (str) the sequence name
+        :return: (str) the sequence
+        """
+        entry = self.entries[name]
+        if entry.length == 0:
+            return ""
+        full_lines, last_bases = divmod(entry.length, entry.line_bases)
+        end = entry.offset + full_lines * entry.line_width + last_bases
+        raw = self._map[entry.offset:end]
+        if entry.line_width != entry.line_bases:
+            raw = raw.replace(b"\n", b"").replace(b"\r", b"")
+
+        return raw.decode()
+
+    def fetch_prefix(self, prefix):
+        """
+        :param prefix: (str) a name prefix, eg: the time point fields CAP177_2000_004wpi
+        :return: (generator) of (name, sequence) for the sequences whose name is the prefix or starts with prefix_
+        """
+        for name in self.entries:
+            if name == prefix or name.startswith(prefix + "_"):
+                yield name, self.fetch(name)
+
+    def groups(self, field):
+        """
+        group the sequence names by their first fields, from the index only
+        :param field: (int) the number of "_" separated fields that make up a time point, eg: 4 for
+        CAP177_2000_004wpi_V3C4_GGGACTCTAGTG_28
+        :return: (OrderedDict) key = prefix, value = list of names
+        """
+        groups_d = collections.OrderedDict()
+        for name in self.entries:
+            prefix = "_".join(name.split("_")[0:field])
+            groups_d.setdefault(prefix, []).append(name)
+
+        return groups_d
+
+
+def main(infile, names, prefix):
+
+    with FastaIndex(infile) as index:
+        print("{0} sequences indexed in {1}".format(len(index), index_name(infile)))
+        records = [(x, index.fetch(x)) for x in names] if names else []
+        if prefix:
+            records.extend(index.fetch_prefix(prefix))
+        for name, seq in records:
+            print(">{0}\n{1}".format(name, seq))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Indexes a fasta file (eg: an alignment) as <infile>.fai and prints '
+                                                 'sequences by name or name prefix without reading the whole file',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--infile', default=argparse.SUPPRESS, type=str,
+                        help='The plain fasta file', required=True)
+    parser.add_argument('-n', '--names', default=[], nargs="+", type=str,
+                        help='The names of the sequences to print', required=False)
+    parser.add_argument('-p', '--prefix', default=None, type=str,
+                        help='Print the sequences whose names start with this prefix, eg: CAP177_2000_004wpi',
+                        required=False)
+
+    args = parser.parse_args()
+    infile = args.infile
+    names = args.names
+    prefix = args.prefix
+
+    main(infile, names, prefix)
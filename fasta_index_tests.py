@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+import fasta_index
+import split_fasta_into_subfiles
+from fasta_index import FastaIndex
+from seq_io import py3_fasta_iter
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_index_written_with_the_file_matches_a_built_index(self):
+        fasta = os.path.join(self.tmp_dir, "CAP1_ENV_aligned.fasta")
+        records = [("CAP1_2000_004wpi_V3_AAA_1", "ACGT--ACGT"), ("CAP1_2000_004wpi_V3_CCC_2", "ACGTTTACGT"),
+                   ("CAP1_2000_010wpi_V3_GGG_1", "ACG---ACGT"), ("HXB2_ENV", "ACGTACACGT")]
+        written = fasta_index.write_indexed_fasta(fasta, records)
+        self.assertEqual(fasta_index.build_index(fasta), written)
+
+        with FastaIndex(fasta) as index:
+            self.assertEqual(index.fetch("CAP1_2000_010wpi_V3_GGG_1"), "ACG---ACGT")
+            self.assertEqual([x[0] for x in index.fetch_prefix("CAP1_2000_004wpi")],
+                             ["CAP1_2000_004wpi_V3_AAA_1", "CAP1_2000_004wpi_V3_CCC_2"])
+            self.assertEqual(list(index.groups(3)), ["CAP1_2000_004wpi", "CAP1_2000_010wpi", "HXB2_ENV"])
+
+        split_fasta_into_subfiles.main(fasta, self.tmp_dir, 3)
+        split_file = os.path.join(self.tmp_dir, "CAP1_2000_004wpi_sep.fasta")
+        self.assertEqual(list(py3_fasta_iter(split_file)), records[:2])
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "HXB2_ENV_sep.fasta")))
+
+    def test_wrapped_lines(self):
+        fasta = os.path.join(self.tmp_dir, "wrapped.fasta")
+        with open(fasta, 'w') as handle:
+            handle.write(">a\nACGTA\nCGTAC\nGT\n>b desc\n\n>c\nTTTTT\nTT\n")
+        with FastaIndex(fasta) as index:
+            self.assertEqual(index.names(), ["a", "b desc", "c"])
+            self.assertEqual([index.fetch(x) for x in index.names()], ["ACGTACGTACGT", "", "TTTTTTT"])
+
+        with open(fasta, 'w') as handle:
+            handle.write(">a\nACG\nACGTA\n")
+        with self.assertRaises(ValueError):
+            fasta_index.build_index(fasta)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import errno
+import shutil
+
+
+__author__ = 'Colin Anthony'
+
+
+def move_file(src, dst):
+    """
+    move a file, using a rename when src and dst are on the same file system and a copy + unlink when they are not
+    :param src: (str) path and name of the file to move
+    :param dst: (str) path and name of the destination file (will be replaced if it exists)
+    :return: (str) the destination file
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        # different file systems, copy to a temp file next to dst and then rename into place
+        tmp_dst = dst + ".part"
+        shutil.copyfile(src, tmp_dst)
+        os.replace(tmp_dst, dst)
+        os.unlink(src)
+
+    return dst
+
+
+def link_or_copy(src, dst):
+    """
+    hardlink a file to a new location where the original must stay in place, falls back to a copy if the
+    file system does not support hardlinks or src and dst are on different file systems
+    :param src: (str) path and name of the file to link
+    :param dst: (str) path and name of the new file (will be replaced if it exists)
+    :return: (str) the destination file
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+    return dst
+
+
+# errors that mean the kernel copy is not supported for this pair of files, rather than a real I/O error
+_KERNEL_COPY_ERRORS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+
+def _kernel_copy(in_fd, out_fd, size):
+    """
+    copy up to size bytes from in_fd to the end of out_fd in the kernel, using copy_file_range or sendfile
+    :param in_fd: (int) file descriptor to read from, positioned at the start of the file
+    :param out_fd: (int) file descriptor to write to, positioned at the end of the file
+    :param size: (int) the number of bytes to copy
+    :return: (int) the number of bytes copied, the caller copies any remainder itself
+    """
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        try:
+            while copied < size:
+                sent = os.copy_file_range(in_fd, out_fd, size - copied)
+                if sent == 0:
+                    break
+                copied += sent
+            return copied
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_ERRORS:
+                raise
+
+    if hasattr(os, "sendfile"):
+        try:
+            while copied < size:
+                sent = os.sendfile(out_fd, in_fd, copied, size - copied)
+                if sent == 0:
+                    break
+                copied += sent
+        except OSError as e:
+            if e.errno not in _KERNEL_COPY_ERRORS:
+                raise
+
+    return copied
+
+
+def concatenate_files(infiles, outfile):
+    """
+    concatenate text files (fasta/fastq) into one file, copying file contents in the kernel where possible.
+    A newline is added between files that do not end in one, so records are never joined together
+    :param infiles: (list) of files to concatenate, in order
+    :param outfile: (str) path and name of the concatenated outfile
+    :return: (str) the outfile
+    """
+    tmp_outfile = outfile + ".part"
+    with open(tmp_outfile, 'wb') as out_handle:
+        out_fd = out_handle.fileno()
+        for infile in infiles:
+            size = os.path.getsize(infile)
+            if size == 0:
+                continue
+            with open(infile, 'rb') as in_handle:
+                copied = _kernel_copy(in_handle.fileno(), out_fd, size)
+                if copied < size:
+                    in_handle.seek(copied)
+                    out_handle.seek(0, os.SEEK_END)
+                    shutil.copyfileobj(in_handle, out_handle)
+                    out_handle.flush()
+                in_handle.seek(-1, os.SEEK_END)
+                if in_handle.read(1) != b"\n":
+                    os.write(out_fd, b"\n")
+
+    os.replace(tmp_outfile, outfile)
+
+    return outfile
+
+
+def commit_folder(temp_folder, perm_folder):
+    """
+    commit a step's temp folder to its permanent folder. Files already in the permanent folder that were not
+    replaced by the temp folder are kept, then the folders are swapped so the permanent folder is never half written
+    :param temp_folder: (str) path to the temp folder (removed after the commit)
+    :param perm_folder: (str) path to the permanent folder
+    :return: None
+    """
+    temp_folder = os.path.abspath(temp_folder)
+    perm_folder = os.path.abspath(perm_folder)
+    parent = os.path.dirname(perm_folder)
+    staging_folder = perm_folder + ".commit"
+    old_folder = perm_folder + ".old"
+
+    for folder in [staging_folder, old_folder]:
+        if os.path.isdir(folder):
+            shutil.rmtree(folder)
+
+    # the staging folder has to be on the same file system as the permanent folder for the swap to be atomic
+    if os.stat(temp_folder).st_dev == os.stat(parent).st_dev:
+        os.rename(temp_folder, staging_folder)
+    else:
+        shutil.copytree(temp_folder, staging_folder, symlinks=True)
+        shutil.rmtree(temp_folder)
+
+    # carry over anything in the permanent folder that this step did not replace
+    if os.path.isdir(perm_folder):
+        _merge_missing(perm_folder, staging_folder)
+        os.rename(perm_folder, old_folder)
+    os.rename(staging_folder, perm_folder)
+
+    if os.path.isdir(old_folder):
+        shutil.rmtree(old_folder)
+
+
+def _merge_missing(src_folder, dst_folder):
+    """
+    hardlink entries from src_folder into dst_folder where dst_folder does not already have them
+    :param src_folder: (str) the folder to take entries from
+    :param dst_folder: (str) the folder to add entries to
+    :return: None
+    """
+    for entry in os.listdir(src_folder):
+        src = os.path.join(src_folder, entry)
+        dst = os.path.join(dst_folder, entry)
+        if os.path.isdir(src) and not os.path.islink(src):
+            if not os.path.lexists(dst):
+                os.makedirs(dst)
+            if os.path.isdir(dst):
+                _merge_missing(src, dst)
+        elif not os.path.lexists(dst):
+            link_or_copy(src, dst)
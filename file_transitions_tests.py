@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+from file_transitions import move_file
+from file_transitions import link_or_copy
+from file_transitions import concatenate_files
+from file_transitions import commit_folder
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        file_name = os.path.join(self.tmp_dir, name)
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        with open(file_name, 'w') as handle:
+            handle.write(content)
+        return file_name
+
+    def test_move_file(self):
+        src = self.write("a.fasta", ">a\nACGT\n")
+        dst = os.path.join(self.tmp_dir, "b.fasta")
+        move_file(src, dst)
+        self.assertFalse(os.path.exists(src))
+        with open(dst) as handle:
+            self.assertEqual(handle.read(), ">a\nACGT\n")
+
+    def test_link_or_copy_keeps_source(self):
+        src = self.write("a.fastq", "@a\nACGT\n+\nIIII\n")
+        dst = self.write("b.fastq", "old")
+        link_or_copy(src, dst)
+        self.assertTrue(os.path.exists(src))
+        with open(dst) as handle:
+            self.assertEqual(handle.read(), "@a\nACGT\n+\nIIII\n")
+
+    def test_concatenate_files_adds_missing_newline(self):
+        file_1 = self.write("a.fasta", ">a\nACGT")
+        file_2 = self.write("b.fasta", "")
+        file_3 = self.write("c.fasta", ">c\nTTTT\n")
+        outfile = os.path.join(self.tmp_dir, "all.fasta")
+        concatenate_files([file_1, file_2, file_3], outfile)
+        with open(outfile) as handle:
+            self.assertEqual(handle.read(), ">a\nACGT\n>c\nTTTT\n")
+
+    def test_commit_folder_keeps_existing_files(self):
+        self.write("temp/new.fasta", "new")
+        self.write("temp/binned/s1/s1.csv", "new")
+        self.write("perm/new.fasta", "old")
+        self.write("perm/kept.fasta", "kept")
+        self.write("perm/binned/s2/s2.csv", "kept")
+        temp_folder = os.path.join(self.tmp_dir, "temp")
+        perm_folder = os.path.join(self.tmp_dir, "perm")
+        commit_folder(temp_folder, perm_folder)
+
+        self.assertFalse(os.path.exists(temp_folder))
+        self.assertFalse(os.path.exists(perm_folder + ".old"))
+        with open(os.path.join(perm_folder, "new.fasta")) as handle:
+            self.assertEqual(handle.read(), "new")
+        self.assertTrue(os.path.isfile(os.path.join(perm_folder, "kept.fasta")))
+        self.assertTrue(os.path.isfile(os.path.join(perm_folder, "binned", "s1", "s1.csv")))
+        self.assertTrue(os.path.isfile(os.path.join(perm_folder, "binned", "s2", "s2.csv")))
+
+
+if __name__ == '__main__':
+    unittest.main()
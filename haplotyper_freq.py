@@ -4,27 +4,14 @@ from __future__ import division
 import os
 import collections
 import argparse
-from itertools import groupby
+import profiling_hooks
+from seq_io import py3_fasta_iter
+from fasta_index import FastaIndex
 
 
 __author__ = 'colin'
 
 
-def py3_fasta_iter(fasta_name):
-    """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
-    """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
-
-
 def fasta_to_dct(file_name):
     """
     :param file_name: The fasta formatted file to read from.
@@ -43,19 +30,26 @@ def fasta_to_dct(file_name):
     return dct
 
 
-def hapl_collapse(fastafile, seq_name, outfile):
+def hapl_collapse(fastafile, seq_name, outfile, prefix=None):
     """
     Haplotype a fasta file by collapsing identical sequences into a single sequence with a frequency count.
     :param fastafile: input fasta file
     :param seq_name: (str) prefix for sequence name
     :param outfile: the path to where the outfile is created
+    :param prefix: (str) only collapse the sequences whose names start with this time point prefix, fetched from the
+    index of fastafile (eg: the whole alignment) without reading the other sequences
     :return: dictionary of key = sequence, value  = count of that sequence
     """
 
     # import seqs to dict and get count of each unique sequence
     total = 0
 
-    all_seqs_d = fasta_to_dct(fastafile)
+    if prefix:
+        with FastaIndex(fastafile) as index:
+            all_seqs_d = collections.OrderedDict((name, seq.replace("~", "_"))
+                                                 for name, seq in index.fetch_prefix(prefix) if "HXB2" not in name)
+    else:
+        all_seqs_d = fasta_to_dct(fastafile)
 
     dct = collections.defaultdict(int)
     for name, seq in all_seqs_d.items():
@@ -76,7 +70,7 @@ def hapl_collapse(fastafile, seq_name, outfile):
             handle.write('>{0}\n{1}\n'.format(n, sequence))
 
 
-def main(infile, outpath, field):
+def main(infile, outpath, field, prefix=None):
 
     print("Collapsing to haplotypes on file: \n\t {}".format(infile))
 
@@ -86,14 +80,17 @@ def main(infile, outpath, field):
     # set the outfile name
     name = os.path.split(infile)[-1]
     name = name.replace("_sep.fasta", "_hap.fasta")
-    out = os.path.join(outpath, name)
     infile_name = os.path.split(infile)[-1]
 
     # get prefix for sequence names from infile name
     seq_name = "_".join(infile_name.split("_")[:field])
+    if prefix:
+        name = prefix + "_hap.fasta"
+        seq_name = prefix
+    out = os.path.join(outpath, name)
 
     # run the haplotyping function
-    hapl_collapse(infile, seq_name, out)
+    hapl_collapse(infile, seq_name, out, prefix)
 
 
 if __name__ == "__main__":
@@ -106,10 +103,15 @@ if __name__ == "__main__":
     parser.add_argument('-f', '--field', type=int, default=4, required=False,
                         help="The field that differentiates your samples/time points (use the last field if multiple."
                              "(ie: 4 for 'CAP177_2000_004wpi_V3C4_GGGACTCTAGTG_28, or 2 for SVB008_SP_GGTAGTCTAGTG_231")
+    parser.add_argument('-p', '--prefix', default=None, type=str, required=False,
+                        help="Collapse only the time point with this name prefix (eg: CAP177_2000_004wpi_V3C4), read "
+                             "through the index of the input file, which can then be the whole alignment")
 
     args = parser.parse_args()
     infile = args.infile
     outpath = args.outpath
     field = args.field
+    prefix = args.prefix
 
-    main(infile, outpath, field)
+    sample = prefix or os.path.split(infile)[-1].replace("_sep.fasta", "")
+    profiling_hooks.run_main(main, "haplotype", sample, infile, outpath, field, prefix)
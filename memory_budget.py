@@ -0,0 +1,87 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+from seq_io import file_compression
+from sample_container import block_entry
+from sample_container import is_block_ref
+
+
+__author__ = 'Colin Anthony'
+
+
+# set NGS_PIPELINE_MEMORY_BUDGETS to eg: "clean=2000,align=8000,default=4000" (MB) to have a stage switch to its
+# streaming implementation when its input is estimated not to fit in the budget
+MEMORY_BUDGETS_ENV = "NGS_PIPELINE_MEMORY_BUDGETS"
+# rough peak memory of a stage's in-memory implementation per byte of input file, on top of BASE_MEMORY_MB
+MEMORY_PER_INPUT_BYTE = {"clean": 4, "align": 10}
+BASE_MEMORY_MB = 30
+# rough size of a decompressed fasta file per byte of its gzip or xz file
+COMPRESSION_RATIO = 4
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the per-stage memory budgets for this process and the processes it starts, from the pipelineSettings
+    of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    memory_budgets = pipeline_settings.get("memory_budgets", {})
+    if memory_budgets:
+        os.environ[MEMORY_BUDGETS_ENV] = ",".join("{0}={1}".format(k, v) for k, v in memory_budgets.items())
+
+
+def memory_budgets_from_env():
+    """
+    read the per-stage memory budgets from the environment
+    :return: (dict) key = stage name (or "default"), value = budget in MB
+    """
+    budgets = {}
+    for item in os.environ.get(MEMORY_BUDGETS_ENV, "").split(","):
+        if "=" not in item:
+            continue
+        stage, budget = item.split("=", 1)
+        try:
+            budgets[stage.strip()] = float(budget)
+        except ValueError:
+            print("Ignoring invalid memory budget: {}".format(item))
+
+    return budgets
+
+
+def estimate_memory_mb(stage, input_files):
+    """
+    estimate the peak memory of a stage's in-memory implementation from the size of its input files
+    :param stage: (str) the name of the stage
+    :param input_files: (list) the input files
+    :return: (float) the estimate in MB
+    """
+    input_bytes = sum(os.path.getsize(x) * (COMPRESSION_RATIO if file_compression(x) else 1)
+                      for x in input_files if os.path.isfile(x))
+    for entry in [block_entry(x) for x in input_files if is_block_ref(x)]:
+        input_bytes += entry["raw_length"] if entry else 0
+
+    return BASE_MEMORY_MB + input_bytes * MEMORY_PER_INPUT_BYTE.get(stage, 4) / 1024 / 1024
+
+
+def use_streaming(stage, input_files, memory_budget=None):
+    """
+    decide if a stage should run its streaming implementation, because its input would not fit in its memory budget
+    :param stage: (str) the name of the stage
+    :param input_files: (list) the input files
+    :param memory_budget: (float) the budget in MB, defaults to the stage's entry in NGS_PIPELINE_MEMORY_BUDGETS
+    :return: (bool) True to stream
+    """
+    if memory_budget is None:
+        budgets = memory_budgets_from_env()
+        memory_budget = budgets.get(stage, budgets.get("default"))
+    if not memory_budget:
+        return False
+
+    estimate = estimate_memory_mb(stage, input_files)
+    streaming = estimate > memory_budget
+    print("{0}: estimated memory {1:.0f} MB, budget {2:.0f} MB, running {3}".format(
+        stage, estimate, memory_budget, "streaming" if streaming else "in memory"))
+
+    return streaming
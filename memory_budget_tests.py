@@ -0,0 +1,38 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+from memory_budget import BASE_MEMORY_MB
+from memory_budget import MEMORY_BUDGETS_ENV
+from memory_budget import memory_budgets_from_env
+from memory_budget import use_streaming
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # 1 MB of sequence, estimated at 4 MB for clean and 10 MB for align on top of BASE_MEMORY_MB
+        self.infile = os.path.join(self.tmp_dir, "in.fasta")
+        with open(self.infile, 'w') as handle:
+            handle.write(">s1\n" + "A" * (1024 * 1024 - 4))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_memory_budgets_from_env(self):
+        with mock.patch.dict(os.environ, {MEMORY_BUDGETS_ENV: "clean=2000, align=8000.5,default=x"}):
+            self.assertEqual(memory_budgets_from_env(), {"clean": 2000, "align": 8000.5})
+
+    def test_use_streaming(self):
+        self.assertTrue(use_streaming("align", [self.infile], BASE_MEMORY_MB + 5))
+        self.assertFalse(use_streaming("clean", [self.infile], BASE_MEMORY_MB + 5))
+        with mock.patch.dict(os.environ, {MEMORY_BUDGETS_ENV: "default={}".format(BASE_MEMORY_MB + 5)}):
+            self.assertTrue(use_streaming("align", [self.infile]))
+        with mock.patch.dict(os.environ, {MEMORY_BUDGETS_ENV: ""}):
+            self.assertFalse(use_streaming("align", [self.infile]))
+
+
+if __name__ == '__main__':
+    unittest.main()
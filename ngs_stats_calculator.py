@@ -4,29 +4,22 @@ import os
 import sys
 import argparse
 import collections
+import csv
 from glob import glob
-from itertools import groupby
-import pandas as pd
+import profiling_hooks
+from seq_io import py3_fasta_iter
+from seq_io import plain_name
+from seq_io import record_names
+from sample_container import CONTAINER_SUFFIX
+from sample_container import block_ref
+from run_manifest import RunManifest
+from run_manifest import committed_files
+from run_manifest import MANIFEST_SUFFIX
 
 
 __author__ = 'Colin Anthony'
 
 
-def py3_fasta_iter(fasta_name):
-    """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
-    """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
-
-
 def fasta_to_dct(file_name):
     """
     :param file_name: The fasta formatted file to read from.
@@ -45,6 +38,20 @@ def fasta_to_dct(file_name):
     return dct
 
 
+def count_sequences(file_name, manifest):
+    """
+    :param file_name: (str) the fasta file
+    :param manifest: (RunManifest) the run manifest, or None
+    :return: (str) the number of sequences, counting each name of a collapsed record, as counted by step 2 if the file
+    has not changed since
+    """
+    entry = manifest.lookup(file_name) if manifest is not None else None
+    if entry is not None and entry["records"] is not None:
+        return str(entry["records"])
+
+    return str(sum(len(record_names(x)) for x in fasta_to_dct(file_name).keys()))
+
+
 def main(inpath, outfile):
 
     print("Calculating sequencing depth and yield statistics")
@@ -70,9 +77,24 @@ def main(inpath, outfile):
     binned_folders = os.path.join(inpath, "1consensus", "binned", "*")
     cleaned_files = os.path.join(inpath, "2cleaned", "*_clean.fasta")
     contam_files = os.path.join(inpath, "3contam_removal", "*_good.fasta")
+    # the files and their record counts are read from the run manifest that step 2 wrote, if there is one
+    manifests = glob(os.path.join(inpath, "*" + MANIFEST_SUFFIX))
+    manifest = RunManifest(manifests[0]) if manifests else None
+    registered_consensus = (manifest.files("motifbinner") if manifest else None) or []
+    # the consensus files are in binned/<name>/<name>_buildConsensus/, the samples of earlier runs are found in the
+    # folders they were committed to
+    binned_found = sorted(set(os.path.dirname(os.path.dirname(x)) for x in registered_consensus) |
+                          set(glob(binned_folders)))
+
+    # the files may be blocks of a sample container instead
+    containers = glob(os.path.join(inpath, "*" + CONTAINER_SUFFIX))
+    cleaned_found = committed_files(manifest, "clean", [cleaned_files] + [
+        block_ref(x, "2cleaned/*_clean.fasta") for x in containers], "*_clean.fasta")
+    contam_found = committed_files(manifest, "contam", [contam_files] + [
+        block_ref(x, "3contam_removal/*_good.fasta") for x in containers], "*_good.fasta")
 
     bin_list = ['raw', 'merged', 'consensus']
-    for binned_folder in glob(binned_folders):
+    for binned_folder in binned_found:
         name = os.path.split(binned_folder)[-1]
         all_names[name] = "True"
         raw = os.path.join(binned_folder, "n001_fwd_loadData", "n001_fwd_loadData.csv")
@@ -80,37 +102,36 @@ def main(inpath, outfile):
         consensus = os.path.join(binned_folder, "n023_buildConsensus", "n023_buildConsensus.csv")
         stats_d[name].append(name)
         for index, item in enumerate([raw, merged, consensus]):
-            data = pd.read_csv(item, sep=',', header=0, parse_dates=True, na_values=[' '])
-            df = pd.DataFrame(data)
-            headers = list(df)
-            count = list(df[headers[2]])[0]
+            # the count is in the third column of the first row
+            with open(item, 'r', newline='') as handle:
+                reader = csv.reader(handle)
+                next(reader)
+                count = int(next(reader)[2])
 
             stats_d[name].append(count)
 
     # calculate number of cleaned sequences
-    for cleaned_file in glob(cleaned_files):
-        name = os.path.split(cleaned_file)[-1].replace("_clean.fasta", "")
+    for cleaned_file in cleaned_found:
+        name = plain_name(os.path.split(cleaned_file)[-1]).replace("_clean.fasta", "")
         if name not in all_names.keys():
             print("Can't match name for cleaned file with parent file name")
             print("name", name)
             print("not in", all_names.keys())
             sys.exit()
 
-        clean_d = fasta_to_dct(cleaned_file)
-        total_clean = str(len(clean_d.keys()))
+        total_clean = count_sequences(cleaned_file, manifest)
         stats_d[name].append(total_clean)
 
     # calculate number of sequences after contam removal
-    for contam_file in glob(contam_files):
-        name = os.path.split(contam_file)[-1].replace("_good.fasta", "")
+    for contam_file in contam_found:
+        name = plain_name(os.path.split(contam_file)[-1]).replace("_good.fasta", "")
         if name not in all_names.keys():
             print("Can't match name for no_contam file with parent file name")
             print("name", name)
             print("not in", all_names.keys())
             sys.exit()
 
-        contam_rem_d = fasta_to_dct(contam_file)
-        total_contam_rem = str(len(contam_rem_d.keys()))
+        total_contam_rem = count_sequences(contam_file, manifest)
         stats_d[name].append(total_contam_rem)
 
         # specify target frequency to detect
@@ -160,4 +181,5 @@ if __name__ == "__main__":
     inpath = args.inpath
     outfile = args.outfile
 
-    main(inpath, outfile)
+    stats_name = os.path.split(outfile)[-1].replace("_sequencing_stats.csv", "")
+    profiling_hooks.run_main(main, "stats", stats_name, inpath, outfile)
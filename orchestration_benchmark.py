@@ -0,0 +1,633 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import csv
+import json
+import time
+import glob
+import random
+import shutil
+import argparse
+import tempfile
+import traceback
+from xml.sax.saxutils import escape
+import collections
+
+
+__author__ = 'Colin Anthony'
+
+
+# the stand-ins append one JSON line per call to this file, so their time can be taken off the stage times
+TOOL_LOG_ENV = "NGS_BENCHMARK_TOOL_LOG"
+STAND_IN_TOOLS = ("MotifBinner2.R", "seqmagick", "mafft", "makeblastdb", "blastn")
+# the smallest number of reads with the same PID that the MotifBinner stand-in builds a consensus from
+MIN_BIN_SIZE = 3
+# k-mer length used by the blastn stand-in to pick the best hit
+BLAST_WORD = 8
+IUPAC_FIRST_BASE = {"R": "A", "Y": "C", "M": "A", "K": "G", "S": "C", "W": "A", "H": "A", "B": "C", "V": "A",
+                    "D": "A"}
+COMPLEMENT = str.maketrans("ACGTNacgtn-", "TGCANtgcan-")
+
+STAND_IN_SCRIPT = """#!{python}
+import sys
+import time
+start = time.time()
+sys.path.insert(0, {folder!r})
+from orchestration_benchmark import run_stand_in
+sys.exit(run_stand_in({tool!r}, sys.argv[1:], start))
+"""
+
+
+def reverse_complement(seq):
+    return seq.translate(COMPLEMENT)[::-1]
+
+
+def read_records(file_name):
+    """
+    read a fasta or fastq file, sequences on one or more lines for fasta
+    :param file_name: (str) the fasta or fastq file
+    :return: (list) of (name, sequence) tuples
+    """
+    records = []
+    with open(file_name, 'r') as handle:
+        if file_name.endswith((".fastq", ".fq")):
+            lines = [line.rstrip("\n") for line in handle]
+            for i in range(0, len(lines) - 3, 4):
+                records.append((lines[i][1:], lines[i + 1]))
+            return records
+
+        for line in handle:
+            line = line.strip()
+            if line.startswith(">"):
+                records.append([line[1:], ""])
+            elif records:
+                records[-1][1] += line
+
+    return [tuple(x) for x in records]
+
+
+def write_fasta(records, handle):
+    for name, seq in records:
+        handle.write(">{0}\n{1}\n".format(name, seq))
+
+
+def _options(args):
+    """
+    :param args: (list) command line arguments as --name=value or as -name value pairs and flags
+    :return: (dict) key = option name without dashes, value = its value or True for flags
+    """
+    options = {}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith("--") and "=" in arg:
+            key, value = arg[2:].split("=", 1)
+            options[key] = value
+        elif arg.startswith("-") and i + 1 < len(args) and not args[i + 1].startswith("-"):
+            options[arg.lstrip("-")] = args[i + 1]
+            i += 1
+        elif arg.startswith("-"):
+            options[arg.lstrip("-")] = True
+        i += 1
+
+    return options
+
+
+def _consensus(seqs):
+    """
+    :param seqs: (list) of read sequences
+    :return: (str) the majority base at each position, over the length of the shortest read
+    """
+    length = min(len(x) for x in seqs)
+    return "".join(collections.Counter(x[i] for x in seqs).most_common(1)[0][0] for i in range(length))
+
+
+def _write_report(file_name, step, count):
+    # MotifBinner's per-step reports have the read count in the third column of the first row
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["step", "parameter", "count"])
+        writer.writerow([step, "sequences", count])
+
+
+def motifbinner_stand_in(args):
+    """
+    bin the read pairs by the PID at the start of read 2 and write the majority consensus of read 1 for each bin with
+    at least MIN_BIN_SIZE reads, in MotifBinner2's output layout: <output_dir>/<base>/n023_buildConsensus/
+    <base>_kept_buildConsensus.fastq and the n001, n019 and n023 report csv files
+    """
+    options = _options(args)
+    base = options["base_for_names"]
+    out_folder = os.path.join(options["output_dir"], base)
+    fwd_trim = sum(int(x) for x in options["fwd_primer_lens"].split(","))
+    pid_len = sum(int(x) for x in options["rev_primer_lens"].split(",")[:2])
+
+    fwd_reads = read_records(options["fwd_file"])
+    rev_reads = read_records(options["rev_file"])
+    bins = collections.OrderedDict()
+    for (_, fwd_seq), (_, rev_seq) in zip(fwd_reads, rev_reads):
+        bins.setdefault(rev_seq[:pid_len], []).append(fwd_seq[fwd_trim:])
+
+    consensus_folder = os.path.join(out_folder, "n023_buildConsensus")
+    os.makedirs(consensus_folder, exist_ok=True)
+    kept = 0
+    with open(os.path.join(consensus_folder, base + "_kept_buildConsensus.fastq"), 'w') as handle:
+        for pid, seqs in bins.items():
+            if len(seqs) < MIN_BIN_SIZE:
+                continue
+            kept += 1
+            seq = _consensus(seqs)
+            handle.write("@{0}_{1}_{2}\n{3}\n+\n{4}\n".format(base, pid, len(seqs), seq, "I" * len(seq)))
+
+    _write_report(os.path.join(out_folder, "n001_fwd_loadData", "n001_fwd_loadData.csv"), "n001_fwd_loadData",
+                  len(fwd_reads))
+    _write_report(os.path.join(out_folder, "n019_mergePEAR", "n019_mergePEAR.csv"), "n019_mergePEAR",
+                  min(len(fwd_reads), len(rev_reads)))
+    _write_report(os.path.join(out_folder, "n023_buildConsensus", "n023_buildConsensus.csv"), "n023_buildConsensus",
+                  kept)
+
+    return "motifbinner"
+
+
+def seqmagick_stand_in(args):
+    """
+    seqmagick convert [--reverse-complement] <infile> <outfile>, written as fasta
+    """
+    rev_comp = "--reverse-complement" in args
+    infile, outfile = [x for x in args if not x.startswith("-")][-2:]
+    records = read_records(infile)
+    if rev_comp:
+        records = [(name, reverse_complement(seq)) for name, seq in records]
+    with open(outfile, 'w') as handle:
+        write_fasta(records, handle)
+
+    return "reverse_complement" if rev_comp else "fastq_to_fasta"
+
+
+def mafft_stand_in(args):
+    """
+    mafft [options] <infile>, the sequences are padded with gaps to the same length and written to stdout
+    """
+    records = read_records(args[-1])
+    length = max(len(seq) for _, seq in records) if records else 0
+    write_fasta([(name, seq.ljust(length, "-")) for name, seq in records], sys.stdout)
+
+    return "align"
+
+
+def makeblastdb_stand_in(args):
+    """
+    makeblastdb -in <fasta> -out <db>, the stand-in database is a copy of the fasta file
+    """
+    options = _options(args)
+    shutil.copyfile(options["in"], options["out"] + ".standin.fasta")
+
+    return "demultiplex"
+
+
+def _kmers(seq):
+    return set(seq[i:i + BLAST_WORD] for i in range(len(seq) - BLAST_WORD + 1))
+
+
+def best_hits(queries, subjects):
+    """
+    :param queries: (list) of (name, sequence) tuples
+    :param subjects: (list) of (name, sequence) tuples
+    :return: (list) of (query name, query sequence, best subject name or None, shared k-mers)
+    """
+    subject_kmers = [(name, _kmers(seq.replace("-", "").upper())) for name, seq in subjects]
+    hits = []
+    for name, seq in queries:
+        query_kmers = _kmers(seq.upper())
+        best, shared = None, 0
+        for subject, kmers in subject_kmers:
+            n = len(query_kmers & kmers)
+            if n > shared:
+                best, shared = subject, n
+        hits.append((name, seq, best, shared))
+
+    return hits
+
+
+def _blast_xml(hits, handle):
+    handle.write('<?xml version="1.0"?>\n<BlastOutput>\n'
+                 '  <BlastOutput_program>blastn</BlastOutput_program>\n'
+                 '  <BlastOutput_version>BLASTN 2.9.0+</BlastOutput_version>\n'
+                 '  <BlastOutput_reference>stand-in</BlastOutput_reference>\n'
+                 '  <BlastOutput_db>lanl_hiv_db</BlastOutput_db>\n'
+                 '  <BlastOutput_query-ID>Query_1</BlastOutput_query-ID>\n'
+                 '  <BlastOutput_query-def>{0}</BlastOutput_query-def>\n'
+                 '  <BlastOutput_query-len>{1}</BlastOutput_query-len>\n'
+                 '  <BlastOutput_param><Parameters><Parameters_expect>1e-06</Parameters_expect>'
+                 '<Parameters_sc-match>1</Parameters_sc-match><Parameters_sc-mismatch>-2</Parameters_sc-mismatch>'
+                 '<Parameters_gap-open>0</Parameters_gap-open><Parameters_gap-extend>0</Parameters_gap-extend>'
+                 '<Parameters_filter>L;m;</Parameters_filter></Parameters></BlastOutput_param>\n'
+                 '  <BlastOutput_iterations>\n'.format(escape(hits[0][0]) if hits else "",
+                                                        len(hits[0][1]) if hits else 0))
+    for i, (name, seq, subject, shared) in enumerate(hits, 1):
+        handle.write('    <Iteration>\n      <Iteration_iter-num>{0}</Iteration_iter-num>\n'
+                     '      <Iteration_query-ID>Query_{0}</Iteration_query-ID>\n'
+                     '      <Iteration_query-def>{1}</Iteration_query-def>\n'
+                     '      <Iteration_query-len>{2}</Iteration_query-len>\n'
+                     '      <Iteration_hits>\n'.format(i, escape(name), len(seq)))
+        if subject:
+            handle.write('        <Hit>\n          <Hit_num>1</Hit_num>\n          <Hit_id>{0}</Hit_id>\n'
+                         '          <Hit_def>stand-in</Hit_def>\n          <Hit_accession>{0}</Hit_accession>\n'
+                         '          <Hit_len>{1}</Hit_len>\n          <Hit_hsps>\n            <Hsp>\n'
+                         '              <Hsp_num>1</Hsp_num>\n              <Hsp_bit-score>{2}</Hsp_bit-score>\n'
+                         '              <Hsp_score>{3}</Hsp_score>\n              <Hsp_evalue>0</Hsp_evalue>\n'
+                         '              <Hsp_query-from>1</Hsp_query-from>\n'
+                         '              <Hsp_query-to>{1}</Hsp_query-to>\n'
+                         '              <Hsp_hit-from>1</Hsp_hit-from>\n              <Hsp_hit-to>{1}</Hsp_hit-to>\n'
+                         '              <Hsp_query-frame>1</Hsp_query-frame>\n'
+                         '              <Hsp_hit-frame>1</Hsp_hit-frame>\n'
+                         '              <Hsp_identity>{1}</Hsp_identity>\n'
+                         '              <Hsp_positive>{1}</Hsp_positive>\n              <Hsp_gaps>0</Hsp_gaps>\n'
+                         '              <Hsp_align-len>{1}</Hsp_align-len>\n'
+                         '              <Hsp_qseq>{4}</Hsp_qseq>\n              <Hsp_hseq>{4}</Hsp_hseq>\n'
+                         '              <Hsp_midline>{5}</Hsp_midline>\n'
+                         '            </Hsp>\n          </Hit_hsps>\n        </Hit>\n'
+                         .format(subject, len(seq), float(shared), shared, seq, "|" * len(seq)))
+        handle.write('      </Iteration_hits>\n      <Iteration_stat><Statistics><Statistics_db-num>0'
+                     '</Statistics_db-num><Statistics_db-len>0</Statistics_db-len><Statistics_hsp-len>0'
+                     '</Statistics_hsp-len><Statistics_eff-space>0</Statistics_eff-space><Statistics_kappa>0.41'
+                     '</Statistics_kappa><Statistics_lambda>0.625</Statistics_lambda><Statistics_entropy>0.78'
+                     '</Statistics_entropy></Statistics></Iteration_stat>\n    </Iteration>\n')
+    handle.write('  </BlastOutput_iterations>\n</BlastOutput>\n')
+
+
+def blastn_stand_in(args):
+    """
+    blastn -query <fasta> -db <db> -outfmt 5|7 [-out <file>], each query gets the subject it shares the most k-mers
+    with as its only hit. The contam check's lanl_hiv_db is stood in for by the pipeline's reference sequences, a
+    database made by the makeblastdb stand-in by its fasta copy
+    """
+    options = _options(args)
+    db_fasta = options["db"] + ".standin.fasta"
+    if not os.path.isfile(db_fasta):
+        script_folder = os.path.split(os.path.abspath(os.path.realpath(__file__)))[0]
+        db_fasta = os.path.join(script_folder, "reference_sequences.fasta")
+    hits = best_hits(read_records(options["query"]), read_records(db_fasta))
+
+    handle = open(options["out"], 'w') if "out" in options else sys.stdout
+    try:
+        if str(options.get("outfmt")) == "5":
+            _blast_xml(hits, handle)
+            return "contam"
+        handle.write("# BLASTN 2.9.0+ stand-in\n# Fields: query id, subject id, % identity, alignment length, "
+                     "mismatches, gap opens, q. start, q. end, s. start, s. end, evalue, bit score\n")
+        for name, seq, subject, shared in hits:
+            if subject:
+                handle.write("\t".join([name.split(" ")[0], subject, "100.00", str(len(seq)), "0", "0", "1",
+                                        str(len(seq)), "1", str(len(seq)), "0.0", str(float(shared))]) + "\n")
+    finally:
+        if handle is not sys.stdout:
+            handle.close()
+
+    return "demultiplex"
+
+
+STAND_INS = {"MotifBinner2.R": motifbinner_stand_in,
+             "seqmagick": seqmagick_stand_in,
+             "mafft": mafft_stand_in,
+             "makeblastdb": makeblastdb_stand_in,
+             "blastn": blastn_stand_in}
+
+
+def run_stand_in(tool, args, start=None):
+    """
+    run a stand-in tool and log its time to the file in NGS_BENCHMARK_TOOL_LOG
+    :param tool: (str) the tool name
+    :param args: (list) the tool's command line arguments
+    :param start: (float) the epoch time the stand-in process started
+    :return: (int) the exit code
+    """
+    start = start or time.time()
+    try:
+        stage = STAND_INS[tool](args)
+        returncode = 0
+    except Exception:
+        traceback.print_exc()
+        stage = None
+        returncode = 1
+    tool_log = os.environ.get(TOOL_LOG_ENV)
+    if tool_log:
+        entry = {"tool": tool, "stage": stage, "start": start, "end": time.time(), "returncode": returncode}
+        with open(tool_log, 'a') as handle:
+            handle.write(json.dumps(entry) + "\n")
+
+    return returncode
+
+
+def write_stand_ins(bin_folder):
+    """
+    write an executable stand-in for each external tool, put bin_folder first on the PATH to use them
+    :param bin_folder: (str) the folder for the stand-ins
+    :return: (list) the stand-in files
+    """
+    script_folder = os.path.split(os.path.abspath(os.path.realpath(__file__)))[0]
+    os.makedirs(bin_folder, exist_ok=True)
+    files = []
+    for tool in STAND_IN_TOOLS:
+        file_name = os.path.join(bin_folder, tool)
+        with open(file_name, 'w') as handle:
+            handle.write(STAND_IN_SCRIPT.format(python=sys.executable, folder=script_folder, tool=tool))
+        os.chmod(file_name, 0o755)
+        files.append(file_name)
+
+    return files
+
+
+def _resolve_primer(primer, rng):
+    """
+    :return: (str) a primer sequence with the wobble bases resolved and the N's (PIDs) filled with random bases
+    """
+    return "".join(rng.choice("ACGT") if x == "N" else IUPAC_FIRST_BASE.get(x, x) for x in primer.upper())
+
+
+def _mutate(seq, rate, rng):
+    seq = list(seq)
+    for i in range(len(seq)):
+        if rng.random() < rate:
+            seq[i] = rng.choice([x for x in "ACGT" if x != seq[i]])
+
+    return "".join(seq)
+
+
+def region_templates(primer_rows, script_folder):
+    """
+    cut a template for each gene region from the CONSENSUS_C reference, at the sub region's coordinates if it has them
+    :param primer_rows: (list) of primer file rows (dicts)
+    :param script_folder: (str) the folder with the reference files
+    :return: (dict) key = gene region, value = template sequence
+    """
+    references = {name: seq.replace("-", "") for name, seq in
+                  read_records(os.path.join(script_folder, "reference_sequences.fasta"))}
+    with open(os.path.join(script_folder, "gene_sub_regions_start_end.csv"), 'r', newline='') as handle:
+        coordinates = {(row["gene"], row["sub_region"]): (int(row["ref_start"]), int(row["ref_end"]))
+                       for row in csv.DictReader(handle) if row["reference_type"] == "CONSENSUS_C"}
+
+    templates = collections.OrderedDict()
+    for row in primer_rows:
+        gene = row["name"].upper().split("_")[0]
+        reference = references["CONSENSUS_C_" + gene]
+        # the coordinates are in codons
+        start, end = coordinates.get((gene, row["sub_region"].strip()), (0, 100))
+        templates[row["name"]] = reference[start * 3:end * 3]
+
+    return templates
+
+
+def make_dataset(work_folder, patients=2, regions=2, families=20, reads_per_family=5, read_length=300,
+                 error_rate=0.002, seed=1, daemon_socket=""):
+    """
+    write a synthetic multiplexed run: an R1 and R2 fastq file per patient with reads from each gene region (and a few
+    unassignable reads), a primer file for the regions and a config file for demultiplex.py
+    :param work_folder: (str) the folder for the fastq_dir, out_folder, primer file and config
+    :param patients: (int) the number of patients
+    :param regions: (int) the number of gene regions, taken from the template primer file
+    :param families: (int) the number of PID families per patient and region
+    :param reads_per_family: (int) the number of read pairs per PID family
+    :param read_length: (int) the read length
+    :param error_rate: (float) the per-base sequencing error rate
+    :param seed: (int) the random seed, the same seed gives the same dataset
+    :param daemon_socket: (str) the daemon_socket setting for the config
+    :return: (str) the config file
+    """
+    script_folder = os.path.split(os.path.abspath(os.path.realpath(__file__)))[0]
+    rng = random.Random(seed)
+    with open(os.path.join(script_folder, "template_master_primer_file.csv"), 'r', newline='') as handle:
+        reader = csv.reader(handle)
+        header = [x.strip() for x in next(reader)]
+        rows = [collections.OrderedDict(zip(header, row)) for row in reader]
+    # overlapping regions first, step 2 merges their reads into one alignment
+    rows.sort(key=lambda row: row["overlapping"] != "yes")
+    if regions > len(rows):
+        raise ValueError("The template primer file only has {} gene regions".format(len(rows)))
+    rows = rows[:regions]
+    templates = region_templates(rows, script_folder)
+
+    fastq_dir = os.path.join(work_folder, "fastq")
+    out_folder = os.path.join(work_folder, "output")
+    os.makedirs(fastq_dir, exist_ok=True)
+    os.makedirs(out_folder, exist_ok=True)
+    primer_file = os.path.join(work_folder, "primers.csv")
+    with open(primer_file, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(list(row.values()))
+
+    patient_list = ["BENCH{:03d}".format(i + 1) for i in range(patients)]
+    for patient in patient_list:
+        pairs = []
+        for row in rows:
+            fwd_pre = int(row["fwd_PID_len"])
+            rev_pre = int(row["rev_pid"])
+            fwd_primer = row["fwd_sequence"].replace(" ", "")
+            rev_primer = row["rev_sequence"].replace(" ", "")
+            # each patient has its own variant of the region and each PID family its own variant of that
+            patient_template = _mutate(templates[row["name"]], 0.01, rng)
+            for _ in range(families):
+                family = _mutate(patient_template, 0.003, rng)
+                pid = _resolve_primer("N" * rev_pre, rng)
+                for _ in range(reads_per_family):
+                    fwd = _resolve_primer(fwd_primer[:fwd_pre], rng) + _resolve_primer(fwd_primer[fwd_pre:], rng)
+                    rev = pid + _resolve_primer(rev_primer[rev_pre:], rng)
+                    fwd += _mutate(family, error_rate, rng)
+                    rev += _mutate(reverse_complement(family), error_rate, rng)
+                    pairs.append((fwd[:read_length], rev[:read_length]))
+        # reads that don't match a primer go to the None folder
+        for _ in range(max(1, len(pairs) // 50)):
+            pairs.append(tuple("".join(rng.choice("ACGT") for _ in range(read_length)) for _ in range(2)))
+        rng.shuffle(pairs)
+
+        for read, index in [("R1", 0), ("R2", 1)]:
+            # named like the sequencer's files, demultiplex.py renames them to <patient>_multiplex_R1.fastq
+            file_name = os.path.join(fastq_dir, "{0}_multiplex_S1_L001_{1}_001.fastq".format(patient, read))
+            with open(file_name, 'w') as handle:
+                for i, pair in enumerate(pairs):
+                    seq = pair[index]
+                    handle.write("@{0}:{1} {2}\n{3}\n+\n{4}\n".format(patient, i, read[1], seq, "I" * len(seq)))
+
+    with open(os.path.join(script_folder, "template_demultiplex_config.json"), 'r') as handle:
+        config = json.load(handle)
+    config["input_data"].update({"fastq_dir": fastq_dir, "primer_csv": primer_file, "patient_list": patient_list,
+                                 "out_folder": out_folder})
+    # the stand-ins don't fail for reasons a retry could fix
+    config["pipelineSettings"].update({"out_prefix": "BENCH", "min_read_length": 100, "run_step": 1,
+                                       "max_retries": 0, "retry_backoff": 0, "daemon_socket": daemon_socket})
+    from resource_manager import machine_cores
+    config["pipelineSettings"]["cores"] = machine_cores()
+    config_file = os.path.join(work_folder, "benchmark_config.json")
+    with open(config_file, 'w') as handle:
+        json.dump(config, handle, indent=2)
+
+    return config_file
+
+
+def busy_seconds(intervals):
+    """
+    :param intervals: (list) of (start, end) times
+    :return: (float) the time covered by at least one interval, so concurrent tool calls are not counted twice
+    """
+    busy = 0
+    current_start, current_end = None, None
+    for start, end in sorted(intervals):
+        if current_end is None or start > current_end:
+            if current_end is not None:
+                busy += current_end - current_start
+            current_start, current_end = start, end
+        else:
+            current_end = max(current_end, end)
+    if current_end is not None:
+        busy += current_end - current_start
+
+    return busy
+
+
+def stage_overhead(metrics_file, tool_log):
+    """
+    take the time spent in the stand-in tools off the wall time of each stage, what is left is the pipeline's own
+    overhead: starting the scripts, staging and committing files, parsing and the stand-in process startup
+    :param metrics_file: (str) the run's stage metrics JSON-lines file
+    :param tool_log: (str) the stand-ins' JSON-lines log
+    :return: (dict) key = stage, value = dict of calls, wall_s, cpu_s, tool_s, overhead_s and overhead_ms_per_call
+    """
+    report = collections.OrderedDict()
+    with open(metrics_file, 'r') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            row = report.setdefault(record["stage"], collections.OrderedDict([("calls", 0), ("wall_s", 0),
+                                                                               ("cpu_s", 0), ("tool_s", 0)]))
+            row["calls"] += 1
+            row["wall_s"] += record.get("wall_s", 0)
+            row["cpu_s"] += record.get("cpu_s", 0)
+
+    intervals = collections.defaultdict(list)
+    if os.path.isfile(tool_log):
+        with open(tool_log, 'r') as handle:
+            for line in handle:
+                if line.strip():
+                    entry = json.loads(line)
+                    intervals[entry["stage"]].append((entry["start"], entry["end"]))
+
+    for stage, row in report.items():
+        row["tool_s"] = busy_seconds(intervals.get(stage, []))
+        row["overhead_s"] = max(0, row["wall_s"] - row["tool_s"])
+        row["overhead_ms_per_call"] = row["overhead_s"] * 1000 / row["calls"]
+
+    return report
+
+
+def run_pipeline(config_file, out_folder):
+    """
+    run demultiplex.main on the config, from the output folder as the pipeline expects
+    :return: (str) the run's stage metrics file
+    """
+    import demultiplex
+    from run_settings import apply_pipeline_settings
+
+    with open(config_file) as handle:
+        pipeline_settings = json.load(handle)["pipelineSettings"]
+    apply_pipeline_settings(pipeline_settings)
+
+    cwd = os.getcwd()
+    os.chdir(out_folder)
+    try:
+        demultiplex.main(config_file, True, False)
+    finally:
+        os.chdir(cwd)
+
+    metrics_files = sorted(glob.glob(os.path.join(out_folder, "Pipeline_*_stage_metrics.jsonl")))
+    if not metrics_files:
+        sys.exit("The pipeline run did not write a stage metrics file")
+
+    return metrics_files[-1]
+
+
+def main(work_folder, patients, regions, families, reads_per_family, seed, daemon_socket, outfile, keep):
+
+    # a work folder given by the user is always kept
+    keep = keep or bool(work_folder)
+    work_folder = os.path.abspath(work_folder) if work_folder else tempfile.mkdtemp(prefix="ngs_benchmark_")
+    os.makedirs(work_folder, exist_ok=True)
+    try:
+        bin_folder = os.path.join(work_folder, "bin")
+        write_stand_ins(bin_folder)
+        os.environ["PATH"] = bin_folder + os.pathsep + os.environ.get("PATH", "")
+        tool_log = os.path.join(work_folder, "stand_in_tools.jsonl")
+        os.environ[TOOL_LOG_ENV] = tool_log
+
+        config_file = make_dataset(work_folder, patients, regions, families, reads_per_family, seed=seed,
+                                   daemon_socket=daemon_socket)
+        print("Synthetic run: {0} patients x {1} regions x {2} PID families x {3} reads in {4}".format(
+            patients, regions, families, reads_per_family, work_folder))
+
+        start = time.perf_counter()
+        metrics_file = run_pipeline(config_file, os.path.join(work_folder, "output"))
+        total = time.perf_counter() - start
+        report = stage_overhead(metrics_file, tool_log)
+
+        headers = ["stage", "calls", "wall_s", "cpu_s", "tool_s", "overhead_s", "overhead_ms_per_call"]
+        print("{0:<20}{1:>7}{2:>10}{3:>10}{4:>10}{5:>12}{6:>14}".format(*headers[:6] + ["ms/call"]))
+        for stage, row in report.items():
+            print("{0:<20}{1:>7}{2:>10.2f}{3:>10.2f}{4:>10.2f}{5:>12.2f}{6:>14.1f}".format(
+                stage, *[row[x] for x in headers[1:]]))
+        print("Total run time {0:.2f} s, overhead {1:.2f} s".format(
+            total, sum(row["overhead_s"] for row in report.values())))
+
+        if outfile:
+            with open(outfile, 'w', newline='') as handle:
+                writer = csv.writer(handle)
+                writer.writerow(headers)
+                for stage, row in report.items():
+                    writer.writerow([stage] + [round(row[x], 3) for x in headers[1:]])
+            print("Stage overhead written to: " + outfile)
+    finally:
+        if not keep:
+            shutil.rmtree(work_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs demultiplex.py end to end on a synthetic dataset, with '
+                                                 'deterministic local stand-ins for MotifBinner2.R, seqmagick, mafft, '
+                                                 'makeblastdb and blastn, and reports the time each stage spends '
+                                                 'outside the tools: the pipeline\'s own overhead',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-w', '--work_folder', default=None, type=str,
+                        help='The folder for the dataset and the run, a temp folder if not set', required=False)
+    parser.add_argument('-p', '--patients', default=2, type=int,
+                        help='The number of patients', required=False)
+    parser.add_argument('-g', '--regions', default=2, type=int,
+                        help='The number of gene regions', required=False)
+    parser.add_argument('-f', '--families', default=20, type=int,
+                        help='The number of PID families per patient and region', required=False)
+    parser.add_argument('-r', '--reads_per_family', default=5, type=int,
+                        help='The number of read pairs per PID family', required=False)
+    parser.add_argument('-s', '--seed', default=1, type=int,
+                        help='The random seed for the dataset', required=False)
+    parser.add_argument('-d', '--daemon_socket', default="", type=str,
+                        help='Run the python scripts in this pipeline daemon', required=False)
+    parser.add_argument('-o', '--outfile', default=None, type=str,
+                        help='The path and name for a csv table of the stage overheads', required=False)
+    parser.add_argument('-k', '--keep', default=False, action='store_true',
+                        help='Keep the temp work folder', required=False)
+
+    args = parser.parse_args()
+    work_folder = args.work_folder
+    patients = args.patients
+    regions = args.regions
+    families = args.families
+    reads_per_family = args.reads_per_family
+    seed = args.seed
+    daemon_socket = args.daemon_socket
+    outfile = args.outfile
+    keep = args.keep
+
+    main(work_folder, patients, regions, families, reads_per_family, seed, daemon_socket, outfile, keep)
@@ -0,0 +1,75 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import orchestration_benchmark
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_dataset_is_deterministic(self):
+        contents = []
+        for name in ["a", "b"]:
+            work_folder = os.path.join(self.tmp_dir, name)
+            orchestration_benchmark.make_dataset(work_folder, patients=2, regions=2, families=3, reads_per_family=3)
+            fastq_dir = os.path.join(work_folder, "fastq")
+            files = sorted(os.listdir(fastq_dir))
+            with open(os.path.join(fastq_dir, files[0])) as handle:
+                contents.append((files, handle.read()))
+        self.assertEqual(len(contents[0][0]), 4)
+        self.assertEqual(contents[0], contents[1])
+
+    def test_motifbinner_stand_in_output_layout(self):
+        work_folder = os.path.join(self.tmp_dir, "run")
+        orchestration_benchmark.make_dataset(work_folder, patients=1, regions=1, families=4, reads_per_family=3)
+        r1 = os.path.join(work_folder, "fastq", "BENCH001_multiplex_S1_L001_R1_001.fastq")
+        out_folder = os.path.join(self.tmp_dir, "binned")
+        args = ["--fwd_file=" + r1, "--rev_file=" + r1.replace("_R1_", "_R2_"), "--output_dir=" + out_folder,
+                "--base_for_names=S1", "--fwd_primer_lens=1,3,24", "--rev_primer_lens=1,10,23"]
+        self.assertEqual(orchestration_benchmark.run_stand_in("MotifBinner2.R", args), 0)
+        consensus = os.path.join(out_folder, "S1", "n023_buildConsensus", "S1_kept_buildConsensus.fastq")
+        self.assertEqual(len(orchestration_benchmark.read_records(consensus)), 4)
+        with open(os.path.join(out_folder, "S1", "n023_buildConsensus", "n023_buildConsensus.csv")) as handle:
+            self.assertEqual(handle.read().splitlines()[1].split(",")[2], "4")
+
+    def test_blastn_stand_in_finds_the_primer(self):
+        db_fasta = os.path.join(self.tmp_dir, "primerList.fasta")
+        query = os.path.join(self.tmp_dir, "temp.fa")
+        with open(db_fasta, 'w') as handle:
+            handle.write(">GAG_P17\nATGGGTGCGAGAGCGTCAGTATTA\n>POL_PRO\nAGCAGAGAGCTTCAGGTTCG\n")
+        with open(query, 'w') as handle:
+            handle.write(">temp_fasta_file\nTTAGCAGAGAGCTTCAGGTT\n")
+        db = os.path.join(self.tmp_dir, "primers_BlastDB")
+        orchestration_benchmark.run_stand_in("makeblastdb", ["-in", db_fasta, "-out", db, "-dbtype", "nucl"])
+        out = os.path.join(self.tmp_dir, "temp_blast.txt")
+        orchestration_benchmark.run_stand_in("blastn", ["-db", db, "-query", query, "-outfmt", "7", "-out", out])
+        with open(out) as handle:
+            hits = [line.split("\t") for line in handle if not line.startswith("#")]
+        self.assertEqual(hits[0][1], "POL_PRO")
+
+    def test_overhead_does_not_count_concurrent_tools_twice(self):
+        self.assertEqual(orchestration_benchmark.busy_seconds([(0, 2), (1, 3), (5, 6)]), 4)
+        metrics_file = os.path.join(self.tmp_dir, "metrics.jsonl")
+        tool_log = os.path.join(self.tmp_dir, "tools.jsonl")
+        with open(metrics_file, 'w') as handle:
+            for wall_s in [3.0, 2.0]:
+                handle.write(json.dumps({"stage": "contam", "wall_s": wall_s, "cpu_s": 1.0}) + "\n")
+        with open(tool_log, 'w') as handle:
+            for start, end in [(10, 12), (11, 13)]:
+                handle.write(json.dumps({"tool": "blastn", "stage": "contam", "start": start, "end": end}) + "\n")
+        row = orchestration_benchmark.stage_overhead(metrics_file, tool_log)["contam"]
+        self.assertEqual(row["calls"], 2)
+        self.assertEqual(row["tool_s"], 3)
+        self.assertEqual(row["overhead_s"], 2)
+        self.assertEqual(row["overhead_ms_per_call"], 1000)
+
+
+if __name__ == '__main__':
+    unittest.main()
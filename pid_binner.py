@@ -0,0 +1,410 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import csv
+import argparse
+import collections
+from call_motifbinner import get_primer_lens_score
+from subsample_reads import paired_records
+from subsample_reads import family_hash
+
+
+__author__ = 'Colin Anthony'
+
+
+# set NGS_PIPELINE_BINNER to pid_binner to bin the reads with pid_binner.py instead of MotifBinner2
+BINNER_ENV = "NGS_PIPELINE_BINNER"
+# the script step 2 runs for each binning engine, and the tool its jobs are granted cores as
+BINNERS = {"motifbinner": ("call_motifbinner.py", "MotifBinner2.R"), "pid_binner": ("pid_binner.py", "pid_binner")}
+# bins with fewer reads are not given a consensus
+MIN_BIN_SIZE = 3
+# a bin whose primer ID is one mismatch from a bin at least this many times bigger is taken to be reads of that bin
+# with a sequencing error in the primer ID, and is dropped
+OFFSPRING_RATIO = 10
+# the shortest overlap of the read 1 and read 2 consensus sequences that they are merged on, and the largest share of
+# mismatches in the overlap
+MIN_OVERLAP = 20
+MAX_OVERLAP_MISMATCH = 0.1
+# the highest consensus base quality
+MAX_QUALITY = 41
+# bit masks of the IUPAC codes, a read base matches a primer base if they share a bit
+IUPAC = {"A": 1, "C": 2, "G": 4, "T": 8, "R": 5, "Y": 10, "S": 6, "W": 9, "K": 12, "M": 3, "B": 14, "D": 13, "H": 11,
+         "V": 7, "N": 15}
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the binning engine for this process and the processes it starts, from the pipelineSettings of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    engine = pipeline_settings.get("binning_engine", "") or "motifbinner"
+    if engine not in BINNERS:
+        raise ValueError("binning_engine must be one of {0}, got {1}".format(sorted(BINNERS), engine))
+    if engine != "motifbinner":
+        os.environ[BINNER_ENV] = engine
+
+
+def binner_from_env():
+    """
+    :return: (str) the binning script and (str) the tool name of its jobs, for the engine set in NGS_PIPELINE_BINNER
+    """
+    engine = os.environ.get(BINNER_ENV, "") or "motifbinner"
+    if engine not in BINNERS:
+        print("Ignoring invalid binning engine: {}".format(engine))
+        engine = "motifbinner"
+
+    return BINNERS[engine]
+
+
+def primer_layout(primer_lens):
+    """
+    :param primer_lens: (str) the MotifBinner2 primer lengths from get_primer_lens_score, eg: 1,10,24
+    :return: (int) the start of the primer ID, (int) its length, (int) the length of the whole primer
+    """
+    lens = [int(x) for x in primer_lens.split(",")]
+
+    return lens[0], max(0, lens[1]), sum(lens)
+
+
+def read_pairs(r1_file, r2_file):
+    """
+    :param r1_file: (str) the R1 fastq file
+    :param r2_file: (str) the R2 fastq file
+    :return: (tuple) of lists: R1 sequences, R1 qualities, R2 sequences, R2 qualities
+    """
+    r1_seqs, r1_quals, r2_seqs, r2_quals = [], [], [], []
+    with open(r1_file, 'r') as r1_in, open(r2_file, 'r') as r2_in:
+        for r1_record, r2_record in paired_records(r1_in, r2_in):
+            r1_seqs.append(r1_record[1].strip().upper())
+            r1_quals.append(r1_record[3].strip())
+            r2_seqs.append(r2_record[1].strip().upper())
+            r2_quals.append(r2_record[3].strip())
+
+    return r1_seqs, r1_quals, r2_seqs, r2_quals
+
+
+def primer_scores(seqs, primer):
+    """
+    score the start of each read against a primer without gaps, as the number of read bases that match the IUPAC
+    code of the primer at their position, so that the primer ID N's match any base
+    :param seqs: (list) the read sequences
+    :param primer: (str) the primer
+    :return: (ndarray) the score of each read
+    """
+    # imported here so that the script starts quickly
+    import numpy as np
+
+    length = len(primer)
+    read_masks = np.zeros(256, dtype=np.uint8)
+    for base in "ACGT":
+        read_masks[ord(base)] = IUPAC[base]
+    primer_masks = np.array([IUPAC.get(x, 0) for x in primer.upper()], dtype=np.uint8)
+    starts = np.frombuffer("".join(x[:length].ljust(length, "N") for x in seqs).encode(),
+                           dtype=np.uint8).reshape(-1, length)
+
+    return ((read_masks[starts] & primer_masks) != 0).sum(axis=1)
+
+
+def find_offspring(bin_sizes):
+    """
+    :param bin_sizes: (dict) key = primer ID, value = number of reads
+    :return: (set) the primer IDs of the bins that are one mismatch from a bin at least OFFSPRING_RATIO times bigger
+    """
+    offspring = set()
+    for pid, size in bin_sizes.items():
+        neighbours = (pid[:i] + base + pid[i + 1:] for i in range(len(pid)) for base in "ACGT" if base != pid[i])
+        if any(bin_sizes.get(x, 0) >= size * OFFSPRING_RATIO for x in neighbours):
+            offspring.add(pid)
+
+    return offspring
+
+
+def consensus(seqs, quals):
+    """
+    build the consensus of reads that start at the same position (after their primer), by summing the quality of each
+    base in each column. The consensus ends where fewer than half of the reads reach, and the quality of a base is the
+    summed quality of the winning base less that of the other bases, so ties are N with quality 0
+    :param seqs: (list) the read sequences
+    :param quals: (list) their fastq quality strings
+    :return: (str) the consensus sequence, (str) its fastq quality string
+    """
+    # imported here so that the script starts quickly
+    import numpy as np
+
+    length = max(len(x) for x in seqs)
+    base_codes = np.full(256, 4, dtype=np.uint8)
+    for code, base in enumerate("ACGT"):
+        base_codes[ord(base)] = code
+    codes = base_codes[np.frombuffer("".join(x.ljust(length, "N") for x in seqs).encode(),
+                                     dtype=np.uint8)].reshape(-1, length)
+    weights = np.frombuffer("".join(x.ljust(length, "!") for x in quals).encode(),
+                            dtype=np.uint8).reshape(-1, length).astype(float) - 33
+
+    counts = np.stack([np.where(codes == code, weights, 0).sum(axis=0) for code in range(4)], axis=1)
+    covered = np.nonzero((codes < 4).sum(axis=0) * 2 >= len(seqs))[0]
+    end = int(covered[-1]) + 1 if len(covered) else 0
+
+    best = counts.max(axis=1)
+    quality = np.clip(np.rint(2 * best - counts.sum(axis=1)), 0, MAX_QUALITY).astype(np.uint8)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)[counts.argmax(axis=1)]
+    bases = np.where(quality > 0, bases, ord("N")).astype(np.uint8)
+
+    return bases[:end].tobytes().decode(), (quality[:end] + 33).tobytes().decode()
+
+
+def merge_pair(fwd_seq, fwd_qual, rev_seq, rev_qual):
+    """
+    merge the read 1 and read 2 consensus sequences of a bin on their longest overlap with at most
+    MAX_OVERLAP_MISMATCH mismatches, the higher quality base is kept where they disagree
+    :param fwd_seq: (str) the read 1 consensus
+    :param fwd_qual: (str) its quality string
+    :param rev_seq: (str) the read 2 consensus, as read
+    :param rev_qual: (str) its quality string
+    :return: (str) the merged sequence and (str) its quality string, None, None if they don't overlap
+    """
+    # imported here so that the script starts quickly
+    import numpy as np
+
+    rc_seq = rev_seq.translate(COMPLEMENT)[::-1]
+    fwd = np.frombuffer(fwd_seq.encode(), dtype=np.uint8)
+    rc = np.frombuffer(rc_seq.encode(), dtype=np.uint8)
+    overlap = None
+    for size in range(min(len(fwd), len(rc)), MIN_OVERLAP - 1, -1):
+        if np.count_nonzero(fwd[len(fwd) - size:] != rc[:size]) <= size * MAX_OVERLAP_MISMATCH:
+            overlap = size
+            break
+    if overlap is None:
+        return None, None
+
+    fwd_q = np.frombuffer(fwd_qual[len(fwd) - overlap:].encode(), dtype=np.uint8).astype(int) - 33
+    rc_q = np.frombuffer(rev_qual[::-1][:overlap].encode(), dtype=np.uint8).astype(int) - 33
+    fwd_part = fwd[len(fwd) - overlap:]
+    rc_part = rc[:overlap]
+    agree = fwd_part == rc_part
+    bases = np.where(fwd_q >= rc_q, fwd_part, rc_part).astype(np.uint8)
+    quality = np.where(agree, np.minimum(fwd_q + rc_q, MAX_QUALITY), np.abs(fwd_q - rc_q)).astype(np.uint8)
+
+    seq = fwd_seq[:len(fwd) - overlap] + bases.tobytes().decode() + rc_seq[overlap:]
+    qual = fwd_qual[:len(fwd) - overlap] + (quality + 33).tobytes().decode() + rev_qual[::-1][overlap:]
+
+    return seq, qual
+
+
+def build_consensuses(bins, merge, merged_read_length):
+    """
+    build the consensus sequences of a shard of bins, run in the worker processes
+    :param bins: (list) of (primer ID, R1 sequences, R1 qualities, R2 sequences, R2 qualities)
+    :param merge: (bool) merge the read 1 and read 2 consensus, False for non overlapping reads
+    :param merged_read_length: (int) the shortest merged consensus to keep
+    :return: (list) of (primer ID, number of reads, R1 or merged (seq, qual), R2 (seq, qual) or None)
+    """
+    records = []
+    for pid, r1_seqs, r1_quals, r2_seqs, r2_quals in bins:
+        fwd = consensus(r1_seqs, r1_quals)
+        rev = consensus(r2_seqs, r2_quals)
+        if not merge:
+            records.append((pid, len(r1_seqs), fwd, rev))
+            continue
+        seq, qual = merge_pair(fwd[0], fwd[1], rev[0], rev[1])
+        if seq is not None and len(seq) >= merged_read_length:
+            records.append((pid, len(r1_seqs), (seq, qual), None))
+
+    return records
+
+
+def _write_report(file_name, step, rows):
+    # MotifBinner's per-step reports have the read count in the third column of the first row
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(["step", "parameter", "count"])
+        for parameter, count in rows:
+            writer.writerow([step, parameter, count])
+
+
+def bin_sample(r1_file, r2_file, outpath, name_prefix, fwd_primer, fwd_primer_score, cDNA_primer, cDNA_primer_lens,
+               cDNA_primer_score, cores=1, shards=None, non_overlap=False, min_read_length=290,
+               merged_read_length=240):
+    """
+    bin the read pairs of a sample by the primer ID in read 2 and write a consensus for each bin, in MotifBinner2's
+    output layout: <outpath>/<name_prefix>/n023_buildConsensus/<name_prefix>_kept_buildConsensus.fastq (or _fwd_ and
+    _rev_ files for non overlapping reads) and the n001, n019 and n023 report csv files
+    :param r1_file: (str) the R1 fastq file
+    :param r2_file: (str) the R2 fastq file
+    :param outpath: (str) the binned folder
+    :param name_prefix: (str) the base name of the sample and its consensus sequences
+    :param fwd_primer: (str) the fwd primer, at the start of read 1
+    :param fwd_primer_score: (str) the lowest fwd primer score from get_primer_lens_score
+    :param cDNA_primer: (str) the cDNA primer, at the start of read 2
+    :param cDNA_primer_lens: (str) the cDNA primer lengths from get_primer_lens_score, the second is the primer ID
+    :param cDNA_primer_score: (str) the lowest cDNA primer score from get_primer_lens_score
+    :param cores: (int) the number of worker processes
+    :param shards: (int) the number of primer ID shards the bins are split into for the workers, default the cores
+    :param non_overlap: (bool) True if read 1 and 2 don't overlap, their consensus sequences are written separately
+    :param min_read_length: (int) the shortest read kept
+    :param merged_read_length: (int) the shortest merged consensus kept
+    :return: (OrderedDict) the counts of reads and bins at each step
+    """
+    r1_seqs, r1_quals, r2_seqs, r2_quals = read_pairs(r1_file, r2_file)
+    fwd_trim = len(fwd_primer)
+    pid_start, pid_len, rev_trim = primer_layout(cDNA_primer_lens)
+
+    fwd_scores = primer_scores(r1_seqs, fwd_primer)
+    rev_scores = primer_scores(r2_seqs, cDNA_primer)
+    bins = collections.OrderedDict()
+    matched = 0
+    for i, (fwd_score, rev_score) in enumerate(zip(fwd_scores, rev_scores)):
+        if fwd_score < float(fwd_primer_score) or rev_score < float(cDNA_primer_score):
+            continue
+        if len(r1_seqs[i]) < min_read_length or len(r2_seqs[i]) < min_read_length:
+            continue
+        pid = r2_seqs[i][pid_start:pid_start + pid_len]
+        if "N" in pid:
+            continue
+        matched += 1
+        bins.setdefault(pid, []).append(i)
+
+    bin_sizes = {pid: len(reads) for pid, reads in bins.items()}
+    offspring = find_offspring(bin_sizes)
+    kept = sorted(pid for pid, size in bin_sizes.items() if size >= MIN_BIN_SIZE and pid not in offspring)
+
+    # the bins are split by the hash of their primer ID, so the shards are the same size whatever the sample
+    shards = max(1, shards or cores)
+    shard_bins = [[] for _ in range(shards)]
+    for pid in kept:
+        reads = bins[pid]
+        shard = int.from_bytes(family_hash(pid), "big") % shards
+        shard_bins[shard].append((pid, [r1_seqs[x][fwd_trim:] for x in reads], [r1_quals[x][fwd_trim:] for x in reads],
+                                  [r2_seqs[x][rev_trim:] for x in reads], [r2_quals[x][rev_trim:] for x in reads]))
+    del r1_seqs, r1_quals, r2_seqs, r2_quals
+
+    merge = not non_overlap
+    if cores > 1 and shards > 1:
+        # imported here so that the script starts quickly
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(cores, shards)) as pool:
+            results = list(pool.map(build_consensuses, shard_bins, [merge] * shards, [merged_read_length] * shards))
+    else:
+        results = [build_consensuses(x, merge, merged_read_length) for x in shard_bins]
+    records = sorted((x for shard in results for x in shard), key=lambda x: x[0])
+
+    sample_folder = os.path.join(outpath, name_prefix)
+    consensus_folder = os.path.join(sample_folder, "n023_buildConsensus")
+    os.makedirs(consensus_folder, exist_ok=True)
+    if merge:
+        outputs = [(name_prefix + "_kept_buildConsensus.fastq", 2)]
+    else:
+        outputs = [(name_prefix + "_fwd_kept_buildConsensus.fastq", 2), (name_prefix + "_rev_kept_buildConsensus.fastq",
+                                                                         3)]
+    for file_name, field in outputs:
+        with open(os.path.join(consensus_folder, file_name), 'w') as handle:
+            for record in records:
+                seq, qual = record[field]
+                handle.write("@{0}_{1}_{2}\n{3}\n+\n{4}\n".format(name_prefix, record[0], record[1], seq, qual))
+
+    stats = collections.OrderedDict([("reads", len(fwd_scores)), ("primers_matched", matched),
+                                     ("bins", len(bins)), ("small_bins", sum(1 for x in bin_sizes.values()
+                                                                            if x < MIN_BIN_SIZE)),
+                                     ("offspring_bins", len(offspring)),
+                                     ("merged_reads", sum(x[1] for x in records)), ("consensus", len(records))])
+    _write_report(os.path.join(sample_folder, "n001_fwd_loadData", "n001_fwd_loadData.csv"), "n001_fwd_loadData",
+                  [("sequences", stats["reads"])])
+    _write_report(os.path.join(sample_folder, "n019_mergePEAR", "n019_mergePEAR.csv"), "n019_mergePEAR",
+                  [("sequences", stats["merged_reads"])])
+    _write_report(os.path.join(consensus_folder, "n023_buildConsensus.csv"), "n023_buildConsensus",
+                  [("sequences", stats["consensus"])] + [(k, v) for k, v in stats.items() if k != "consensus"])
+
+    return stats
+
+
+def main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, logfile, cores, non_overlap,
+         shards=None, min_read_length=290, merged_read_length=240, cache_folder=None):
+
+    print("binning reads by primer ID")
+    fwd_primer = fwd_primer.upper()
+    cDNA_primer = cDNA_primer.upper()
+
+    # the same primer scheme as MotifBinner2
+    fwd_primer_lens, fwd_primer_score = get_primer_lens_score(fwd_primer, False)
+    cDNA_primer_lens, cDNA_primer_score = get_primer_lens_score(cDNA_primer, True)
+
+    # only write to log file if this is the first iteration
+    if int(counter) == 0:
+        with open(logfile, 'a') as handle:
+            handle.write("pid_binner settings:\nfwd_primer={0} min_score={1}, cDNA_primer={2} lens={3} min_score={4}, "
+                         "min_bin_size={5}, offspring_ratio={6}, min_read_length={7}, merged_read_length={8}\n".format(
+                             fwd_primer, fwd_primer_score, cDNA_primer, cDNA_primer_lens, cDNA_primer_score,
+                             MIN_BIN_SIZE, OFFSPRING_RATIO, min_read_length, merged_read_length))
+
+    def run():
+        stats = bin_sample(read1, read2, outpath, name_prefix, fwd_primer, fwd_primer_score, cDNA_primer,
+                           cDNA_primer_lens, cDNA_primer_score, cores, shards, non_overlap, min_read_length,
+                           merged_read_length)
+        print("{0}: {1}".format(name_prefix, ", ".join("{0}={1}".format(k, v) for k, v in stats.items())))
+        return True
+
+    # imported here so that the script starts quickly
+    from binning_cache import run_cached
+    from binning_cache import tool_version
+    settings = ["pid_binner", fwd_primer, fwd_primer_score, cDNA_primer, cDNA_primer_lens, cDNA_primer_score,
+                name_prefix, non_overlap, min_read_length, merged_read_length, tool_version(os.path.abspath(__file__))]
+    run_cached(cache_folder, [read1, read2], settings, outpath, name_prefix, logfile, run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Bins read pairs by primer ID and builds a consensus for each bin, '
+                                                 'in place of MotifBinner2',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-r1', '--read1', default=argparse.SUPPRESS, type=str,
+                        help='The read1 (R1) fastq file', required=True)
+    parser.add_argument('-r2', '--read2', default=argparse.SUPPRESS, type=str,
+                        help='The read2 (R2) fastq file', required=True)
+    parser.add_argument('-o', '--outpath', default=argparse.SUPPRESS, type=str,
+                        help='The path to where the output file will be created', required=True)
+    parser.add_argument('-f', '--fwd_primer', default=argparse.SUPPRESS, type=str,
+                        help='The fwd primer for these samples', required=True)
+    parser.add_argument('-r', '--cDNA_primer', default=argparse.SUPPRESS, type=str,
+                        help='The cDNA primer for these samples', required=True)
+    parser.add_argument('-n', '--name_prefix', default=argparse.SUPPRESS, type=str,
+                        help='The prefix for labeling sequence headers', required=True)
+    parser.add_argument('-c', '--counter', default=argparse.SUPPRESS, type=str,
+                        help='Counter to keep track of logging commands to the log file', required=True)
+    parser.add_argument('-l', '--logfile', default=argparse.SUPPRESS, type=str,
+                        help='The path and name of the log file', required=True)
+    parser.add_argument('-ncpu', '--cores', default=3, type=int,
+                        help='the number of CPU cores to use', required=False)
+    parser.add_argument('-v', '--non_overlap', default=False, action='store_true',
+                        help="Use if reads don't overlap)", required=False)
+    parser.add_argument('-k', '--shards', default=None, type=int,
+                        help='The number of primer ID shards the bins are split into, default the number of cores',
+                        required=False)
+    parser.add_argument('-ml', '--min_read_length', default=290, type=int,
+                        help='The shortest read to keep', required=False)
+    parser.add_argument('-mm', '--merged_read_length', default=240, type=int,
+                        help='The shortest merged consensus to keep', required=False)
+    parser.add_argument('-cache', '--cache_folder', default=None, type=str,
+                        help='Restore the binned outputs from this binning result store if the reads and settings '
+                             'are unchanged, and store new ones', required=False)
+
+    args = parser.parse_args()
+    read1 = args.read1
+    read2 = args.read2
+    outpath = args.outpath
+    fwd_primer = args.fwd_primer
+    cDNA_primer = args.cDNA_primer
+    name_prefix = args.name_prefix
+    counter = args.counter
+    non_overlap = args.non_overlap
+    cores = args.cores
+    logfile = args.logfile
+    shards = args.shards
+    min_read_length = args.min_read_length
+    merged_read_length = args.merged_read_length
+    cache_folder = args.cache_folder
+
+    main(read1, read2, outpath, fwd_primer, cDNA_primer, name_prefix, counter, logfile, cores, non_overlap, shards,
+         min_read_length, merged_read_length, cache_folder)
@@ -0,0 +1,78 @@
+import os
+import csv
+import random
+import shutil
+import tempfile
+import unittest
+import pid_binner
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.rng = random.Random(1)
+        self.fwd_primer = "GGAAATATGGAAAGGAAGGAC"
+        self.cDNA_primer = "NNNNNNNNNNNTCTTCTAATACTGTATC"
+        # a 300 base amplicon read from both ends by 200 base reads
+        self.templates = ["".join(self.rng.choice("ACGT") for _ in range(300)) for _ in range(3)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def rev_comp(self, seq):
+        return seq.translate(pid_binner.COMPLEMENT)[::-1]
+
+    def error(self, seq, rate=0.02):
+        return "".join(self.rng.choice("ACGT") if self.rng.random() < rate else x for x in seq)
+
+    def write_reads(self, families):
+        r1_file = os.path.join(self.tmp_dir, "CAP1_ENV_R1.fastq")
+        r2_file = os.path.join(self.tmp_dir, "CAP1_ENV_R2.fastq")
+        with open(r1_file, 'w') as r1, open(r2_file, 'w') as r2:
+            n = 0
+            for pid, template, size in families:
+                for _ in range(size):
+                    r1_seq = self.fwd_primer + self.error(template[:200])
+                    r2_seq = pid + self.cDNA_primer[11:] + self.error(self.rev_comp(template)[:200])
+                    r1.write("@read{0} 1\n{1}\n+\n{2}\n".format(n, r1_seq, "I" * len(r1_seq)))
+                    r2.write("@read{0} 2\n{1}\n+\n{2}\n".format(n, r2_seq, "I" * len(r2_seq)))
+                    n += 1
+        return r1_file, r2_file
+
+    def test_families_are_binned_and_merged(self):
+        families = [("AAAACCCCGGG", self.templates[0], 12), ("TTTTGGGGCCC", self.templates[1], 5),
+                    # an offspring of the first family, and a family too small for a consensus
+                    ("AAAACCCCGGT", self.templates[0], 1), ("CCCCAAAATTT", self.templates[2], 2)]
+        r1_file, r2_file = self.write_reads(families)
+        outpath = os.path.join(self.tmp_dir, "binned")
+        stats = pid_binner.bin_sample(r1_file, r2_file, outpath, "CAP1_ENV", self.fwd_primer, "15",
+                                      self.cDNA_primer, "1,10,17", "24", cores=2, shards=2, min_read_length=200)
+        self.assertEqual((stats["reads"], stats["bins"], stats["offspring_bins"], stats["consensus"]), (20, 4, 1, 2))
+
+        consensus_file = os.path.join(outpath, "CAP1_ENV", "n023_buildConsensus", "CAP1_ENV_kept_buildConsensus.fastq")
+        with open(consensus_file) as handle:
+            lines = handle.read().splitlines()
+        # the primer ID is the second fragment of the primer lengths, without its first base
+        self.assertEqual(lines[0], "@CAP1_ENV_AAACCCCGGG_12")
+        self.assertEqual(lines[1], self.templates[0])
+        self.assertEqual(lines[5], self.templates[1])
+
+        with open(os.path.join(outpath, "CAP1_ENV", "n023_buildConsensus", "n023_buildConsensus.csv")) as handle:
+            reader = csv.reader(handle)
+            next(reader)
+            self.assertEqual(int(next(reader)[2]), 2)
+
+    def test_engine_from_config(self):
+        self.assertEqual(pid_binner.binner_from_env(), ("call_motifbinner.py", "MotifBinner2.R"))
+        pid_binner.enable_from_config({"binning_engine": "pid_binner"})
+        try:
+            self.assertEqual(pid_binner.binner_from_env(), ("pid_binner.py", "pid_binner"))
+        finally:
+            del os.environ[pid_binner.BINNER_ENV]
+        with self.assertRaises(ValueError):
+            pid_binner.enable_from_config({"binning_engine": "unknown"})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,362 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import json
+import math
+import time
+import runpy
+import signal
+import socket
+import argparse
+import importlib
+import threading
+import traceback
+import socketserver
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import reference_cache
+from tool_runner import DAEMON_ENV
+from tool_runner import DAEMON_SCRIPTS
+from tool_runner import ENV_PREFIX
+from tool_runner import proc_status_kb
+from resource_manager import machine_cores
+
+
+__author__ = 'Colin Anthony'
+
+
+# imported once by the daemon so that the workers don't pay for them on every job
+WARM_MODULES = ["regex", "seqanpy", "Bio.Blast.NCBIXML", "align_ngs_codons"]
+
+
+class JobTimeout(BaseException):
+    """
+    raised in a worker when a job runs past its timeout, a BaseException so the scripts' own handlers don't catch it
+    """
+    pass
+
+
+def _alarm(signum, frame):
+    raise JobTimeout()
+
+
+def _init_worker():
+    # the workers are stopped by the pool, not by the daemon's signal handlers
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGALRM, _alarm)
+
+
+def warm_up(script_folder):
+    """
+    import the heavy modules and fill the reference cache with the reference sequences, region tables and the
+    compiled variable region patterns, before the workers are forked so that they all share them
+    :param script_folder: (str) the folder with the pipeline scripts and reference files
+    :return: (list) the modules that were imported
+    """
+    loaded = []
+    for module in WARM_MODULES:
+        try:
+            importlib.import_module(module)
+            loaded.append(module)
+        except ImportError as e:
+            print("Not preloading {0}: {1}".format(module, e))
+    if "align_ngs_codons" not in loaded:
+        return loaded
+
+    import regex
+    import align_ngs_codons
+    align_ngs_codons.load_reference_sequences(os.path.join(script_folder, "reference_sequences.fasta"))
+    regions_file = os.path.join(script_folder, "gene_sub_regions_start_end.csv")
+    reference_cache.cached("csv", regions_file, lambda: align_ngs_codons.read_regions_table(regions_file))
+    var_regions_file = os.path.join(script_folder, "HIV_var_cons_regions.csv")
+    rows = reference_cache.cached("csv", var_regions_file,
+                                  lambda: align_ngs_codons.read_regions_table(var_regions_file))
+    # the patterns are built as in align_ngs_codons.find_var_region_boundaries
+    for ref_type in sorted(set(row["reference_type"] for row in rows if row["gene"] == "ENV")):
+        regions_dict, errors_allowed = align_ngs_codons.get_var_regions_dict(ref_type, "ENV", script_folder)
+        for var_reg_name, var_seq in regions_dict.items():
+            pattern = "{0}{{e<{1}}}".format(var_seq, errors_allowed[var_reg_name])
+            reference_cache.compile_pattern(pattern, regex.BESTMATCH)
+
+    return loaded
+
+
+def _exit_code(code):
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    # sys.exit("message") prints the message and exits with 1
+    print(code, file=sys.stderr)
+
+    return 1
+
+
+def _reset_peak_rss():
+    # writing 5 to clear_refs resets VmHWM (linux >= 4.0), so each job's peak is measured on its own
+    try:
+        with open("/proc/self/clear_refs", 'w') as handle:
+            handle.write("5")
+    except OSError:
+        pass
+
+
+def _set_pipeline_env(env):
+    """
+    replace the NGS_PIPELINE_* settings of this worker
+    :param env: (dict) the new settings
+    :return: (dict) the old settings
+    """
+    old_env = {k: v for k, v in os.environ.items() if k.startswith(ENV_PREFIX)}
+    for key in old_env:
+        del os.environ[key]
+    os.environ.update(env)
+
+    return old_env
+
+
+def run_script(argv, log_file=None, cwd=None, timeout=None, env=None):
+    """
+    run one of the pipeline's python scripts in this worker, as if it was started from the command line
+    :param argv: (list) the script and its arguments
+    :param log_file: (str) file to append the script's stdout and stderr to
+    :param cwd: (str) working directory for the script
+    :param timeout: (float) seconds before the script is stopped, None for no limit
+    :param env: (dict) the NGS_PIPELINE_* settings of the client, the worker's own settings are restored afterwards
+    :return: (dict) the returncode, duration, timed_out status and peak memory use of the job
+    """
+    script = argv[0]
+    if os.path.basename(script) not in DAEMON_SCRIPTS:
+        return {"returncode": 2, "error": "{} is not a pipeline script".format(script)}
+
+    start = time.perf_counter()
+    returncode = 0
+    timed_out = False
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved_fds = os.dup(1), os.dup(2)
+    log_fd = os.open(log_file or os.devnull, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+    os.dup2(log_fd, 1)
+    os.dup2(log_fd, 2)
+    os.close(log_fd)
+    # sys.stdout and sys.stderr may not write to fds 1 and 2 (eg: when replaced by a test runner), so the script
+    # gets new ones that do
+    saved_streams = sys.stdout, sys.stderr
+    sys.stdout = open(1, 'w', buffering=1, closefd=False)
+    sys.stderr = open(2, 'w', buffering=1, closefd=False)
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    # jobs must not send their own jobs back to the daemon
+    saved_env = _set_pipeline_env({k: v for k, v in (env or {}).items() if k != DAEMON_ENV})
+    _reset_peak_rss()
+    try:
+        sys.argv = list(argv)
+        if cwd:
+            os.chdir(cwd)
+        if timeout:
+            signal.alarm(max(1, int(math.ceil(timeout))))
+        runpy.run_path(script, run_name="__main__")
+    except JobTimeout:
+        timed_out = True
+        returncode = None
+        print("timed out after {} s".format(timeout), file=sys.stderr)
+    except SystemExit as e:
+        returncode = _exit_code(e.code)
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        signal.alarm(0)
+        sys.stdout.close()
+        sys.stderr.close()
+        sys.stdout, sys.stderr = saved_streams
+        os.dup2(saved_fds[0], 1)
+        os.dup2(saved_fds[1], 2)
+        os.close(saved_fds[0])
+        os.close(saved_fds[1])
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+        _set_pipeline_env(saved_env)
+
+    peak_kb = proc_status_kb(os.getpid(), ("VmHWM",)).get("VmHWM")
+
+    return {"returncode": returncode, "timed_out": timed_out, "duration": round(time.perf_counter() - start, 3),
+            "peak_rss_mb": round(peak_kb / 1024, 1) if peak_kb else None}
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    """
+    one JSON request per line: {"argv": [script, args...], "log_file", "cwd", "timeout", "env"}, {"ping": true} or
+    {"shutdown": true}, each answered with one JSON line
+    """
+
+    def handle(self):
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line.decode())
+                if request.get("ping"):
+                    reply = self.server.status()
+                elif request.get("shutdown"):
+                    reply = {"ok": True}
+                    threading.Thread(target=self.server.shutdown, daemon=True).start()
+                else:
+                    reply = self.server.submit(request)
+            except Exception as e:
+                reply = {"returncode": None, "error": repr(e)}
+            self.wfile.write(json.dumps(reply).encode() + b"\n")
+            self.wfile.flush()
+
+
+class PipelineDaemon(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    a long-lived server on a unix socket that runs the pipeline's python scripts in a pool of pre-forked worker
+    processes. The workers are forked after the warm up, so they start with the heavy modules imported, the
+    references parsed and the variable region patterns compiled, instead of paying for that on every job
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_file, workers, warm=None):
+        """
+        :param socket_file: (str) the unix socket to listen on
+        :param workers: (int) the number of worker processes
+        :param warm: (list) the modules imported by the warm up, reported by ping
+        """
+        self.workers = workers
+        self.warm = warm or []
+        self.started = time.time()
+        self.jobs = 0
+        self._lock = threading.Lock()
+        self.pool = None
+        self._start_pool()
+        socketserver.UnixStreamServer.__init__(self, socket_file, _Handler)
+
+    def _start_pool(self):
+        self.pool = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("fork"),
+                                        initializer=_init_worker)
+        # fork all the workers now, while the daemon has no other threads
+        for future in [self.pool.submit(time.sleep, 0.2) for _ in range(self.workers)]:
+            future.result()
+
+    def submit(self, request):
+        """
+        :param request: (dict) a job request
+        :return: (dict) the job's result
+        """
+        with self._lock:
+            self.jobs += 1
+            pool = self.pool
+        try:
+            return pool.submit(run_script, request["argv"], request.get("log_file"), request.get("cwd"),
+                               request.get("timeout"), request.get("env")).result()
+        except BrokenProcessPool:
+            # a worker died, eg: killed for using too much memory, replace the pool for the next jobs
+            with self._lock:
+                if self.pool is pool:
+                    self._start_pool()
+            return {"returncode": None, "error": "the worker running the job died"}
+
+    def status(self):
+        return {"ok": True, "pid": os.getpid(), "workers": self.workers, "jobs": self.jobs,
+                "uptime": round(time.time() - self.started), "warm": self.warm, "cache": reference_cache.cache_info()}
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        self.pool.shutdown()
+
+
+def send(socket_file, request, timeout=None):
+    """
+    send one request to a pipeline daemon and wait for the reply
+    :param socket_file: (str) the daemon's unix socket
+    :param request: (dict) the request
+    :param timeout: (float) seconds to wait for the reply
+    :return: (dict) the reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(timeout)
+        client.connect(socket_file)
+        client.sendall(json.dumps(request).encode() + b"\n")
+        with client.makefile('rb') as handle:
+            line = handle.readline()
+
+    return json.loads(line.decode()) if line else {"ok": False}
+
+
+def serve(socket_file, workers):
+    """
+    warm up and serve jobs until stopped with --stop, SIGTERM or ctrl-c
+    :param socket_file: (str) the unix socket to listen on
+    :param workers: (int) the number of worker processes
+    :return: None
+    """
+    if os.path.exists(socket_file):
+        try:
+            send(socket_file, {"ping": True}, timeout=5)
+            sys.exit("A pipeline daemon is already listening on {}".format(socket_file))
+        except OSError:
+            os.unlink(socket_file)
+
+    script_folder = os.path.split(os.path.abspath(os.path.realpath(__file__)))[0]
+    if script_folder not in sys.path:
+        sys.path.insert(0, script_folder)
+    # jobs run by the daemon must not send their own jobs back to it
+    os.environ.pop(DAEMON_ENV, None)
+
+    start = time.perf_counter()
+    warm = warm_up(script_folder)
+    print("Warm up took {0:.1f} s, {1}".format(time.perf_counter() - start, reference_cache.cache_info()))
+
+    server = PipelineDaemon(socket_file, workers, warm)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("Pipeline daemon listening on {0} with {1} workers".format(socket_file, workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_file):
+            os.unlink(socket_file)
+    print("Pipeline daemon stopped after {} jobs".format(server.jobs))
+
+
+def main(socket_file, workers, ping, stop):
+
+    if ping or stop:
+        reply = send(socket_file, {"shutdown": True} if stop else {"ping": True}, timeout=30)
+        for key, value in reply.items():
+            print("{0}: {1}".format(key, value))
+        return
+
+    serve(socket_file, workers)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs a long-lived pipeline daemon that keeps the references, '
+                                                 'region tables and variable region patterns loaded and runs the '
+                                                 'clean, contam, align, stats and haplotype jobs of step 2 and 3 in '
+                                                 'warm worker processes. Set daemon_socket in the config file (or '
+                                                 'NGS_PIPELINE_DAEMON) to the same socket to use it',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-s', '--socket_file', default=argparse.SUPPRESS, type=str,
+                        help='The unix socket to listen on', required=True)
+    parser.add_argument('-n', '--workers', default=machine_cores(), type=int,
+                        help='The number of worker processes', required=False)
+    parser.add_argument('-p', '--ping', default=False, action='store_true',
+                        help='Print the status of a running daemon', required=False)
+    parser.add_argument('--stop', default=False, action='store_true',
+                        help='Stop a running daemon', required=False)
+
+    args = parser.parse_args()
+    socket_file = args.socket_file
+    workers = args.workers
+    ping = args.ping
+    stop = args.stop
+
+    main(socket_file, workers, ping, stop)
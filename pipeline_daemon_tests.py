@@ -0,0 +1,84 @@
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+from tool_runner import ToolJob
+from tool_runner import ToolRunner
+from pipeline_daemon import PipelineDaemon
+from pipeline_daemon import send
+
+
+SCRIPT = """import os
+import sys
+print("running", sys.argv[1:])
+print("setting", os.environ.get("NGS_PIPELINE_TEST_SETTING"))
+if sys.argv[1] == "fail":
+    sys.exit("bad input")
+if sys.argv[1] == "hang":
+    import time
+    time.sleep(30)
+"""
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        # the daemon only runs the pipeline's own scripts, so the test script takes one of their names
+        self.script = os.path.join(self.tmp_dir, "haplotyper_freq.py")
+        with open(self.script, 'w') as handle:
+            handle.write(SCRIPT)
+        self.socket_file = os.path.join(self.tmp_dir, "daemon.sock")
+        self.server = PipelineDaemon(self.socket_file, 1)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def job(self, argument, timeout=None):
+        log_file = os.path.join(self.tmp_dir, argument + ".log")
+        return ToolJob("haplotyper_freq", [sys.executable, self.script, argument], log_file, None, timeout)
+
+    def test_jobs_run_in_the_daemon(self):
+        runner = ToolRunner(daemon=self.socket_file)
+        ok, failed, hung = runner.run_jobs([self.job("ok"), self.job("fail"), self.job("hang", timeout=1)])
+        self.assertEqual(ok.returncode, 0)
+        self.assertEqual(failed.returncode, 1)
+        self.assertTrue(hung.timed_out)
+        with open(ok.log_file) as handle:
+            content = handle.read()
+        self.assertIn("running ['ok']", content)
+        self.assertIn("daemon", content)
+        with open(failed.log_file) as handle:
+            self.assertIn("bad input", handle.read())
+        self.assertEqual(send(self.socket_file, {"ping": True})["jobs"], 3)
+
+    def test_jobs_get_the_client_settings(self):
+        runner = ToolRunner(daemon=self.socket_file)
+        os.environ["NGS_PIPELINE_TEST_SETTING"] = "client"
+        try:
+            with_setting = runner.run_jobs([self.job("ok")])[0]
+        finally:
+            del os.environ["NGS_PIPELINE_TEST_SETTING"]
+        # the worker does not keep the settings of an earlier job
+        without_setting = runner.run_jobs([self.job("other")])[0]
+        with open(with_setting.log_file) as handle:
+            self.assertIn("setting client", handle.read())
+        with open(without_setting.log_file) as handle:
+            self.assertIn("setting None", handle.read())
+
+    def test_falls_back_to_processes_without_daemon(self):
+        runner = ToolRunner(daemon=os.path.join(self.tmp_dir, "missing.sock"))
+        result = runner.run_jobs([self.job("ok")])[0]
+        self.assertEqual(result.returncode, 0)
+        self.assertIsNone(runner.daemon)
+        self.assertEqual(send(self.socket_file, {"ping": True})["jobs"], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,223 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import json
+import argparse
+import collections
+from glob import glob
+from itertools import islice
+
+
+__author__ = 'Colin Anthony'
+
+
+# the number of records at the start of each file whose structure and pairing is checked, 0 to skip the check
+SAMPLE_RECORDS = 1000
+# the bytes read at the end of a file to check its last record
+TAIL_BYTES = 64 * 1024
+# seconds per read pair for the whole run, used to estimate the run time when there are no stage metrics of an
+# earlier run in the output folder
+SECONDS_PER_PAIR = 0.001
+
+
+def count_lines(fastq_file):
+    """
+    count the lines of a file in blocks, without parsing it
+    :param fastq_file: (str) the fastq file
+    :return: (int) the number of lines, a last line without a newline counts
+    """
+    block_size = 1024 * 1024
+    lines = 0
+    last = b"\n"
+    with open(fastq_file, 'rb') as handle:
+        block = handle.read(block_size)
+        while block:
+            lines += block.count(b"\n")
+            last = block[-1:]
+            block = handle.read(block_size)
+    if last != b"\n":
+        lines += 1
+
+    return lines
+
+
+def record_problem(record):
+    """
+    :param record: (list) the 4 lines of a fastq record
+    :return: (str) what is wrong with the record, None if it is a valid record
+    """
+    if len(record) < 4:
+        return "truncated record"
+    header, seq, plus, qual = [x.rstrip("\r\n") for x in record]
+    if not header.startswith("@"):
+        return "header does not start with @"
+    if not plus.startswith("+"):
+        return "separator line does not start with +"
+    if len(seq) != len(qual):
+        return "sequence and quality lengths differ"
+
+    return None
+
+
+def read_id(header):
+    """
+    :param header: (str) a fastq header line
+    :return: (str) the read name without the /1 or /2 mate suffix
+    """
+    name = header.split()[0].lstrip("@") if header.strip() else ""
+    if name.endswith(("/1", "/2")):
+        name = name[:-2]
+
+    return name
+
+
+def last_record(fastq_file):
+    """
+    :param fastq_file: (str) the fastq file
+    :return: (list) the last 4 lines of the file
+    """
+    with open(fastq_file, 'rb') as handle:
+        handle.seek(max(0, os.path.getsize(fastq_file) - TAIL_BYTES))
+        lines = handle.read().decode(errors="replace").splitlines(True)
+
+    return lines[-4:]
+
+
+def scan_pair(r1_file, r2_file, sample_records=SAMPLE_RECORDS):
+    """
+    check an R1/R2 pair: both files exist, have the same number of complete 4 line records, the first records are valid
+    and have the same read names in both files, and the last record of each file is complete
+    :param r1_file: (str) the R1 fastq file
+    :param r2_file: (str) the R2 fastq file
+    :param sample_records: (int) the number of records at the start of the files to check
+    :return: (dict) bytes, read_pairs and problems (a list of str)
+    """
+    problems = []
+    result = collections.OrderedDict([("bytes", 0), ("read_pairs", 0), ("problems", problems)])
+    for file in [r1_file, r2_file]:
+        if not file or not os.path.isfile(file):
+            problems.append("missing file: {}".format(file))
+    if problems:
+        return result
+
+    counts = []
+    for file in [r1_file, r2_file]:
+        result["bytes"] += os.path.getsize(file)
+        lines = count_lines(file)
+        if lines % 4:
+            problems.append("{0}: {1} lines is not a multiple of 4, the file is truncated".format(file, lines))
+        elif lines and record_problem(last_record(file)):
+            problems.append("{0}: last record: {1}".format(file, record_problem(last_record(file))))
+        counts.append(lines // 4)
+    result["read_pairs"] = min(counts)
+    if counts[0] != counts[1]:
+        problems.append("R1 has {0} records and R2 has {1}, the mates are out of sync".format(*counts))
+
+    with open(r1_file, 'r') as r1_handle, open(r2_file, 'r') as r2_handle:
+        for i in range(sample_records):
+            r1_record = list(islice(r1_handle, 4))
+            r2_record = list(islice(r2_handle, 4))
+            if not r1_record or not r2_record:
+                break
+            for file, record in [(r1_file, r1_record), (r2_file, r2_record)]:
+                problem = record_problem(record)
+                if problem:
+                    problems.append("{0}: record {1}: {2}".format(file, i + 1, problem))
+            if problems:
+                break
+            if read_id(r1_record[0]) != read_id(r2_record[0]):
+                problems.append("record {0}: R1 read {1} is paired with R2 read {2}".format(
+                    i + 1, read_id(r1_record[0]), read_id(r2_record[0])))
+                break
+
+    return result
+
+
+def seconds_per_pair(out_folder):
+    """
+    :param out_folder: (str) the output folder of the run
+    :return: (float) the seconds per read pair of the latest earlier run in the output folder, from its stage metrics,
+    or SECONDS_PER_PAIR
+    """
+    metrics_files = sorted(glob(os.path.join(out_folder, "Pipeline_*_stage_metrics.jsonl")))
+    if metrics_files:
+        wall_s = 0
+        pairs = 0
+        with open(metrics_files[-1], 'r') as handle:
+            for line in handle:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                wall_s += record.get("wall_s", 0)
+                if record["stage"] == "demultiplex":
+                    # the demultiplex records count the R1 and R2 reads
+                    pairs += record.get("input_records", 0) / 2
+        if pairs:
+            return wall_s / pairs
+
+    return SECONDS_PER_PAIR
+
+
+def preflight(pairs, cores=1, sample_records=SAMPLE_RECORDS, out_folder=None):
+    """
+    scan the R1/R2 pairs of a run in parallel and report their sizes, the estimated run time and any problems
+    :param pairs: (list) of (sample, R1 file, R2 file)
+    :param cores: (int) the number of pairs to scan at the same time
+    :param sample_records: (int) the number of records at the start of each pair to check
+    :param out_folder: (str) the output folder, to estimate the run time from an earlier run
+    :return: (list) of str, the problems found
+    """
+    # imported here so that the script starts quickly
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(max_workers=max(1, min(cores, len(pairs) or 1))) as executor:
+        results = list(executor.map(scan_pair, [x[1] for x in pairs], [x[2] for x in pairs],
+                                    [sample_records] * len(pairs)))
+
+    problems = []
+    total_bytes = 0
+    total_pairs = 0
+    for (sample, r1_file, r2_file), result in zip(pairs, results):
+        total_bytes += result["bytes"]
+        total_pairs += result["read_pairs"]
+        print("{0:<40}{1:>12} read pairs{2:>10.1f} MB".format(sample, result["read_pairs"], result["bytes"] / 1e6))
+        problems.extend("{0}: {1}".format(sample, x) for x in result["problems"])
+
+    rate = seconds_per_pair(out_folder) if out_folder else SECONDS_PER_PAIR
+    print("{0} samples, {1} read pairs, {2:.1f} MB, estimated run time {3:.1f} hours".format(
+        len(pairs), total_pairs, total_bytes / 1e6, total_pairs * rate / 3600))
+    for problem in problems:
+        print("Input problem: " + problem)
+
+    return problems
+
+
+def main(fastq_dir, cores, sample_records):
+
+    pairs = []
+    for r1_file in sorted(glob(os.path.join(fastq_dir, "*R1*.fastq"))):
+        r2_file = "R2".join(r1_file.rsplit("R1", 1))
+        pairs.append((os.path.basename(r1_file), r1_file, r2_file))
+    if preflight(pairs, cores, sample_records):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Checks the R1/R2 fastq pairs of a run before demultiplexing: record '
+                                                 'counts, 4 line record structure, truncated files and mate pairing',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--fastq_dir', default=argparse.SUPPRESS, type=str,
+                        help='The folder with the R1 and R2 fastq files', required=True)
+    parser.add_argument('-t', '--cores', default=1, type=int,
+                        help='The number of pairs to scan at the same time', required=False)
+    parser.add_argument('-s', '--sample_records', default=SAMPLE_RECORDS, type=int,
+                        help='The number of records at the start of each pair to check', required=False)
+
+    args = parser.parse_args()
+    fastq_dir = args.fastq_dir
+    cores = args.cores
+    sample_records = args.sample_records
+
+    main(fastq_dir, cores, sample_records)
@@ -0,0 +1,46 @@
+import os
+import shutil
+import tempfile
+import unittest
+import preflight_check
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, reads, extra=""):
+        file = os.path.join(self.tmp_dir, name)
+        with open(file, 'w') as handle:
+            for read in reads:
+                handle.write("@{0}\nACGT\n+\nIIII\n".format(read))
+            handle.write(extra)
+        return file
+
+    def test_valid_pair(self):
+        r1 = self.write("CAP1_R1.fastq", ["read{} 1".format(i) for i in range(10)])
+        r2 = self.write("CAP1_R2.fastq", ["read{} 2".format(i) for i in range(10)])
+        result = preflight_check.scan_pair(r1, r2)
+        self.assertEqual((result["read_pairs"], result["problems"]), (10, []))
+        self.assertEqual(preflight_check.preflight([("CAP1", r1, r2)], cores=2, out_folder=self.tmp_dir), [])
+
+    def test_problems_are_found(self):
+        r1 = self.write("CAP1_R1.fastq", ["read{}/1".format(i) for i in range(10)])
+        # an R2 file that is one record short, a truncated one and one with the reads in another order
+        short = self.write("short_R2.fastq", ["read{}/2".format(i) for i in range(9)])
+        truncated = self.write("truncated_R2.fastq", ["read{}/2".format(i) for i in range(10)], "@read10/2\nAC")
+        swapped = self.write("swapped_R2.fastq", ["read{}/2".format(i) for i in reversed(range(10))])
+
+        self.assertIn("out of sync", preflight_check.scan_pair(r1, short)["problems"][0])
+        self.assertIn("truncated", preflight_check.scan_pair(r1, truncated)["problems"][0])
+        self.assertIn("R1 read read0 is paired with R2 read read9",
+                      preflight_check.scan_pair(r1, swapped)["problems"][0])
+        self.assertIn("missing file", preflight_check.scan_pair(r1, None)["problems"][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
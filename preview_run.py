@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import csv
+import json
+import shutil
+import argparse
+import collections
+from glob import glob
+from subsample_reads import sample_pairs
+
+
+__author__ = 'Colin Anthony'
+
+
+# the preview is run in <out_folder>_preview, so it never touches the output tree of the real run
+PREVIEW_SUFFIX = "_preview"
+PREVIEW_CONFIG = "preview_config.json"
+PREVIEW_REPORT = "preview_report.csv"
+# what survives each stage, in pipeline order: (column, stage, metric). The contam and align stages also write the
+# contaminant and translated files, so the survivors of a stage are counted as the inputs of the stage after it
+SURVIVAL = [("consensus", "motifbinner", "output_records"),
+            ("clean", "contam", "input_records"),
+            ("not_contam", "merge", "input_records"),
+            ("aligned", "align", "output_records")]
+
+
+def preview_folder(out_folder):
+    """
+    :param out_folder: (str) the output folder of the real run
+    :return: (str) the output folder of its preview
+    """
+    return os.path.abspath(out_folder).rstrip(os.sep) + PREVIEW_SUFFIX
+
+
+def make_preview(config_file, n_pairs, reservoir=False, seed=0):
+    """
+    sample n read pairs from each R1/R2 pair in the fastq_dir into a new preview tree, with a copy of the config file
+    that points at it. An earlier preview of the same run is replaced
+    :param config_file: (str) the config file of the real run
+    :param n_pairs: (int) the number of read pairs to keep from each input pair
+    :param reservoir: (bool) True for a random sample of the pairs, False for the first n pairs
+    :param seed: (int) changes which pairs are picked for a random sample
+    :return: (str) the preview config file
+    """
+    with open(config_file) as handle:
+        data = json.load(handle)
+
+    out_folder = preview_folder(data['input_data']['out_folder'])
+    if os.path.isdir(out_folder):
+        if not os.path.isfile(os.path.join(out_folder, PREVIEW_CONFIG)):
+            raise ValueError("{} exists and is not a preview folder, move it out of the way".format(out_folder))
+        shutil.rmtree(out_folder)
+    fastq_dir = os.path.join(out_folder, "0fastq")
+    os.makedirs(fastq_dir)
+
+    for r1_file in sorted(glob(os.path.join(data['input_data']['fastq_dir'], "*R1*.fastq"))):
+        r2_file = "R2".join(r1_file.rsplit("R1", 1))
+        if "None" in r1_file.split("_") or not os.path.isfile(r2_file):
+            continue
+        written = sample_pairs(r1_file, r2_file, os.path.join(fastq_dir, os.path.basename(r1_file)),
+                               os.path.join(fastq_dir, os.path.basename(r2_file)), n_pairs, reservoir, seed)
+        print("Preview: {0} read pairs from {1}".format(written, os.path.basename(r1_file)))
+
+    data['input_data']['fastq_dir'] = fastq_dir
+    data['input_data']['out_folder'] = out_folder
+    data['pipelineSettings']['run_step'] = 1
+    preview_config = os.path.join(out_folder, PREVIEW_CONFIG)
+    with open(preview_config, 'w') as handle:
+        json.dump(data, handle, indent=2)
+
+    return preview_config
+
+
+def survival_report(metrics_file, outfile):
+    """
+    summarise the stage metrics of a preview run: the share of each patient's read pairs assigned to each gene region,
+    and how many consensus sequences each stage kept
+    :param metrics_file: (str) the stage metrics file of the preview run
+    :param outfile: (str) path and name of the csv report
+    :return: (list) of dicts, one row per patient and gene region
+    """
+    totals = collections.defaultdict(float)
+    with open(metrics_file, 'r') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            for field in ["input_records", "output_records"]:
+                totals[(record["patient"], record["region"], record["stage"], field)] += record.get(field, 0)
+
+    rows = []
+    regions = sorted(set((patient, region) for patient, region, stage, field in totals if stage == "stage_inputs"))
+    for patient, region in regions:
+        # the demultiplex and stage_inputs records count the R1 and R2 reads
+        demultiplexed = totals[(patient, "all", "demultiplex", "input_records")] / 2
+        pairs = totals[(patient, region, "stage_inputs", "input_records")] / 2
+        row = collections.OrderedDict([("patient", patient), ("region", region), ("read_pairs", int(pairs)),
+                                       ("assigned_pct", round(100 * pairs / demultiplexed, 1) if demultiplexed else 0)])
+        previous = None
+        for column, stage, field in SURVIVAL:
+            count = totals[(patient, region, stage, field)]
+            if stage == "align":
+                # the DNA alignment and its translation
+                count = count / 2
+            row[column] = int(count)
+            if previous is not None:
+                row[column + "_pct"] = round(100 * count / previous, 1) if previous else 0
+            previous = count
+        rows.append(row)
+
+    with open(outfile, 'w', newline='') as handle:
+        writer = csv.writer(handle)
+        if rows:
+            writer.writerow(list(rows[0].keys()))
+        for row in rows:
+            writer.writerow(list(row.values()))
+
+    for row in rows:
+        print("{patient} {region}: {read_pairs} read pairs ({assigned_pct}% of the sample), {consensus} consensus, "
+              "{clean_pct}% clean, {not_contam_pct}% not contaminants, {aligned_pct}% aligned".format(**row))
+    print("Preview report written to: " + outfile)
+
+    return rows
+
+
+def main(metrics_file, outfile):
+
+    survival_report(metrics_file, outfile)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Reports the share of the reads assigned to each gene region and '
+                                                 'how many sequences survive each stage, from the stage metrics of a '
+                                                 'preview run (demultiplex.py --preview)',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--metrics_file', default=argparse.SUPPRESS, type=str,
+                        help='The Pipeline_*_stage_metrics.jsonl file of the preview run', required=True)
+    parser.add_argument('-o', '--outfile', default=PREVIEW_REPORT, type=str,
+                        help='The csv report', required=False)
+
+    args = parser.parse_args()
+    metrics_file = args.metrics_file
+    outfile = args.outfile
+
+    main(metrics_file, outfile)
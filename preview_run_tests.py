@@ -0,0 +1,61 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import preview_run
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_preview_tree_has_sampled_reads(self):
+        fastq_dir = os.path.join(self.tmp_dir, "fastq")
+        os.makedirs(fastq_dir)
+        for read in ["R1", "R2"]:
+            with open(os.path.join(fastq_dir, "CAP1_multiplex_S1_L001_{}_001.fastq".format(read)), 'w') as handle:
+                for i in range(20):
+                    handle.write("@read{0}\nACGT\n+\nIIII\n".format(i))
+        config_file = os.path.join(self.tmp_dir, "config.json")
+        with open(config_file, 'w') as handle:
+            json.dump({"input_data": {"fastq_dir": fastq_dir, "out_folder": os.path.join(self.tmp_dir, "out")},
+                       "pipelineSettings": {"run_step": 3}}, handle)
+
+        preview_config = preview_run.make_preview(config_file, 5)
+        self.assertEqual(os.path.dirname(preview_config), os.path.join(self.tmp_dir, "out_preview"))
+        with open(preview_config) as handle:
+            data = json.load(handle)
+        self.assertEqual(data["pipelineSettings"]["run_step"], 1)
+        with open(os.path.join(data["input_data"]["fastq_dir"], "CAP1_multiplex_S1_L001_R2_001.fastq")) as handle:
+            self.assertEqual(len(handle.readlines()), 20)
+
+        # a second preview replaces the first, but a folder that is not a preview is left alone
+        self.assertEqual(preview_run.make_preview(config_file, 5), preview_config)
+        os.unlink(preview_config)
+        with self.assertRaises(ValueError):
+            preview_run.make_preview(config_file, 5)
+
+    def test_survival_report(self):
+        metrics_file = os.path.join(self.tmp_dir, "metrics.jsonl")
+        records = [("all", "demultiplex", 200, 0), ("ENV", "stage_inputs", 150, 0), ("ENV", "motifbinner", 150, 20),
+                   ("ENV", "contam", 16, 20), ("ENV", "merge", 12, 12), ("ENV", "align", 12, 18),
+                   ("GAG", "stage_inputs", 10, 0)]
+        with open(metrics_file, 'w') as handle:
+            for region, stage, inputs, outputs in records:
+                handle.write(json.dumps({"patient": "CAP1", "region": region, "stage": stage, "wall_s": 1,
+                                         "input_records": inputs, "output_records": outputs}) + "\n")
+
+        rows = preview_run.survival_report(metrics_file, os.path.join(self.tmp_dir, "report.csv"))
+        self.assertEqual([(x["region"], x["read_pairs"], x["assigned_pct"]) for x in rows],
+                         [("ENV", 75, 75.0), ("GAG", 5, 5.0)])
+        self.assertEqual([rows[0][x] for x in ["consensus", "clean_pct", "not_contam_pct", "aligned_pct"]],
+                         [20, 80.0, 75.0, 75.0])
+
+
+if __name__ == '__main__':
+    unittest.main()
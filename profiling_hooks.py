@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import re
+import argparse
+from glob import glob
+
+
+__author__ = 'Colin Anthony'
+
+# set NGS_PIPELINE_PROFILE to a folder to profile every script's main, child processes inherit the setting
+PROFILE_ENV = "NGS_PIPELINE_PROFILE"
+# set NGS_PIPELINE_TRACEMALLOC to N to also write the top N memory allocation sites
+TRACEMALLOC_ENV = "NGS_PIPELINE_TRACEMALLOC"
+# the merged stats of merge_profiles are dumped to <report> + MERGED_SUFFIX, which the next merge skips
+MERGED_SUFFIX = "_merged.prof"
+
+# the profilers of the run_main calls that are running in this process, innermost last
+_active_profilers = []
+
+
+def enable_from_config(pipeline_settings):
+    """
+    switch profiling on for this process and the processes it starts, from the pipelineSettings of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    profile_dir = pipeline_settings.get("profile_dir", "")
+    if profile_dir:
+        os.environ[PROFILE_ENV] = os.path.abspath(profile_dir)
+        tracemalloc_top = pipeline_settings.get("profile_tracemalloc_top", 0)
+        if tracemalloc_top:
+            os.environ[TRACEMALLOC_ENV] = str(tracemalloc_top)
+
+
+def profile_file_prefix(profile_dir, stage, label):
+    """
+    build a unique file prefix for one profiled invocation
+    :param profile_dir: (str) the folder for the profile files
+    :param stage: (str) the name of the stage/script
+    :param label: (str) patient/region/sample label for this invocation
+    :return: (str) path and file prefix
+    """
+    label = re.sub(r"[^A-Za-z0-9_.-]+", "_", str(label)).strip("_")
+    name = "{0}_{1}_{2}".format(label, stage, os.getpid()) if label else "{0}_{1}".format(stage, os.getpid())
+    prefix = os.path.join(profile_dir, name)
+    # eg: watch mode runs step 2 on the same region again in the same process
+    number = 1
+    while os.path.exists(prefix + ".prof"):
+        number += 1
+        prefix = os.path.join(profile_dir, "{0}_{1}".format(name, number))
+
+    return prefix
+
+
+def run_main(main_func, stage, label, *args, **kwargs):
+    """
+    call a script's main function, under cProfile (and tracemalloc) if profiling was switched on. A run_main call
+    inside another one, eg: step 2 for each region inside demultiplex, writes its own profile and the outer profile is
+    paused meanwhile, so merge_profiles doesn't count the time twice
+    :param main_func: (func) the main function of the script
+    :param stage: (str) the name of the stage/script, used in the profile file name
+    :param label: (str) patient/region/sample label for this invocation, used in the profile file name
+    :param args: the arguments for main_func
+    :param kwargs: the keyword arguments for main_func
+    :return: the return value of main_func
+    """
+    profile_dir = os.environ.get(PROFILE_ENV, "")
+    if not profile_dir:
+        return main_func(*args, **kwargs)
+
+    import cProfile
+    os.makedirs(profile_dir, exist_ok=True)
+    prefix = profile_file_prefix(profile_dir, stage, label)
+    tracemalloc_top = int(os.environ.get(TRACEMALLOC_ENV, "0") or 0)
+    started_tracemalloc = False
+    if tracemalloc_top:
+        import tracemalloc
+        # a nested call shares the tracing of the outer one
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            started_tracemalloc = True
+
+    outer = _active_profilers[-1] if _active_profilers else None
+    if outer is not None:
+        outer.disable()
+    profiler = cProfile.Profile()
+    _active_profilers.append(profiler)
+    try:
+        return profiler.runcall(main_func, *args, **kwargs)
+    finally:
+        _active_profilers.pop()
+        if outer is not None:
+            outer.enable()
+        profiler.dump_stats(prefix + ".prof")
+        if tracemalloc_top:
+            snapshot = tracemalloc.take_snapshot()
+            if started_tracemalloc:
+                tracemalloc.stop()
+            with open(prefix + "_tracemalloc.txt", 'w') as handle:
+                handle.write("Top {0} allocation sites for {1}\n".format(tracemalloc_top, os.path.split(prefix)[-1]))
+                for stat in snapshot.statistics('lineno')[:tracemalloc_top]:
+                    handle.write("{}\n".format(stat))
+        print("Profile written to: {}.prof".format(prefix))
+
+
+def merge_profiles(profile_dir, outfile, top_n, sort_key):
+    """
+    merge all the .prof files of a run into one hot-function report
+    :param profile_dir: (str) the folder with the .prof files
+    :param outfile: (str) path and name of the text report, the merged stats are also dumped to outfile +
+    MERGED_SUFFIX
+    :param top_n: (int) the number of functions to report
+    :param sort_key: (str) pstats sort key (cumulative, tottime, ncalls)
+    :return: (int) the number of profiles merged
+    """
+    import pstats
+    # the merged stats of earlier merges would count their profiles twice
+    profile_files = sorted(x for x in glob(os.path.join(profile_dir, "*.prof")) if not x.endswith(MERGED_SUFFIX))
+    if not profile_files:
+        print("No .prof files found in {}".format(profile_dir))
+        return 0
+
+    with open(outfile, 'w') as handle:
+        handle.write("Merged {0} profiles from {1}\n\n".format(len(profile_files), profile_dir))
+        stats = pstats.Stats(profile_files[0], stream=handle)
+        for profile_file in profile_files[1:]:
+            stats.add(profile_file)
+        stats.strip_dirs().sort_stats(sort_key).print_stats(top_n)
+        stats.dump_stats(outfile + MERGED_SUFFIX)
+
+    return len(profile_files)
+
+
+def main(profile_dir, outfile, top_n, sort_key):
+
+    number_merged = merge_profiles(profile_dir, outfile, top_n, sort_key)
+    if number_merged:
+        print("Hot-function report for {0} profiles written to {1}".format(number_merged, outfile))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Merges the cProfile output of all the profiled scripts in a run '
+                                                 'into one hot-function report. Switch profiling on with the '
+                                                 'profile_dir config setting or the {} environment '
+                                                 'variable'.format(PROFILE_ENV),
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--profile_dir', default=argparse.SUPPRESS, type=str,
+                        help='The folder containing the .prof files', required=True)
+    parser.add_argument('-o', '--outfile', default=argparse.SUPPRESS, type=str,
+                        help='The path and name for the report', required=True)
+    parser.add_argument('-n', '--top_n', default=40, type=int,
+                        help='The number of functions to report', required=False)
+    parser.add_argument('-s', '--sort', default="cumulative", type=str,
+                        choices=["cumulative", "tottime", "ncalls"],
+                        help='The sort order for the report', required=False)
+
+    args = parser.parse_args()
+    profile_dir = args.profile_dir
+    outfile = args.outfile
+    top_n = args.top_n
+    sort_key = args.sort
+
+    main(profile_dir, outfile, top_n, sort_key)
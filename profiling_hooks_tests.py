@@ -0,0 +1,113 @@
+import os
+import sys
+import shutil
+import tempfile
+import pstats
+import unittest
+import subprocess
+from unittest import mock
+import profiling_hooks
+from profiling_hooks import PROFILE_ENV
+from profiling_hooks import TRACEMALLOC_ENV
+from profiling_hooks import merge_profiles
+from profiling_hooks import run_main
+
+# a script that exits with the code of its main, which fails with SystemExit like the pipeline scripts
+SCRIPT = """
+import sys
+sys.path.insert(0, {0!r})
+import profiling_hooks
+
+
+def main(code):
+    if code == 4:
+        sys.exit(code)
+    return code
+
+
+sys.exit(profiling_hooks.run_main(main, "clean", "CAP1_env", int(sys.argv[1])))
+"""
+
+
+def add(a, b=0):
+    return [a + b for _ in range(1000)][0]
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.profile_dir = os.path.join(self.tmp_dir, "profiles")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_profile_is_written(self):
+        with mock.patch.dict(os.environ, {PROFILE_ENV: self.profile_dir, TRACEMALLOC_ENV: ""}):
+            self.assertEqual(run_main(add, "clean", "CAP1/env 1", 1, 2), 3)
+        self.assertEqual(os.listdir(self.profile_dir), ["CAP1_env_1_clean_{}.prof".format(os.getpid())])
+
+    def test_tracemalloc_snapshot_is_written(self):
+        with mock.patch.dict(os.environ, {PROFILE_ENV: self.profile_dir, TRACEMALLOC_ENV: "5"}):
+            run_main(add, "align", "CAP1_gag", 1, 2)
+        prefix = os.path.join(self.profile_dir, "CAP1_gag_align_{}".format(os.getpid()))
+        self.assertTrue(os.path.isfile(prefix + ".prof"))
+        with open(prefix + "_tracemalloc.txt") as handle:
+            lines = handle.readlines()
+        self.assertEqual(lines[0], "Top 5 allocation sites for CAP1_gag_align_{}\n".format(os.getpid()))
+        self.assertLessEqual(len(lines), 6)
+
+    def test_nested_profiles(self):
+        def demultiplex():
+            add(1, 2)
+            for region in ["ENV", "ENV", "GAG"]:
+                run_main(add, "step_2", "CAP1_" + region, 1, b=2)
+
+        with mock.patch.dict(os.environ, {PROFILE_ENV: self.profile_dir, TRACEMALLOC_ENV: ""}):
+            run_main(demultiplex, "demultiplex", "config")
+        pid = os.getpid()
+        self.assertEqual(sorted(os.listdir(self.profile_dir)),
+                         ["CAP1_ENV_step_2_{}.prof".format(pid), "CAP1_ENV_step_2_{}_2.prof".format(pid),
+                          "CAP1_GAG_step_2_{}.prof".format(pid), "config_demultiplex_{}.prof".format(pid)])
+        # the outer profile was paused while the regions ran
+        stats = pstats.Stats(os.path.join(self.profile_dir, "config_demultiplex_{}.prof".format(pid)))
+        self.assertEqual([v[0] for k, v in stats.stats.items() if k[2] == "add"], [1])
+
+    def test_switched_off(self):
+        with mock.patch.dict(os.environ, {PROFILE_ENV: ""}):
+            self.assertEqual(run_main(add, "clean", "CAP1_env", 1, 2), 3)
+        self.assertFalse(os.path.exists(self.profile_dir))
+
+    def test_exit_code_is_unchanged(self):
+        script = os.path.join(self.tmp_dir, "script.py")
+        with open(script, 'w') as handle:
+            handle.write(SCRIPT.format(os.path.dirname(os.path.abspath(profiling_hooks.__file__))))
+        for profile_dir in ["", self.profile_dir]:
+            env = dict(os.environ, **{PROFILE_ENV: profile_dir})
+            for code in [0, 3, 4]:
+                result = subprocess.run([sys.executable, script, str(code)], env=env, stdout=subprocess.DEVNULL)
+                self.assertEqual(result.returncode, code)
+        # the script that exits from its main is profiled too
+        self.assertEqual(len(os.listdir(self.profile_dir)), 3)
+
+    def test_merge_profiles(self):
+        with mock.patch.dict(os.environ, {PROFILE_ENV: self.profile_dir, TRACEMALLOC_ENV: ""}):
+            run_main(add, "clean", "CAP1_env", 1, 2)
+            run_main(add, "align", "CAP1_env", 1, 2)
+        outfile = os.path.join(self.tmp_dir, "report.txt")
+        self.assertEqual(merge_profiles(self.profile_dir, outfile, 10, "cumulative"), 2)
+        with open(outfile) as handle:
+            report = handle.read()
+        self.assertTrue(report.startswith("Merged 2 profiles from {}\n".format(self.profile_dir)))
+        self.assertIn("(add)", report)
+        self.assertTrue(os.path.isfile(outfile + profiling_hooks.MERGED_SUFFIX))
+        # a report written into the profile folder is not merged into the next one
+        report = os.path.join(self.profile_dir, "report.txt")
+        self.assertEqual(merge_profiles(self.profile_dir, report, 10, "cumulative"), 2)
+        self.assertEqual(merge_profiles(self.profile_dir, report, 10, "cumulative"), 2)
+        self.assertEqual(merge_profiles(os.path.join(self.tmp_dir, "empty"), outfile + "2", 10, "cumulative"), 0)
+        self.assertFalse(os.path.exists(outfile + "2"))
+
+
+if __name__ == '__main__':
+    unittest.main()
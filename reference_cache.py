@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import functools
+
+
+__author__ = 'Colin Anthony'
+
+
+# key = (kind, file name, modification time), value = the parsed file
+_cache = {}
+
+
+def cached(kind, file_name, loader):
+    """
+    parse a reference file once per process, eg: the reference sequences or a region table. A long-lived process
+    (pipeline_daemon.py) keeps the parsed files for all its jobs, a changed file is parsed again
+    :param kind: (str) the kind of parse, so one file can be cached in different forms
+    :param file_name: (str) the file
+    :param loader: (func) called without arguments to parse the file
+    :return: the parsed file, callers must not modify it
+    """
+    file_name = os.path.abspath(file_name)
+    key = (kind, file_name, os.path.getmtime(file_name))
+    if key not in _cache:
+        _cache[key] = loader()
+
+    return _cache[key]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_pattern(pattern, flags=0):
+    """
+    compile a (fuzzy) regex pattern once per process
+    :param pattern: (str) the pattern
+    :param flags: (int) regex flags, eg: regex.BESTMATCH
+    :return: the compiled pattern
+    """
+    import regex
+
+    return regex.compile(pattern, flags)
+
+
+def cache_info():
+    """
+    :return: (dict) the number of cached files and compiled patterns
+    """
+    return {"files": len(_cache), "patterns": compile_pattern.cache_info().currsize}
@@ -2,45 +2,36 @@
 from __future__ import print_function
 from __future__ import division
 import argparse
-from itertools import groupby
 import os
 import collections
+import profiling_hooks
+from seq_io import py3_fasta_iter
+from seq_io import open_seq
+from seq_io import plain_name
+from seq_io import storage_name
+from seq_io import record_names
+from seq_io import collapsed_header
+from seq_io import collapse_records
+from memory_budget import use_streaming
 
 
 __author__ = 'Colin Anthony'
 
 
-def py3_fasta_iter(fasta_name):
+def unique_seqs(file_name):
     """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
+    :param file_name: The fasta formatted file to read from, its records may already be collapsed
+    :return: a dictionary of each unique sequence under its first name and a dictionary of the names of each unique
+    sequence, both keyed by the first name: {sequence_id: sequence_string}, {sequence_id: [sequence_id, id_2, etc.]}
     """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
+    records = ((k.replace(" ", "_"), str(v).replace("~", "_").upper()) for k, v in py3_fasta_iter(file_name))
+    dct = collections.OrderedDict()
+    names_d = collections.OrderedDict()
+    for names, seq in collapse_records(records):
+        dct[names[0]] = seq
+        names_d[names[0]] = names
 
-
-def fasta_to_dct(file_name):
-    """
-    :param file_name: The fasta formatted file to read from.
-    :return: a dictionary of the contents of the file name given. Dictionary in the format:
-    {sequence_id: sequence_string, id_2: sequence_2, etc.}
-    """
-    dct = collections.defaultdict(str)
-    my_gen = py3_fasta_iter(file_name)
-    for k, v in my_gen:
-        new_key = k.replace(" ", "_")
-        if new_key in dct.keys():
-            print("Duplicate sequence ids found. Exiting")
-            raise KeyError("Duplicate sequence ids found")
-        dct[new_key] = str(v).replace("~", "_").upper()
-
-    return dct
+    return dct, names_d
 
 
 def translate_dna(sequence):
@@ -138,9 +129,10 @@ def stops_remove(d, frame):
     return good_d, bad_d, stops
 
 
-def length_check(d):
+def length_check(d, length):
     """
     :param d: (dict) dictionary of sequence names and DNA sequences)
+    :param length: (int) the minimum sequence length
     :return: (dict) dictionary with short sequences removed
     """
     short = 0
@@ -158,20 +150,66 @@ def length_check(d):
     return n_d, bad_d, short
 
 
-def main(infile, outp, frame, stops, length, logfile):
-
-    # set outfile names
-    n = os.path.split(infile)[1]
+def clean_streaming(infile, outfile_good, frame, stops, length):
+    """
+    clean the sequences one at a time and write the kept ones as they are read, for inputs too large to hold in
+    memory. Each record goes through the same checks as in main, so the same sequences are kept, but duplicate
+    sequences are not collapsed
+    :param infile: (str) the fasta file to clean
+    :param outfile_good: (str) the file for the kept sequences
+    :param frame: (int) the reading frame (1, 2 or 3)
+    :param stops: (bool) remove sequences with stop codons
+    :param length: (int) the minimum sequence length, None to keep short sequences
+    :return: (int) number of input sequences, (int) degenerate, (int) with stops, (int) short
+    """
+    inseq_no = degen_no = stops_no = short_no = 0
+    names = set()
+    with open_seq(outfile_good, "w", stage="clean") as handle:
+        for name, seq in py3_fasta_iter(infile):
+            name = name.replace(" ", "_")
+            # a collapsed record counts once for each of its names
+            weight = len(record_names(name))
+            if name in names:
+                print("Duplicate sequence ids found. Exiting")
+                raise KeyError("Duplicate sequence ids found")
+            names.add(name)
+            inseq_no += weight
+            record_d, bad_d, degen = degen_remove({name: str(seq).replace("~", "_").upper()})
+            degen_no += degen * weight
+            if stops and record_d:
+                record_d, bad_d, stop = stops_remove(record_d, int(frame) - 1)
+                stops_no += stop * weight
+            if length is not None and record_d:
+                record_d, bad_d, short = length_check(record_d, length)
+                short_no += short * weight
+            for seq_name, clean_seq in record_d.items():
+                handle.write(">{0}\n{1}\n".format(seq_name, clean_seq))
+
+    return inseq_no, degen_no, stops_no, short_no
+
+
+def main(infile, outp, frame, stops, length, logfile, memory_budget=None):
+
+    # set outfile names, the cleaned file is compressed if NGS_PIPELINE_COMPRESSION is set
+    n = plain_name(os.path.split(infile)[1])
     out_gd = n.replace(".fasta", '_clean.fasta')
     # out_bd = n.replace(".fasta", '_dirty.fa')
-    outfile_good = os.path.join(outp, out_gd)
+    outfile_good = storage_name(os.path.join(outp, out_gd))
     # outfile_bad = os.path.join(outp, out_bd)
-    d = fasta_to_dct(infile)
-    inseq_no = len(d)
+    if use_streaming("clean", [infile], memory_budget):
+        inseq_no, degen_no, stops_no, short_no = clean_streaming(infile, outfile_good, frame, stops, length)
+        kept = inseq_no - degen_no - stops_no - short_no
+        write_stats(infile, logfile, inseq_no, degen_no, stops_no, short_no, kept, stops, length)
+        return
+
+    # the checks are run once for each unique sequence, and the counts weighted by the number of names it has
+    d, names_d = unique_seqs(infile)
+    inseq_no = sum(len(x) for x in names_d.values())
 
     # remove sequences with degenerate bases
     print('removing degenerates')
     cln1_d, bad_d1, degen_no = degen_remove(d)
+    degen_no = sum(len(names_d[x]) for x in bad_d1)
 
     # remove sequences with stop codons
     stops_no = 0
@@ -180,6 +218,7 @@ def main(infile, outp, frame, stops, length, logfile):
         # account for python zero indexing
         frame = int(frame) - 1
         cln2_d, bad_d2, stops_no = stops_remove(cln1_d, frame)
+        stops_no = sum(len(names_d[x]) for x in bad_d2)
     else:
         cln2_d = cln1_d
         bad_d2 = {}
@@ -191,16 +230,16 @@ def main(infile, outp, frame, stops, length, logfile):
         bad_d3 = {}
         short_no = 0
     else:
-        cln3_d, bad_d3, short_no = length_check(cln2_d)
+        cln3_d, bad_d3, short_no = length_check(cln2_d, length)
+        short_no = sum(len(names_d[x]) for x in bad_d3)
 
-    # get totals for kept and removed seqs
-    kept = len(cln3_d)
-    removed = inseq_no - kept
+    # get totals for kept seqs
+    kept = sum(len(names_d[x]) for x in cln3_d)
 
-    # write the cleaned sequences to file
-    with open(outfile_good, "w") as handle:
+    # write the cleaned sequences to file, each unique sequence once with the names of its duplicates
+    with open_seq(outfile_good, "w", stage="clean") as handle:
         for seq_name, seq in cln3_d.items():
-            handle.write(">{0}\n{1}\n".format(seq_name, seq))
+            handle.write(">{0}\n{1}\n".format(collapsed_header(names_d[seq_name]), seq))
 
     ## merge the 'bad sequence' dictionaries
     # bad_part = dict(bad_d1, **bad_d2)
@@ -211,6 +250,16 @@ def main(infile, outp, frame, stops, length, logfile):
     #     for seq_name1, seq in all_bad.items():
     #         handle.write(">{0}\n{1}\n".format(seq_name1, seq))
 
+    write_stats(infile, logfile, inseq_no, degen_no, stops_no, short_no, kept, stops, length)
+
+
+def write_stats(infile, logfile, inseq_no, degen_no, stops_no, short_no, kept, stops, length):
+    """
+    write the number of sequences removed by each check to the log file
+    """
+    n = os.path.split(infile)[1]
+    removed = inseq_no - kept
+
     # calculate stats on removed sequences for each operation
     percent_degen = round((degen_no / inseq_no) * 100, 2)
     if stops:
@@ -261,6 +310,9 @@ if __name__ == "__main__":
                         help='The minimum read length)', required=False)
     parser.add_argument('-lf', '--logfile', default=argparse.SUPPRESS, type=str,
                         help='The path and name of the log file', required=True)
+    parser.add_argument('-mb', '--memory_budget', default=None, type=float,
+                        help='Clean one sequence at a time if the file would need more memory than this (MB), '
+                             'defaults to the clean entry of NGS_PIPELINE_MEMORY_BUDGETS', required=False)
 
 
     args = parser.parse_args()
@@ -270,6 +322,7 @@ if __name__ == "__main__":
     stops = args.stops
     length = args.length
     logfile = args.logfile
+    memory_budget = args.memory_budget
 
-
-    main(infile, outpath, frame, stops, length, logfile)
+    sample = plain_name(os.path.split(infile)[-1]).replace(".fasta", "")
+    profiling_hooks.run_main(main, "clean", sample, infile, outpath, frame, stops, length, logfile, memory_budget)
@@ -0,0 +1,52 @@
+import os
+import shutil
+import tempfile
+import unittest
+from remove_bad_sequences import main
+from stage_metrics import count_records
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_streaming_matches_in_memory(self):
+        infile = os.path.join(self.tmp_dir, "s1.fasta")
+        with open(infile, 'w') as handle:
+            handle.write(">s1 a\nNNATGAAACCC\nGGGTTTNN\n>s1_b\nATGTAAAAACCCGGG\n>s1_c\nATGARACCC\n>s1_d\nATG\n")
+        outputs = []
+        for name, budget in [("memory", None), ("streaming", 0.001)]:
+            outpath = os.path.join(self.tmp_dir, name)
+            os.makedirs(outpath)
+            logfile = os.path.join(outpath, "log.txt")
+            main(infile, outpath, 1, True, 6, logfile, memory_budget=budget)
+            with open(os.path.join(outpath, "s1_clean.fasta")) as handle:
+                clean = handle.read()
+            with open(logfile) as handle:
+                log = handle.read()
+            outputs.append((clean, log))
+        self.assertEqual(outputs[0][0], ">s1_a\nATGAAACCCGGGTTT\n")
+        self.assertEqual(outputs[0], outputs[1])
+
+    def test_duplicates_are_collapsed(self):
+        infile = os.path.join(self.tmp_dir, "s1.fasta")
+        with open(infile, 'w') as handle:
+            handle.write(">s1_a\nATGAAACCC\n>s1_b\nATGARACCC\n>s1_c\nATGAAACCC\n>s1_d\nATGARACCC\n>s1_e\nATGAAACCC\n")
+        logfile = os.path.join(self.tmp_dir, "log.txt")
+        main(infile, self.tmp_dir, 1, True, 6, logfile)
+        outfile = os.path.join(self.tmp_dir, "s1_clean.fasta")
+        with open(outfile) as handle:
+            self.assertEqual(handle.read(), ">s1_a;dups=s1_c,s1_e\nATGAAACCC\n")
+        self.assertEqual(count_records(outfile), 3)
+        with open(logfile) as handle:
+            log = handle.read()
+        self.assertIn("Number of input sequences                = 5", log)
+        self.assertIn("Number of sequences with non ACGT bases  = 2 - (40.0 %)", log)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import time
+import argparse
+import collections
+
+
+__author__ = 'Colin Anthony'
+
+
+# the number of concurrent jobs and the threads per job granted to a stage
+Grant = collections.namedtuple("Grant", ["stage", "tool", "concurrency", "threads"])
+
+# the most threads each tool makes good use of, None for no limit, 1 for single threaded tools
+TOOL_MAX_THREADS = {"MotifBinner2.R": None, "pid_binner": None, "blastn": 8, "mafft": 8, "align": None,
+                    "seqmagick": 1, "remove_bad_sequences": 1, "ngs_stats_calculator": 1}
+# rough peak memory of one job in MB, used to cap concurrency when memory is short
+TOOL_MEMORY_MB = {"MotifBinner2.R": 2000, "pid_binner": 2000, "blastn": 1000, "mafft": 500, "align": 1000,
+                  "seqmagick": 300, "remove_bad_sequences": 300, "ngs_stats_calculator": 300}
+# the share of the available memory that the pipeline's jobs may use
+MEMORY_FRACTION = 0.8
+
+
+def machine_cores():
+    """
+    :return: (int) the number of cores this process may run on
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def available_memory_mb():
+    """
+    :return: (float) the memory available to new processes in MB, None if it can't be read
+    """
+    try:
+        with open("/proc/meminfo", 'r') as handle:
+            for line in handle:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _cpu_times():
+    with open("/proc/stat", 'r') as handle:
+        fields = [int(x) for x in handle.readline().split()[1:]]
+    # idle + iowait
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0)
+
+    return sum(fields), idle
+
+
+def busy_cores(interval=0.25):
+    """
+    measure how many cores are busy right now, from /proc/stat, or from the 1 minute load average if that can't be read
+    :param interval: (float) seconds to sample /proc/stat over
+    :return: (float) the number of busy cores
+    """
+    try:
+        total_1, idle_1 = _cpu_times()
+        time.sleep(interval)
+        total_2, idle_2 = _cpu_times()
+        total = total_2 - total_1
+        if total > 0:
+            return os.cpu_count() * (1 - (idle_2 - idle_1) / total)
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        return os.getloadavg()[0]
+    except (OSError, AttributeError):
+        return 0.0
+
+
+class ResourceManager(object):
+    """
+    divides the cores and memory of the machine between the jobs of each stage. Each stage asks for a grant before it
+    runs and the thread counts passed to the tools are taken from the grant. The load and free memory are measured
+    for every grant, so a busy machine gets fewer, smaller jobs. Every decision is logged
+    """
+
+    def __init__(self, cores=None, log_file=None, measure_load=True):
+        """
+        :param cores: (int) the most cores the pipeline may use, None or 0 for all the cores of the machine
+        :param log_file: (str) file to append the allocation decisions to, they are always printed
+        :param measure_load: (bool) False to ignore other work on the machine, eg: for tests
+        """
+        self.machine_cores = machine_cores()
+        self.cores = min(int(cores), self.machine_cores) if cores else self.machine_cores
+        self.log_file = log_file
+        self.measure_load = measure_load
+
+    def free_cores(self):
+        """
+        :return: (int) the cores the pipeline may use now, (float) the busy cores that were measured
+        """
+        if not self.measure_load:
+            return self.cores, 0.0
+        busy = busy_cores()
+        # busy is measured over all the cores of the machine, not just the ones this process may use
+        idle = int(round((os.cpu_count() or self.machine_cores) - busy))
+
+        return max(1, min(self.cores, idle)), busy
+
+    def grant(self, stage, tool, n_jobs, tool_limit=None, max_threads=None):
+        """
+        decide how many of a stage's jobs to run at once and how many threads each job gets
+        :param stage: (str) the name of the stage
+        :param tool: (str) the tool the jobs run
+        :param n_jobs: (int) the number of jobs in the stage
+        :param tool_limit: (int) the most jobs of this tool allowed at once, eg: from tool_limits
+        :param max_threads: (int) the most threads a job can use, defaults to the tool's entry in TOOL_MAX_THREADS
+        :return: (Grant)
+        """
+        free, busy = self.free_cores()
+        if max_threads is None:
+            max_threads = TOOL_MAX_THREADS.get(tool)
+        memory_mb = available_memory_mb()
+        job_memory = TOOL_MEMORY_MB.get(tool, 500)
+
+        concurrency = max(1, min(n_jobs, free))
+        if tool_limit:
+            concurrency = min(concurrency, tool_limit)
+        memory_cap = None
+        if memory_mb is not None:
+            memory_cap = max(1, int(memory_mb * MEMORY_FRACTION // job_memory))
+            concurrency = min(concurrency, memory_cap)
+
+        threads = max(1, free // concurrency)
+        if max_threads:
+            threads = min(threads, max_threads)
+
+        grant = Grant(stage, tool, concurrency, threads)
+        self.log("{0} {1}: jobs={2}, cores={3}/{4}, busy={5:.1f}, memory_available={6} MB, tool_limit={7}, "
+                 "memory_cap={8} -> concurrency={9}, threads={10}".format(stage, tool, n_jobs, free, self.cores, busy,
+                                                                          "?" if memory_mb is None else int(memory_mb),
+                                                                          tool_limit, memory_cap, concurrency,
+                                                                          threads))
+
+        return grant
+
+    def log(self, message):
+        line = "{0} resource allocation: {1}".format(time.strftime("%Y-%m-%d %H:%M:%S"), message)
+        print(line)
+        if self.log_file:
+            with open(self.log_file, 'a') as handle:
+                handle.write(line + "\n")
+
+
+def main(cores):
+
+    manager = ResourceManager(cores)
+    print("Machine cores: {0}, pipeline cores: {1}, available memory: {2:.0f} MB".format(manager.machine_cores,
+                                                                                       manager.cores,
+                                                                                       available_memory_mb() or 0))
+    for tool in sorted(TOOL_MAX_THREADS):
+        manager.grant("example", tool, 4)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Shows how the cores and memory of this machine would be divided '
+                                                 'between the jobs of each pipeline tool right now',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-ncpu', '--cores', default=0, type=int,
+                        help='The most cores the pipeline may use, 0 for all', required=False)
+
+    args = parser.parse_args()
+    cores = args.cores
+
+    main(cores)
@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import resource_manager
+from resource_manager import Grant
+from resource_manager import ResourceManager
+from resource_manager import busy_cores
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.log_file = os.path.join(self.tmp_dir, "allocation.log")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def grant(self, tool, n_jobs, busy=0.0, memory_mb=64000, cores=8, **kwargs):
+        # an 8 core machine with the given load and free memory
+        with mock.patch.object(resource_manager, "machine_cores", return_value=8), \
+                mock.patch("os.cpu_count", return_value=8), \
+                mock.patch.object(resource_manager, "busy_cores", return_value=busy), \
+                mock.patch.object(resource_manager, "available_memory_mb", return_value=memory_mb):
+            manager = ResourceManager(cores, log_file=self.log_file)
+            return manager.grant("stage", tool, n_jobs, **kwargs)
+
+    def test_idle_machine(self):
+        self.assertEqual(self.grant("mafft", 4), Grant("stage", "mafft", 4, 2))
+        self.assertEqual(self.grant("mafft", 20), Grant("stage", "mafft", 8, 1))
+        # one job gets the most threads the tool makes good use of
+        self.assertEqual(self.grant("mafft", 1), Grant("stage", "mafft", 1, 8))
+        self.assertEqual(self.grant("seqmagick", 2), Grant("stage", "seqmagick", 2, 1))
+        self.assertEqual(self.grant("mafft", 4, cores=4), Grant("stage", "mafft", 4, 1))
+        self.assertEqual(self.grant("mafft", 4, tool_limit=2), Grant("stage", "mafft", 2, 4))
+
+    def test_grant_under_load(self):
+        self.assertEqual(self.grant("mafft", 4, busy=6.0), Grant("stage", "mafft", 2, 1))
+        self.assertEqual(self.grant("MotifBinner2.R", 1, busy=4.2), Grant("stage", "MotifBinner2.R", 1, 4))
+        # a fully loaded machine still runs one job at a time
+        self.assertEqual(self.grant("mafft", 4, busy=12.0), Grant("stage", "mafft", 1, 1))
+
+    def test_grant_under_memory_pressure(self):
+        # 80% of 2000 MB fits three 500 MB mafft jobs
+        self.assertEqual(self.grant("mafft", 8, memory_mb=2000), Grant("stage", "mafft", 3, 2))
+        self.assertEqual(self.grant("MotifBinner2.R", 8, memory_mb=5000), Grant("stage", "MotifBinner2.R", 2, 4))
+        # too little memory for even one job still runs one at a time
+        self.assertEqual(self.grant("MotifBinner2.R", 8, memory_mb=100), Grant("stage", "MotifBinner2.R", 1, 8))
+        # the memory can't be read
+        self.assertEqual(self.grant("mafft", 4, memory_mb=None), Grant("stage", "mafft", 4, 2))
+        self.assertEqual(self.grant("mafft", 8, busy=4.0, memory_mb=1000), Grant("stage", "mafft", 1, 4))
+
+    def test_grant_is_logged(self):
+        self.grant("mafft", 8, busy=2.0, memory_mb=2000)
+        with open(self.log_file) as handle:
+            lines = handle.readlines()
+        self.assertEqual(len(lines), 1)
+        self.assertIn("stage mafft: jobs=8, cores=6/8, busy=2.0, memory_available=2000 MB", lines[0])
+        self.assertIn("memory_cap=3 -> concurrency=3, threads=2", lines[0])
+
+    def test_busy_cores(self):
+        # half the cpu time since the first sample was idle
+        with mock.patch.object(resource_manager, "_cpu_times", side_effect=[(1000, 800), (1100, 850)]), \
+                mock.patch("os.cpu_count", return_value=4):
+            self.assertAlmostEqual(busy_cores(interval=0), 2.0)
+        # fall back to the load average when /proc/stat can't be read
+        with mock.patch.object(resource_manager, "_cpu_times", side_effect=OSError), \
+                mock.patch("os.getloadavg", return_value=(1.5, 1.0, 0.5)):
+            self.assertEqual(busy_cores(interval=0), 1.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
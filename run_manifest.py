@@ -0,0 +1,287 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import time
+import fnmatch
+import hashlib
+import argparse
+import collections
+from sample_container import is_block_ref
+
+
+__author__ = 'Colin Anthony'
+
+
+MANIFEST_SUFFIX = "_run_manifest.json"
+
+
+def manifest_file(path, gene_region):
+    """
+    :param path: (str) the patient's gene region folder
+    :param gene_region: (str) the gene region
+    :return: (str) the run manifest of the gene region
+    """
+    return os.path.join(path, gene_region + MANIFEST_SUFFIX)
+
+
+def file_entry(file_name):
+    """
+    measure an output file, or sample container block, for the manifest
+    :param file_name: (str) the file or block reference
+    :return: (OrderedDict) the file, its size, mtime, number of records and sha256 checksum, None if it does not exist
+    """
+    # imported here so that the scripts start quickly
+    from seq_io import plain_name
+    from stage_metrics import count_records
+    sha256 = hashlib.sha256()
+    if is_block_ref(file_name):
+        from sample_container import block_entry
+        from sample_container import open_block
+        entry = block_entry(file_name)
+        if entry is None:
+            return None
+        with open_block(file_name, 'rb') as handle:
+            sha256.update(handle.read())
+        return collections.OrderedDict([("file", file_name), ("bytes", entry["length"]), ("mtime_ns", None),
+                                        ("records", entry["records"]), ("sha256", sha256.hexdigest())])
+
+    if not os.path.isfile(file_name):
+        return None
+    stat = os.stat(file_name)
+    with open(file_name, 'rb') as handle:
+        for block in iter(lambda: handle.read(1024 * 1024), b""):
+            sha256.update(block)
+    records = None
+    if plain_name(file_name).endswith((".fasta", ".fastq", ".fa", ".fq")):
+        records = count_records(file_name)
+
+    return collections.OrderedDict([("file", file_name), ("bytes", stat.st_size), ("mtime_ns", stat.st_mtime_ns),
+                                    ("records", records), ("sha256", sha256.hexdigest())])
+
+
+class RunManifest(object):
+    """
+    the outputs that each stage of step 2 wrote for a patient and gene region, with their record counts and
+    checksums. Later stages and the stats calculator read their inputs and counts from here instead of listing folders
+    and parsing files again. The manifest is written by the single step 2 process of the region, and replaced
+    atomically so a reader never sees half of it
+    """
+
+    def __init__(self, file_name, patient=None, gene_region=None):
+        """
+        :param file_name: (str) the manifest, created by the first register
+        :param patient: (str) the patient/participant name
+        :param gene_region: (str) the gene region
+        """
+        self.file_name = file_name
+        self.patient = patient
+        self.gene_region = gene_region
+
+    def load(self):
+        """
+        :return: (dict) the manifest, with an empty stages dict if it does not exist yet
+        """
+        if os.path.isfile(self.file_name):
+            with open(self.file_name, 'r') as handle:
+                return json.load(handle, object_pairs_hook=collections.OrderedDict)
+
+        return collections.OrderedDict([("patient", self.patient), ("region", self.gene_region),
+                                        ("stages", collections.OrderedDict())])
+
+    def _save(self, manifest):
+        tmp_file = self.file_name + ".part"
+        with open(tmp_file, 'w') as handle:
+            json.dump(manifest, handle, indent=1)
+        os.replace(tmp_file, self.file_name)
+
+    def register(self, stage, files):
+        """
+        record the outputs of a stage, replacing what an earlier run of the stage recorded. Missing files (eg: of a
+        failed job) are left out
+        :param stage: (str) the stage name
+        :param files: (list) the output files or sample container blocks
+        :return: (list) the entries of the files that exist
+        """
+        entries = [x for x in (file_entry(f) for f in files) if x is not None]
+        manifest = self.load()
+        manifest["stages"][stage] = collections.OrderedDict([("time", time.strftime("%Y-%m-%d %H:%M:%S")),
+                                                             ("files", entries)])
+        self._save(manifest)
+
+        return entries
+
+    def discard(self, stage):
+        """
+        forget the outputs of a stage, eg: when it failed, so that a later stage does not read those of an earlier run
+        :param stage: (str) the stage name
+        :return: None
+        """
+        if not os.path.isfile(self.file_name):
+            return
+        manifest = self.load()
+        if manifest["stages"].pop(stage, None) is not None:
+            self._save(manifest)
+
+    def entries(self, stage, pattern=None):
+        """
+        :param stage: (str) the stage name
+        :param pattern: (str) a glob pattern for the file names, eg: *_good.fasta
+        :return: (list) the entries of the stage's outputs, None if the stage is not in the manifest
+        """
+        stage_d = self.load()["stages"].get(stage)
+        if stage_d is None:
+            return None
+
+        return [x for x in stage_d["files"]
+                if pattern is None or fnmatch.fnmatchcase(_base_name(x["file"]), pattern)]
+
+    def files(self, stage, pattern=None):
+        """
+        :param stage: (str) the stage name
+        :param pattern: (str) a glob pattern for the file names, eg: *_good.fasta
+        :return: (list) the stage's outputs that still exist, None if the stage is not in the manifest or none of its
+        outputs are left, so that the caller falls back to searching the folders
+        """
+        entries = self.entries(stage, pattern)
+        if entries is None:
+            return None
+        files = [x["file"] for x in entries if is_block_ref(x["file"]) or os.path.isfile(x["file"])]
+
+        return files if files or not entries else None
+
+    def lookup(self, file_name):
+        """
+        :param file_name: (str) a file or block reference
+        :return: (dict) its latest entry if the file has not changed since it was registered, otherwise None
+        """
+        for stage_d in reversed(list(self.load()["stages"].values())):
+            for entry in stage_d["files"]:
+                if entry["file"] != file_name:
+                    continue
+                if is_block_ref(file_name):
+                    from sample_container import block_entry
+                    block = block_entry(file_name)
+                    return entry if block is not None and block["length"] == entry["bytes"] else None
+                if not os.path.isfile(file_name):
+                    return None
+                stat = os.stat(file_name)
+                if stat.st_size == entry["bytes"] and stat.st_mtime_ns == entry["mtime_ns"]:
+                    return entry
+                return None
+
+        return None
+
+    def relocate(self, old_folder, new_folder):
+        """
+        point the entries of the files in a folder to the folder they were moved to, eg: when a temp folder is
+        committed to its permanent folder
+        :param old_folder: (str) the folder the files were registered in
+        :param new_folder: (str) the folder they are in now
+        :return: None
+        """
+        if not os.path.isfile(self.file_name):
+            return
+        old_folder = os.path.abspath(old_folder) + os.sep
+        new_folder = os.path.abspath(new_folder) + os.sep
+        manifest = self.load()
+        for stage_d in manifest["stages"].values():
+            for entry in stage_d["files"]:
+                if entry["file"].startswith(old_folder):
+                    entry["file"] = new_folder + entry["file"][len(old_folder):]
+        self._save(manifest)
+
+    def verify(self):
+        """
+        compare the registered files with the files on disk
+        :return: (list) of (file, problem) for the files that are missing or whose checksum changed
+        """
+        problems = []
+        for stage_d in self.load()["stages"].values():
+            for entry in stage_d["files"]:
+                current = file_entry(entry["file"])
+                if current is None:
+                    problems.append((entry["file"], "missing"))
+                elif current["sha256"] != entry["sha256"]:
+                    problems.append((entry["file"], "checksum changed"))
+
+        return problems
+
+
+def registered_files(manifest, stage, search, pattern=None):
+    """
+    :param manifest: (RunManifest) the run manifest, or None
+    :param stage: (str) the stage that wrote the files
+    :param search: (str) glob pattern for the files, or sample container blocks, used if the stage is not registered
+    :param pattern: (str) a glob pattern for the names of the registered files, eg: *_good.fasta
+    :return: (list) the files the stage registered, or the files found by the search
+    """
+    files = manifest.files(stage, pattern) if manifest is not None else None
+    if files is None:
+        # imported here so that the scripts start quickly
+        from seq_io import seq_glob
+        return seq_glob(search)
+
+    return files
+
+
+def committed_files(manifest, stage, search, pattern=None):
+    """
+    the files a stage registered in this run, and the files of earlier runs that were committed to the same folders and
+    not replaced, eg: the samples of a gene region that were processed before new samples were added
+    :param manifest: (RunManifest) the run manifest, or None
+    :param stage: (str) the stage that wrote the files
+    :param search: (str/list) glob patterns for the committed files, or sample container blocks
+    :param pattern: (str) a glob pattern for the names of the registered files, eg: *_good.fasta
+    :return: (list) the files
+    """
+    # imported here so that the scripts start quickly
+    from seq_io import seq_glob
+
+    files = list((manifest.files(stage, pattern) if manifest is not None else None) or [])
+    names = set(_base_name(x) for x in files)
+    for one_search in ([search] if isinstance(search, str) else search):
+        for file in seq_glob(one_search):
+            if _base_name(file) not in names:
+                names.add(_base_name(file))
+                files.append(file)
+
+    return files
+
+
+def _base_name(file_name):
+    # imported here so that the scripts start quickly
+    from seq_io import plain_name
+
+    return plain_name(os.path.basename(file_name))
+
+
+def main(infile, verify):
+
+    manifest = RunManifest(infile)
+    for stage, stage_d in manifest.load()["stages"].items():
+        records = sum(x["records"] or 0 for x in stage_d["files"])
+        print("{0:<20}{1:>8} files{2:>12} records  {3}".format(stage, len(stage_d["files"]), records, stage_d["time"]))
+
+    if verify:
+        problems = manifest.verify()
+        for file_name, problem in problems:
+            print("{0}: {1}".format(problem, file_name))
+        print("{} files differ from the manifest".format(len(problems)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lists the stage outputs recorded in the run manifest of a patient '
+                                                 'and gene region, and checks them against the files',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--infile', default=argparse.SUPPRESS, type=str,
+                        help='The run manifest (<gene_region>_run_manifest.json)', required=True)
+    parser.add_argument('-v', '--verify', default=False, action='store_true',
+                        help='Check that the files still exist and match their checksums', required=False)
+
+    args = parser.parse_args()
+    infile = args.infile
+    verify = args.verify
+
+    main(infile, verify)
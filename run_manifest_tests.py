@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+from stage_metrics import record_stage
+from run_manifest import RunManifest
+from run_manifest import registered_files
+from run_manifest import committed_files
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = RunManifest(os.path.join(self.tmp_dir, "ENV_run_manifest.json"), "CAP1", "ENV")
+        self.temp_folder = os.path.join(self.tmp_dir, "2cleaned_temp")
+        os.makedirs(self.temp_folder)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        file_name = os.path.join(self.temp_folder, name)
+        with open(file_name, 'w') as handle:
+            handle.write(content)
+        return file_name
+
+    def test_stage_outputs_are_registered_and_found(self):
+        s1 = self.write("s1_clean.fasta", ">a\nACGT\n>b\nACGT\n")
+        s2 = self.write("s2_clean.fasta", ">c\nACGT\n")
+        metrics_file = os.path.join(self.tmp_dir, "metrics.jsonl")
+        with record_stage(metrics_file, "CAP1", "ENV", "clean", manifest=self.manifest) as record:
+            record["outputs"] = [s1, s2, os.path.join(self.temp_folder, "failed_clean.fasta")]
+
+        self.assertEqual(self.manifest.files("clean", "s2*"), [s2])
+        self.assertEqual(self.manifest.lookup(s1)["records"], 2)
+        # a stage that is not registered falls back to the search
+        search = os.path.join(self.temp_folder, "*.fasta")
+        self.assertEqual(sorted(registered_files(self.manifest, "contam", search)), [s1, s2])
+
+        with open(s1, 'a') as handle:
+            handle.write(">d\nACGT\n")
+        self.assertIsNone(self.manifest.lookup(s1))
+        self.assertEqual(self.manifest.verify(), [(s1, "checksum changed")])
+
+    def test_relocate_and_discard(self):
+        s1 = self.write("s1_clean.fasta", ">a\nACGT\n")
+        self.manifest.register("clean", [s1])
+        perm_folder = os.path.join(self.tmp_dir, "2cleaned")
+        os.rename(self.temp_folder, perm_folder)
+        self.manifest.relocate(self.temp_folder, perm_folder)
+        self.assertEqual(self.manifest.files("clean"), [os.path.join(perm_folder, "s1_clean.fasta")])
+        self.assertEqual(self.manifest.verify(), [])
+
+        with self.assertRaises(ValueError):
+            with record_stage(False, "CAP1", "ENV", "clean", manifest=self.manifest):
+                raise ValueError("the stage failed")
+        self.assertIsNone(self.manifest.files("clean"))
+
+    def test_committed_files_include_earlier_runs(self):
+        s1 = self.write("s1_clean.fasta", ">a\nACGT\n")
+        # a sample committed by an earlier run, and this run's copy of s1 in another folder
+        s0 = self.write("s0_clean.fasta", ">b\nACGT\n")
+        new_folder = os.path.join(self.tmp_dir, "new")
+        os.makedirs(new_folder)
+        s1_new = os.path.join(new_folder, "s1_clean.fasta")
+        shutil.copy(s1, s1_new)
+        self.manifest.register("clean", [s1_new])
+
+        search = os.path.join(self.temp_folder, "*.fasta")
+        self.assertEqual(committed_files(self.manifest, "clean", search), [s1_new, s0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+from tool_runner import ENV_PREFIX
+
+
+__author__ = 'Colin Anthony'
+
+
+# the NGS_PIPELINE_* settings the process was started with (eg: exported in the shell), kept when the settings of a
+# run are applied
+_STARTUP_ENV = {k: v for k, v in os.environ.items() if k.startswith(ENV_PREFIX)}
+
+
+def apply_pipeline_settings(pipeline_settings):
+    """
+    apply the pipelineSettings of a run to this process and the processes it starts. The NGS_PIPELINE_* settings of
+    an earlier run are cleared first, so a process that runs the tasks of several runs only has the settings of this
+    one
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    # imported here so that the scripts start quickly
+    import tool_runner
+    import supervisor
+    import profiling_hooks
+    import memory_budget
+    import seq_io
+    import sample_container
+    import subsample_reads
+    import call_motifbinner
+    import pid_binner
+    import binning_cache
+
+    for key in [x for x in os.environ if x.startswith(ENV_PREFIX)]:
+        del os.environ[key]
+    os.environ.update(_STARTUP_ENV)
+
+    tool_runner.enable_from_config(pipeline_settings)
+    supervisor.enable_from_config(pipeline_settings)
+    profiling_hooks.enable_from_config(pipeline_settings)
+    memory_budget.enable_from_config(pipeline_settings)
+    seq_io.enable_from_config(pipeline_settings)
+    sample_container.enable_from_config(pipeline_settings)
+    subsample_reads.enable_from_config(pipeline_settings)
+    call_motifbinner.enable_from_config(pipeline_settings)
+    pid_binner.enable_from_config(pipeline_settings)
+    binning_cache.enable_from_config(pipeline_settings)
@@ -0,0 +1,26 @@
+import os
+import unittest
+from unittest import mock
+import run_settings
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_settings_of_an_earlier_run_are_cleared(self):
+        startup = {"NGS_PIPELINE_TOOL_LIMITS": "mafft=1"}
+        with mock.patch.dict(os.environ, startup, clear=True), mock.patch.object(run_settings, "_STARTUP_ENV", startup):
+            run_settings.apply_pipeline_settings({"compression": "gzip", "memory_budgets": {"clean": 10},
+                                                  "profile_dir": "/tmp/profiles"})
+            self.assertEqual(os.environ.get("NGS_PIPELINE_COMPRESSION"), "gzip")
+            self.assertIn("NGS_PIPELINE_MEMORY_BUDGETS", os.environ)
+            run_settings.apply_pipeline_settings({"max_retries": 0})
+            self.assertNotIn("NGS_PIPELINE_COMPRESSION", os.environ)
+            self.assertNotIn("NGS_PIPELINE_MEMORY_BUDGETS", os.environ)
+            self.assertEqual(os.environ.get("NGS_PIPELINE_MAX_RETRIES"), "0")
+            self.assertEqual(os.environ.get("NGS_PIPELINE_TOOL_LIMITS"), "mafft=1")
+            self.assertEqual(sorted(x for x in os.environ if x.startswith("NGS_PIPELINE_")),
+                             ["NGS_PIPELINE_MAX_RETRIES", "NGS_PIPELINE_TOOL_LIMITS"])
+
+
+if __name__ == '__main__':
+    unittest.main()
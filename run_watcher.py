@@ -0,0 +1,203 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import time
+from glob import glob
+from file_transitions import move_file
+
+
+__author__ = 'Colin Anthony'
+
+
+# seconds between looks at the fastq folder in watch mode
+WATCH_INTERVAL = 60
+# seconds that the size and modification time of a fastq file must stay the same before it is taken to be complete
+SETTLE_SECONDS = 120
+# a <fastq file>.done marker file marks a pair as complete without waiting for it to settle
+MARKER_SUFFIX = ".done"
+# the input pairs that watch mode has demultiplexed, in the output folder
+WATCH_STATE_FILE = "watch_state.json"
+# watch mode demultiplexes each pair into this folder in the output folder and then moves the files into 0new_data,
+# so step 2 never reads a half written file
+STAGING_FOLDER = "watch_staging"
+
+
+def watch_settings(pipeline_settings):
+    """
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: (float) seconds between looks, (float) seconds for a file to settle, (float) minutes without new data
+    before watch mode stops, 0 to keep watching
+    """
+    interval = float(pipeline_settings.get("watch_interval", WATCH_INTERVAL) or WATCH_INTERVAL)
+    settle = float(pipeline_settings.get("watch_settle", SETTLE_SECONDS) or 0)
+    idle = float(pipeline_settings.get("watch_idle", 0) or 0)
+
+    return interval, settle, idle
+
+
+def r2_name(r1_file):
+    """
+    :param r1_file: (str) an R1 fastq file
+    :return: (str) its R2 file, the last R1 in the name replaced with R2
+    """
+    return "R2".join(r1_file.rsplit("R1", 1))
+
+
+def stable_pairs(folder, snapshots, settle=SETTLE_SECONDS, now=None):
+    """
+    find the R1/R2 fastq pairs in a folder that are completely written: either file has a .done marker, or the size and
+    modification time of both files are the same as at the last look and more than settle seconds old
+    :param folder: (str) the folder to look in
+    :param snapshots: (dict) key = file, value = (size, mtime) at the last look, updated in place
+    :param settle: (float) seconds the files must be unchanged
+    :param now: (float) the time of this look, defaults to now
+    :return: (list) of (R1, R2) files
+    """
+    now = time.time() if now is None else now
+    pairs = []
+    for r1_file in sorted(glob(os.path.join(folder, "*R1*.fastq"))):
+        r2_file = r2_name(r1_file)
+        if not os.path.isfile(r2_file):
+            continue
+        if any(os.path.isfile(x + MARKER_SUFFIX) for x in [r1_file, r2_file]):
+            pairs.append((r1_file, r2_file))
+            continue
+        stable = True
+        for file in [r1_file, r2_file]:
+            try:
+                stat = os.stat(file)
+            except FileNotFoundError:
+                stable = False
+                continue
+            current = (stat.st_size, stat.st_mtime_ns)
+            if snapshots.get(file) != current or now - stat.st_mtime < settle:
+                stable = False
+            snapshots[file] = current
+        if stable:
+            pairs.append((r1_file, r2_file))
+
+    return pairs
+
+
+class WatchState(object):
+    """
+    the input R1 files that watch mode has demultiplexed, kept in the output folder so that a restarted watch carries on
+    where it stopped
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: (str) the state file
+        """
+        self.file_name = file_name
+        self.processed = set()
+        if os.path.isfile(file_name):
+            with open(file_name, 'r') as handle:
+                self.processed = set(json.load(handle)["processed"])
+
+    def __contains__(self, r1_file):
+        return os.path.basename(r1_file) in self.processed
+
+    def add(self, r1_file):
+        """
+        :param r1_file: (str) an input R1 file that was demultiplexed
+        :return: None
+        """
+        self.processed.add(os.path.basename(r1_file))
+        tmp_file = self.file_name + ".part"
+        with open(tmp_file, 'w') as handle:
+            json.dump({"processed": sorted(self.processed)}, handle, indent=1)
+        os.replace(tmp_file, self.file_name)
+
+
+def batch_name(file_name, batch):
+    """
+    :param file_name: (str) a fastq file name
+    :param batch: (str) a batch tag
+    :return: (str) the name with the batch tag before its last R1 (or R2), so the R1 and R2 files of a batch stay a pair
+    """
+    for read in ["R1", "R2"]:
+        if read in file_name:
+            head, tail = file_name.rsplit(read, 1)
+            return "{0}{1}_{2}{3}".format(head, batch, read, tail)
+
+    return "{0}_{1}".format(batch, file_name)
+
+
+def commit_staged(staging_root, out_dir):
+    """
+    move the demultiplexed files of a pair from the staging folder into the gene region 0new_data folders. Files
+    already in 0new_data are never changed, as a step 2 run may be reading them: if a name is taken the files of the
+    pair are moved in under a batch name, and are processed by the next step 2 run
+    :param staging_root: (str) the staging folder, with the <patient>/<gene region>/0new_data layout
+    :param out_dir: (str) the output folder
+    :return: (set) of (patient, gene region) that got new files
+    """
+    targets = []
+    for staged in sorted(glob(os.path.join(staging_root, "*", "*", "0new_data", "*"))):
+        rel_name = os.path.relpath(staged, staging_root)
+        targets.append((staged, rel_name, os.path.join(out_dir, rel_name)))
+
+    # if any name is taken, all the files of the pair get one batch tag that gives none of them a taken name
+    batch = None
+    if any(os.path.exists(x[2]) for x in targets):
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        batch = stamp
+        number = 1
+        while any(os.path.exists(os.path.join(os.path.dirname(x[2]), batch_name(os.path.basename(x[2]), batch)))
+                  for x in targets):
+            batch = "{0}_{1}".format(stamp, number)
+            number += 1
+
+    regions = set()
+    for staged, rel_name, target in targets:
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if batch:
+            target = os.path.join(os.path.dirname(target), batch_name(os.path.basename(target), batch))
+        move_file(staged, target)
+        patient, region = rel_name.split(os.sep)[:2]
+        regions.add((patient, region))
+
+    return regions
+
+
+def region_signature(out_dir, patient, region):
+    """
+    :param out_dir: (str) the output folder
+    :param patient: (str) the patient
+    :param region: (str) the gene region
+    :return: (tuple) the name, size and modification time of the fastq files waiting in the 0new_data folder, to
+    tell whether they changed since step 2 last ran on them
+    """
+    signature = []
+    for file in sorted(glob(os.path.join(out_dir, patient, region, "0new_data", "*.fastq"))):
+        try:
+            stat = os.stat(file)
+        except FileNotFoundError:
+            continue
+        signature.append((os.path.basename(file), stat.st_size, stat.st_mtime_ns))
+
+    return tuple(signature)
+
+
+def new_data_regions(out_dir, snapshots, settle=SETTLE_SECONDS):
+    """
+    find the gene regions with complete R1/R2 pairs waiting in their 0new_data folder, eg: put there by hand or left
+    for the next step 2 run
+    :param out_dir: (str) the output folder
+    :param snapshots: (dict) the file snapshots of stable_pairs
+    :param settle: (float) seconds the files must be unchanged
+    :return: (set) of (patient, gene region)
+    """
+    regions = set()
+    for folder in glob(os.path.join(out_dir, "*", "*", "0new_data")):
+        region_folder = os.path.dirname(folder)
+        region = os.path.basename(region_folder)
+        if region == "None":
+            continue
+        if stable_pairs(folder, snapshots, settle):
+            regions.add((os.path.basename(os.path.dirname(region_folder)), region))
+
+    return regions
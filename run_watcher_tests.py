@@ -0,0 +1,88 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import run_watcher
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_pair(self, name, age=0):
+        files = []
+        for read in ["R1", "R2"]:
+            file = os.path.join(self.tmp_dir, "{0}_{1}.fastq".format(name, read))
+            with open(file, 'w') as handle:
+                handle.write("@read1\nACGT\n+\nIIII\n")
+            old = time.time() - age
+            os.utime(file, (old, old))
+            files.append(file)
+        return tuple(files)
+
+    def test_pairs_are_complete_when_settled_or_marked(self):
+        settled = self.write_pair("CAP1_multiplex", age=600)
+        fresh = self.write_pair("CAP2_multiplex")
+        # an R1 file without its R2 file yet
+        with open(os.path.join(self.tmp_dir, "CAP3_multiplex_R1.fastq"), 'w') as handle:
+            handle.write("@read1\n")
+
+        snapshots = {}
+        # the first look only records the sizes
+        self.assertEqual(run_watcher.stable_pairs(self.tmp_dir, snapshots, settle=120), [])
+        self.assertEqual(run_watcher.stable_pairs(self.tmp_dir, snapshots, settle=120), [settled])
+
+        # a pair that grows is not complete, unless it is marked
+        with open(settled[1], 'a') as handle:
+            handle.write("@read2\nACGT\n+\nIIII\n")
+        self.assertEqual(run_watcher.stable_pairs(self.tmp_dir, snapshots, settle=120), [])
+        open(fresh[0] + run_watcher.MARKER_SUFFIX, 'w').close()
+        self.assertEqual(run_watcher.stable_pairs(self.tmp_dir, snapshots, settle=120), [fresh])
+
+    def test_staged_files_never_change_waiting_files(self):
+        staging = os.path.join(self.tmp_dir, "staging")
+        out_dir = os.path.join(self.tmp_dir, "out")
+        for folder in [staging, out_dir]:
+            os.makedirs(os.path.join(folder, "CAP1", "ENV", "0new_data"))
+            with open(os.path.join(folder, "CAP1", "ENV", "0new_data", "CAP1_ENV_R1.fastq"), 'w') as handle:
+                handle.write(folder)
+        with open(os.path.join(staging, "CAP1", "ENV", "0new_data", "CAP1_ENV_R2.fastq"), 'w') as handle:
+            handle.write(staging)
+        os.makedirs(os.path.join(staging, "CAP1", "GAG", "0new_data"))
+        with open(os.path.join(staging, "CAP1", "GAG", "0new_data", "CAP1_GAG_R1.fastq"), 'w') as handle:
+            handle.write("gag")
+
+        with mock.patch("time.strftime", return_value="20260101120000"):
+            self.assertEqual(run_watcher.commit_staged(staging, out_dir), {("CAP1", "ENV"), ("CAP1", "GAG")})
+        env_folder = os.path.join(out_dir, "CAP1", "ENV", "0new_data")
+        with open(os.path.join(env_folder, "CAP1_ENV_R1.fastq")) as handle:
+            self.assertEqual(handle.read(), out_dir)
+        # the new pair gets one batch name, as the R1 name was taken
+        self.assertEqual(sorted(os.listdir(env_folder)), ["CAP1_ENV_20260101120000_R1.fastq",
+                                                          "CAP1_ENV_20260101120000_R2.fastq", "CAP1_ENV_R1.fastq"])
+        with open(os.path.join(env_folder, "CAP1_ENV_20260101120000_R1.fastq")) as handle:
+            self.assertEqual(handle.read(), staging)
+        gag_folder = os.path.join(out_dir, "CAP1", "GAG", "0new_data")
+        self.assertEqual(os.listdir(gag_folder), ["CAP1_GAG_20260101120000_R1.fastq"])
+
+        # a second batch in the same second gets its own name
+        with open(os.path.join(staging, "CAP1", "ENV", "0new_data", "CAP1_ENV_R1.fastq"), 'w') as handle:
+            handle.write("third")
+        with mock.patch("time.strftime", return_value="20260101120000"):
+            run_watcher.commit_staged(staging, out_dir)
+        self.assertIn("CAP1_ENV_20260101120000_1_R1.fastq", os.listdir(env_folder))
+
+        # the processed pairs survive a restart
+        state_file = os.path.join(self.tmp_dir, run_watcher.WATCH_STATE_FILE)
+        run_watcher.WatchState(state_file).add("/data/CAP1_multiplex_R1.fastq")
+        self.assertIn("CAP1_multiplex_R1.fastq", run_watcher.WatchState(state_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,394 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import io
+import os
+import json
+import time
+import fcntl
+import struct
+import fnmatch
+import argparse
+import collections
+
+
+__author__ = 'Colin Anthony'
+
+
+# set NGS_PIPELINE_CONTAINER to 1 to keep the consensus, cleaned and contam removal fasta files of each patient and
+# region in one container file instead of the 1consensus, 2cleaned and 3contam_removal folders
+CONTAINER_ENV = "NGS_PIPELINE_CONTAINER"
+CONTAINER_SUFFIX = "_samples.ngsc"
+# a block is named like the file it replaces, relative to the region folder: <container>::2cleaned/s1_clean.fasta
+REF_SEP = "::"
+MAGIC = b"NGSCONT1"
+FOOTER_MAGIC = b"NGSCTOC1"
+# the footer is the offset and length of the table of contents, then FOOTER_MAGIC
+_FOOTER = struct.Struct(">QQ")
+_LENGTH = struct.Struct(">Q")
+FOOTER_SIZE = _FOOTER.size + len(FOOTER_MAGIC)
+# the stage whose compression level is used for the blocks in each folder
+FOLDER_STAGES = {"1consensus": "consensus", "2cleaned": "clean", "3contam_removal": "contam"}
+
+
+class ContainerError(Exception):
+    """
+    raised for a file that is not a sample container or a block that is not in it
+    """
+    pass
+
+
+def enable_from_config(pipeline_settings):
+    """
+    switch the sample containers on for this process and the processes it starts, from the pipelineSettings of the
+    config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    if pipeline_settings.get("sample_container"):
+        os.environ[CONTAINER_ENV] = "1"
+
+
+def container_from_env():
+    """
+    :return: (bool) True if the intermediates are kept in sample containers
+    """
+    return os.environ.get(CONTAINER_ENV, "") not in ("", "0")
+
+
+def container_file(path, gene_region):
+    """
+    :param path: (str) the patient's gene region folder
+    :param gene_region: (str) the gene region
+    :return: (str) the container of the gene region
+    """
+    return os.path.join(path, gene_region + CONTAINER_SUFFIX)
+
+
+def block_ref(file_name, name):
+    """
+    :param file_name: (str) the container
+    :param name: (str) the block name, eg: 2cleaned/s1_clean.fasta
+    :return: (str) a reference to the block, which the pipeline's scripts read and write like a file name
+    """
+    return file_name + REF_SEP + name
+
+
+def is_block_ref(name):
+    return REF_SEP in str(name)
+
+
+def split_ref(ref):
+    """
+    :param ref: (str) a block reference
+    :return: (str) the container, (str) the block name
+    """
+    file_name, name = str(ref).split(REF_SEP, 1)
+
+    return file_name, name.lstrip("/")
+
+
+def _count_records(data):
+    if not data:
+        return 0
+    # imported here so that the scripts start quickly
+    from seq_io import count_duplicate_names
+
+    # a collapsed record counts once for each of its names
+    return data.count(b"\n>") + (1 if data.startswith(b">") else 0) + count_duplicate_names(data)
+
+
+class SampleContainer(object):
+    """
+    one file holding the sequence sets of a patient and region as length-prefixed blocks, with a table of contents at
+    the end. Blocks are only ever appended: a block written again under the same name replaces the old one in the
+    table of contents. Appends take an exclusive lock on the file, so the concurrent jobs of a stage can share it,
+    and a torn write is recovered from by going back to the last complete table of contents
+    """
+
+    def __init__(self, file_name):
+        """
+        :param file_name: (str) the container, created by the first append
+        """
+        self.file_name = file_name
+
+    def _read_toc(self, handle):
+        """
+        :return: (OrderedDict) key = block name, value = entry dict, empty for a new container
+        """
+        handle.seek(0, os.SEEK_END)
+        end = handle.tell()
+        if end == 0:
+            return collections.OrderedDict()
+        handle.seek(0)
+        if handle.read(len(MAGIC)) != MAGIC:
+            raise ContainerError("{} is not a sample container".format(self.file_name))
+
+        # normally the footer is at the end, after a torn write it is the last one before the end
+        position = end
+        chunk_size = 1024 * 1024
+        while position > len(MAGIC):
+            start = max(len(MAGIC), position - chunk_size)
+            handle.seek(start)
+            chunk = handle.read(position - start + FOOTER_SIZE)
+            index = chunk.rfind(FOOTER_MAGIC)
+            while index >= _FOOTER.size:
+                toc_offset, toc_length = _FOOTER.unpack(chunk[index - _FOOTER.size:index])
+                footer_end = start + index + len(FOOTER_MAGIC)
+                if toc_offset + toc_length + FOOTER_SIZE == footer_end:
+                    handle.seek(toc_offset)
+                    try:
+                        entries = json.loads(handle.read(toc_length).decode())
+                        return collections.OrderedDict((entry["name"], entry) for entry in entries)
+                    except ValueError:
+                        pass
+                index = chunk.rfind(FOOTER_MAGIC, 0, index)
+            position = start
+
+        return collections.OrderedDict()
+
+    def entries(self):
+        """
+        :return: (OrderedDict) key = block name, value = dict with the offset, length, records, compression, stage
+        """
+        if not os.path.isfile(self.file_name):
+            return collections.OrderedDict()
+        with open(self.file_name, 'rb') as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH)
+            return self._read_toc(handle)
+
+    def names(self, pattern=None):
+        """
+        :param pattern: (str) a glob pattern for the block names, eg: 2cleaned/*_clean.fasta
+        :return: (list) the block names, in the order they were first written
+        """
+        return [name for name in self.entries() if pattern is None or fnmatch.fnmatchcase(name, pattern)]
+
+    def append(self, name, data, stage=None):
+        """
+        write a block
+        :param name: (str) the block name
+        :param data: (bytes) the block content, a fasta file
+        :param stage: (str) the stage writing the block, for its compression level
+        :return: (dict) the block's entry in the table of contents
+        """
+        # imported here so that the scripts start quickly
+        import seq_io
+        compression = seq_io.compression_from_env()
+        payload = data
+        level = seq_io.compression_level(stage or FOLDER_STAGES.get(name.split("/")[0]))
+        if compression == "gzip":
+            import gzip
+            payload = gzip.compress(data, compresslevel=level)
+        elif compression == "xz":
+            import lzma
+            payload = lzma.compress(data, preset=level)
+
+        entry = collections.OrderedDict([("name", name), ("offset", None), ("length", len(payload)),
+                                         ("raw_length", len(data)), ("records", _count_records(data)),
+                                         ("compression", compression), ("stage", stage),
+                                         ("time", time.strftime("%Y-%m-%d %H:%M:%S"))])
+
+        return self._write_blocks([(entry, payload)])[0]
+
+    def _write_blocks(self, blocks):
+        """
+        append blocks and then one table of contents, so a reader sees all the blocks or none of them
+        :param blocks: (list) of (entry, payload), the entry's offset is filled in
+        :return: (list) the entries
+        """
+        # open without truncating and create if missing
+        fd = os.open(self.file_name, os.O_RDWR | os.O_CREAT, 0o644)
+        with os.fdopen(fd, 'r+b') as handle:
+            fcntl.flock(handle, fcntl.LOCK_EX)
+            toc = self._read_toc(handle)
+            handle.seek(0, os.SEEK_END)
+            if handle.tell() == 0:
+                handle.write(MAGIC)
+            for entry, payload in blocks:
+                entry["offset"] = handle.tell() + _LENGTH.size
+                handle.write(_LENGTH.pack(len(payload)))
+                handle.write(payload)
+                toc.pop(entry["name"], None)
+                toc[entry["name"]] = entry
+            toc_bytes = json.dumps(list(toc.values())).encode()
+            toc_offset = handle.tell()
+            handle.write(toc_bytes)
+            handle.write(_FOOTER.pack(toc_offset, len(toc_bytes)) + FOOTER_MAGIC)
+            handle.flush()
+            os.fsync(handle.fileno())
+
+        return [x[0] for x in blocks]
+
+    def publish(self, staged_file):
+        """
+        copy all the blocks of a staged container into this one, eg: the blocks written by a run in its temp folder
+        when the run commits. The blocks replace those of the same name together, with one table of contents write
+        :param staged_file: (str) the staged container
+        :return: (list) the names of the blocks that were copied
+        """
+        staged = SampleContainer(staged_file)
+        blocks = []
+        with open(staged_file, 'rb') as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH)
+            for entry in staged._read_toc(handle).values():
+                handle.seek(entry["offset"])
+                blocks.append((collections.OrderedDict(entry), handle.read(entry["length"])))
+        if blocks:
+            self._write_blocks(blocks)
+
+        return [x[0]["name"] for x in blocks]
+
+    def read(self, name):
+        """
+        :param name: (str) the block name
+        :return: (bytes) the block content
+        """
+        if not os.path.isfile(self.file_name):
+            raise ContainerError("{} does not exist".format(self.file_name))
+        with open(self.file_name, 'rb') as handle:
+            fcntl.flock(handle, fcntl.LOCK_SH)
+            entry = self._read_toc(handle).get(name)
+            if entry is None:
+                raise ContainerError("{0} has no block {1}".format(self.file_name, name))
+            handle.seek(entry["offset"])
+            payload = handle.read(entry["length"])
+
+        if entry["compression"] == "gzip":
+            import gzip
+            return gzip.decompress(payload)
+        if entry["compression"] == "xz":
+            import lzma
+            return lzma.decompress(payload)
+
+        return payload
+
+    def export(self, out_folder, pattern=None):
+        """
+        write the blocks as plain fasta files in the classic folder layout, eg: <out_folder>/2cleaned/s1_clean.fasta
+        :param out_folder: (str) the gene region folder to write to
+        :param pattern: (str) a glob pattern for the blocks to export
+        :return: (list) the files written
+        """
+        files = []
+        for name in self.names(pattern):
+            out_file = os.path.join(out_folder, name)
+            os.makedirs(os.path.dirname(out_file), exist_ok=True)
+            with open(out_file, 'wb') as handle:
+                handle.write(self.read(name))
+            files.append(out_file)
+
+        return files
+
+
+class _BlockWriter(io.BytesIO):
+    """
+    collects what is written and appends it to the container as a block when closed
+    """
+
+    def __init__(self, container, name, stage):
+        io.BytesIO.__init__(self)
+        self._container = container
+        self._name = name
+        self._stage = stage
+
+    def close(self):
+        if not self.closed:
+            self._container.append(self._name, self.getvalue(), self._stage)
+        io.BytesIO.close(self)
+
+
+def open_block(ref, mode='r', stage=None):
+    """
+    open a block like a file: read from a copy of its content, or write a new block when the file object is closed.
+    Blocks can't be appended to, writing replaces the block
+    :param ref: (str) the block reference, <container>::<block name>
+    :param mode: (str) r or w, with b for binary
+    :param stage: (str) the stage writing the block, for its compression level
+    :return: file object
+    """
+    file_name, name = split_ref(ref)
+    container = SampleContainer(file_name)
+    if mode.startswith("r"):
+        handle = io.BytesIO(container.read(name))
+    else:
+        handle = _BlockWriter(container, name, stage)
+    if "b" in mode:
+        return handle
+
+    return io.TextIOWrapper(handle, encoding="utf-8", newline="")
+
+
+def import_files(files, file_name, folder, stage=None):
+    """
+    move fasta files into a container, eg: the consensus files written by the external tools
+    :param files: (list) the fasta files, plain or compressed, they are removed once they are in the container
+    :param file_name: (str) the container
+    :param folder: (str) the folder the blocks are named for, eg: 1consensus
+    :param stage: (str) the stage the files come from, for their compression level in the container
+    :return: (list) the references to the new blocks
+    """
+    # imported here so that the scripts start quickly
+    from seq_io import open_seq
+    from seq_io import plain_name
+    container = SampleContainer(file_name)
+    refs = []
+    for infile in files:
+        name = folder + "/" + plain_name(os.path.basename(infile))
+        with open_seq(infile, 'rb') as handle:
+            container.append(name, handle.read(), stage)
+        os.unlink(infile)
+        refs.append(block_ref(file_name, name))
+
+    return refs
+
+
+def block_entry(ref):
+    """
+    :param ref: (str) the block reference
+    :return: (dict) the block's entry in the table of contents, with its length in the container, raw_length and
+    records, or None if there is no such block
+    """
+    file_name, name = split_ref(ref)
+
+    return SampleContainer(file_name).entries().get(name)
+
+
+def main(infile, outpath, pattern, list_blocks):
+
+    container = SampleContainer(infile)
+    if list_blocks:
+        print("{0:<60}{1:>10}{2:>12}{3:>8}  {4}".format("block", "records", "bytes", "comp", "written"))
+        for name, entry in container.entries().items():
+            print("{0:<60}{1:>10}{2:>12}{3:>8}  {4}".format(name, entry["records"], entry["length"],
+                                                           entry["compression"] or "-", entry["time"]))
+        return
+
+    files = container.export(outpath, pattern)
+    print("{0} blocks exported to {1}".format(len(files), outpath))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lists or exports the blocks of a sample container, which holds the '
+                                                 'consensus, cleaned and contam removal fasta files of a patient and '
+                                                 'gene region when sample_container is set in the config file. The '
+                                                 'export writes them as plain fasta files in the classic 1consensus, '
+                                                 '2cleaned and 3contam_removal folders',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--infile', default=argparse.SUPPRESS, type=str,
+                        help='The sample container (<gene_region>_samples.ngsc)', required=True)
+    parser.add_argument('-o', '--outpath', default=None, type=str,
+                        help='The folder to export to, defaults to the folder of the container', required=False)
+    parser.add_argument('-p', '--pattern', default=None, type=str,
+                        help='Only export the blocks matching this pattern, eg: "3contam_removal/*_good.fasta"',
+                        required=False)
+    parser.add_argument('-ls', '--list', default=False, action='store_true',
+                        help='List the blocks instead of exporting them', required=False)
+
+    args = parser.parse_args()
+    infile = args.infile
+    outpath = args.outpath or os.path.dirname(os.path.abspath(infile))
+    pattern = args.pattern
+    list_blocks = args.list
+
+    main(infile, outpath, pattern, list_blocks)
@@ -0,0 +1,85 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import seq_io
+import sample_container
+from sample_container import SampleContainer
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.container = os.path.join(self.tmp_dir, "ENV" + sample_container.CONTAINER_SUFFIX)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_blocks_are_replaced_and_exported(self):
+        container = SampleContainer(self.container)
+        container.append("2cleaned/s1_clean.fasta", b">a\nACGT\n")
+        container.append("2cleaned/s2_clean.fasta", b">b\nCCCC\n>c\nGGGG\n")
+        with mock.patch.dict(os.environ, {seq_io.COMPRESSION_ENV: "gzip"}):
+            container.append("2cleaned/s1_clean.fasta", b">a\nTTTT\n")
+        self.assertEqual(container.read("2cleaned/s1_clean.fasta"), b">a\nTTTT\n")
+        self.assertEqual(container.entries()["2cleaned/s2_clean.fasta"]["records"], 2)
+        self.assertEqual(container.names("2cleaned/s2*"), ["2cleaned/s2_clean.fasta"])
+        with self.assertRaises(sample_container.ContainerError):
+            container.read("3contam_removal/s1_good.fasta")
+
+        files = container.export(os.path.join(self.tmp_dir, "export"))
+        self.assertEqual(sorted(os.path.relpath(x, self.tmp_dir) for x in files),
+                         [os.path.join("export", "2cleaned", "s1_clean.fasta"),
+                          os.path.join("export", "2cleaned", "s2_clean.fasta")])
+        with open(files[-1], 'rb') as handle:
+            self.assertEqual(handle.read(), b">a\nTTTT\n")
+
+    def test_staged_blocks_are_published_together(self):
+        container = SampleContainer(self.container)
+        container.append("2cleaned/s1_clean.fasta", b">a\nACGT\n")
+        staged = SampleContainer(os.path.join(self.tmp_dir, "staged" + sample_container.CONTAINER_SUFFIX))
+        with mock.patch.dict(os.environ, {seq_io.COMPRESSION_ENV: "gzip"}):
+            staged.append("2cleaned/s1_clean.fasta", b">a\nTTTT\n")
+        staged.append("2cleaned/s2_clean.fasta", b">b\nCCCC\n")
+        # the committed blocks are untouched until the staged ones are published
+        self.assertEqual(container.read("2cleaned/s1_clean.fasta"), b">a\nACGT\n")
+
+        self.assertEqual(container.publish(staged.file_name), ["2cleaned/s1_clean.fasta", "2cleaned/s2_clean.fasta"])
+        self.assertEqual(container.names(), ["2cleaned/s1_clean.fasta", "2cleaned/s2_clean.fasta"])
+        self.assertEqual(container.read("2cleaned/s1_clean.fasta"), b">a\nTTTT\n")
+        self.assertEqual(container.read("2cleaned/s2_clean.fasta"), b">b\nCCCC\n")
+        self.assertEqual(container.entries()["2cleaned/s1_clean.fasta"]["compression"], "gzip")
+
+    def test_torn_append_keeps_the_last_complete_table_of_contents(self):
+        container = SampleContainer(self.container)
+        container.append("1consensus/s1.fasta", b">a\nACGT\n")
+        with open(self.container, 'ab') as handle:
+            handle.write(b"\x00\x00\x00\x00\x00\x01\x00\x00>partial")
+        self.assertEqual(container.names(), ["1consensus/s1.fasta"])
+        container.append("1consensus/s2.fasta", b">b\nCCCC\n")
+        self.assertEqual(container.read("1consensus/s1.fasta"), b">a\nACGT\n")
+        self.assertEqual(container.read("1consensus/s2.fasta"), b">b\nCCCC\n")
+
+    def test_blocks_are_read_and_written_like_files(self):
+        fasta = os.path.join(self.tmp_dir, "s1.fasta")
+        with open(fasta, 'w') as handle:
+            handle.write(">a\nAC\nGT\n")
+        refs = sample_container.import_files([fasta], self.container, "1consensus")
+        self.assertFalse(os.path.exists(fasta))
+        self.assertEqual(refs, seq_io.seq_glob(sample_container.block_ref(self.container, "1consensus/*.fasta")))
+
+        out_ref = os.path.join(sample_container.block_ref(self.container, "2cleaned"), "s1_clean.fasta")
+        with seq_io.open_seq(out_ref, 'w', stage="clean") as handle:
+            for name, seq in seq_io.py3_fasta_iter(refs[0]):
+                handle.write(">{0}\n{1}\n".format(name, seq))
+        self.assertEqual(list(seq_io.py3_fasta_iter(out_ref)), [("a", "ACGT")])
+
+        outfile = os.path.join(self.tmp_dir, "all.fasta")
+        seq_io.concatenate_seq_files(refs + [out_ref], outfile)
+        self.assertEqual(list(seq_io.py3_fasta_iter(outfile)), [("a", "ACGT"), ("a", "ACGT")])
+
+
+if __name__ == '__main__':
+    unittest.main()
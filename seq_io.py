@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+from glob import glob
+from itertools import groupby
+from sample_container import is_block_ref
+
+
+__author__ = 'Colin Anthony'
+
+
+# set NGS_PIPELINE_COMPRESSION to gzip or xz to write the fasta intermediates compressed, child processes inherit it
+COMPRESSION_ENV = "NGS_PIPELINE_COMPRESSION"
+# set NGS_PIPELINE_COMPRESSION_LEVELS to eg: "clean=1,contam=6" to change the compression level of a stage's outputs
+COMPRESSION_LEVELS_ENV = "NGS_PIPELINE_COMPRESSION_LEVELS"
+COMPRESSED_EXTENSIONS = {"gzip": ".gz", "xz": ".xz"}
+_MAGIC = ((b"\x1f\x8b", "gzip"), (b"\xfd7zXZ\x00", "xz"))
+# the outputs of these stages are read once by the next stage, so a fast level is used for them by default
+DEFAULT_LEVELS = {"consensus": 1, "clean": 1, "merge": 1}
+# the level for the outputs of other stages, which stay in the output folder
+DEFAULT_LEVEL = 6
+# the clean and contam stages write each unique sequence once, with the names of its duplicates in the header:
+# >name_1;dups=name_2,name_3
+DUPS_SEP = ";dups="
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the compression of the fasta intermediates for this process and the processes it starts, from the
+    pipelineSettings of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    compression = pipeline_settings.get("compression", "")
+    if compression:
+        if compression not in COMPRESSED_EXTENSIONS:
+            raise ValueError("compression must be one of {0}, got {1}".format(sorted(COMPRESSED_EXTENSIONS),
+                                                                             compression))
+        os.environ[COMPRESSION_ENV] = compression
+    compression_levels = pipeline_settings.get("compression_levels", {})
+    if compression_levels:
+        os.environ[COMPRESSION_LEVELS_ENV] = ",".join("{0}={1}".format(k, v) for k, v in compression_levels.items())
+
+
+def compression_from_env():
+    """
+    :return: (str) the compression for new intermediates: gzip, xz or None
+    """
+    compression = os.environ.get(COMPRESSION_ENV, "")
+
+    return compression if compression in COMPRESSED_EXTENSIONS else None
+
+
+def compression_level(stage):
+    """
+    :param stage: (str) the stage writing the file
+    :return: (int) the compression level for the stage's outputs
+    """
+    for item in os.environ.get(COMPRESSION_LEVELS_ENV, "").split(","):
+        if "=" not in item:
+            continue
+        name, level = item.split("=", 1)
+        if name.strip() == stage:
+            try:
+                return int(level)
+            except ValueError:
+                print("Ignoring invalid compression level: {}".format(item))
+
+    return DEFAULT_LEVELS.get(stage, DEFAULT_LEVEL)
+
+
+def file_compression(file_name):
+    """
+    :param file_name: (str) the file, it is sniffed if it exists, otherwise its extension is used
+    :return: (str) gzip, xz or None, None for a sample container block, which the container decompresses
+    """
+    if is_block_ref(file_name):
+        return None
+    if os.path.isfile(file_name):
+        with open(file_name, 'rb') as handle:
+            start = handle.read(6)
+        for magic, compression in _MAGIC:
+            if start.startswith(magic):
+                return compression
+        return None
+
+    return _extension_compression(file_name)
+
+
+def _extension_compression(file_name):
+    for compression, extension in COMPRESSED_EXTENSIONS.items():
+        if file_name.endswith(extension):
+            return compression
+
+    return None
+
+
+def plain_name(file_name):
+    """
+    :param file_name: (str) a file name, eg: s1_clean.fasta.gz
+    :return: (str) the name without the compression extension, eg: s1_clean.fasta
+    """
+    for extension in COMPRESSED_EXTENSIONS.values():
+        if file_name.endswith(extension):
+            return file_name[:-len(extension)]
+
+    return file_name
+
+
+def storage_name(file_name):
+    """
+    :param file_name: (str) the plain name of a new intermediate file, eg: s1_clean.fasta
+    :return: (str) the name to write it to, with the extension of the compression set in NGS_PIPELINE_COMPRESSION
+    """
+    compression = compression_from_env()
+    if not compression or is_block_ref(file_name):
+        return file_name
+
+    return plain_name(file_name) + COMPRESSED_EXTENSIONS[compression]
+
+
+def seq_glob(pattern):
+    """
+    :param pattern: (str) a glob pattern for plain files, eg: *_good.fasta, or for the blocks of a sample container
+    :return: (list) the files matching the pattern, compressed or not
+    """
+    if is_block_ref(pattern):
+        # imported here so that the scripts start quickly
+        from sample_container import SampleContainer, block_ref, split_ref
+        file_name, name_pattern = split_ref(pattern)
+        return [block_ref(file_name, x) for x in SampleContainer(file_name).names(name_pattern)]
+    files = glob(pattern)
+    for extension in COMPRESSED_EXTENSIONS.values():
+        files.extend(glob(pattern + extension))
+
+    return files
+
+
+def open_seq(file_name, mode='r', stage=None):
+    """
+    open a sequence file, compressed or not. Files are read as they are found (sniffed), and written compressed if
+    their name ends in .gz or .xz, at the compression level of the stage. A sample container block is opened like a
+    file, writing it replaces the block
+    :param file_name: (str) the file or block reference
+    :param mode: (str) r, w or a, with b for binary
+    :param stage: (str) the stage writing the file, for its compression level
+    :return: file object
+    """
+    if is_block_ref(file_name):
+        from sample_container import open_block
+        return open_block(file_name, mode, stage)
+    reading = mode.startswith("r")
+    if reading or (mode.startswith("a") and os.path.isfile(file_name)):
+        compression = file_compression(file_name)
+    else:
+        compression = _extension_compression(file_name)
+    if not compression:
+        return open(str(file_name), mode)
+
+    text_mode = mode if "b" in mode else mode + "t"
+    # imported here so that the scripts start quickly
+    if compression == "gzip":
+        import gzip
+        if reading:
+            return gzip.open(file_name, text_mode)
+        return gzip.open(file_name, text_mode, compresslevel=compression_level(stage))
+
+    import lzma
+    if reading:
+        return lzma.open(file_name, text_mode)
+    return lzma.open(file_name, text_mode, preset=compression_level(stage))
+
+
+def py3_fasta_iter(fasta_name):
+    """
+    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
+    given a fasta file, plain or compressed. yield tuples of header, sequence
+    """
+    with open_seq(fasta_name) as fh:
+        faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
+        for header in faiter:
+            # drop the ">"
+            header_str = header.__next__()[1:].strip()
+            # join all sequence lines to one.
+            seq = "".join(s.strip() for s in faiter.__next__())
+            yield (header_str, seq)
+
+
+def record_names(header):
+    """
+    :param header: (str) a fasta header, without the ">"
+    :return: (list) the names of the sequence, the first name followed by the names of its duplicates
+    """
+    if DUPS_SEP not in header:
+        return [header]
+    name, dups = header.split(DUPS_SEP, 1)
+
+    return [name] + dups.split(",")
+
+
+def collapsed_header(names):
+    """
+    :param names: (list) the names of a unique sequence
+    :return: (str) the fasta header for the sequence, without the ">"
+    """
+    if len(names) == 1:
+        return names[0]
+
+    return names[0] + DUPS_SEP + ",".join(names[1:])
+
+
+def collapse_records(records):
+    """
+    group identical sequences, in the order they are first seen. Records that are already collapsed are merged with
+    their names, names with a "," in them are left as records of their own, as their header could not be split again
+    :param records: (iterable) of (header, sequence)
+    :return: (list) of [names, sequence], one for each unique sequence
+    """
+    uniques = []
+    seq_index = {}
+    seen = set()
+    for header, seq in records:
+        names = record_names(header)
+        for name in names:
+            if name in seen:
+                print("Duplicate sequence ids found. Exiting")
+                raise KeyError("Duplicate sequence ids found")
+            seen.add(name)
+        if any("," in x for x in names):
+            uniques.append([names, seq])
+        elif seq in seq_index:
+            uniques[seq_index[seq]][0].extend(names)
+        else:
+            seq_index[seq] = len(uniques)
+            uniques.append([names, seq])
+
+    return uniques
+
+
+def count_duplicate_names(data):
+    """
+    :param data: (bytes) fasta data, made of whole lines
+    :return: (int) the number of duplicate names carried in the collapsed headers of the data
+    """
+    sep = DUPS_SEP.encode()
+    extra = 0
+    start = data.find(sep)
+    while start != -1:
+        end = data.find(b"\n", start)
+        end = len(data) if end == -1 else end
+        extra += data.count(b",", start, end) + 1
+        start = data.find(sep, end)
+
+    return extra
+
+
+def plain_copy(file_name, folder):
+    """
+    decompress a file, or write out a sample container block, for a tool that only reads plain files
+    :param file_name: (str) the file or block reference
+    :param folder: (str) the folder for the plain copy
+    :return: (str) the file itself if it is a plain file, otherwise the plain copy, which the caller removes
+    """
+    if not is_block_ref(file_name) and not file_compression(file_name):
+        return file_name
+
+    import shutil
+    plain_file = os.path.join(folder, "plain_" + plain_name(os.path.basename(file_name)))
+    with open_seq(file_name, 'rb') as in_handle, open(plain_file, 'wb') as out_handle:
+        shutil.copyfileobj(in_handle, out_handle)
+
+    return plain_file
+
+
+def _compressed_stream(raw_handle, compression, stage):
+    """
+    :return: a file object that compresses what is written to it onto raw_handle, closing it leaves raw_handle open
+    """
+    if compression == "gzip":
+        import gzip
+        return gzip.GzipFile(fileobj=raw_handle, mode='wb', compresslevel=compression_level(stage))
+
+    import lzma
+    return lzma.LZMAFile(raw_handle, 'wb', preset=compression_level(stage))
+
+
+def concatenate_seq_files(infiles, outfile, stage=None):
+    """
+    concatenate fasta files into one file, compressed or not. Files that are already compressed like the outfile are
+    appended as they are (gzip members and xz streams can be concatenated), the others are decompressed or compressed.
+    The pipeline's fasta files end in a newline, so records are never joined together
+    :param infiles: (list) of files or sample container blocks to concatenate, in order
+    :param outfile: (str) path and name of the concatenated outfile, compressed if it ends in .gz or .xz
+    :param stage: (str) the stage writing the file, for its compression level
+    :return: (str) the outfile
+    """
+    out_compression = _extension_compression(outfile)
+    if all(file_compression(x) is None and not is_block_ref(x) for x in infiles) and out_compression is None:
+        # imported here so that the scripts start quickly
+        from file_transitions import concatenate_files
+        return concatenate_files(infiles, outfile)
+
+    import shutil
+    tmp_outfile = outfile + ".part"
+    with open(tmp_outfile, 'wb') as raw_handle:
+        for infile in infiles:
+            if not is_block_ref(infile) and os.path.getsize(infile) == 0:
+                continue
+            if not is_block_ref(infile) and file_compression(infile) == out_compression:
+                with open(infile, 'rb') as in_handle:
+                    shutil.copyfileobj(in_handle, raw_handle)
+                continue
+            with open_seq(infile, 'rb') as in_handle:
+                if out_compression:
+                    # a new gzip member or xz stream, written to the end of the outfile
+                    with _compressed_stream(raw_handle, out_compression, stage) as member:
+                        shutil.copyfileobj(in_handle, member)
+                else:
+                    shutil.copyfileobj(in_handle, raw_handle)
+
+    os.replace(tmp_outfile, outfile)
+
+    return outfile
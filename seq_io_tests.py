@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import seq_io
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        file_name = os.path.join(self.tmp_dir, name)
+        with seq_io.open_seq(file_name, 'w', stage="clean") as handle:
+            handle.write(content)
+        return file_name
+
+    def test_compressed_files_are_read_like_plain_files(self):
+        content = ">s1\nACGT\nACGT\n>s2\nTTTT\n"
+        for name in ["s.fasta", "s.fasta.gz", "s.fasta.xz"]:
+            file_name = self.write(name, content)
+            self.assertEqual(seq_io.file_compression(file_name), seq_io._extension_compression(name))
+            self.assertEqual(list(seq_io.py3_fasta_iter(file_name)), [("s1", "ACGTACGT"), ("s2", "TTTT")])
+
+    def test_storage_name_follows_the_setting(self):
+        with mock.patch.dict(os.environ, {seq_io.COMPRESSION_ENV: ""}):
+            self.assertEqual(seq_io.storage_name("/a/s1_clean.fasta"), "/a/s1_clean.fasta")
+        with mock.patch.dict(os.environ, {seq_io.COMPRESSION_ENV: "xz", seq_io.COMPRESSION_LEVELS_ENV: "clean=3"}):
+            self.assertEqual(seq_io.storage_name("/a/s1_clean.fasta.gz"), "/a/s1_clean.fasta.xz")
+            self.assertEqual(seq_io.compression_level("clean"), 3)
+            self.assertEqual(seq_io.compression_level("contam"), seq_io.DEFAULT_LEVEL)
+        self.assertEqual(seq_io.plain_name("s1_good.fasta.gz"), "s1_good.fasta")
+
+    def test_concatenate_mixed_inputs(self):
+        infiles = [self.write("a.fasta.gz", ">a\nAAAA\n"), self.write("b.fasta", ">b\nCCCC\n"),
+                   self.write("c.fasta.xz", ">c\nGGGG\n")]
+        expected = [("a", "AAAA"), ("b", "CCCC"), ("c", "GGGG")]
+        for outfile in ["all.fasta.gz", "all.fasta"]:
+            outfile = os.path.join(self.tmp_dir, outfile)
+            seq_io.concatenate_seq_files(infiles, outfile, stage="merge")
+            self.assertEqual(list(seq_io.py3_fasta_iter(outfile)), expected)
+        self.assertEqual(seq_io.file_compression(os.path.join(self.tmp_dir, "all.fasta")), None)
+
+    def test_collapse_records(self):
+        records = [("s1_a", "ACGT"), ("s1_b;dups=s1_c", "TTTT"), ("s1_d", "ACGT"), ("s1_e", "TTTT"),
+                   ("s1_f,x", "ACGT")]
+        uniques = seq_io.collapse_records(records)
+        self.assertEqual(uniques, [[["s1_a", "s1_d"], "ACGT"], [["s1_b", "s1_c", "s1_e"], "TTTT"],
+                                   [["s1_f,x"], "ACGT"]])
+        headers = [seq_io.collapsed_header(names) for names, seq in uniques]
+        self.assertEqual(headers, ["s1_a;dups=s1_d", "s1_b;dups=s1_c,s1_e", "s1_f,x"])
+        self.assertEqual([seq_io.record_names(x) for x in headers[:2]], [x[0] for x in uniques[:2]])
+        self.assertEqual(seq_io.count_duplicate_names("".join(">{}\nA\n".format(x) for x in headers).encode()), 3)
+        with self.assertRaises(KeyError):
+            seq_io.collapse_records([("s1_a", "ACGT"), ("s1_b;dups=s1_a", "TTTT")])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,27 +4,14 @@ from __future__ import division
 import os
 import argparse
 import collections
-from itertools import groupby
+from seq_io import py3_fasta_iter
+from seq_io import file_compression
+from fasta_index import FastaIndex
 
 
 __author__ = 'Colin Anthony'
 
 
-def py3_fasta_iter(fasta_name):
-    """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
-    """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
-
-
 def fasta_to_dct(file_name):
     """
     :param file_name: The fasta formatted file to read from.
@@ -43,11 +30,36 @@ def fasta_to_dct(file_name):
     return dct
 
 
+def split_indexed(infile, outpath, field):
+    """
+    split a plain fasta file by time point through its index, one time point in memory at a time
+    :param infile: (str) the plain fasta file, indexed if it is not yet
+    :param outpath: (str) the path for the outfiles
+    :param field: (int) the number of name fields that make up a time point
+    :return: None
+    """
+    with FastaIndex(infile) as index:
+        for prefix, names in index.groups(field).items():
+            kept = [x for x in names if "HXB2" not in x]
+            if len(kept) != len(names):
+                print("found HXB2, excluding from output")
+            if not kept:
+                continue
+            out_file_name = os.path.join(outpath, prefix + "_sep.fasta")
+            with open(out_file_name, 'a') as handle:
+                for name in kept:
+                    handle.write(">{0}\n{1}\n".format(name.replace(" ", "_"), index.fetch(name).replace("~", "_")))
+
+
 def main(infile, outpath, field):
 
     infile = os.path.abspath(infile)
     outpath = os.path.abspath(outpath)
 
+    if not file_compression(infile):
+        split_indexed(infile, outpath, field)
+        return
+
     alignment = fasta_to_dct(infile)
     d = collections.defaultdict(list)
 
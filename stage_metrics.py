@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import resource
+import collections
+from contextlib import contextmanager
+from seq_io import open_seq
+from seq_io import plain_name
+from seq_io import count_duplicate_names
+from sample_container import block_entry
+from sample_container import is_block_ref
+
+
+__author__ = 'Colin Anthony'
+
+
+def count_records(file_name):
+    """
+    count the records in a fasta or fastq file without parsing it, by counting newlines or header lines in blocks
+    :param file_name: (str) the fasta or fastq file, plain or compressed
+    :return: (int) the number of records in the file, a collapsed fasta record counts once for each of its names
+    """
+    block_size = 1024 * 1024
+    if plain_name(file_name).endswith((".fastq", ".fq")):
+        newlines = 0
+        with open_seq(file_name, 'rb') as handle:
+            block = handle.read(block_size)
+            last = b"\n"
+            while block:
+                newlines += block.count(b"\n")
+                last = block[-1:]
+                block = handle.read(block_size)
+        # a file without a final newline still has a last line
+        if last != b"\n":
+            newlines += 1
+        return newlines // 4
+
+    headers = 0
+    duplicates = 0
+    with open_seq(file_name, 'rb') as handle:
+        previous = b"\n"
+        # the unfinished last line of a block, so that a collapsed header split across blocks is counted
+        partial = b""
+        block = handle.read(block_size)
+        while block:
+            headers += block.count(b"\n>")
+            # catch the first header in the file and headers split across a block boundary
+            if previous == b"\n" and block[:1] == b">":
+                headers += 1
+            previous = block[-1:]
+            lines = partial + block
+            cut = lines.rfind(b"\n") + 1
+            duplicates += count_duplicate_names(lines[:cut])
+            partial = lines[cut:]
+            block = handle.read(block_size)
+        duplicates += count_duplicate_names(partial)
+
+    # a collapsed record counts once for each of its names
+    return headers + duplicates
+
+
+def file_stats(file_list, manifest=None):
+    """
+    get the total size and number of records in a list of sequence files
+    :param file_list: (list) of fasta/fastq files or sample container blocks, missing files are skipped
+    :param manifest: (RunManifest) the counts of unchanged files registered in it are used instead of counting again
+    :return: (int) total bytes, (int) total records
+    """
+    total_bytes = 0
+    total_records = 0
+    for file_name in file_list:
+        entry = manifest.lookup(file_name) if manifest is not None else None
+        if entry is not None:
+            total_bytes += entry["bytes"]
+            total_records += entry["records"] or 0
+            continue
+        if is_block_ref(file_name):
+            entry = block_entry(file_name)
+            if entry is not None:
+                total_bytes += entry["length"]
+                total_records += entry["records"]
+            continue
+        if not os.path.isfile(file_name):
+            continue
+        total_bytes += os.path.getsize(file_name)
+        if plain_name(file_name).endswith((".fasta", ".fastq", ".fa", ".fq")):
+            total_records += count_records(file_name)
+
+    return total_bytes, total_records
+
+
+def process_peak_rss_mb():
+    """
+    get the peak resident memory of this process and of its largest finished child process, over the life of the
+    process so far: it is not reset between stages, see job_peak_rss_mb for the peak of a stage's own jobs
+    :return: (float) peak RSS in MB
+    """
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    child_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    peak = max(self_rss, child_rss)
+    # ru_maxrss is in bytes on macOS and in kilobytes on linux
+    if sys.platform == "darwin":
+        return round(peak / 1024 / 1024, 1)
+
+    return round(peak / 1024, 1)
+
+
+def _cpu_seconds():
+    """
+    :return: (float) user + system CPU time of this process and all its waited-for children
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+@contextmanager
+def record_stage(metrics_file, patient, region, stage, inputs=None, sample=None, manifest=None):
+    """
+    time a pipeline stage and append its resource usage to a JSON-lines metrics file.
+    Set record["outputs"] to the list of output files inside the with block to have them measured too, the peak
+    memory use of the stage's tool jobs is added as record["job_peak_rss_mb"] by StageSupervisor.run_jobs, this is the
+    stage's own peak. process_peak_rss_mb is the peak of the pipeline process over its life so far.
+    With a run manifest, the outputs of a completed stage are registered in it
+    :param metrics_file: (str) path and name of the JSON-lines file, if False nothing is recorded
+    :param patient: (str) the patient/participant name
+    :param region: (str) the gene region
+    :param stage: (str) the name of the stage
+    :param inputs: (list) of input files for the stage
+    :param sample: (str) the sample name, if the stage was run on a single sample
+    :param manifest: (RunManifest) the run manifest of the patient and region, or None
+    :return: (dict) the record, written to file when the stage finishes
+    """
+    record = collections.OrderedDict([("patient", patient), ("region", region), ("stage", stage),
+                                      ("sample", sample), ("outputs", [])])
+    inputs = list(inputs) if inputs else []
+    start_wall = time.perf_counter()
+    start_cpu = _cpu_seconds()
+    status = "complete"
+    try:
+        yield record
+    except BaseException:
+        status = "failed"
+        raise
+    finally:
+        wall_s = round(time.perf_counter() - start_wall, 3)
+        cpu_s = round(_cpu_seconds() - start_cpu, 3)
+        outputs = record.pop("outputs")
+        if manifest is not None and status == "complete" and outputs:
+            manifest.register(stage, outputs)
+        elif manifest is not None:
+            manifest.discard(stage)
+        if metrics_file:
+            record["wall_s"] = wall_s
+            record["cpu_s"] = cpu_s
+            record["process_peak_rss_mb"] = process_peak_rss_mb()
+            record["input_bytes"], record["input_records"] = file_stats(inputs, manifest)
+            record["output_bytes"], record["output_records"] = file_stats(outputs, manifest)
+            record["status"] = status
+            record["time"] = time.strftime("%Y-%m-%d %H:%M:%S")
+            with open(metrics_file, 'a') as handle:
+                handle.write(json.dumps(record) + "\n")
+
+
+def summarise_metrics(metrics_file, outfile):
+    """
+    sum the stage records of a run into one row per (patient, region, stage)
+    :param metrics_file: (str) the JSON-lines metrics file
+    :param outfile: (str) path and name of the csv summary table
+    :return: (dict) key = (patient, region, stage), value = dict of summed metrics
+    """
+    sum_fields = ["wall_s", "cpu_s", "input_bytes", "output_bytes", "input_records", "output_records"]
+    summary_d = collections.OrderedDict()
+    with open(metrics_file, 'r') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            key = (record["patient"], record["region"], record["stage"])
+            if key not in summary_d:
+                summary_d[key] = collections.OrderedDict([("calls", 0), ("failed", 0), ("job_peak_rss_mb", 0),
+                                                          ("process_peak_rss_mb", 0)])
+                for field in sum_fields:
+                    summary_d[key][field] = 0
+            row = summary_d[key]
+            row["calls"] += 1
+            if record.get("status") == "failed":
+                row["failed"] += 1
+            row["job_peak_rss_mb"] = max(row["job_peak_rss_mb"], record.get("job_peak_rss_mb") or 0)
+            # peak_rss_mb in the metrics of older runs
+            process_peak = record.get("process_peak_rss_mb", record.get("peak_rss_mb", 0))
+            row["process_peak_rss_mb"] = max(row["process_peak_rss_mb"], process_peak)
+            for field in sum_fields:
+                row[field] += record.get(field, 0)
+
+    headers = ["patient", "region", "stage", "calls", "failed"] + sum_fields
+    headers += ["job_peak_rss_mb", "process_peak_rss_mb"]
+    with open(outfile, 'w') as handle:
+        writer = csv.writer(handle)
+        writer.writerow(headers)
+        for (patient, region, stage), row in summary_d.items():
+            writer.writerow([patient, region, stage] + [round(row[x], 3) for x in headers[3:]])
+
+    return summary_d
+
+
+def main(infile, outfile):
+
+    print("Summarising stage metrics from: {}".format(infile))
+    summary_d = summarise_metrics(infile, outfile)
+    print("{0} (patient, region, stage) rows written to {1}".format(len(summary_d), outfile))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Sums the per-stage timing and resource records of a pipeline run '
+                                                 'into one row per patient, region and stage',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--infile', default=argparse.SUPPRESS, type=str,
+                        help='The stage metrics JSON-lines file', required=True)
+    parser.add_argument('-o', '--outfile', default=argparse.SUPPRESS, type=str,
+                        help='The path and name for the csv summary table', required=True)
+
+    args = parser.parse_args()
+    infile = args.infile
+    outfile = args.outfile
+
+    main(infile, outfile)
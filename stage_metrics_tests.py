@@ -0,0 +1,95 @@
+import os
+import csv
+import json
+import shutil
+import tempfile
+import unittest
+import seq_io
+from run_manifest import RunManifest
+from stage_metrics import count_records
+from stage_metrics import file_stats
+from stage_metrics import record_stage
+from stage_metrics import summarise_metrics
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.metrics_file = os.path.join(self.tmp_dir, "metrics.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        file_name = os.path.join(self.tmp_dir, name)
+        with seq_io.open_seq(file_name, 'w', stage="clean") as handle:
+            handle.write(content)
+        return file_name
+
+    def read_metrics(self):
+        with open(self.metrics_file) as handle:
+            return [json.loads(x) for x in handle]
+
+    def test_count_records(self):
+        self.assertEqual(count_records(self.write("a.fasta", ">s1\nAC\nGT\n>s2\nTT\n")), 2)
+        self.assertEqual(count_records(self.write("a.fasta.gz", ">s1\nAC\n>s2;dups=s3,s4\nTT\n")), 4)
+        self.assertEqual(count_records(self.write("a.fastq", "@r1\nAC\n+\nII\n@r2\nGT\n+\nII")), 2)
+        self.assertEqual(count_records(self.write("empty.fasta", "")), 0)
+
+    def test_file_stats(self):
+        fasta = self.write("a.fasta", ">s1\nACGT\n")
+        fastq = self.write("a.fastq", "@r1\nAC\n+\nII\n")
+        other = self.write("a.txt", "text\n")
+        missing = os.path.join(self.tmp_dir, "missing.fasta")
+        total_bytes, total_records = file_stats([fasta, fastq, other, missing])
+        self.assertEqual(total_bytes, sum(os.path.getsize(x) for x in [fasta, fastq, other]))
+        self.assertEqual(total_records, 2)
+        self.assertEqual(file_stats([]), (0, 0))
+
+    def test_record_stage(self):
+        infile = self.write("in.fasta", ">s1\nACGT\n>s2\nACGA\n")
+        outfile = os.path.join(self.tmp_dir, "out.fasta")
+        manifest = RunManifest(os.path.join(self.tmp_dir, "manifest.json"), "CAP1", "GAG_1")
+        with record_stage(self.metrics_file, "CAP1", "GAG_1", "clean", inputs=[infile], manifest=manifest) as record:
+            self.write("out.fasta", ">s1\nACGT\n")
+            record["outputs"] = [outfile]
+            record["job_peak_rss_mb"] = 12.5
+        with self.assertRaises(ValueError):
+            with record_stage(self.metrics_file, "CAP1", "GAG_1", "contam", inputs=[outfile], sample="s1"):
+                raise ValueError("no blast output")
+
+        clean, contam = self.read_metrics()
+        self.assertEqual((clean["stage"], clean["status"], clean["input_records"], clean["output_records"]),
+                         ("clean", "complete", 2, 1))
+        self.assertEqual(clean["output_bytes"], os.path.getsize(outfile))
+        self.assertEqual(clean["job_peak_rss_mb"], 12.5)
+        self.assertGreater(clean["process_peak_rss_mb"], 0)
+        self.assertNotIn("outputs", clean)
+        self.assertIsNotNone(manifest.lookup(outfile))
+        self.assertEqual((contam["stage"], contam["sample"], contam["status"]), ("contam", "s1", "failed"))
+
+    def test_summarise_metrics(self):
+        records = [{"patient": "CAP1", "region": "GAG_1", "stage": "clean", "wall_s": 1.5, "cpu_s": 1,
+                    "input_records": 10, "output_records": 8, "job_peak_rss_mb": 20, "process_peak_rss_mb": 50,
+                    "status": "complete"},
+                   {"patient": "CAP1", "region": "GAG_1", "stage": "clean", "wall_s": 2, "cpu_s": 1,
+                    "input_records": 5, "output_records": 5, "job_peak_rss_mb": 30, "peak_rss_mb": 40,
+                    "status": "failed"},
+                   {"patient": "CAP1", "region": "GAG_1", "stage": "align", "wall_s": 3, "status": "complete"}]
+        with open(self.metrics_file, 'w') as handle:
+            for record in records:
+                handle.write(json.dumps(record) + "\n\n")
+        outfile = os.path.join(self.tmp_dir, "summary.csv")
+        summary_d = summarise_metrics(self.metrics_file, outfile)
+        clean = summary_d[("CAP1", "GAG_1", "clean")]
+        self.assertEqual((clean["calls"], clean["failed"], clean["wall_s"], clean["input_records"]), (2, 1, 3.5, 15))
+        self.assertEqual((clean["job_peak_rss_mb"], clean["process_peak_rss_mb"]), (30, 50))
+        with open(outfile) as handle:
+            rows = list(csv.DictReader(handle))
+        self.assertEqual([x["stage"] for x in rows], ["clean", "align"])
+        self.assertEqual(rows[1]["wall_s"], "3")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import sys
+import argparse
+import subprocess
+import collections
+
+
+__author__ = 'Colin Anthony'
+
+
+# startup budget in ms for the import time of each script that step 2 and 3 start once per sample or file,
+# measured with python -X importtime and including the interpreter's own startup imports
+STARTUP_BUDGET_MS = collections.OrderedDict([("remove_bad_sequences.py", 60),
+                                             ("contam_removal.py", 60),
+                                             ("align_ngs_codons.py", 75),
+                                             ("ngs_stats_calculator.py", 60),
+                                             ("split_fasta_into_subfiles.py", 60),
+                                             ("haplotyper_freq.py", 60),
+                                             ("call_motifbinner.py", 60),
+                                             ("pid_binner.py", 60)])
+# modules that must only be imported by the code paths that need them
+HEAVY_MODULES = ("pandas", "numpy", "regex", "seqanpy", "Bio", "asyncio")
+
+
+def parse_importtime(stderr):
+    """
+    parse the -X importtime report of one run
+    :param stderr: (str) the stderr of the run
+    :return: (float) the total import time in ms, (set) the top level names of all imported modules
+    """
+    total_us = 0
+    modules = set()
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        fields = line[len("import time:"):].split("|")
+        try:
+            cumulative = int(fields[1])
+        except ValueError:
+            # the header line
+            continue
+        name = fields[2].rstrip()
+        # nested imports are indented, their time is already in the cumulative time of their parent
+        if not name.startswith("  "):
+            total_us += cumulative
+        modules.add(name.strip().split(".")[0])
+
+    return total_us / 1000, modules
+
+
+def measure(script, repeats=5):
+    """
+    start a script with --help under -X importtime, so that only its imports and argument parsing are run
+    :param script: (str) the path of the script
+    :param repeats: (int) the number of runs, the fastest is kept
+    :return: (float) the import time in ms, (list) the heavy modules that were imported
+    """
+    best = None
+    modules = set()
+    for _ in range(repeats):
+        run = subprocess.run([sys.executable, "-X", "importtime", script, "--help"], stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+        import_ms, modules = parse_importtime(run.stderr)
+        best = import_ms if best is None else min(best, import_ms)
+
+    return best, sorted(modules.intersection(HEAVY_MODULES))
+
+
+def main(repeats, budget_scale):
+    script_folder = os.path.split(os.path.abspath(os.path.realpath(__file__)))[0]
+    over_budget = []
+    print("{0:<32}{1:>10}{2:>10}  {3}".format("script", "ms", "budget", "heavy imports"))
+    for script, budget in STARTUP_BUDGET_MS.items():
+        import_ms, heavy = measure(os.path.join(script_folder, script), repeats)
+        budget *= budget_scale
+        if import_ms > budget or heavy:
+            over_budget.append(script)
+        print("{0:<32}{1:>10.1f}{2:>10.0f}  {3}".format(script, import_ms, budget, ", ".join(heavy)))
+
+    if over_budget:
+        sys.exit("Over the startup budget: {}".format(", ".join(over_budget)))
+    print("All scripts are within their startup budget")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Measures the import time of the scripts that the pipeline starts '
+                                                 'once per sample or file, with python -X importtime, and fails if a '
+                                                 'script is over its budget or imports a heavy module at startup',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r', '--repeats', default=5, type=int,
+                        help='The number of runs per script, the fastest is kept', required=False)
+    parser.add_argument('-s', '--budget_scale', default=1.0, type=float,
+                        help='Multiply the budgets by this, eg: for a slow file system', required=False)
+
+    args = parser.parse_args()
+    repeats = args.repeats
+    budget_scale = args.budget_scale
+
+    main(repeats, budget_scale)
@@ -0,0 +1,26 @@
+import os
+import unittest
+from startup_benchmark import measure
+from startup_benchmark import parse_importtime
+
+
+class MyTestCase(unittest.TestCase):
+
+    def test_parse_importtime(self):
+        stderr = "import time: self [us] | cumulative | imported package\n" \
+                 "import time:       100 |        100 |   _abc\n" \
+                 "import time:       200 |        300 | abc\n" \
+                 "import time:       500 |        500 | regex\n"
+        import_ms, modules = parse_importtime(stderr)
+        self.assertEqual(import_ms, 0.8)
+        self.assertEqual(modules, {"_abc", "abc", "regex"})
+
+    def test_stage_scripts_do_not_import_heavy_modules(self):
+        script_folder = os.path.split(os.path.abspath(__file__))[0]
+        for script in ["align_ngs_codons.py", "contam_removal.py", "ngs_stats_calculator.py"]:
+            import_ms, heavy = measure(os.path.join(script_folder, script), repeats=1)
+            self.assertEqual(heavy, [], script)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,33 +3,53 @@ from __future__ import print_function
 from __future__ import division
 import os
 import sys
-from shutil import copyfile
+import shutil
 from shutil import rmtree
-from distutils.dir_util import copy_tree
 import argparse
-import subprocess
+import tempfile
 from glob import glob
 import re
-from itertools import groupby
 import collections
+from file_transitions import move_file
+from file_transitions import link_or_copy
+from file_transitions import commit_folder
+from stage_metrics import record_stage
+from stage_metrics import summarise_metrics
+from tool_runner import ToolJob
+from tool_runner import job_log_file
+from supervisor import StageSupervisor
+from resource_manager import ResourceManager
+import profiling_hooks
+from seq_io import py3_fasta_iter
+from seq_io import open_seq
+from seq_io import plain_name
+from seq_io import seq_glob
+from seq_io import storage_name
+from seq_io import concatenate_seq_files
+from sample_container import container_from_env
+from sample_container import container_file
+from sample_container import block_ref
+from sample_container import import_files
+from sample_container import is_block_ref
+from sample_container import SampleContainer
+from run_manifest import RunManifest
+from run_manifest import manifest_file
+from run_manifest import registered_files
+from run_manifest import committed_files
+from subsample_reads import subsample_from_env
+from subsample_reads import subsample_pair
+from subsample_reads import pid_length
+from call_motifbinner import shards_from_env
+from call_motifbinner import motifbinner_version
+from pid_binner import binner_from_env
+from binning_cache import cache_from_env
 
 
 __author__ = 'Colin Anthony'
 
 
-def py3_fasta_iter(fasta_name):
-    """
-    modified from Brent Pedersen: https://www.biostars.org/p/710/#1412
-    given a fasta file. yield tuples of header, sequence
-    """
-    fh = open(str(fasta_name), 'r')
-    faiter = (x[1] for x in groupby(fh, lambda line: line[0] == ">"))
-    for header in faiter:
-        # drop the ">"
-        header_str = header.__next__()[1:].strip()
-        # join all sequence lines to one.
-        seq = "".join(s.strip() for s in faiter.__next__())
-        yield (header_str, seq)
+# the staged raw reads are only read by MotifBinner from their folder, so they are not worth checksumming
+UNREGISTERED_STAGES = ["stage_inputs", "commit"]
 
 
 def fasta_to_dct(file_name):
@@ -93,9 +113,48 @@ def rename_sequences(raw_files_search):
             os.rename(inf_R2, outf_R2_rename_with_path)
 
 
-def call_motifbinner(raw_files, motifbinner, cons_outpath, fwd_primer, cDNA_primer, nonoverlap, counter, cores, logfile):
+def stage_raw_reads(raw_files, move_folder, cDNA_primer, logfile):
+    """
+    put the raw fastq files in the 0raw_temp folder, subsampled to whole primer ID families if a depth cap is set in
+    NGS_PIPELINE_SUBSAMPLE, otherwise linked
+    :param raw_files: (list) the R1 and R2 fastq files
+    :param move_folder: (str) the 0raw_temp folder
+    :param cDNA_primer: (str) the cDNA primer, its leading N's are the primer ID
+    :param logfile: (str) path and name of the log file
+    :return: (list) the staged files
+    """
+    subsample = subsample_from_env()
+    pairs = []
+    if subsample is not None:
+        pairs = [(x, x.replace("R1_001.fastq", "R2_001.fastq")) for x in raw_files if "R1_001.fastq" in x]
+        pairs = [(r1, r2) for r1, r2 in pairs if r2 in raw_files]
+    paired = set(x for pair in pairs for x in pair)
+
+    staged = []
+    for r1_file, r2_file in pairs:
+        r1_location = os.path.join(move_folder, os.path.split(r1_file)[-1])
+        r2_location = os.path.join(move_folder, os.path.split(r2_file)[-1])
+        stats = subsample_pair(r1_file, r2_file, r1_location, r2_location, pid_length(cDNA_primer),
+                               subsample.max_reads, subsample.max_pids, subsample.seed)
+        with open(logfile, 'a') as handle:
+            handle.write("\nSubsampled {0}: kept {reads_out} of {reads_in} read pairs from {families_out} of "
+                         "{families_in} primer ID families\n".format(os.path.split(r1_file)[-1], **stats))
+        staged.extend([r1_location, r2_location])
+
+    for file in raw_files:
+        if file not in paired:
+            staged.append(link_or_copy(file, os.path.join(move_folder, os.path.split(file)[-1])))
+
+    return staged
+
+
+def call_motifbinner(raw_files, motifbinner, cons_outpath, fwd_primer, cDNA_primer, nonoverlap, counter, logfile,
+                     recorder, supervisor, tool="MotifBinner2.R"):
     """
-    function to pass args to the script that calls the motifbinner2
+    function to pass args to the script that calls the motifbinner2, the samples are binned concurrently and the
+    cores for each MotifBinner2 job are granted by the resource manager. Each sample is binned in primer ID shards if
+    NGS_PIPELINE_MOTIFBINNER_SHARDS is set, and restored from the binning result store if NGS_PIPELINE_BINNING_CACHE is
+    set and its reads and settings did not change
     :param raw_files: (list) of all the read 1 files
     :param motifbinner: (str) call motifbinner script name
     :param cons_outpath: (str) desired outpath
@@ -104,136 +163,287 @@ def call_motifbinner(raw_files, motifbinner, cons_outpath, fwd_primer, cDNA_prim
     :param nonoverlap: (bool) False for overlapping read 1 and 2, True of read 1 and 2 don't overlap
     :param counter: (int) count of number of times the script has been called (so that we only write to log once)
     :param logfile: (str) path and name of the log file
+    :param recorder: (func) stage metrics recorder for this patient and region
+    :param supervisor: (StageSupervisor) runs the jobs with timeouts and retries, and records the failures
+    :param tool: (str) the tool the binning script runs, MotifBinner2.R or pid_binner
     :return:
     """
 
     if type(raw_files) is not list:
         raise TypeError('Expected list of raw files, got: ', raw_files)
 
-    if nonoverlap:
-        overlap_flag = "-v"
-    else:
-        overlap_flag = ""
-    ncpu = "-ncpu {}".format(cores)
+    log_folder = os.path.join(os.path.dirname(logfile), "tool_logs")
+    grant = supervisor.grant("motifbinner", tool, len(raw_files))
+    shards = shards_from_env()
+    # the binned outputs of samples whose reads and settings did not change are restored from the result store
+    cache_folder = cache_from_env(os.path.dirname(logfile))
+    version = motifbinner_version() if cache_folder and tool == "MotifBinner2.R" else None
+    jobs = []
+    samples = []
+    read_files = []
     for file in raw_files:
         read1 = file
         read2 = file.replace("R1.fastq", "R2.fastq")
         name_prefix = os.path.split(file)[-1].replace("_R1.fastq", "")
 
-        cmd1 = 'python3 {0} -r1 {1} -r2 {2} -o {3} -f {4} -r {5} -n {6} -c {7} -l {8} {9} {10}'.format(motifbinner,
-                                                                                                        read1,
-                                                                                                        read2,
-                                                                                                        cons_outpath,
-                                                                                                        fwd_primer,
-                                                                                                        cDNA_primer,
-                                                                                                        name_prefix,
-                                                                                                        counter,
-                                                                                                        logfile,
-                                                                                                        ncpu,
-                                                                                                        overlap_flag)
-
-        try:
-            subprocess.call(cmd1, shell=True)
-            counter += 1
-        except Exception as e:
-            raise e
+        cmd1 = ['python3', motifbinner, '-r1', read1, '-r2', read2, '-o', cons_outpath, '-f', fwd_primer,
+                '-r', cDNA_primer, '-n', name_prefix, '-c', str(counter), '-l', logfile, '-ncpu', str(grant.threads)]
+        if nonoverlap:
+            cmd1.append("-v")
+        if shards > 1:
+            cmd1.extend(['-k', str(shards)])
+        if cache_folder:
+            cmd1.extend(['-cache', cache_folder])
+        if version:
+            cmd1.extend(['-tv', version])
+        jobs.append(ToolJob(tool, cmd1, job_log_file(log_folder, "motifbinner", name_prefix)))
+        samples.append(name_prefix)
+        read_files.extend([read1, read2])
+        counter += 1
+
+    with recorder("motifbinner", inputs=read_files) as record:
+        supervisor.run_jobs("motifbinner", jobs, samples, tool_limits={grant.tool: grant.concurrency},
+                            record=record)
+        record["outputs"] = glob(os.path.join(cons_outpath, "*", "*", "*_buildConsensus.fastq"))
 
 
 def delete_gaps(fasta_infiles):
     """
-    removes gap characters from binned consensus sequence fasta file
+    removes gap characters from binned consensus sequence fasta file, the files are compressed if
+    NGS_PIPELINE_COMPRESSION is set
     :param fasta_infiles: list of consensus sequence fasta file
     :return: None
     """
 
     for fasta_file in fasta_infiles:
-        temp_out = fasta_file.replace(".fasta", ".fasta.bak")
-        new_fasta = temp_out.replace(".bak", "")
+        out_file = storage_name(fasta_file)
+        temp_out = storage_name(plain_name(fasta_file) + ".bak")
         cons_d = fasta_to_dct(fasta_file)
-        with open(temp_out, 'w') as handle:
+        with open_seq(temp_out, 'w', stage="consensus") as handle:
             for seq_name, seq in cons_d.items():
                 seq = seq.upper().replace("-", "")
                 handle.write('>{0}\n{1}\n'.format(seq_name, seq))
 
-        os.remove(fasta_file)
-        copyfile(temp_out, new_fasta)
-        os.remove(temp_out)
+        move_file(temp_out, out_file)
+        if out_file != fasta_file:
+            os.unlink(fasta_file)
 
 
-def call_fasta_cleanup(consensus_fasta, remove_bad_seqs, clean_path, length, logfile):
+def call_fasta_cleanup(consensus_fasta, remove_bad_seqs, clean_path, length, logfile, recorder, supervisor):
     """
-    function to pass args to remove bad sequences script
+    function to pass args to remove bad sequences script, the files are cleaned concurrently
     :param consensus_fasta: (str) list of binned consensus sequence fasta files
     :param remove_bad_seqs: (str) name of script to run
     :param clean_path: (str) desired outpath
     :param length: (int) min length of sequence allowed
     :param logfile: the path and name of the log file
+    :param recorder: (func) stage metrics recorder for this patient and region
+    :param supervisor: (StageSupervisor) runs the jobs with timeouts and retries, and records the failures
     :return:
     """
-
+    log_folder = os.path.join(os.path.dirname(logfile), "tool_logs")
+    jobs = []
+    samples = []
+    outputs = []
     for fasta_file in consensus_fasta:
-        cmd4 = 'python3 {0} -in {1} -o {2} -l {3} -lf {4}'.format(remove_bad_seqs,
-                                                                        fasta_file,
-                                                                        clean_path,
-                                                                        length,
-                                                                        logfile)
+        cmd4 = ['python3', remove_bad_seqs, '-in', fasta_file, '-o', clean_path, '-l', str(length), '-lf', logfile]
         if os.path.exists(logfile):
             with open(logfile, 'a') as handle:
-                handle.write("\nremove_bad_sequences commands:\n{}\n".format(cmd4))
+                handle.write("\nremove_bad_sequences commands:\n{}\n".format(" ".join(cmd4)))
 
-        subprocess.call(cmd4, shell=True)
+        sample = plain_name(os.path.split(fasta_file)[-1]).replace(".fasta", "")
+        jobs.append(ToolJob("remove_bad_sequences", cmd4, job_log_file(log_folder, "clean", sample)))
+        samples.append(sample)
+        outputs.append(storage_name(os.path.join(clean_path, sample + "_clean.fasta")))
 
+    with recorder("clean", inputs=consensus_fasta) as record:
+        grant = supervisor.grant("clean", "remove_bad_sequences", len(jobs))
+        supervisor.run_jobs("clean", jobs, samples, tool_limits={grant.tool: grant.concurrency}, record=record)
+        record["outputs"] = outputs
 
-def call_contam_check(consensuses, contam_removal_script, contam_removed_path, gene_region, logfile):
+
+def call_contam_check(consensuses, contam_removal_script, contam_removed_path, gene_region, logfile, recorder,
+                      supervisor):
     """
-    function to pass args to contam check script
+    function to pass args to contam check script, the files are checked concurrently and the blastn threads for each
+    check are granted by the resource manager
     :param consensuses: list of cleaned fasta files
     :param contam_removal_script: path to script
     :param contam_removed_path: output path location
     :param gene_region: the gene region
     :param logfile: the path and name of the log file
+    :param recorder: (func) stage metrics recorder for this patient and region
+    :param supervisor: (StageSupervisor) runs the jobs with timeouts and retries, and records the failures
     :return: None
     """
+    log_folder = os.path.join(os.path.dirname(logfile), "tool_logs")
+    grant = supervisor.grant("contam", "blastn", len(consensuses))
+    jobs = []
+    samples = []
+    outputs = []
     for consensus_file in consensuses:
-        cmd3 = 'python3 {0} -in {1} -o {2} -g {3} -l {4}'.format(contam_removal_script,
-                                                                consensus_file,
-                                                                contam_removed_path,
-                                                                gene_region,
-                                                                logfile)
+        cmd3 = ['python3', contam_removal_script, '-in', consensus_file, '-o', contam_removed_path,
+                '-g', gene_region, '-l', logfile, '-t', str(grant.threads)]
+
+        sample = plain_name(os.path.split(consensus_file)[-1]).replace("_clean.fasta", "")
+        jobs.append(ToolJob("blastn", cmd3, job_log_file(log_folder, "contam", sample)))
+        samples.append(sample)
+        outputs.extend([storage_name(os.path.join(contam_removed_path, sample + "_good.fasta")),
+                        storage_name(os.path.join(contam_removed_path, sample + "_contam_seqs.fasta"))])
 
-        subprocess.call(cmd3, shell=True)
+    with recorder("contam", inputs=consensuses) as record:
+        supervisor.run_jobs("contam", jobs, samples, tool_limits={grant.tool: grant.concurrency}, record=record)
+        record["outputs"] = outputs
 
 
-def call_align(script_folder, to_align, aln_path, fname, ref, gene, sub_region, user_ref):
+def align_job(script_folder, to_align, aln_path, fname, ref, gene, sub_region, user_ref):
     """
-    function to call the alignment script
+    build the job that calls the alignment script
     :param script_folder: (str) path to the folder containing the repo scripts
     :param to_align: (str) file to align
     :param aln_path: (str) the output path
     :param fname: (str) the prefix for the output file name
     :param ref: (str) the reference type
-    :param gene_region: (str) the HIV gene region
+    :param gene: (str) the HIV gene region
     :param sub_region: (str) the HIV gene sub-region
     :param user_ref: (str) path to the user reference fasta file
-    :return: None
+    :return: (ToolJob) the job, the DNA alignment and its protein translation (_aligned_translated.fasta) are written
+    to aln_path
     """
     align_function = os.path.join(script_folder, 'align_ngs_codons.py')
+    cmd5 = ['python3', align_function, '-in', to_align, '-o', aln_path, '-n', fname, '-r', ref, '-g', gene, '-v']
     if sub_region:
-        reg = "-reg {}".format(sub_region)
-    else:
-        reg = ""
-    if not user_ref:
-        usr_ref = ""
+        cmd5.extend(["-reg", sub_region])
+    if user_ref:
+        cmd5.extend(["-u", user_ref])
+
+    log_folder = os.path.join(os.path.dirname(aln_path), "tool_logs")
+
+    return ToolJob("align", cmd5, job_log_file(log_folder, "align", fname))
+
+
+def call_align(jobs, aln_path, recorder, supervisor):
+    """
+    function to call the alignment script, independent alignments (eg: fwd and rev) are run concurrently and the mafft
+    threads for each alignment are granted by the resource manager
+    :param jobs: (list) of align jobs from align_job
+    :param aln_path: (str) the output path
+    :param recorder: (func) stage metrics recorder for this patient and region
+    :param supervisor: (StageSupervisor) runs the jobs with timeouts and retries, and records the failures
+    :return: (list) of the names of the alignments that failed
+    """
+    grant = supervisor.grant("align", "align", len(jobs), tool_limit=len(jobs))
+    jobs = [job._replace(argv=job.argv + ["-t", str(grant.threads)]) for job in jobs]
+    inputs = [job.argv[job.argv.index("-in") + 1] for job in jobs]
+    names = [job.argv[job.argv.index("-n") + 1] for job in jobs]
+    with recorder("align", inputs=inputs) as record:
+        results, failed = supervisor.run_jobs("align", jobs, names, tool_limits={grant.tool: grant.concurrency},
+                                              record=record)
+        record["outputs"] = [os.path.join(aln_path, x + suffix) for x in names
+                             for suffix in ["_aligned.fasta", "_aligned_translated.fasta"]]
+
+    return failed
+
+
+def estimate_scratch_space(new_data, run_step):
+    """
+    estimate the scratch space the temp folders will need, from the size of the input files in 0new_data
+    :param new_data: (str) path to the 0new_data folder
+    :param run_step: (int) the step the pipeline is starting from
+    :return: (int) estimated number of bytes needed, (int) size of the input files in bytes
+    """
+    if run_step <= 2:
+        # raw reads are staged once and MotifBinner writes several intermediate copies of them
+        input_files = glob(os.path.join(new_data, "*.fastq"))
+        expansion = 4
     else:
-        usr_ref = "-u {}".format(user_ref)
+        input_files = seq_glob(os.path.join(new_data, "*.fasta"))
+        expansion = 3
 
-    cmd5 = 'python3 {0}  -in {1} -o {2} -n {3} -r {4} -g {5} -v {6} {7}'.format(align_function, to_align, aln_path, fname,
-                                                                            ref, gene, reg, usr_ref)
-    subprocess.call(cmd5, shell=True)
+    input_size = sum(os.path.getsize(x) for x in input_files)
+
+    return input_size * expansion, input_size
 
 
 def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
-         run_only, user_ref, cores):
+         run_only, user_ref, cores, scratch_dir=False, metrics_file=False, failure_manifest=False):
+    """
+    run the pipeline steps for one gene region folder, staging the temp folders in scratch_dir if one is given
+    :param scratch_dir: (str/bool) path to a local scratch folder for the temp folders, False to use the output folder
+    :param metrics_file: (str/bool) JSON-lines file to record stage timings in, False to use one in the region folder
+    and write a per-stage summary table for this run
+    :param failure_manifest: (str/bool) JSON-lines file to record failed stages in, False to use one in the region
+    folder
+    :return: (bool) False if the pipeline crashed, the failure is recorded in the failure manifest
+    """
+    path = os.path.abspath(path)
+    patient = os.path.split(os.path.dirname(path))[-1]
+
+    summarise = False
+    if not metrics_file:
+        metrics_file = os.path.join(path, gene_region + "_stage_metrics.jsonl")
+        summarise = True
+
+    if not failure_manifest:
+        failure_manifest = os.path.join(path, gene_region + "_failure_manifest.jsonl")
+    resources = ResourceManager(cores, log_file=os.path.join(path, gene_region + "_logfile.txt"))
+    supervisor = StageSupervisor(failure_manifest, patient, gene_region, resources=resources)
+    # each stage registers its outputs in the run manifest, where the next stage finds them
+    manifest = RunManifest(manifest_file(path, gene_region), patient, gene_region)
+
+    def recorder(stage, inputs=None, sample=None):
+        return record_stage(metrics_file, patient, gene_region, stage, inputs=inputs, sample=sample,
+                            manifest=None if stage in UNREGISTERED_STAGES else manifest)
+
+    try:
+        stage_temp_folders(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
+                           run_only, user_ref, scratch_dir, recorder, supervisor, manifest)
+        return True
+    except (Exception, SystemExit) as e:
+        # record the crash and return, so that a batch run carries on with the next patient and region
+        supervisor.record_exception("step_2", e)
+        return False
+    finally:
+        if summarise and os.path.isfile(metrics_file):
+            summary_file = os.path.join(path, gene_region + "_stage_summary.csv")
+            summarise_metrics(metrics_file, summary_file)
+
+
+def stage_temp_folders(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
+                       run_only, user_ref, scratch_dir, recorder, supervisor, manifest):
+    """
+    set up the temp folder root, in the scratch folder if one is given, and run the pipeline steps
+    """
+    if not scratch_dir or run_step > 4:
+        run_steps(path, path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
+                  run_only, user_ref, recorder, supervisor, manifest)
+        return
+
+    scratch_dir = os.path.abspath(scratch_dir)
+    os.makedirs(scratch_dir, exist_ok=True)
+    new_data = os.path.join(path, "0new_data")
+    needed, input_size = estimate_scratch_space(new_data, run_step)
+    free = shutil.disk_usage(scratch_dir).free
+    print("Scratch folder: {0}\n\tinput size = {1:.1f} MB, estimated scratch space needed = {2:.1f} MB, "
+          "free = {3:.1f} MB".format(scratch_dir, input_size / 1e6, needed / 1e6, free / 1e6))
+    if needed > free:
+        print("Warning: the scratch folder may not have enough free space for this run")
+
+    temp_root = tempfile.mkdtemp(prefix="{0}_{1}_".format(name, gene_region), dir=scratch_dir)
+    try:
+        run_steps(path, temp_root, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length,
+                  run_step, run_only, user_ref, recorder, supervisor, manifest)
+    finally:
+        # the scratch space is always released, committed data is already in the output folder
+        rmtree(temp_root, ignore_errors=True)
+
+
+def run_steps(path, temp_root, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
+              run_only, user_ref, recorder, supervisor, manifest):
+    """
+    run the pipeline steps from run_step, each step reads the outputs that the previous one registered in the run
+    manifest, or searches the folders for them if the previous step was not run
+    """
 
     get_script_path = os.path.realpath(__file__)
     script_folder = os.path.split(get_script_path)[0]
@@ -243,13 +453,22 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
 
     gene = gene_region.upper().split("_")[0]
 
-    # define logfile filename
+    # define logfile filename, the output of each external tool call is logged to the tool_logs folder
     logfile = os.path.join(path, (gene_region + "_logfile.txt"))
+    tool_log_folder = os.path.join(path, "tool_logs")
     if not os.path.isfile(logfile):
         # initialize the log file
         with open(logfile, 'w') as handle:
             handle.write("Log File,{0}_{1}\n".format(name, gene_region))
 
+    # the consensus, cleaned and contam removal fasta files go in one container file when sample_container is set
+    container = container_file(path, gene_region) if container_from_env() else None
+    # the run writes its blocks to a staged container in the temp folders, which is published to the region's
+    # container at the commit, so a failed run leaves the committed blocks as they were
+    staged_container = None
+    if container:
+        staged_container = os.path.join(temp_root, "container_temp", os.path.basename(container))
+
     folders_to_make = ['0raw_temp', '1consensus_temp', '2cleaned_temp', '3contam_removal_temp']
 
     print("running pipeline from step:", run_step)
@@ -259,28 +478,32 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
         print("making temp folders")
 
         for folder in folders_to_make:
-            flder = os.path.join(path, folder)
+            flder = os.path.join(temp_root, folder)
             if os.path.isdir(flder):
                 print("Deleting exisiting folders")
                 rmtree(flder)
             os.makedirs(flder, exist_ok=True)
             if folder == '1consensus_temp':
                 os.makedirs(os.path.join(flder, "binned"), exist_ok=True)
+        if staged_container:
+            rmtree(os.path.dirname(staged_container), ignore_errors=True)
+            os.makedirs(os.path.dirname(staged_container))
 
     new_data = os.path.join(path, "0new_data")
+    # only the files in 0new_data now are staged and cleared at the commit, files that land during the run (eg: from
+    # demultiplex.py --watch) are left for the next run
+    new_data_files = glob(os.path.join(new_data, "*"))
+    new_fastq = [x for x in new_data_files if x.endswith(".fastq")]
 
     # Step 1: rename the raw sequences
     if run_step == 1:
         # move files from new_data to 0raw_temp
-        files_to_move = os.path.join(new_data, "*.fastq")
-        move_folder = os.path.join(path, '0raw_temp')
-        for file in glob(files_to_move):
-            file_name = os.path.split(file)[-1]
-            move_location = os.path.join(move_folder, file_name)
-            copyfile(file, move_location)
+        move_folder = os.path.join(temp_root, '0raw_temp')
+        with recorder("stage_inputs", inputs=new_fastq) as record:
+            record["outputs"] = stage_raw_reads(new_fastq, move_folder, cDNA_primer, logfile)
 
         # do the renaming
-        raw_fastq_inpath = os.path.join(path, '0raw_temp')
+        raw_fastq_inpath = os.path.join(temp_root, '0raw_temp')
         raw_files_search = os.path.join(raw_fastq_inpath, "*R1*.fastq")
         raw_files = glob(raw_files_search)
         if not raw_files:
@@ -302,22 +525,19 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
 
     # Step 2: run the call_MotifBinner script which will loop over fastq files in the target folder
     if run_step == 2:
-        move_folder = os.path.join(path, '0raw_temp')
+        move_folder = os.path.join(temp_root, '0raw_temp')
         if initual_run_step == 2:
-            files_to_move = os.path.join(new_data, "*.fastq")
-            for file in glob(files_to_move):
-                file_name = os.path.split(file)[-1]
-                move_location = os.path.join(move_folder, file_name)
-                copyfile(file, move_location)
+            stage_raw_reads(new_fastq, move_folder, cDNA_primer, logfile)
         
-        motifbinner = os.path.join(script_folder, 'call_motifbinner.py')
+        binner_script, binner_tool = binner_from_env()
+        motifbinner = os.path.join(script_folder, binner_script)
         rename_in_search = os.path.join(move_folder, "*_R1.fastq")
         rename_in = glob(rename_in_search)
-        cons_outpath = os.path.join(path, '1consensus_temp', 'binned')
+        cons_outpath = os.path.join(temp_root, '1consensus_temp', 'binned')
         counter = 0
         try:
-            call_motifbinner(rename_in, motifbinner, cons_outpath, fwd_primer, cDNA_primer, nonoverlap, counter, cores,
-                             logfile)
+            call_motifbinner(rename_in, motifbinner, cons_outpath, fwd_primer, cDNA_primer, nonoverlap, counter, logfile,
+                             recorder, supervisor, binner_tool)
             run_step += 1
         except Exception as e:
             print("MotifBinner2 crashed, this could be because the wrong primer was set, "
@@ -325,9 +545,9 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
             run_step = 100
 
         # check if the consensus files exist
-        nested_consensuses_path = os.path.join(path,
+        nested_consensuses_path = os.path.join(temp_root,
                                                '1consensus_temp/binned/*/*_buildConsensus/*_buildConsensus.fastq')
-        nested_consesnsuses = glob(nested_consensuses_path)
+        nested_consesnsuses = registered_files(manifest, "motifbinner", nested_consensuses_path)
         if not nested_consesnsuses:
             print("No consensus sequences were found\n"
                   "This is likely if MotifBinner was not able to complete\n"
@@ -337,50 +557,65 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
             run_step = 100
 
         if run_step != 100:
-            # copy data from nested binned folders into 1consensus folder
-            print("Coping fastq files from nested folders to '1consensus_temp' folder")
-            consensus_path = os.path.join(path, '1consensus_temp')
+            # link data from nested binned folders into 1consensus folder
+            print("Linking fastq files from nested folders to '1consensus_temp' folder")
+            consensus_path = os.path.join(temp_root, '1consensus_temp')
+            consensuses = []
             for cons_file in nested_consesnsuses:
                 old_path, old_name = os.path.split(cons_file)
                 new_name1 = old_name.replace("_buildConsensus", "")
                 new_name = new_name1.replace("_kept", "")
                 new_file = os.path.join(consensus_path, new_name)
-                copyfile(cons_file, new_file)
+                link_or_copy(cons_file, new_file)
+                consensuses.append(new_file)
 
             # convert copied fastq to fasta
             print("Converting fastq to fasta")
-            cons_search_path = os.path.join(consensus_path, '*.fastq')
-            consensuses = glob(cons_search_path)
+            jobs = []
             for fastq in consensuses:
                 fasta = fastq.replace("fastq", "fasta")
-                cmd2 = 'seqmagick convert {0} {1}'.format(fastq,
-                                                          fasta)
-
-                subprocess.call(cmd2, shell=True)
-
-            # remove the copied fastq files
-            print("Removing the copied fastq files")
-            remove_fastq = cons_search_path
-            for old_fastq_copy in glob(remove_fastq):
+                cmd2 = ['seqmagick', 'convert', fastq, fasta]
+                sample = os.path.split(fastq)[-1].replace(".fastq", "")
+                jobs.append(ToolJob("seqmagick", cmd2, job_log_file(tool_log_folder, "seqmagick", sample)))
+
+            grant = supervisor.grant("fastq_to_fasta", "seqmagick", len(jobs))
+            with recorder("fastq_to_fasta", inputs=consensuses) as record:
+                supervisor.run_jobs("fastq_to_fasta", jobs, tool_limits={grant.tool: grant.concurrency}, record=record)
+                record["outputs"] = [x.replace("fastq", "fasta") for x in consensuses]
+
+            # remove the linked fastq files
+            print("Removing the linked fastq files")
+            for old_fastq_copy in consensuses:
                 os.remove(old_fastq_copy)
 
             # delete any gaps characters in the fasta sequences
             print("deleting gaps in consensus sequences")
-            consensus_path = os.path.join(path, '1consensus_temp')
+            consensus_path = os.path.join(temp_root, '1consensus_temp')
             consensus_search = os.path.join(consensus_path, '*.fasta')
-            consensus_infiles = glob(consensus_search)
-            delete_gaps(consensus_infiles)
+            consensus_infiles = registered_files(manifest, "fastq_to_fasta", consensus_search)
+            with recorder("delete_gaps", inputs=consensus_infiles) as record:
+                delete_gaps(consensus_infiles)
+                record["outputs"] = [storage_name(x) for x in consensus_infiles]
 
             if nonoverlap:
                 print("move folder", consensus_path)
                 search_fwd_rev = os.path.join(move_folder, "*rev.fasta")
                 print("reverse complementing *rev.fasta")
-                for file in glob(search_fwd_rev):
+                rev_files = glob(search_fwd_rev)
+                jobs = []
+                for file in rev_files:
                     out = file + "_temp.fasta"
-                    cmd_rev_comp = 'seqmagick convert --reverse-complement {0} {1}'.format(file, out)
-                    subprocess.call(cmd_rev_comp, shell=True)
-                    os.unlink(file)
-                    os.rename(out, file)
+                    cmd_rev_comp = ['seqmagick', 'convert', '--reverse-complement', file, out]
+                    sample = os.path.split(file)[-1].replace(".fasta", "")
+                    jobs.append(ToolJob("seqmagick", cmd_rev_comp,
+                                        job_log_file(tool_log_folder, "reverse_complement", sample)))
+                grant = supervisor.grant("reverse_complement", "seqmagick", len(jobs))
+                results, failed = supervisor.run_jobs("reverse_complement", jobs, rev_files,
+                                                      tool_limits={grant.tool: grant.concurrency})
+                for file in rev_files:
+                    if file in failed:
+                        continue
+                    move_file(file + "_temp.fasta", file)
 
             if run_only:
                 # copy back to permanent folder, remove temp folder
@@ -388,26 +623,35 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
 
     # Step 3: call remove bad sequences
     if run_step == 3:
-        move_folder = os.path.join(path, '1consensus_temp')
+        move_folder = os.path.join(temp_root, '1consensus_temp')
         if initual_run_step == 3:
             files_to_move = os.path.join(new_data, "*.fasta")
-            for file in glob(files_to_move):
+            for file in [x for x in seq_glob(files_to_move) if x in new_data_files]:
                 file_name = os.path.split(file)[-1]
                 move_location = os.path.join(move_folder, file_name)
-                copyfile(file, move_location)
+                link_or_copy(file, move_location)
 
         print("Removing 'bad' sequences")
         remove_bad_seqs = os.path.join(script_folder, 'remove_bad_sequences.py')
         consensus_search = os.path.join(move_folder, '*.fasta')
-        consensus_infiles = glob(consensus_search)
-        clean_path = os.path.join(path, '2cleaned_temp')
+        if initual_run_step == 3:
+            consensus_infiles = seq_glob(consensus_search)
+        else:
+            consensus_infiles = registered_files(manifest, "delete_gaps", consensus_search)
+        clean_path = os.path.join(temp_root, '2cleaned_temp')
+        if container:
+            # only this run's samples are cleaned, not the samples of earlier runs in the region's container
+            imported = import_files([x for x in consensus_infiles if not is_block_ref(x)], staged_container,
+                                    "1consensus", stage="consensus")
+            consensus_infiles = [x for x in consensus_infiles if is_block_ref(x)] + imported
+            clean_path = block_ref(staged_container, "2cleaned")
         if not consensus_infiles:
             print("Could not find consensus fasta files\n"
                   "It is possible something went wrong when copying the consensus sequences from the nested folders "
                   "to the 1consensus folder")
             run_step = 100
         if run_step != 100:
-            call_fasta_cleanup(consensus_infiles, remove_bad_seqs, clean_path, length, logfile)
+            call_fasta_cleanup(consensus_infiles, remove_bad_seqs, clean_path, length, logfile, recorder, supervisor)
             run_step += 1
 
         if run_only:
@@ -416,19 +660,27 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
 
     # Step 4: remove contaminating sequences
     if run_step == 4:
-        move_folder = os.path.join(path, '2cleaned_temp')
+        move_folder = os.path.join(temp_root, '2cleaned_temp')
         if initual_run_step == 4:
             files_to_move = os.path.join(new_data, "*.fasta")
-            for file in glob(files_to_move):
+            for file in [x for x in seq_glob(files_to_move) if x in new_data_files]:
                 file_name = os.path.split(file)[-1]
                 move_location = os.path.join(move_folder, file_name)
-                copyfile(file, move_location)
+                link_or_copy(file, move_location)
 
         print("removing contaminating non-HIV sequences")
         contam_removal_script = os.path.join(script_folder, "contam_removal.py")
         clean_search = os.path.join(move_folder, "*clean.fasta")
-        contam_removed_path = os.path.join(path, '3contam_removal_temp')
-        clean_files = glob(clean_search)
+        contam_removed_path = os.path.join(temp_root, '3contam_removal_temp')
+        if initual_run_step == 4:
+            clean_files = seq_glob(clean_search)
+        else:
+            clean_files = registered_files(manifest, "clean", clean_search, pattern="*clean.fasta")
+        if container:
+            imported = import_files([x for x in clean_files if not is_block_ref(x)], staged_container, "2cleaned",
+                                    stage="clean")
+            clean_files = [x for x in clean_files if is_block_ref(x)] + imported
+            contam_removed_path = block_ref(staged_container, "3contam_removal")
         hxb2_region = {"GAG": "GAG", "POL": "POL", "PRO": "POL", "RT": "POL", "RT1": "POL", "RT2": "POL",
                        "RNASE": "POL", "INT": "POL", "ENV": "ENV", "GP160": "ENV", "GP120": "ENV", "GP41": "ENV",
                        "NEF": "NEF", "VIF": "VIF", "VPR": "VPR", "REV": "REV", "VPU": "VPU"}
@@ -444,17 +696,18 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
                   )
             run_step = 100
         if run_step != 100:
-            call_contam_check(clean_files, contam_removal_script, contam_removed_path, region_to_check, logfile)
+            call_contam_check(clean_files, contam_removal_script, contam_removed_path, region_to_check, logfile,
+                              recorder, supervisor)
 
         # copy back to permanent folder, remove temp folder
         run_step = 10
 
-    # copy data to permanent folders, delete temp folders/files
+    # commit temp folders to the permanent folders
     if run_step == 10:
-        print('copying data from temp folders')
+        print('committing data from temp folders')
         for folder in folders_to_make:
-            temp_folder = os.path.join(path, folder)
-            perm_folder = temp_folder.replace("_temp", "")
+            temp_folder = os.path.join(temp_root, folder)
+            perm_folder = os.path.join(path, folder.replace("_temp", ""))
             if not os.path.isdir(temp_folder):
                 print("temp folder does not exist")
                 sys.exit()
@@ -462,33 +715,44 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
                 print("folder does not exist")
                 sys.exit()
 
-            copy_tree(temp_folder, perm_folder)
-            rmtree(temp_folder)
-
-        # clear the new_data folder
-        new_files_to_remove = os.path.join(new_data, "*")
-        for file in glob(new_files_to_remove):
-            os.unlink(file)
+            with recorder("commit"):
+                commit_folder(temp_folder, perm_folder)
+            manifest.relocate(temp_folder, perm_folder)
+        if staged_container and os.path.isfile(staged_container):
+            with recorder("commit"):
+                SampleContainer(container).publish(staged_container)
+            manifest.relocate(os.path.dirname(staged_container), path)
+            rmtree(os.path.dirname(staged_container), ignore_errors=True)
+
+        # clear the new_data files that this run processed
+        for file in new_data_files:
+            if os.path.isfile(file):
+                os.unlink(file)
         run_step = 5
 
     # Step 5: set things up to align sequences
     if run_step == 5:
 
-        # cat all cleaned files into one file + the relevant HXB2 sequence
+        # cat all cleaned files into one file in the 4aligned folder
         print("merging all cleaned and contam removed fasta files into one file")
-        all_clean_path = os.path.join(path, '3contam_removal')
+        aln_path = os.path.join(path, '4aligned')
         contam_removed_path = os.path.join(path, '3contam_removal')
+        if container:
+            contam_removed_path = block_ref(container, "3contam_removal")
         if nonoverlap:
             clean_name_fwd = name + "_" + gene_region + "_fwd_all.fasta"
             clean_name_rev = name + "_" + gene_region + "_rev_all.fasta"
-            all_cleaned_outname_fwd = os.path.join(all_clean_path, clean_name_fwd)
-            all_cleaned_outname_rev = os.path.join(all_clean_path, clean_name_rev)
+            all_fasta_fwd = storage_name(os.path.join(aln_path, clean_name_fwd))
+            all_fasta_rev = storage_name(os.path.join(aln_path, clean_name_rev))
 
             cleaned_files_search_fwd = os.path.join(contam_removed_path, '*fwd_good.fasta')
             cleaned_files_search_rev = os.path.join(contam_removed_path, '*rev_good.fasta')
 
-            cleaned_files_fwd = glob(cleaned_files_search_fwd)
-            cleaned_files_ref = glob(cleaned_files_search_rev)
+            # the samples of earlier runs of this gene region are aligned with the new ones
+            cleaned_files_fwd = committed_files(manifest, "contam", cleaned_files_search_fwd,
+                                                pattern="*fwd_good.fasta")
+            cleaned_files_ref = committed_files(manifest, "contam", cleaned_files_search_rev,
+                                                pattern="*rev_good.fasta")
 
             if not cleaned_files_fwd:
                 print("No cleaned fwd-fasta files were found\n"
@@ -500,10 +764,11 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
                 run_step = 100
         else:
             clean_name = name + "_" + gene_region + "_all.fasta"
-            all_cleaned_outname = os.path.join(all_clean_path, clean_name)
+            all_fasta = storage_name(os.path.join(aln_path, clean_name))
 
             cleaned_files_search = os.path.join(contam_removed_path, '*_good.fasta')
-            cleaned_files = glob(cleaned_files_search)
+            # the samples of earlier runs of this gene region are aligned with the new ones
+            cleaned_files = committed_files(manifest, "contam", cleaned_files_search, pattern="*_good.fasta")
 
             if not cleaned_files:
                 print("No cleaned fasta files were found\n"
@@ -512,72 +777,47 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
 
         if run_step != 100:
             if nonoverlap:
-                with open(all_cleaned_outname_fwd, 'w') as outfile:
-                    for fasta_file in cleaned_files_fwd:
-                        with open(fasta_file) as infile:
-                            for line in infile:
-                                outfile.write(line + "\n")
-
-                with open(all_cleaned_outname_rev, 'w') as outfile:
-                    for fasta_file in cleaned_files_ref:
-                        with open(fasta_file) as infile:
-                            for line in infile:
-                                outfile.write(line + "\n")
+                with recorder("merge", inputs=cleaned_files_fwd + cleaned_files_ref) as record:
+                    concatenate_seq_files(cleaned_files_fwd, all_fasta_fwd, stage="merge")
+                    concatenate_seq_files(cleaned_files_ref, all_fasta_rev, stage="merge")
+                    record["outputs"] = [all_fasta_fwd, all_fasta_rev]
             else:
-                with open(all_cleaned_outname, 'w') as outfile:
-                    for fasta_file in cleaned_files:
-                        with open(fasta_file) as infile:
-                            for line in infile:
-                                outfile.write(line + "\n")
-
-            # move concatenated file to 4aligned
-            print("moving concatenated file to 4aligned folder")
-            aln_path = os.path.join(path, '4aligned')
-            if nonoverlap:
-                move_file_fwd = os.path.join(aln_path, clean_name_fwd)
-                copyfile(all_cleaned_outname_fwd, move_file_fwd)
-                os.unlink(all_cleaned_outname_fwd)
-                move_file_rev = os.path.join(aln_path, clean_name_rev)
-                copyfile(all_cleaned_outname_rev, move_file_rev)
-                os.unlink(all_cleaned_outname_rev)
-            else:
-                move_file = os.path.join(aln_path, clean_name)
-                copyfile(all_cleaned_outname, move_file)
-                os.unlink(all_cleaned_outname)
+                with recorder("merge", inputs=cleaned_files) as record:
+                    concatenate_seq_files(cleaned_files, all_fasta, stage="merge")
+                    record["outputs"] = [all_fasta]
 
             # call alignment script
             print("Aligning the sequences")
             if nonoverlap:
-                for move_file in [move_file_fwd, move_file_rev]:
-                    if sub_region == "C1C3" and "fwd" in move_file:
+                align_jobs = []
+                for all_fasta in [all_fasta_fwd, all_fasta_rev]:
+                    if sub_region == "C1C3" and "fwd" in all_fasta:
                         sub_region = "C1C2"
-                    elif sub_region == "C1C3" and "rev" in move_file:
+                    elif sub_region == "C1C3" and "rev" in all_fasta:
                         sub_region = "C2C3"
 
-                    to_align = move_file
+                    to_align = all_fasta
                     inpath, fname = os.path.split(to_align)
-                    fname = fname.replace(".fasta", "")
+                    fname = plain_name(fname).replace(".fasta", "")
                     ref = "CONSENSUS_C"
+                    align_jobs.append(align_job(script_folder, to_align, aln_path, fname, ref, gene_region,
+                                                sub_region, user_ref))
 
-                    try:
-                        call_align(script_folder, to_align, aln_path, fname, ref, gene_region, sub_region, user_ref)
-                    except Exception as e:
-                        print(e)
-                        run_step = 100
-                    # translate alignment
-                    transl_name = fname.replace("_aligned.fasta", "_aligned_translated.fasta")
-                    cmd = "seqmagick convert --sort length-asc --upper --translate dna2protein --line-wrap 0 {0} {1}".format(fname, transl_name)
-                    subprocess.call(cmd, shell=True)
+                if call_align(align_jobs, aln_path, recorder, supervisor):
+                    run_step = 100
 
             else:
-                to_align = move_file
+                to_align = all_fasta
                 inpath, fname = os.path.split(to_align)
-                fname = fname.replace(".fasta", "")
+                fname = plain_name(fname).replace(".fasta", "")
                 ref = "CONSENSUS_C"
 
-                call_align(script_folder, to_align, aln_path, fname, ref, gene, sub_region, user_ref)
+                if call_align([align_job(script_folder, to_align, aln_path, fname, ref, gene, sub_region, user_ref)],
+                              aln_path, recorder, supervisor):
+                    run_step = 100
 
-            run_step += 1
+            if run_step != 100:
+                run_step += 1
 
             if run_only:
                 run_step = 100
@@ -588,13 +828,17 @@ def main(path, name, gene_region, sub_region, fwd_primer, cDNA_primer, nonoverla
         call_stats_calc = os.path.join(script_folder, 'ngs_stats_calculator.py')
         stats_outfname = (name + "_" + gene_region + '_sequencing_stats.csv')
         stats_outpath = os.path.join(path, stats_outfname)
-        cmd6 = 'python3 {0} -in {1} -o {2}'.format(call_stats_calc, path, stats_outpath)
-        subprocess.call(cmd6, shell=True)
+        cmd6 = ['python3', call_stats_calc, '-in', path, '-o', stats_outpath]
+        with recorder("stats") as record:
+            supervisor.run_jobs("stats", [ToolJob("ngs_stats_calculator", cmd6,
+                                                  job_log_file(tool_log_folder, "stats", name))], record=record)
+            record["outputs"] = [stats_outpath]
 
     print("The sample processing has been completed")
 
     if run_step == 100:
         print("Pipeline failed on this sample")
+        supervisor.record("step_2", "the pipeline stopped before completing, see the log for this region")
 
 
 if __name__ == "__main__":
@@ -629,7 +873,11 @@ if __name__ == "__main__":
                         help='the path and file name for the custom DNA reference sequence for codon aligning\n'
                              'must start in reading frame 1', required=False)
     parser.add_argument('-ncpu', '--cores', default=3, type=int,
-                        help='the number of CPU cores to use', required=False)
+                        help='the most CPU cores to use, they are divided between the jobs of each step',
+                        required=False)
+    parser.add_argument('-sd', '--scratch_dir', default=False, type=str,
+                        help='a local scratch folder (eg: on a local disk or tmpfs) for the temp folders of steps 1-4, '
+                             'the results are committed to the output folder at the end', required=False)
     parser.add_argument('-rs', '--run_step', type=int, default=1,
                         help='rerun the pipeline from a given step:\n'
                              '1 = step 1: rename raw files;\n'
@@ -658,11 +906,16 @@ if __name__ == "__main__":
     run_step = args.run_step
     run_only = args.run_only
     user_ref = args.user_ref
+    scratch_dir = args.scratch_dir
     if gene_region == "ENV":
         if not regions:
             sys.exit("must use the -reg flag for ENV")
     if regions == "C4C5":
         regions = "C3C5"
 
-    main(path, name, gene_region, regions, fwd_primer, cDNA_primer, nonoverlap, length, run_step, run_only,
-         user_ref, cores)
+    patient = os.path.split(os.path.dirname(os.path.abspath(path)))[-1]
+    completed = profiling_hooks.run_main(main, "step_2", "{0}_{1}".format(patient, gene_region), path, name,
+                                         gene_region, regions, fwd_primer, cDNA_primer, nonoverlap, length, run_step,
+                                         run_only, user_ref, cores, scratch_dir)
+    if not completed:
+        sys.exit(1)
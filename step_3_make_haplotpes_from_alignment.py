@@ -4,8 +4,11 @@ from __future__ import division
 import os
 import sys
 import argparse
-import subprocess
 from glob import glob
+from tool_runner import ToolJob
+from tool_runner import ToolRunner
+from tool_runner import failed_jobs
+from tool_runner import job_log_file
 
 
 __author__ = 'Colin Anthony'
@@ -25,16 +28,23 @@ def main(infile, field):
         print("could not find the 5haplotype folder\n check your file naming structure conforms to the required format")
         sys.exit()
     split_by_unique = os.path.join(script_folder, 'split_fasta_into_subfiles.py')
-    cmd6 = 'python3 {0} -in {1} -o {2} -f {3}'.format(split_by_unique, infile, haplo_outpath, field)
-
-    subprocess.call(cmd6, shell=True)
+    log_folder = os.path.join(parent_path, "tool_logs")
+    # the python scripts are run by the pipeline daemon, if one is configured
+    runner = ToolRunner()
+    cmd6 = ['python3', split_by_unique, '-in', infile, '-o', haplo_outpath, '-f', str(field)]
+    name = os.path.splitext(os.path.split(infile)[-1])[0]
+    failed_jobs(runner.run_jobs([ToolJob("split_fasta_into_subfiles", cmd6,
+                                         job_log_file(log_folder, "split_fasta", name))]))
 
     # haplotype
     split_fasta_files = os.path.join(haplo_outpath, "*_sep.fasta")
     haplotyper = os.path.join(script_folder, 'haplotyper_freq.py')
+    jobs = []
     for split_fasta in glob(split_fasta_files):
-        cmd7 = 'python3 {0} -in {1} -o {2}'.format(haplotyper, split_fasta, haplo_outpath)
-        subprocess.call(cmd7, shell=True)
+        cmd7 = ['python3', haplotyper, '-in', split_fasta, '-o', haplo_outpath]
+        name = os.path.splitext(os.path.split(split_fasta)[-1])[0]
+        jobs.append(ToolJob("haplotyper_freq", cmd7, job_log_file(log_folder, "haplotyper", name)))
+    failed_jobs(runner.run_jobs(jobs))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,297 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import random
+import hashlib
+import argparse
+import collections
+from itertools import islice
+from itertools import zip_longest
+
+
+__author__ = 'Colin Anthony'
+
+
+# set NGS_PIPELINE_SUBSAMPLE to eg: "reads=200000,pids=0,seed=0" to cap the depth of each sample before MotifBinner
+SUBSAMPLE_ENV = "NGS_PIPELINE_SUBSAMPLE"
+# families with fewer reads than this are too small for a consensus, so they don't count towards a PID target
+MIN_FAMILY_SIZE = 3
+
+# the subsampling settings, 0 for no cap
+Subsample = collections.namedtuple("Subsample", ["max_reads", "max_pids", "seed"])
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the subsampling caps for this process and the processes it starts, from the pipelineSettings of the config
+    file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    max_reads = int(pipeline_settings.get("subsample_reads", 0) or 0)
+    max_pids = int(pipeline_settings.get("subsample_pids", 0) or 0)
+    if max_reads or max_pids:
+        seed = int(pipeline_settings.get("subsample_seed", 0) or 0)
+        os.environ[SUBSAMPLE_ENV] = "reads={0},pids={1},seed={2}".format(max_reads, max_pids, seed)
+
+
+def subsample_from_env():
+    """
+    :return: (Subsample) the caps set in NGS_PIPELINE_SUBSAMPLE, None if there are none
+    """
+    settings = {"reads": 0, "pids": 0, "seed": 0}
+    for item in os.environ.get(SUBSAMPLE_ENV, "").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        try:
+            settings[name.strip()] = int(value)
+        except ValueError:
+            print("Ignoring invalid subsample setting: {}".format(item))
+
+    if not settings["reads"] and not settings["pids"]:
+        return None
+
+    return Subsample(settings["reads"], settings["pids"], settings["seed"])
+
+
+def pid_length(cDNA_primer):
+    """
+    :param cDNA_primer: (str) the full cDNA primer, with the primer ID as its leading N's
+    :return: (int) the length of the primer ID
+    """
+    cDNA_primer = cDNA_primer.upper()
+
+    return len(cDNA_primer) - len(cDNA_primer.lstrip("N"))
+
+
+def fastq_records(handle):
+    """
+    :param handle: an open fastq file
+    :return: (generator) of the 4 lines of each record
+    """
+    while True:
+        record = list(islice(handle, 4))
+        if not record:
+            return
+        if len(record) < 4:
+            raise ValueError("truncated fastq record at the end of {}".format(handle.name))
+        yield record
+
+
+def paired_records(r1_in, r2_in):
+    """
+    :param r1_in: an open R1 fastq file
+    :param r2_in: an open R2 fastq file
+    :return: (generator) of the (R1, R2) records of each read pair
+    """
+    for r1_record, r2_record in zip_longest(fastq_records(r1_in), fastq_records(r2_in)):
+        # zip would silently drop the end of the longer file and leave the mates out of sync
+        if r1_record is None or r2_record is None:
+            raise ValueError("{0} and {1} have different numbers of records, the mates are out of sync".format(
+                r1_in.name, r2_in.name))
+        yield r1_record, r2_record
+
+
+def family_key(r2_record, pid_len):
+    """
+    :param r2_record: (list) the 4 lines of the R2 record
+    :param pid_len: (int) the length of the primer ID at the start of R2
+    :return: (str) the primer ID of the read's family, or the read name if there is no primer ID
+    """
+    if pid_len:
+        return r2_record[1][:pid_len]
+
+    return r2_record[0].split()[0]
+
+
+def family_hash(key, seed=0):
+    """
+    :param key: (str) the family's primer ID
+    :param seed: (int) changes the hash
+    :return: (bytes) a deterministic, uniformly spread hash of a family, the same on every machine and run
+    """
+    return hashlib.blake2b(key.encode(), digest_size=8, key=str(seed).encode()).digest()
+
+
+def count_families(r2_file, pid_len):
+    """
+    :param r2_file: (str) the R2 fastq file
+    :param pid_len: (int) the length of the primer ID at the start of R2
+    :return: (dict) key = primer ID, value = number of reads
+    """
+    families = collections.Counter()
+    with open(r2_file, 'r') as handle:
+        for record in fastq_records(handle):
+            families[family_key(record, pid_len)] += 1
+
+    return families
+
+
+def select_families(families, max_reads=0, max_pids=0, seed=0):
+    """
+    pick whole families in the order of the hash of their primer ID until a cap is reached, so the same families
+    are picked on every run and the picked families are a random sample of the primer IDs
+    :param families: (dict) key = primer ID, value = number of reads
+    :param max_reads: (int) the most reads to keep, 0 for no cap
+    :param max_pids: (int) the most families of at least MIN_FAMILY_SIZE reads to keep, 0 for no cap
+    :param seed: (int) changes which families are picked
+    :return: (set) the primer IDs to keep
+    """
+    keep = set()
+    reads = 0
+    pids = 0
+    for key in sorted(families, key=lambda x: family_hash(x, seed)):
+        size = families[key]
+        if max_reads and reads + size > max_reads:
+            # a family that doesn't fit is skipped whole, smaller ones further on may still fit
+            continue
+        if max_pids and pids >= max_pids:
+            break
+        keep.add(key)
+        reads += size
+        if size >= MIN_FAMILY_SIZE:
+            pids += 1
+
+    return keep
+
+
+def subsample_pair(r1_file, r2_file, out_r1, out_r2, pid_len, max_reads=0, max_pids=0, seed=0):
+    """
+    write the reads of the picked primer ID families of a sample, both reads of a pair are kept or dropped together
+    :param r1_file: (str) the R1 fastq file
+    :param r2_file: (str) the R2 fastq file, with the primer ID at the start of the reads
+    :param out_r1: (str) the subsampled R1 file
+    :param out_r2: (str) the subsampled R2 file
+    :param pid_len: (int) the length of the primer ID, 0 to pick single read pairs
+    :param max_reads: (int) the most read pairs to keep, 0 for no cap
+    :param max_pids: (int) the most families of at least MIN_FAMILY_SIZE reads to keep, 0 for no cap
+    :param seed: (int) changes which families are picked
+    :return: (dict) reads_in, reads_out, families_in and families_out
+    """
+    families = count_families(r2_file, pid_len)
+    keep = select_families(families, max_reads, max_pids, seed)
+
+    reads_out = 0
+    with open(r1_file, 'r') as r1_in, open(r2_file, 'r') as r2_in, \
+            open(out_r1, 'w') as r1_out, open(out_r2, 'w') as r2_out:
+        for r1_record, r2_record in paired_records(r1_in, r2_in):
+            if family_key(r2_record, pid_len) in keep:
+                r1_out.writelines(r1_record)
+                r2_out.writelines(r2_record)
+                reads_out += 1
+
+    return collections.OrderedDict([("reads_in", sum(families.values())), ("reads_out", reads_out),
+                                    ("families_in", len(families)), ("families_out", len(keep))])
+
+
+def shard_pair(r1_file, r2_file, out_folder, shards, pid_len):
+    """
+    split a sample into shards by the hash of the primer ID, so all the reads of a family are in the same shard
+    :param r1_file: (str) the R1 fastq file
+    :param r2_file: (str) the R2 fastq file, with the primer ID at the start of the reads
+    :param out_folder: (str) the folder for the shards, shard<i>_R1.fastq and shard<i>_R2.fastq
+    :param shards: (int) the number of shards
+    :param pid_len: (int) the length of the primer ID, 0 to shard single read pairs
+    :return: (list) of (R1, R2) files of the shards that have reads
+    """
+    names = [(os.path.join(out_folder, "shard{}_R1.fastq".format(i)), os.path.join(out_folder,
+                                                                                  "shard{}_R2.fastq".format(i)))
+             for i in range(shards)]
+    handles = [(open(r1, 'w'), open(r2, 'w')) for r1, r2 in names]
+    counts = [0] * shards
+    try:
+        with open(r1_file, 'r') as r1_in, open(r2_file, 'r') as r2_in:
+            for r1_record, r2_record in paired_records(r1_in, r2_in):
+                shard = int.from_bytes(family_hash(family_key(r2_record, pid_len)), "big") % shards
+                handles[shard][0].writelines(r1_record)
+                handles[shard][1].writelines(r2_record)
+                counts[shard] += 1
+    finally:
+        for r1_handle, r2_handle in handles:
+            r1_handle.close()
+            r2_handle.close()
+
+    return [pair for pair, count in zip(names, counts) if count]
+
+
+def sample_pairs(r1_file, r2_file, out_r1, out_r2, n_pairs, reservoir=False, seed=0):
+    """
+    write the first n read pairs of a sample, or a uniform random sample of n pairs from the whole sample (reservoir
+    sampling: one pass, holding at most n pairs in memory)
+    :param r1_file: (str) the R1 fastq file
+    :param r2_file: (str) the R2 fastq file
+    :param out_r1: (str) the sampled R1 file
+    :param out_r2: (str) the sampled R2 file
+    :param n_pairs: (int) the number of read pairs to keep
+    :param reservoir: (bool) True for a random sample, False for the first n pairs
+    :param seed: (int) changes which pairs are picked
+    :return: (int) the number of read pairs written
+    """
+    written = 0
+    with open(r1_file, 'r') as r1_in, open(r2_file, 'r') as r2_in, \
+            open(out_r1, 'w') as r1_out, open(out_r2, 'w') as r2_out:
+        pairs = paired_records(r1_in, r2_in)
+        if reservoir:
+            rng = random.Random(seed)
+            kept = []
+            for i, pair in enumerate(pairs):
+                if i < n_pairs:
+                    kept.append(pair)
+                else:
+                    j = rng.randint(0, i)
+                    if j < n_pairs:
+                        kept[j] = pair
+        else:
+            kept = islice(pairs, n_pairs)
+        for r1_record, r2_record in kept:
+            r1_out.writelines(r1_record)
+            r2_out.writelines(r2_record)
+            written += 1
+
+    return written
+
+
+def main(infile, outpath, cDNA_primer, max_reads, max_pids, seed):
+
+    r2_file = "R2".join(infile.rsplit("R1", 1))
+    out_r1 = os.path.join(outpath, os.path.basename(infile))
+    out_r2 = os.path.join(outpath, os.path.basename(r2_file))
+    if os.path.abspath(out_r1) == os.path.abspath(infile):
+        raise ValueError("the outpath must not be the folder of the input files")
+
+    stats = subsample_pair(infile, r2_file, out_r1, out_r2, pid_length(cDNA_primer), max_reads, max_pids, seed)
+    print("kept {reads_out} of {reads_in} read pairs from {families_out} of {families_in} primer ID families".format(
+        **stats))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Caps the depth of a sample by keeping whole primer ID families, '
+                                                 'picked deterministically by the hash of their primer ID',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--infile', default=argparse.SUPPRESS, type=str,
+                        help='The R1 fastq file, the R2 file is found by replacing the last R1 in the name with R2',
+                        required=True)
+    parser.add_argument('-o', '--outpath', default=argparse.SUPPRESS, type=str,
+                        help='The folder for the subsampled R1 and R2 files', required=True)
+    parser.add_argument('-r', '--cDNA_primer', default=argparse.SUPPRESS, type=str,
+                        help='The cDNA primer, its leading Ns are the primer ID (eg: NNNNNNNNNNNTCTTCTAATACTG)',
+                        required=True)
+    parser.add_argument('-mr', '--max_reads', default=0, type=int,
+                        help='The most read pairs to keep, 0 for no cap', required=False)
+    parser.add_argument('-mp', '--max_pids', default=0, type=int,
+                        help='The most primer ID families (of at least {} reads) to keep, 0 for no cap'.format(
+                            MIN_FAMILY_SIZE), required=False)
+    parser.add_argument('-s', '--seed', default=0, type=int,
+                        help='Changes which families are picked', required=False)
+
+    args = parser.parse_args()
+    infile = args.infile
+    outpath = args.outpath
+    cDNA_primer = args.cDNA_primer
+    max_reads = args.max_reads
+    max_pids = args.max_pids
+    seed = args.seed
+
+    main(infile, outpath, cDNA_primer, max_reads, max_pids, seed)
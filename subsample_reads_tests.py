@@ -0,0 +1,102 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+import subsample_reads
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.r1 = os.path.join(self.tmp_dir, "CAP1_ENV_S1_L001_R1_001.fastq")
+        self.r2 = os.path.join(self.tmp_dir, "CAP1_ENV_S1_L001_R2_001.fastq")
+        rng = random.Random(1)
+        reads = []
+        for family in range(40):
+            pid = "".join(rng.choice("ACGT") for _ in range(11))
+            reads.extend([pid] * rng.randint(1, 8))
+        rng.shuffle(reads)
+        with open(self.r1, 'w') as r1, open(self.r2, 'w') as r2:
+            for i, pid in enumerate(reads):
+                r1.write("@read{0} 1\nACGTACGT\n+\nIIIIIIII\n".format(i))
+                r2.write("@read{0} 2\n{1}TCTTCTAATACTG\n+\n{2}\n".format(i, pid, "I" * 24))
+        self.families = subsample_reads.count_families(self.r2, 11)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def subsample(self, name, **caps):
+        out_r1 = os.path.join(self.tmp_dir, name + "_R1.fastq")
+        out_r2 = os.path.join(self.tmp_dir, name + "_R2.fastq")
+        stats = subsample_reads.subsample_pair(self.r1, self.r2, out_r1, out_r2, 11, **caps)
+        with open(out_r1) as r1, open(out_r2) as r2:
+            pairs = [(a[0].split()[0], b[0].split()[0], b[1][:11])
+                     for a, b in subsample_reads.paired_records(r1, r2)]
+        return stats, pairs
+
+    def test_whole_families_are_kept_up_to_the_read_cap(self):
+        stats, pairs = self.subsample("a", max_reads=60)
+        self.assertTrue(0 < stats["reads_out"] <= 60)
+        self.assertEqual(stats["reads_out"], len(pairs))
+        self.assertTrue(all(r1 == r2 for r1, r2, pid in pairs))
+        kept_pids = set(pid for r1, r2, pid in pairs)
+        self.assertEqual(sum(self.families[x] for x in kept_pids), len(pairs))
+
+        # the same families are picked again, and a different seed picks others
+        self.assertEqual(self.subsample("b", max_reads=60)[1], pairs)
+        self.assertNotEqual(self.subsample("c", max_reads=60, seed=1)[1], pairs)
+
+    def test_pid_target(self):
+        keep = subsample_reads.select_families(self.families, max_pids=5)
+        self.assertEqual(len([x for x in keep if self.families[x] >= subsample_reads.MIN_FAMILY_SIZE]), 5)
+        self.assertEqual(subsample_reads.pid_length("NNNNNNNNNNNTCTTCTAATACTG"), 11)
+
+    def test_shards_keep_families_whole(self):
+        shards = subsample_reads.shard_pair(self.r1, self.r2, self.tmp_dir, 4, 11)
+        self.assertEqual(len(shards), 4)
+        seen = set()
+        reads = 0
+        for r1_file, r2_file in shards:
+            with open(r1_file) as r1, open(r2_file) as r2:
+                pairs = [(a[0].split()[0], b[1][:11])
+                         for a, b in subsample_reads.paired_records(r1, r2)]
+            pids = set(pid for name, pid in pairs)
+            self.assertFalse(pids & seen)
+            seen.update(pids)
+            reads += len(pairs)
+        self.assertEqual(seen, set(self.families))
+        self.assertEqual(reads, sum(self.families.values()))
+
+    def test_sample_pairs(self):
+        out_r1 = os.path.join(self.tmp_dir, "s_R1.fastq")
+        out_r2 = os.path.join(self.tmp_dir, "s_R2.fastq")
+        for reservoir in [False, True]:
+            self.assertEqual(subsample_reads.sample_pairs(self.r1, self.r2, out_r1, out_r2, 10, reservoir), 10)
+            with open(out_r1) as r1, open(out_r2) as r2:
+                names = [(a[0].split()[0], b[0].split()[0])
+                         for a, b in subsample_reads.paired_records(r1, r2)]
+            self.assertTrue(all(a == b for a, b in names))
+            if not reservoir:
+                self.assertEqual([a for a, b in names], ["@read{}".format(i) for i in range(10)])
+            else:
+                self.assertEqual(len(set(names)), 10)
+
+    def test_mates_out_of_sync(self):
+        with open(self.r1) as handle:
+            lines = handle.readlines()
+        with open(self.r1, 'w') as handle:
+            handle.writelines(lines[:-4])
+        out_r1 = os.path.join(self.tmp_dir, "s_R1.fastq")
+        out_r2 = os.path.join(self.tmp_dir, "s_R2.fastq")
+        with self.assertRaises(ValueError):
+            subsample_reads.subsample_pair(self.r1, self.r2, out_r1, out_r2, 11, max_reads=60)
+        with self.assertRaises(ValueError):
+            subsample_reads.shard_pair(self.r1, self.r2, self.tmp_dir, 3, 11)
+        with self.assertRaises(ValueError):
+            subsample_reads.sample_pairs(self.r1, self.r2, out_r1, out_r2, 10, reservoir=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
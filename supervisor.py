@@ -0,0 +1,236 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import time
+import argparse
+import traceback
+import collections
+from tool_runner import ToolRunner
+from tool_runner import failed_jobs
+from tool_runner import failure_reason
+from tool_runner import peak_rss_mb
+from resource_manager import ResourceManager
+
+
+__author__ = 'Colin Anthony'
+
+# set NGS_PIPELINE_STAGE_TIMEOUTS to eg: "motifbinner=7200,align=3600,default=1800" to time out hung stages
+STAGE_TIMEOUTS_ENV = "NGS_PIPELINE_STAGE_TIMEOUTS"
+# number of retries for a failed job and the seconds to wait before the first retry (doubled for each retry)
+MAX_RETRIES_ENV = "NGS_PIPELINE_MAX_RETRIES"
+RETRY_BACKOFF_ENV = "NGS_PIPELINE_RETRY_BACKOFF"
+
+DEFAULT_MAX_RETRIES = 1
+DEFAULT_RETRY_BACKOFF = 30
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the stage timeouts and retry settings for this process and the processes it starts, from the pipelineSettings
+    of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    stage_timeouts = pipeline_settings.get("stage_timeouts", {})
+    if stage_timeouts:
+        os.environ[STAGE_TIMEOUTS_ENV] = ",".join("{0}={1}".format(k, v) for k, v in stage_timeouts.items())
+    if "max_retries" in pipeline_settings:
+        os.environ[MAX_RETRIES_ENV] = str(pipeline_settings["max_retries"])
+    if "retry_backoff" in pipeline_settings:
+        os.environ[RETRY_BACKOFF_ENV] = str(pipeline_settings["retry_backoff"])
+
+
+def stage_timeouts_from_env():
+    """
+    read the per-stage timeouts from the environment
+    :return: (dict) key = stage name (or "default"), value = timeout in seconds
+    """
+    timeouts = {}
+    for item in os.environ.get(STAGE_TIMEOUTS_ENV, "").split(","):
+        if "=" not in item:
+            continue
+        stage, timeout = item.split("=", 1)
+        try:
+            timeouts[stage.strip()] = float(timeout)
+        except ValueError:
+            print("Ignoring invalid stage timeout: {}".format(item))
+
+    return timeouts
+
+
+def log_tail(log_file, lines=20):
+    """
+    get the last lines of a job's log file, where its stderr was captured
+    :param log_file: (str) the log file, may be None
+    :param lines: (int) the number of lines to return
+    :return: (str) the tail of the log
+    """
+    if not log_file or not os.path.isfile(log_file):
+        return ""
+    with open(log_file, 'rb') as handle:
+        handle.seek(0, os.SEEK_END)
+        # the tail is read from the last 64 KB, enough for the last few lines of a tool's output
+        handle.seek(max(0, handle.tell() - 65536))
+        tail = handle.read().decode(errors="replace").splitlines()[-lines:]
+
+    return "\n".join(tail)
+
+
+def record_failure(manifest_file, patient, region, sample, stage, reason, stderr_tail="", log_file=None, attempts=1):
+    """
+    append a failed (patient, region, sample, stage) to the JSON-lines failure manifest
+    :param manifest_file: (str) path and name of the failure manifest, if False nothing is recorded
+    :param patient: (str) the patient/participant name
+    :param region: (str) the gene region
+    :param sample: (str) the sample name, None if the whole stage failed
+    :param stage: (str) the name of the stage
+    :param reason: (str) exit code, timeout or exception
+    :param stderr_tail: (str) the last lines of the captured stderr
+    :param log_file: (str) the full log of the failed job
+    :param attempts: (int) the number of times the job was run
+    :return: None
+    """
+    print("Failed: {0} {1} {2} {3}: {4}".format(patient, region, sample if sample else "", stage, reason))
+    if not manifest_file:
+        return
+    record = collections.OrderedDict([("patient", patient), ("region", region), ("sample", sample), ("stage", stage),
+                                      ("reason", reason), ("attempts", attempts), ("log_file", log_file),
+                                      ("stderr_tail", stderr_tail), ("time", time.strftime("%Y-%m-%d %H:%M:%S"))])
+    with open(manifest_file, 'a') as handle:
+        handle.write(json.dumps(record) + "\n")
+
+
+class StageSupervisor(object):
+    """
+    runs the tool jobs of each stage for one patient and gene region with the stage's timeout and bounded retries,
+    and records every job that still fails in the failure manifest so that the rest of the batch can carry on.
+    The cores for each stage are granted by the resource manager
+    """
+
+    def __init__(self, manifest_file, patient, region, stage_timeouts=None, max_retries=None, retry_backoff=None,
+                 resources=None):
+        """
+        :param manifest_file: (str) path and name of the failure manifest
+        :param patient: (str) the patient/participant name
+        :param region: (str) the gene region
+        :param stage_timeouts: (dict) key = stage name (or "default"), value = timeout in seconds
+        :param max_retries: (int) number of retries for a failed job
+        :param retry_backoff: (float) seconds to wait before the first retry
+        :param resources: (ResourceManager) divides the cores between the jobs, None to use all the machine's cores
+        """
+        self.manifest_file = manifest_file
+        self.patient = patient
+        self.region = region
+        self.stage_timeouts = stage_timeouts_from_env()
+        if stage_timeouts:
+            self.stage_timeouts.update(stage_timeouts)
+        if max_retries is None:
+            max_retries = int(os.environ.get(MAX_RETRIES_ENV, DEFAULT_MAX_RETRIES))
+        if retry_backoff is None:
+            retry_backoff = float(os.environ.get(RETRY_BACKOFF_ENV, DEFAULT_RETRY_BACKOFF))
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+        self.resources = resources if resources is not None else ResourceManager()
+
+    def timeout(self, stage):
+        """
+        :param stage: (str) the name of the stage
+        :return: (float) the timeout for the stage's jobs, None for no limit
+        """
+        return self.stage_timeouts.get(stage, self.stage_timeouts.get("default"))
+
+    def grant(self, stage, tool, n_jobs, tool_limit=None):
+        """
+        ask the resource manager how many of the stage's jobs to run at once and how many threads each job gets
+        :param stage: (str) the name of the stage
+        :param tool: (str) the tool the jobs run
+        :param n_jobs: (int) the number of jobs in the stage
+        :param tool_limit: (int) the most jobs to run at once, defaults to the tool's limit from tool_limits
+        :return: (Grant) pass {grant.tool: grant.concurrency} as the tool_limits of run_jobs
+        """
+        if tool_limit is None:
+            tool_limit = ToolRunner().tool_limits.get(tool, 1)
+
+        return self.resources.grant(stage, tool, n_jobs, tool_limit=tool_limit)
+
+    def run_jobs(self, stage, jobs, samples=None, tool_limits=None, record=None):
+        """
+        run the jobs of a stage, the failed jobs are recorded in the failure manifest
+        :param stage: (str) the name of the stage
+        :param jobs: (list) of ToolJob
+        :param samples: (list) the sample name of each job
+        :param tool_limits: (dict) concurrency limits per tool for this stage
+        :param record: (dict) the stage metrics record, the peak memory use of the largest job is added to it
+        :return: (list) of ToolResult, (list) of the samples that failed
+        """
+        timeout = self.timeout(stage)
+        if timeout:
+            jobs = [job._replace(timeout=timeout) for job in jobs]
+        if samples is None:
+            samples = [None] * len(jobs)
+
+        runner = ToolRunner(tool_limits, retries=self.max_retries, retry_backoff=self.retry_backoff)
+        results = runner.run_jobs(jobs)
+        if record is not None:
+            record["job_peak_rss_mb"] = max(record.get("job_peak_rss_mb") or 0, peak_rss_mb(results) or 0)
+        failed = set(id(x) for x in failed_jobs(results))
+        failed_samples = []
+        for result, sample in zip(results, samples):
+            if id(result) in failed:
+                failed_samples.append(sample)
+                record_failure(self.manifest_file, self.patient, self.region, sample, stage, failure_reason(result),
+                               log_tail(result.log_file), result.log_file, result.attempts)
+
+        return results, failed_samples
+
+    def record(self, stage, reason, sample=None):
+        """
+        record a stage that failed without a tool error, eg: no output files were found
+        :param stage: (str) the name of the stage
+        :param reason: (str) why the stage failed
+        :param sample: (str) the sample name, if any
+        :return: None
+        """
+        record_failure(self.manifest_file, self.patient, self.region, sample, stage, reason)
+
+    def record_exception(self, stage, error, sample=None):
+        """
+        record a stage that failed with a python exception
+        :param stage: (str) the name of the stage
+        :param error: (Exception) the exception
+        :param sample: (str) the sample name, if any
+        :return: None
+        """
+        tail = "".join(traceback.format_exception(type(error), error, error.__traceback__)[-5:])
+        record_failure(self.manifest_file, self.patient, self.region, sample, stage, repr(error), tail)
+
+
+def main(manifest_file):
+
+    counts = collections.Counter()
+    with open(manifest_file, 'r') as handle:
+        for line in handle:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            counts[record["stage"]] += 1
+            print("{0}\t{1}\t{2}\t{3}\t{4}".format(record["patient"], record["region"], record["sample"],
+                                                   record["stage"], record["reason"]))
+    print("\n{} failures".format(sum(counts.values())))
+    for stage, count in counts.most_common():
+        print("\t{0}: {1}".format(stage, count))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Lists the failed patient, region, sample and stage entries of a '
+                                                 'failure manifest written by the pipeline',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-in', '--infile', default=argparse.SUPPRESS, type=str,
+                        help='The failure manifest JSON-lines file', required=True)
+
+    args = parser.parse_args()
+    infile = args.infile
+
+    main(infile)
@@ -0,0 +1,52 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+from tool_runner import ToolJob
+from supervisor import StageSupervisor
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.manifest = os.path.join(self.tmp_dir, "failure_manifest.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_failed_sample_is_recorded_and_batch_continues(self):
+        supervisor = StageSupervisor(self.manifest, "CAP1", "ENV_C1C2", stage_timeouts={"clean": 5}, max_retries=1,
+                                     retry_backoff=0)
+        fail_code = "import sys; sys.stderr.write('bad input\\n'); sys.exit(1)"
+        jobs = [ToolJob("python", [sys.executable, "-c", "print('ok')"], os.path.join(self.tmp_dir, "s1.log")),
+                ToolJob("python", [sys.executable, "-c", fail_code], os.path.join(self.tmp_dir, "s2.log"))]
+        results, failed = supervisor.run_jobs("clean", jobs, ["s1", "s2"])
+        self.assertEqual(results[0].returncode, 0)
+        self.assertEqual(failed, ["s2"])
+
+        with open(self.manifest) as handle:
+            records = [json.loads(x) for x in handle]
+        self.assertEqual(len(records), 1)
+        self.assertEqual((records[0]["patient"], records[0]["region"], records[0]["sample"], records[0]["stage"]),
+                         ("CAP1", "ENV_C1C2", "s2", "clean"))
+        # exit code 1 is not a transient failure, so it is not retried
+        self.assertEqual(records[0]["attempts"], 1)
+        self.assertIn("bad input", records[0]["stderr_tail"])
+
+    def test_record_exception(self):
+        supervisor = StageSupervisor(self.manifest, "CAP1", "GAG_1", max_retries=0, retry_backoff=0)
+        try:
+            raise ValueError("no consensus files")
+        except ValueError as e:
+            supervisor.record_exception("step_2", e)
+        with open(self.manifest) as handle:
+            record = json.loads(handle.readline())
+        self.assertEqual(record["stage"], "step_2")
+        self.assertIn("no consensus files", record["stderr_tail"])
+
+
+if __name__ == '__main__':
+    unittest.main()
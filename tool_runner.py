@@ -0,0 +1,463 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import time
+import signal
+import asyncio
+import collections
+
+
+__author__ = 'Colin Anthony'
+
+
+# a job to run: tool is the name used for its concurrency limit, argv is run without a shell
+ToolJob = collections.namedtuple("ToolJob", ["tool", "argv", "log_file", "stdout_file", "timeout", "cwd"])
+ToolJob.__new__.__defaults__ = (None, None, None, None)
+
+ToolResult = collections.namedtuple("ToolResult", ["tool", "argv", "returncode", "duration", "timed_out", "log_file",
+                                                   "attempts", "peak_rss_mb"])
+
+# default number of concurrent jobs per tool, tools not listed here run one at a time
+DEFAULT_TOOL_LIMITS = {"seqmagick": 4, "remove_bad_sequences": 4, "mafft": 2}
+# set NGS_PIPELINE_TOOL_LIMITS to eg: "mafft=4,blastn=2" to change the limits, child processes inherit the setting
+TOOL_LIMITS_ENV = "NGS_PIPELINE_TOOL_LIMITS"
+# a failed job is only retried if it timed out, was killed by a signal or exited with one of these codes, any other
+# failure (a traceback, bad input, a missing tool) would fail again. 75 = EX_TEMPFAIL, a temporary failure
+TRANSIENT_EXIT_CODES = (75,)
+# set NGS_PIPELINE_TRANSIENT_EXIT_CODES to eg: "75,143" to change the exit codes that are retried
+TRANSIENT_EXIT_CODES_ENV = "NGS_PIPELINE_TRANSIENT_EXIT_CODES"
+# seconds between asking a timed out job to stop and killing it
+KILL_GRACE = 5
+# seconds between samples of a job's memory use
+RSS_POLL_INTERVAL = 0.5
+# the per-run settings of the pipeline are passed to the scripts it runs as environment variables with this prefix
+ENV_PREFIX = "NGS_PIPELINE_"
+# set NGS_PIPELINE_DAEMON to the socket of a running pipeline_daemon.py to run the pipeline's python scripts in its
+# warm worker processes, other tools are always started as processes
+DAEMON_ENV = "NGS_PIPELINE_DAEMON"
+DAEMON_SCRIPTS = ("remove_bad_sequences.py", "contam_removal.py", "align_ngs_codons.py", "ngs_stats_calculator.py",
+                  "split_fasta_into_subfiles.py", "haplotyper_freq.py")
+
+
+def tool_limits_from_env():
+    """
+    read the per-tool concurrency limits from the environment
+    :return: (dict) key = tool name, value = max number of concurrent jobs
+    """
+    limits = {}
+    for item in os.environ.get(TOOL_LIMITS_ENV, "").split(","):
+        if "=" not in item:
+            continue
+        tool, limit = item.split("=", 1)
+        try:
+            limits[tool.strip()] = int(limit)
+        except ValueError:
+            print("Ignoring invalid tool limit: {}".format(item))
+
+    return limits
+
+
+def transient_exit_codes_from_env():
+    """
+    :return: (tuple) the exit codes of failures that may not happen again, from the environment or
+    TRANSIENT_EXIT_CODES
+    """
+    value = os.environ.get(TRANSIENT_EXIT_CODES_ENV)
+    if value is None:
+        return TRANSIENT_EXIT_CODES
+    codes = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        try:
+            codes.append(int(item))
+        except ValueError:
+            print("Ignoring invalid transient exit code: {}".format(item))
+
+    return tuple(codes)
+
+
+def enable_from_config(pipeline_settings):
+    """
+    set the per-tool concurrency limits for this process and the processes it starts, from the pipelineSettings
+    of the config file
+    :param pipeline_settings: (dict) the pipelineSettings section of the config file
+    :return: None
+    """
+    tool_limits = pipeline_settings.get("tool_limits", {})
+    if tool_limits:
+        os.environ[TOOL_LIMITS_ENV] = ",".join("{0}={1}".format(k, v) for k, v in tool_limits.items())
+    if pipeline_settings.get("daemon_socket"):
+        os.environ[DAEMON_ENV] = pipeline_settings["daemon_socket"]
+    if "transient_exit_codes" in pipeline_settings:
+        os.environ[TRANSIENT_EXIT_CODES_ENV] = ",".join(str(x) for x in pipeline_settings["transient_exit_codes"])
+
+
+def pipeline_env():
+    """
+    :return: (dict) the NGS_PIPELINE_* settings of this process, without the daemon socket, for a job run by a
+    pipeline daemon that was started with other settings
+    """
+    return {k: v for k, v in os.environ.items() if k.startswith(ENV_PREFIX) and k != DAEMON_ENV}
+
+
+def daemon_script(job):
+    """
+    :param job: (ToolJob) a job
+    :return: (bool) True if the job runs one of the pipeline's python scripts that a pipeline daemon can run
+    """
+    if job.stdout_file or len(job.argv) < 2 or not os.path.basename(job.argv[0]).startswith("python"):
+        return False
+
+    return os.path.basename(job.argv[1]) in DAEMON_SCRIPTS
+
+
+class ToolRunner(object):
+    """
+    runs external tools as argv lists (no shell) on an asyncio event loop, with a concurrency limit per tool,
+    streaming capture of stdout/stderr to a per-job log file and an optional timeout per job. If a pipeline daemon
+    is running, the pipeline's python scripts are sent to it instead of being started as new processes
+    """
+
+    def __init__(self, tool_limits=None, retries=0, retry_backoff=0, daemon=None, transient_exit_codes=None):
+        """
+        :param tool_limits: (dict) key = tool name, value = max number of concurrent jobs for that tool
+        :param retries: (int) number of times to rerun a job that timed out, was killed or failed transiently
+        :param retry_backoff: (float) seconds to wait before the first retry, doubled for each further retry
+        :param daemon: (str) the socket of a pipeline daemon, defaults to NGS_PIPELINE_DAEMON
+        :param transient_exit_codes: (tuple) exit codes that are retried, defaults to
+        NGS_PIPELINE_TRANSIENT_EXIT_CODES or TRANSIENT_EXIT_CODES
+        """
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        if transient_exit_codes is None:
+            transient_exit_codes = transient_exit_codes_from_env()
+        self.transient_exit_codes = tuple(transient_exit_codes)
+        self.daemon = daemon if daemon is not None else os.environ.get(DAEMON_ENV) or None
+        self.tool_limits = dict(DEFAULT_TOOL_LIMITS)
+        self.tool_limits.update(tool_limits_from_env())
+        if tool_limits:
+            self.tool_limits.update(tool_limits)
+        self._semaphores = {}
+
+    def _semaphore(self, tool):
+        if tool not in self._semaphores:
+            self._semaphores[tool] = asyncio.Semaphore(max(1, int(self.tool_limits.get(tool, 1))))
+        return self._semaphores[tool]
+
+    async def run(self, job):
+        """
+        run one job once a slot for its tool is free
+        :param job: (ToolJob) the job to run
+        :return: (ToolResult) exit code, duration and timeout status of the job
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            async with self._semaphore(job.tool):
+                result = await self._run_job(job)
+            result = result._replace(attempts=attempt)
+            if not should_retry(result, self.transient_exit_codes) or attempt > self.retries:
+                return result
+            # wait outside the semaphore so other jobs can use the slot
+            delay = self.retry_backoff * 2 ** (attempt - 1)
+            print("{0} failed, retrying in {1} s".format(" ".join(job.argv[:2]), delay))
+            await asyncio.sleep(delay)
+
+    async def _run_job(self, job):
+        if self.daemon and daemon_script(job):
+            try:
+                return await self._run_daemon(job)
+            except OSError as e:
+                # the daemon is not running, run this and the remaining jobs as processes
+                print("Pipeline daemon {0} not available ({1}), starting processes instead".format(self.daemon, e))
+                self.daemon = None
+
+        return await self._run_process(job)
+
+    async def _run_daemon(self, job):
+        """
+        send a python script job to the pipeline daemon and wait for its exit code, the daemon appends the script's
+        output to the job's log file, runs it with this process's NGS_PIPELINE_* settings and stops it at the job's
+        timeout
+        """
+        reader, writer = await asyncio.open_unix_connection(self.daemon)
+        start = time.perf_counter()
+        log_file = os.path.abspath(job.log_file) if job.log_file else None
+        if log_file:
+            with open(log_file, 'ab') as handle:
+                handle.write("$ {}\n".format(" ".join(job.argv)).encode())
+        request = {"argv": job.argv[1:], "log_file": log_file, "cwd": job.cwd, "timeout": job.timeout,
+                   "env": pipeline_env()}
+        timed_out = False
+        returncode = None
+        peak_rss = None
+        try:
+            writer.write(json.dumps(request).encode() + b"\n")
+            await writer.drain()
+            wait = job.timeout + KILL_GRACE if job.timeout else None
+            try:
+                line = await asyncio.wait_for(reader.readline(), timeout=wait)
+            except asyncio.TimeoutError:
+                line = b'{"timed_out": true}'
+            reply = json.loads(line.decode()) if line else {"error": "the daemon closed the connection"}
+            timed_out = reply.get("timed_out", False)
+            returncode = reply.get("returncode")
+            peak_rss = reply.get("peak_rss_mb")
+            if returncode is None and not timed_out:
+                returncode = 1
+                if log_file:
+                    with open(log_file, 'ab') as handle:
+                        handle.write("{}\n".format(reply.get("error")).encode())
+        finally:
+            writer.close()
+            duration = round(time.perf_counter() - start, 3)
+            if log_file:
+                footer = "# exit code {0}, {1} s{2}, daemon\n".format(returncode, duration,
+                                                                      ", timed out" if timed_out else "")
+                with open(log_file, 'ab') as handle:
+                    handle.write(footer.encode())
+
+        return ToolResult(job.tool, job.argv, returncode, duration, timed_out, job.log_file, 1, peak_rss)
+
+    async def _run_process(self, job):
+        log_handle = open(job.log_file, 'ab') if job.log_file else None
+        stdout_handle = open(job.stdout_file, 'wb') if job.stdout_file else None
+        if stdout_handle is not None:
+            stdout = stdout_handle
+        elif log_handle is not None:
+            stdout = asyncio.subprocess.PIPE
+        else:
+            stdout = None
+        stderr = asyncio.subprocess.PIPE if log_handle is not None else None
+
+        start = time.perf_counter()
+        timed_out = False
+        returncode = None
+        peak_kb = [0]
+        watcher = None
+        try:
+            if log_handle is not None:
+                log_handle.write("$ {}\n".format(" ".join(job.argv)).encode())
+                log_handle.flush()
+            # each job gets its own process group so that a timeout also stops the processes the tool started
+            process = await asyncio.create_subprocess_exec(*job.argv, stdout=stdout, stderr=stderr, cwd=job.cwd,
+                                                           start_new_session=True)
+            watcher = asyncio.ensure_future(_watch_rss(process.pid, peak_kb))
+            pumps = []
+            if stdout == asyncio.subprocess.PIPE:
+                pumps.append(_pump(process.stdout, log_handle))
+            if stderr == asyncio.subprocess.PIPE:
+                pumps.append(_pump(process.stderr, log_handle))
+            try:
+                await asyncio.wait_for(asyncio.gather(process.wait(), *pumps), timeout=job.timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                await _kill_group(process)
+            except asyncio.CancelledError:
+                await _kill_group(process)
+                raise
+            returncode = process.returncode
+        except OSError as e:
+            # the tool could not be started, eg: not installed
+            returncode = 127
+            if log_handle is not None:
+                log_handle.write("{}\n".format(e).encode())
+            else:
+                print(e)
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+            duration = round(time.perf_counter() - start, 3)
+            if log_handle is not None:
+                log_handle.write("# exit code {0}, {1} s{2}\n".format(returncode, duration,
+                                                                      ", timed out" if timed_out else "").encode())
+                log_handle.close()
+            if stdout_handle is not None:
+                stdout_handle.close()
+
+        peak_rss = round(peak_kb[0] / 1024, 1) if peak_kb[0] else None
+
+        return ToolResult(job.tool, job.argv, returncode, duration, timed_out, job.log_file, 1, peak_rss)
+
+    async def _run_all(self, jobs):
+        self._semaphores = {}
+        return await asyncio.gather(*(self.run(job) for job in jobs))
+
+    def run_jobs(self, jobs):
+        """
+        run a batch of independent jobs, overlapping them up to each tool's concurrency limit
+        :param jobs: (list) of ToolJob
+        :return: (list) of ToolResult, in the same order as jobs
+        """
+        if not jobs:
+            return []
+
+        return asyncio.run(self._run_all(list(jobs)))
+
+
+def should_retry(result, transient_exit_codes=TRANSIENT_EXIT_CODES):
+    """
+    :param result: (ToolResult) the result of a job
+    :param transient_exit_codes: (tuple) the exit codes of failures that may not happen again
+    :return: (bool) True if the job failed in a way that may not happen again: a timeout, being killed by a signal
+    (a negative exit code) or a transient exit code
+    """
+    if result.timed_out:
+        return True
+    if result.returncode is None or result.returncode == 0:
+        return False
+
+    return result.returncode < 0 or result.returncode in transient_exit_codes
+
+
+async def _kill_group(process):
+    """
+    stop a job and every process in its process group, killing them if they ignore SIGTERM
+    """
+    for sig in [signal.SIGTERM, signal.SIGKILL]:
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            break
+        try:
+            await asyncio.wait_for(process.wait(), timeout=KILL_GRACE)
+            break
+        except asyncio.TimeoutError:
+            continue
+
+
+def proc_status_kb(pid, fields):
+    """
+    :param pid: (int) a process id
+    :param fields: (tuple) the /proc/<pid>/status fields to read, eg: VmRSS
+    :return: (dict) the values in kB, empty if the process is gone or /proc is not available
+    """
+    values = {}
+    try:
+        with open("/proc/{}/status".format(pid), 'r') as handle:
+            for line in handle:
+                key = line.split(":", 1)[0]
+                if key in fields:
+                    values[key] = int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+
+    return values
+
+
+def process_tree_rss_kb(pid):
+    """
+    :param pid: (int) the process id of a job
+    :return: (int) the resident memory of the job and the processes it started in kB, or the peak of the job's own
+    process if that is larger
+    """
+    total = 0
+    peak = 0
+    pids = [pid]
+    while pids:
+        this_pid = pids.pop()
+        values = proc_status_kb(this_pid, ("VmRSS", "VmHWM"))
+        total += values.get("VmRSS", 0)
+        if this_pid == pid:
+            peak = values.get("VmHWM", 0)
+        try:
+            with open("/proc/{0}/task/{0}/children".format(this_pid), 'r') as handle:
+                pids.extend(int(x) for x in handle.read().split())
+        except (OSError, ValueError):
+            pass
+
+    return max(total, peak)
+
+
+async def _watch_rss(pid, peak_kb):
+    """
+    sample the memory use of a running job until it is cancelled, keeping the peak in peak_kb[0]
+    """
+    while True:
+        peak_kb[0] = max(peak_kb[0], process_tree_rss_kb(pid))
+        await asyncio.sleep(RSS_POLL_INTERVAL)
+
+
+async def _pump(stream, handle):
+    """
+    copy a process output stream to the log file line by line as it is produced
+    """
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        handle.write(line)
+        handle.flush()
+
+
+def run_tool(tool, argv, log_file=None, stdout_file=None, timeout=None, cwd=None, tool_limits=None):
+    """
+    run a single tool and wait for it
+    :param tool: (str) name of the tool
+    :param argv: (list) the command and its arguments
+    :param log_file: (str) file to stream stdout/stderr to, None to leave them on the console
+    :param stdout_file: (str) file to write stdout to, eg: for tools that write their result to stdout
+    :param timeout: (float) seconds before the job is killed, None for no limit
+    :param cwd: (str) working directory for the job
+    :param tool_limits: (dict) concurrency limits per tool
+    :return: (ToolResult)
+    """
+    runner = ToolRunner(tool_limits)
+
+    return runner.run_jobs([ToolJob(tool, argv, log_file, stdout_file, timeout, cwd)])[0]
+
+
+def failure_reason(result):
+    """
+    :param result: (ToolResult) a failed job
+    :return: (str) why it failed
+    """
+    if result.timed_out:
+        reason = "timed out after {} s".format(result.duration)
+    else:
+        reason = "exit code {}".format(result.returncode)
+    if result.attempts > 1:
+        reason += ", {} attempts".format(result.attempts)
+
+    return reason
+
+
+def peak_rss_mb(results):
+    """
+    :param results: (list) of ToolResult
+    :return: (float) the largest peak memory use of the jobs in MB, None if it was not measured
+    """
+    peaks = [x.peak_rss_mb for x in results if x.peak_rss_mb is not None]
+
+    return max(peaks) if peaks else None
+
+
+def failed_jobs(results):
+    """
+    print and return the jobs that did not exit cleanly
+    :param results: (list) of ToolResult
+    :return: (list) of the failed ToolResults
+    """
+    failed = [x for x in results if x.returncode != 0 or x.timed_out]
+    for result in failed:
+        reason = failure_reason(result)
+        log = ", see {}".format(result.log_file) if result.log_file else ""
+        print("{0} failed ({1}){2}".format(" ".join(result.argv[:2]), reason, log))
+
+    return failed
+
+
+def job_log_file(log_folder, tool, name):
+    """
+    get the per-job log file name for a tool run
+    :param log_folder: (str) the folder for the tool logs, created if needed
+    :param tool: (str) the tool name
+    :param name: (str) sample or file name for this job
+    :return: (str) path and name of the log file
+    """
+    os.makedirs(log_folder, exist_ok=True)
+
+    return os.path.join(log_folder, "{0}_{1}.log".format(name, tool.replace(".", "_")))
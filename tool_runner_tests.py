@@ -0,0 +1,117 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+from tool_runner import ToolJob
+from tool_runner import ToolRunner
+from tool_runner import run_tool
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_run_tool_captures_output_to_log(self):
+        log_file = os.path.join(self.tmp_dir, "job.log")
+        result = run_tool("python", [sys.executable, "-c", "import sys; print('out'); sys.stderr.write('err\\n')"],
+                          log_file=log_file)
+        self.assertEqual(result.returncode, 0)
+        self.assertFalse(result.timed_out)
+        with open(log_file) as handle:
+            content = handle.read()
+        self.assertIn("out\n", content)
+        self.assertIn("err\n", content)
+
+    def test_stdout_file_and_no_shell(self):
+        outfile = os.path.join(self.tmp_dir, "out.txt")
+        result = run_tool("python", [sys.executable, "-c", "import sys; print(sys.argv[1])", "a b; echo c"],
+                          stdout_file=outfile)
+        self.assertEqual(result.returncode, 0)
+        with open(outfile) as handle:
+            self.assertEqual(handle.read(), "a b; echo c\n")
+
+    def test_timeout_and_missing_tool(self):
+        result = run_tool("python", [sys.executable, "-c", "import time; time.sleep(10)"], timeout=0.5)
+        self.assertTrue(result.timed_out)
+        self.assertLess(result.duration, 5)
+        result = run_tool("missing", ["no_such_tool_on_the_path"])
+        self.assertEqual(result.returncode, 127)
+
+    def test_retry_transient_failure(self):
+        # fails the first time, succeeds once the marker file exists
+        marker = os.path.join(self.tmp_dir, "marker")
+        code = "import os, sys; m = sys.argv[1]; ok = os.path.exists(m); open(m, 'w').close(); sys.exit(0 if ok else 75)"
+        job = ToolJob("python", [sys.executable, "-c", code, marker])
+        result = ToolRunner(retries=2, retry_backoff=0).run_jobs([job])[0]
+        self.assertEqual(result.returncode, 0)
+        self.assertEqual(result.attempts, 2)
+        # killed by a signal
+        code = "import os, signal, sys; m = sys.argv[1]; ok = os.path.exists(m); open(m, 'w').close(); " \
+               "ok or os.kill(os.getpid(), signal.SIGKILL)"
+        job = ToolJob("python", [sys.executable, "-c", code, marker + "_2"])
+        result = ToolRunner(retries=2, retry_backoff=0).run_jobs([job])[0]
+        self.assertEqual((result.returncode, result.attempts), (0, 2))
+        result = ToolRunner(retries=2, retry_backoff=0).run_jobs([ToolJob("missing", ["no_such_tool_on_the_path"])])[0]
+        self.assertEqual(result.attempts, 1)
+
+    def test_deterministic_failure_is_not_retried(self):
+        marker = os.path.join(self.tmp_dir, "marker")
+        code = "import os, sys; m = sys.argv[1]; ok = os.path.exists(m); open(m, 'w').close(); sys.exit(0 if ok else 1)"
+        job = ToolJob("python", [sys.executable, "-c", code, marker])
+        result = ToolRunner(retries=2, retry_backoff=0).run_jobs([job])[0]
+        self.assertEqual((result.returncode, result.attempts), (1, 1))
+        # unless the exit code is configured as transient
+        os.unlink(marker)
+        result = ToolRunner(retries=2, retry_backoff=0, transient_exit_codes=(1,)).run_jobs([job])[0]
+        self.assertEqual((result.returncode, result.attempts), (0, 2))
+
+    def test_timeout_kills_process_group(self):
+        pid_file = os.path.join(self.tmp_dir, "child.pid")
+        code = "import subprocess, sys, time; p = subprocess.Popen([sys.executable, '-c', 'import time; " \
+               "time.sleep(30)']); open(sys.argv[1], 'w').write(str(p.pid)); time.sleep(30)"
+        result = run_tool("python", [sys.executable, "-c", code, pid_file], timeout=1)
+        self.assertTrue(result.timed_out)
+        with open(pid_file) as handle:
+            child_pid = int(handle.read())
+        # the grandchild is gone (or a zombie waiting for init) once the group was killed, the kill signal is
+        # delivered asynchronously so give it a moment
+        state = None
+        for _ in range(50):
+            try:
+                with open("/proc/{}/stat".format(child_pid)) as handle:
+                    state = handle.read().split()[2]
+            except (ProcessLookupError, FileNotFoundError):
+                state = None
+            if state in (None, "Z", "X"):
+                break
+            time.sleep(0.1)
+        self.assertIn(state, (None, "Z", "X"))
+
+    def test_tool_limit_caps_concurrency(self):
+        # each job records the number of running jobs in a shared folder
+        code = "import os, sys, time; f = os.path.join(sys.argv[1], str(os.getpid())); open(f, 'w').close(); " \
+               "time.sleep(0.3); print(len(os.listdir(sys.argv[1]))); os.remove(f)"
+        jobs = [ToolJob("sleeper", [sys.executable, "-c", code, self.tmp_dir],
+                        stdout_file=os.path.join(self.tmp_dir + "_{}.txt".format(i))) for i in range(4)]
+        results = ToolRunner({"sleeper": 2}).run_jobs(jobs)
+        self.assertEqual([x.returncode for x in results], [0, 0, 0, 0])
+        for job in jobs:
+            with open(job.stdout_file) as handle:
+                self.assertLessEqual(int(handle.read()), 2)
+            os.remove(job.stdout_file)
+
+    @unittest.skipUnless(os.path.isdir("/proc/self"), "needs /proc")
+    def test_peak_rss_of_job(self):
+        code = "import time; block = bytearray(100 * 1024 * 1024); time.sleep(1.5)"
+        result = run_tool("python", [sys.executable, "-c", code])
+        self.assertGreater(result.peak_rss_mb, 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
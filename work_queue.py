@@ -0,0 +1,366 @@
+#!/usr/bin/python3
+from __future__ import print_function
+from __future__ import division
+import os
+import json
+import time
+import socket
+import argparse
+import threading
+import traceback
+import collections
+from glob import glob
+import profiling_hooks
+
+
+__author__ = 'Colin Anthony'
+
+# a lease that has not had a heartbeat for this many seconds belongs to a dead worker and may be taken over
+LEASE_TIMEOUT = 300
+HEARTBEAT_INTERVAL = 30
+# seconds between checks for new or stale tasks while other workers still hold leases
+POLL_INTERVAL = 30
+
+
+def queue_folders(queue_dir):
+    """
+    :param queue_dir: (str) the queue folder in the shared output tree
+    :return: (dict) the sub folders of the queue, created if needed
+    """
+    folders = collections.OrderedDict()
+    for name in ["tasks", "leases", "done", "failed", "logs"]:
+        folders[name] = os.path.join(queue_dir, name)
+        os.makedirs(folders[name], exist_ok=True)
+
+    return folders
+
+
+def task_id(patient, region, stage):
+    return "{0}__{1}__{2}".format(patient, region, stage)
+
+
+def _write_atomic(file_name, content):
+    """
+    write a file under a temporary name and rename it into place, so other nodes never see a partial file
+    """
+    temp_file = "{0}.{1}_{2}.part".format(file_name, socket.gethostname(), os.getpid())
+    with open(temp_file, 'w') as handle:
+        handle.write(content)
+    os.replace(temp_file, file_name)
+
+
+def enqueue(queue_dir, tasks):
+    """
+    write a task file for each (patient, region, stage) task, tasks that are already queued are left as they are
+    :param queue_dir: (str) the queue folder in the shared output tree
+    :param tasks: (list) of dicts with patient, region, stage, args and settings keys
+    :return: (int) the number of new tasks
+    """
+    folders = queue_folders(queue_dir)
+    new_tasks = 0
+    for task in tasks:
+        this_id = task_id(task["patient"], task["region"], task["stage"])
+        task_file = os.path.join(folders["tasks"], this_id + ".json")
+        if os.path.isfile(task_file):
+            continue
+        _write_atomic(task_file, json.dumps(task, indent=2))
+        new_tasks += 1
+
+    return new_tasks
+
+
+def requeue(queue_dir, tasks):
+    """
+    queue tasks again after they finished (done or failed), eg: for a gene region that got new samples. Tasks that are
+    still waiting or running are left as they are, files that land while a task runs are picked up by the next requeue
+    :param queue_dir: (str) the queue folder in the shared output tree
+    :param tasks: (list) of dicts with patient, region, stage, args and settings keys
+    :return: (list) the ids of the tasks that were queued
+    """
+    folders = queue_folders(queue_dir)
+    pending = set(pending_tasks(folders))
+    queued = []
+    for task in tasks:
+        this_id = task_id(task["patient"], task["region"], task["stage"])
+        if this_id in pending:
+            continue
+        # the task file is written before the markers are removed, so a worker never sees an old task as pending
+        _write_atomic(os.path.join(folders["tasks"], this_id + ".json"), json.dumps(task, indent=2))
+        for marker in [os.path.join(folders["done"], this_id + ".done"),
+                       os.path.join(folders["failed"], this_id + ".failed")]:
+            if os.path.isfile(marker):
+                os.unlink(marker)
+        queued.append(this_id)
+
+    return queued
+
+
+def _lease_holder(lease_file):
+    try:
+        with open(lease_file, 'r') as handle:
+            return json.load(handle).get("worker")
+    except (OSError, ValueError):
+        return None
+
+
+def server_time(folder, worker_id):
+    """
+    read the clock of the file server that holds a folder, by touching a probe file in it. Lease ages are measured
+    on the file server's clock, so clock skew between nodes doesn't make healthy leases look stale
+    :param folder: (str) a folder on the file server
+    :param worker_id: (str) the name of this worker, keeps the probe files of the workers apart
+    :return: (float) the file server's time in seconds since the epoch
+    """
+    probe_file = os.path.join(folder, ".clock_{}".format(worker_id))
+    with open(probe_file, 'w'):
+        pass
+    # setting the time to now makes the file server stamp it with its own clock
+    os.utime(probe_file, None)
+    now = os.path.getmtime(probe_file)
+    os.unlink(probe_file)
+
+    return now
+
+
+def claim(lease_file, worker_id, lease_timeout=LEASE_TIMEOUT):
+    """
+    try to take the lease on a task, by creating its lease file exclusively. A lease without a recent heartbeat is
+    taken over from its (dead) worker
+    :param lease_file: (str) the lease file of the task
+    :param worker_id: (str) the name of this worker
+    :param lease_timeout: (float) seconds without a heartbeat before a lease is stale
+    :return: (bool) True if this worker now holds the lease
+    """
+    try:
+        mtime = os.path.getmtime(lease_file)
+    except FileNotFoundError:
+        mtime = None
+    if mtime is not None:
+        now = server_time(os.path.dirname(lease_file), worker_id)
+        if now - mtime < lease_timeout:
+            return False
+        stale_holder = _lease_holder(lease_file)
+        # only one worker can rename the stale lease away, the others get FileNotFoundError
+        stale_file = "{0}.stale_{1}".format(lease_file, worker_id)
+        try:
+            os.rename(lease_file, stale_file)
+        except FileNotFoundError:
+            return False
+        # another worker may have taken over the stale lease between the check and the rename, in which case the
+        # renamed file is its fresh lease and has to be put back
+        if _lease_holder(stale_file) != stale_holder or now - os.path.getmtime(stale_file) < lease_timeout:
+            try:
+                # a link doesn't replace a lease that was created in the meantime
+                os.link(stale_file, lease_file)
+            except FileExistsError:
+                pass
+            os.unlink(stale_file)
+            return False
+        print("{0}: taking over the stale lease of {1} ({2:.0f} s old)".format(worker_id, stale_holder, now - mtime))
+        os.unlink(stale_file)
+
+    try:
+        fd = os.open(lease_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except FileExistsError:
+        return False
+    with os.fdopen(fd, 'w') as handle:
+        json.dump({"worker": worker_id, "host": socket.gethostname(), "pid": os.getpid(),
+                   "time": time.strftime("%Y-%m-%d %H:%M:%S")}, handle)
+
+    return True
+
+
+class Heartbeat(object):
+    """
+    keeps a lease alive by updating the lease file's modification time from a background thread. If another worker
+    took the lease over, lost() is True and the task's result must not be recorded
+    """
+
+    def __init__(self, lease_file, worker_id, interval=HEARTBEAT_INTERVAL):
+        self.lease_file = lease_file
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._lost = threading.Event()
+        self._thread = threading.Thread(target=self._beat, daemon=True)
+
+    def _beat(self):
+        while not self._stop.wait(self.interval):
+            if self.lost():
+                return
+            try:
+                os.utime(self.lease_file, None)
+            except FileNotFoundError:
+                pass
+
+    def lost(self):
+        """
+        :return: (bool) True if this worker no longer holds the lease
+        """
+        if not self._lost.is_set() and _lease_holder(self.lease_file) != self.worker_id:
+            print("{0}: lost the lease {1}".format(self.worker_id, self.lease_file))
+            self._lost.set()
+
+        return self._lost.is_set()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_task(task, worker_files):
+    """
+    run one task in this process
+    :param task: (dict) the task, with patient, region, stage, args and settings keys
+    :param worker_files: (dict) this worker's stage metrics and failure manifest files
+    :return: (bool) True if the task completed
+    """
+    # apply the pipelineSettings of the run, the worker may not have been started with the config file
+    settings = task.get("settings", {})
+    # imported here so that the script starts quickly
+    from run_settings import apply_pipeline_settings
+    apply_pipeline_settings(settings)
+
+    if task["stage"] == "step_2":
+        import step_2_ngs_processing_pipeline_master_call
+        return profiling_hooks.run_main(step_2_ngs_processing_pipeline_master_call.main, "step_2",
+                                        "{0}_{1}".format(task["patient"], task["region"]), *task["args"],
+                                        metrics_file=worker_files["metrics_file"],
+                                        failure_manifest=worker_files["failure_manifest"])
+
+    raise ValueError("Unknown task stage: {}".format(task["stage"]))
+
+
+def pending_tasks(folders):
+    """
+    :param folders: (dict) the queue folders
+    :return: (list) of the task ids without a done or failed marker
+    """
+    pending = []
+    for task_file in sorted(glob(os.path.join(folders["tasks"], "*.json"))):
+        this_id = os.path.split(task_file)[-1][:-len(".json")]
+        if os.path.isfile(os.path.join(folders["done"], this_id + ".done")):
+            continue
+        if os.path.isfile(os.path.join(folders["failed"], this_id + ".failed")):
+            continue
+        pending.append(this_id)
+
+    return pending
+
+
+def run_worker(queue_dir, worker_id=None, lease_timeout=LEASE_TIMEOUT, heartbeat_interval=HEARTBEAT_INTERVAL,
+               poll_interval=POLL_INTERVAL):
+    """
+    claim and run queued tasks until none are left, waiting for tasks leased by other workers in case they die
+    :param queue_dir: (str) the queue folder in the shared output tree
+    :param worker_id: (str) a name for this worker, defaults to host_pid
+    :param lease_timeout: (float) seconds without a heartbeat before a lease is stale
+    :param heartbeat_interval: (float) seconds between heartbeats
+    :param poll_interval: (float) seconds between checks while other workers hold the remaining leases
+    :return: (int) the number of tasks this worker completed
+    """
+    folders = queue_folders(queue_dir)
+    if not worker_id:
+        worker_id = "{0}_{1}".format(socket.gethostname(), os.getpid())
+    # each worker writes its own metrics and failures, appends from several nodes to one NFS file are not safe
+    worker_files = {"metrics_file": os.path.join(folders["logs"], worker_id + "_stage_metrics.jsonl"),
+                    "failure_manifest": os.path.join(folders["logs"], worker_id + "_failure_manifest.jsonl")}
+    print("Worker {0} processing queue {1}".format(worker_id, queue_dir))
+
+    completed = 0
+    while True:
+        pending = pending_tasks(folders)
+        if not pending:
+            break
+        claimed_one = False
+        for this_id in pending:
+            lease_file = os.path.join(folders["leases"], this_id + ".lock")
+            if not claim(lease_file, worker_id, lease_timeout):
+                continue
+            # another worker may have finished the task between the listing and the claim
+            if this_id not in pending_tasks(folders):
+                os.unlink(lease_file)
+                continue
+            claimed_one = True
+            with open(os.path.join(folders["tasks"], this_id + ".json"), 'r') as handle:
+                task = json.load(handle)
+            print("{0}: running {1}".format(worker_id, this_id))
+            start = time.time()
+            heartbeat = Heartbeat(lease_file, worker_id, heartbeat_interval)
+            try:
+                with heartbeat:
+                    success = run_task(task, worker_files)
+                error = ""
+            except (Exception, SystemExit) as e:
+                success = False
+                error = "".join(traceback.format_exception(type(e), e, e.__traceback__)[-5:])
+            if heartbeat.lost():
+                # the worker that took the lease over runs the task again and records its result
+                print("{0}: not recording the result of {1}, the lease was taken over".format(worker_id, this_id))
+                continue
+            marker = collections.OrderedDict([("worker", worker_id), ("seconds", round(time.time() - start, 1)),
+                                              ("time", time.strftime("%Y-%m-%d %H:%M:%S")), ("error", error)])
+            if success:
+                _write_atomic(os.path.join(folders["done"], this_id + ".done"), json.dumps(marker))
+                completed += 1
+            else:
+                _write_atomic(os.path.join(folders["failed"], this_id + ".failed"), json.dumps(marker))
+                print("{0}: {1} failed".format(worker_id, this_id))
+            os.unlink(lease_file)
+        if not claimed_one:
+            # the remaining tasks are leased by other workers, wait in case one of them dies
+            time.sleep(poll_interval)
+
+    print("Worker {0} finished, {1} tasks completed".format(worker_id, completed))
+
+    return completed
+
+
+def queue_status(queue_dir):
+    """
+    :param queue_dir: (str) the queue folder
+    :return: (dict) the number of tasks that are done, failed, running and waiting
+    """
+    folders = queue_folders(queue_dir)
+    status = collections.OrderedDict([("tasks", len(glob(os.path.join(folders["tasks"], "*.json")))),
+                                      ("done", len(glob(os.path.join(folders["done"], "*.done")))),
+                                      ("failed", len(glob(os.path.join(folders["failed"], "*.failed"))))])
+    pending = pending_tasks(folders)
+    status["running"] = len([x for x in pending if os.path.isfile(os.path.join(folders["leases"], x + ".lock"))])
+    status["waiting"] = len(pending) - status["running"]
+
+    return status
+
+
+def main(queue_dir, worker_id, status_only):
+
+    if status_only:
+        for key, value in queue_status(queue_dir).items():
+            print("{0}: {1}".format(key, value))
+        return
+
+    profiling_hooks.run_main(run_worker, "worker", worker_id or "", queue_dir, worker_id)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Runs a worker that claims and processes the (patient, gene region, '
+                                                 'stage) tasks queued by demultiplex.py --queue. Start one on each '
+                                                 'node that shares the output folder',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-q', '--queue_dir', default=argparse.SUPPRESS, type=str,
+                        help='The work_queue folder in the output folder', required=True)
+    parser.add_argument('-w', '--worker_id', default=None, type=str,
+                        help='A name for this worker, defaults to host_pid', required=False)
+    parser.add_argument('-s', '--status', default=False, action='store_true',
+                        help='Only print the number of done, failed, running and waiting tasks', required=False)
+
+    args = parser.parse_args()
+    queue_dir = args.queue_dir
+    worker_id = args.worker_id
+    status_only = args.status
+
+    main(queue_dir, worker_id, status_only)
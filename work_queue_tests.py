@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import types
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+import work_queue
+
+
+class MyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue_dir = os.path.join(self.tmp_dir, "work_queue")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_claim_is_exclusive(self):
+        lease_file = os.path.join(self.tmp_dir, "task.lock")
+        self.assertTrue(work_queue.claim(lease_file, "worker_1"))
+        self.assertFalse(work_queue.claim(lease_file, "worker_2"))
+
+    def test_stale_lease_is_taken_over(self):
+        lease_file = os.path.join(self.tmp_dir, "task.lock")
+        self.assertTrue(work_queue.claim(lease_file, "worker_1"))
+        old = time.time() - 1000
+        os.utime(lease_file, (old, old))
+        self.assertTrue(work_queue.claim(lease_file, "worker_2", lease_timeout=300))
+        self.assertEqual(work_queue._lease_holder(lease_file), "worker_2")
+
+    def test_lease_age_uses_the_file_server_clock(self):
+        lease_file = os.path.join(self.tmp_dir, "task.lock")
+        self.assertTrue(work_queue.claim(lease_file, "worker_1"))
+        # a node with its clock 1000 s ahead doesn't see the fresh lease as stale
+        with mock.patch("time.time", return_value=time.time() + 1000):
+            self.assertFalse(work_queue.claim(lease_file, "worker_2", lease_timeout=300))
+        self.assertEqual(work_queue._lease_holder(lease_file), "worker_1")
+        self.assertEqual(os.listdir(self.tmp_dir), ["task.lock"])
+
+    def test_stale_lease_is_taken_over_once(self):
+        lease_file = os.path.join(self.tmp_dir, "task.lock")
+        self.assertTrue(work_queue.claim(lease_file, "worker_1"))
+        old = time.time() - 1000
+        os.utime(lease_file, (old, old))
+        server_time = work_queue.server_time
+
+        def worker_3_takes_over_first(folder, worker_id):
+            now = server_time(folder, worker_id)
+            if worker_id == "worker_2":
+                self.assertTrue(work_queue.claim(lease_file, "worker_3", lease_timeout=300))
+            return now
+
+        with mock.patch.object(work_queue, "server_time", side_effect=worker_3_takes_over_first):
+            self.assertFalse(work_queue.claim(lease_file, "worker_2", lease_timeout=300))
+        self.assertEqual(work_queue._lease_holder(lease_file), "worker_3")
+        self.assertEqual(os.listdir(self.tmp_dir), ["task.lock"])
+
+    def test_lost_lease_is_not_recorded(self):
+        tasks = [{"patient": "CAP1", "region": "GAG_1", "stage": "step_2", "args": [], "settings": {}}]
+        work_queue.enqueue(self.queue_dir, tasks)
+        lease_file = os.path.join(self.queue_dir, "leases", "CAP1__GAG_1__step_2.lock")
+
+        def taken_over(task, worker_files):
+            os.unlink(lease_file)
+            self.assertTrue(work_queue.claim(lease_file, "worker_2"))
+            return True
+
+        with mock.patch.object(work_queue, "run_task", side_effect=taken_over):
+            # the task is still pending afterwards, so stop the worker from running it again
+            with mock.patch.object(work_queue, "pending_tasks", side_effect=[["CAP1__GAG_1__step_2"]] * 2 + [[]]):
+                self.assertEqual(work_queue.run_worker(self.queue_dir, "worker_1", poll_interval=0), 0)
+        status = work_queue.queue_status(self.queue_dir)
+        self.assertEqual((status["done"], status["failed"], status["running"]), (0, 0, 1))
+        self.assertEqual(work_queue._lease_holder(lease_file), "worker_2")
+
+    def test_worker_runs_tasks_once_and_writes_markers(self):
+        tasks = [{"patient": "CAP1", "region": region, "stage": "step_2", "args": [], "settings": {}}
+                 for region in ["ENV_C1C2", "GAG_1"]]
+        self.assertEqual(work_queue.enqueue(self.queue_dir, tasks), 2)
+        self.assertEqual(work_queue.enqueue(self.queue_dir, tasks), 0)
+
+        def fake_run_task(task, worker_files):
+            return task["region"] == "GAG_1"
+
+        with mock.patch.object(work_queue, "run_task", side_effect=fake_run_task) as run_task:
+            completed = work_queue.run_worker(self.queue_dir, "worker_1", poll_interval=0)
+            self.assertEqual(completed, 1)
+            self.assertEqual(run_task.call_count, 2)
+            # a second worker finds nothing left to do
+            self.assertEqual(work_queue.run_worker(self.queue_dir, "worker_2", poll_interval=0), 0)
+            self.assertEqual(run_task.call_count, 2)
+
+        status = work_queue.queue_status(self.queue_dir)
+        self.assertEqual((status["done"], status["failed"], status["running"], status["waiting"]), (1, 1, 0, 0))
+        self.assertEqual(os.listdir(os.path.join(self.queue_dir, "leases")), [])
+
+    def test_step_2_is_profiled_per_region(self):
+        profile_dir = os.path.join(self.tmp_dir, "profiles")
+        step_2 = types.ModuleType("step_2_ngs_processing_pipeline_master_call")
+        step_2.main = mock.Mock(return_value=True)
+        task = {"patient": "CAP1", "region": "GAG_1", "stage": "step_2", "args": ["path"],
+                "settings": {"profile_dir": profile_dir}}
+        worker_files = {"metrics_file": "metrics.jsonl", "failure_manifest": "failures.jsonl"}
+        with mock.patch.dict(sys.modules, {step_2.__name__: step_2}), mock.patch.dict(os.environ):
+            self.assertTrue(work_queue.run_task(task, worker_files))
+        step_2.main.assert_called_once_with("path", **worker_files)
+        self.assertEqual(os.listdir(profile_dir), ["CAP1_GAG_1_step_2_{}.prof".format(os.getpid())])
+
+    def test_requeue_only_finished_tasks(self):
+        tasks = [{"patient": "CAP1", "region": region, "stage": "step_2", "args": [], "settings": {}}
+                 for region in ["ENV_C1C2", "GAG_1"]]
+        work_queue.enqueue(self.queue_dir, tasks[:1])
+        with mock.patch.object(work_queue, "run_task", return_value=True):
+            work_queue.run_worker(self.queue_dir, "worker_1", poll_interval=0)
+        work_queue.enqueue(self.queue_dir, tasks[1:])
+
+        # the finished task is queued again, the waiting one is left as it is
+        self.assertEqual(work_queue.requeue(self.queue_dir, tasks), ["CAP1__ENV_C1C2__step_2"])
+        status = work_queue.queue_status(self.queue_dir)
+        self.assertEqual((status["done"], status["waiting"]), (0, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()